@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сравнение бэкендов языковой модели бота Оданна
+Загружает каждый бэкенд (transformers, onnx, gguf) и генерирует ответы на
+типичные сообщения пользователей с одинаковыми параметрами сэмплирования.
+Результат — время загрузки, мс на токен, токены в секунду и ускорение
+относительно первого бэкенда в JSON.
+
+Пример:
+    python benchmark_backends.py \\
+        --backend transformers=microsoft/DialoGPT-medium \\
+        --backend onnx=microsoft/DialoGPT-medium \\
+        --backend gguf=models/dialogpt-medium-q8_0.gguf --output backends.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import List
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_speculative import build_prompts
+from odanna_bot import MAX_NEW_TOKENS, MAX_PROMPT_TOKENS, MODEL_NAME, AIManager
+
+
+def run_backend(name: str, model_name: str, rounds: int, seed: int) -> dict:
+    """Загрузка бэкенда и прогон набора промптов"""
+    started = time.perf_counter()
+    ai = AIManager(name, model_name)
+    load_seconds = time.perf_counter() - started
+    if ai.backend is None:
+        return {"model": model_name, "error": "модель не загрузилась"}
+
+    prompts = build_prompts(ai)
+    prompt_ids = [ai.backend.encode(prompt)[:MAX_PROMPT_TOKENS - MAX_NEW_TOKENS] for prompt in prompts]
+    ai.backend.generate(prompt_ids[0], MAX_NEW_TOKENS)  # прогрев
+
+    seconds, tokens, per_token = 0.0, 0, []
+    for round_index in range(rounds):
+        for prompt_index, input_ids in enumerate(prompt_ids):
+            torch.manual_seed(seed + round_index * len(prompt_ids) + prompt_index)
+            generation_started = time.perf_counter()
+            output_ids = ai.backend.generate(input_ids, MAX_NEW_TOKENS)
+            elapsed = time.perf_counter() - generation_started
+            seconds += elapsed
+            tokens += len(output_ids)
+            if output_ids:
+                per_token.append(elapsed / len(output_ids) * 1000)
+
+    return {
+        "model": model_name,
+        "load_s": round(load_seconds, 3),
+        "generations": rounds * len(prompt_ids),
+        "tokens": tokens,
+        "seconds": round(seconds, 3),
+        "tokens_per_s": round(tokens / seconds, 3) if seconds else 0.0,
+        "ms_per_token_median": round(statistics.median(per_token), 3) if per_token else 0.0,
+    }
+
+
+def parse_backends(specs: List[str]) -> List[tuple]:
+    """«бэкенд=модель» → [(бэкенд, модель)]; без модели берётся MODEL_NAME"""
+    backends = []
+    for spec in specs:
+        name, _, model_name = spec.partition("=")
+        backends.append((name, model_name or MODEL_NAME))
+    return backends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение бэкендов языковой модели бота Оданна")
+    parser.add_argument("--backend", action="append", dest="backends",
+                        help="бэкенд=модель (можно несколько; первый — эталон)")
+    parser.add_argument("--rounds", type=int, default=3, help="проходов по набору сообщений")
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads (0 — по умолчанию)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON-отчёта (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    backends = parse_backends(args.backends or ["transformers", "onnx"])
+
+    results = {}
+    reference = None
+    for name, model_name in backends:
+        stats = run_backend(name, model_name, args.rounds, args.seed)
+        if "error" in stats:
+            print(f"❌ {name}: {stats['error']}", file=sys.stderr)
+        else:
+            if reference is None:
+                reference = stats["ms_per_token_median"]
+            if stats["ms_per_token_median"]:
+                stats["speedup"] = round(reference / stats["ms_per_token_median"], 3)
+            print(f"  {name:<14} {stats['ms_per_token_median']:>8.1f} мс/токен, "
+                  f"ускорение {stats.get('speedup', 0):.2f}x", file=sys.stderr)
+        results[name] = stats
+
+    report = {
+        "config": {
+            "rounds": args.rounds,
+            "threads": torch.get_num_threads(),
+            "max_new_tokens": MAX_NEW_TOKENS,
+            "seed": args.seed,
+        },
+        "backends": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
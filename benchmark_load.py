@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест бота Оданна от начала до конца
+Поднимает локальный фейковый Telegram Bot API, запускает настоящий OdannaBot
+с заглушкой вместо нейросети и имитирует N одновременных пользователей.
+Результат — задержки p50/p95/p99 и пропускная способность в JSON.
+
+Пример:
+    python benchmark_load.py --users 50 --requests 20 --generate-ms 200 --output load.json
+    python benchmark_load.py --baseline load.json   # проверка на регрессию
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from odanna_bot import AIManager, DatabaseManager, OdannaBot, SemanticMemory
+
+logger = logging.getLogger("benchmark_load")
+
+BOT_TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Оданна", "username": "odanna_bot"}
+
+# Типичные сообщения пользователей
+MESSAGES = [
+    "Привет, Оданна!",
+    "Как дела в гостинице?",
+    "Мне сегодня грустно...",
+    "Спасибо за ужин, было очень вкусно!",
+    "Расскажи о себе",
+    "Почему ты всегда такой холодный?",
+    "Я устал от всего, хочу просто посидеть в тишине",
+    "Что за духи приходили вчера вечером?",
+    "Аой снова приготовила что-то необычное! Ты пробовал?",
+    "Забудь про вчерашний разговор",
+]
+
+# Кнопки меню (дешёвые обработчики без генерации)
+CALLBACKS = ["list_chats", "settings", "back_to_main", "create_chat", "create_default"]
+
+# Доли действий: обычное сообщение, кнопка, команда /start
+ACTION_WEIGHTS = {"message": 0.7, "callback": 0.25, "command": 0.05}
+
+
+class StubAIManager(AIManager):
+    """Детерминированная замена нейросети
+
+    Блокирует поток на generate_ms, как синхронный model.generate,
+    и отвечает заготовками _fallback_response.
+    """
+
+    def __init__(self, generate_ms: float):
+        super().__init__(backend='')
+        self.generate_ms = generate_ms
+
+    def generate_odanna_response(self, user_message: str, chat_history: List[str],
+                                 empathy_level: int, emotion: str, scenario: str, **kwargs) -> str:
+        time.sleep(self.generate_ms / 1000)
+        return self._fallback_response(user_message, empathy_level, emotion)
+
+
+class FakeTelegramServer:
+    """Минимальный Bot API: getUpdates с long polling и методы отправки
+
+    Ответ бота (sendMessage/editMessageText/editMessageReplyMarkup) в чат
+    завершает ожидающий запрос пользователя этого чата.
+    """
+
+    REPLY_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup"}
+
+    def __init__(self):
+        self.updates: List[dict] = []
+        self.updates_changed = asyncio.Condition()
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.waiters: Dict[int, asyncio.Future] = {}
+        self.calls: Dict[str, int] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    async def start(self, port: int = 0) -> str:
+        """Запуск сервера; возвращает base_url для Application.builder()"""
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/bot"
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _message(self, chat_id: int, text: str = "", sender: dict = BOT_USER) -> dict:
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": sender,
+            "text": text,
+        }
+
+    async def push_update(self, user_id: int, kind: str, payload: str) -> asyncio.Future:
+        """Поставить обновление в очередь getUpdates и вернуть future ответа бота"""
+        user = {"id": user_id, "is_bot": False, "first_name": "Гость", "username": f"guest{user_id}"}
+        update = {"update_id": self.next_update_id}
+        self.next_update_id += 1
+
+        if kind == "callback":
+            update["callback_query"] = {
+                "id": str(update["update_id"]),
+                "from": user,
+                "chat_instance": str(user_id),
+                "data": payload,
+                "message": self._message(user_id, "Меню"),
+            }
+        else:
+            message = self._message(user_id, payload, sender=user)
+            if payload.startswith("/"):
+                command_length = len(payload.split()[0])
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+            update["message"] = message
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[user_id] = future
+
+        async with self.updates_changed:
+            self.updates.append(update)
+            self.updates_changed.notify_all()
+
+        return future
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getMe":
+            result = {**BOT_USER, "can_join_groups": False, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method in self.REPLY_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            result = self._message(chat_id, params.get("text", ""))
+            waiter = self.waiters.pop(chat_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(time.perf_counter())
+        else:
+            # deleteWebhook, answerCallbackQuery и прочие служебные методы
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params: dict) -> List[dict]:
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+
+        async with self.updates_changed:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            if not self.updates and timeout > 0:
+                try:
+                    await asyncio.wait_for(self.updates_changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self.updates)
+
+
+def pick_action(rng: random.Random):
+    """Случайное действие пользователя согласно ACTION_WEIGHTS"""
+    kind = rng.choices(list(ACTION_WEIGHTS), weights=list(ACTION_WEIGHTS.values()))[0]
+    if kind == "message":
+        return kind, rng.choice(MESSAGES)
+    if kind == "callback":
+        return kind, rng.choice(CALLBACKS)
+    return kind, "/start"
+
+
+async def simulate_user(server: FakeTelegramServer, user_id: int, requests: int, seed: int,
+                        think_ms: float, timeout: float, results: List[dict]):
+    """Пользователь отправляет действия по одному, дожидаясь ответа бота"""
+    rng = random.Random(seed)
+
+    for _ in range(requests):
+        kind, payload = pick_action(rng)
+        started = time.perf_counter()
+        future = await server.push_update(user_id, kind, payload)
+
+        try:
+            finished = await asyncio.wait_for(future, timeout)
+            results.append({"kind": kind, "latency": finished - started, "ok": True})
+        except asyncio.TimeoutError:
+            results.append({"kind": kind, "latency": timeout, "ok": False})
+
+        if think_ms:
+            await asyncio.sleep(rng.uniform(0, think_ms) / 1000)
+
+
+def percentiles(latencies: List[float]) -> dict:
+    """p50/p95/p99/max в миллисекундах (nearest-rank)"""
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+
+    def rank(p: float) -> float:
+        index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(ordered[-1] * 1000, 3),
+    }
+
+
+async def run_load_test(args) -> dict:
+    """Запуск бота против фейкового API и сбор статистики"""
+    server = FakeTelegramServer()
+    base_url = await server.start()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "load.db"))
+        bot = OdannaBot(
+            BOT_TOKEN,
+            db=db,
+            ai=StubAIManager(args.generate_ms),
+            memory=SemanticMemory(db, model_name=""),
+        )
+        application = bot.build_application(base_url=base_url)
+
+        await application.initialize()
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+
+        results: List[dict] = []
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            simulate_user(server, 10_000 + i, args.requests, args.seed + i, args.think_ms, args.timeout, results)
+            for i in range(args.users)
+        ])
+        duration = time.perf_counter() - started
+
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+    await server.stop()
+
+    ok = [r for r in results if r["ok"]]
+    report = {
+        "config": {
+            "users": args.users,
+            "requests_per_user": args.requests,
+            "generate_ms": args.generate_ms,
+            "think_ms": args.think_ms,
+            "seed": args.seed,
+        },
+        "duration_s": round(duration, 3),
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "throughput_rps": round(len(ok) / duration, 3) if duration else 0.0,
+        "messages_per_s": round(sum(1 for r in ok if r["kind"] == "message") / duration, 3) if duration else 0.0,
+        "latency_ms": {
+            "all": percentiles([r["latency"] for r in ok]),
+            **{kind: percentiles([r["latency"] for r in ok if r["kind"] == kind]) for kind in ACTION_WEIGHTS},
+        },
+        "api_calls": server.calls,
+    }
+    return report
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Список регрессий относительно сохранённого отчёта"""
+    problems = []
+
+    for kind, stats in report["latency_ms"].items():
+        base = baseline.get("latency_ms", {}).get(kind, {})
+        for key in ("p95", "p99"):
+            if key in stats and key in base and stats[key] > base[key] * (1 + tolerance):
+                problems.append(f"{kind}.{key}: {stats[key]} мс > {base[key]} мс")
+
+    if report["throughput_rps"] < baseline.get("throughput_rps", 0) * (1 - tolerance):
+        problems.append(f"throughput_rps: {report['throughput_rps']} < {baseline['throughput_rps']}")
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота Оданна")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--requests", type=int, default=10, help="действий на пользователя")
+    parser.add_argument("--generate-ms", type=float, default=100, help="время «генерации» заглушки")
+    parser.add_argument("--think-ms", type=float, default=0, help="максимальная пауза между действиями")
+    parser.add_argument("--timeout", type=float, default=60, help="таймаут ответа, секунд")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON-отчёта (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="отчёт для сравнения; при регрессии код возврата 1")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(run_load_test(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            problems = compare_with_baseline(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"❌ Регрессия: {problem}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
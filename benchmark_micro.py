@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарки DatabaseManager и вспомогательных методов AIManager
+Каждый метод БД замеряется на базах с 1k/100k/1M сообщений, а чистые
+функции горячего пути (анализ эмоций, эмпатия, сборка контекста,
+постобработка, заготовленные ответы) — на типичных и враждебных входах.
+
+Пример:
+    python benchmark_micro.py --sizes 1000,100000 --save micro.json
+    python benchmark_micro.py --sizes 1000,100000 --compare micro.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from odanna_bot import AIManager, DatabaseManager
+
+WORDS = (
+    "гостиница оданна демон бог дух кухня повар ужин чай луна сад ночь день "
+    "спасибо грустно устал рад почему как что вкусно красные глаза кимоно "
+    "тишина правило гость хозяин аой долг память сон весна дождь"
+).split()
+
+MESSAGES_PER_CHAT = 200
+CHATS_PER_USER = 5
+
+
+class HelperOnlyAIManager(AIManager):
+    """AIManager без загрузки модели: для замеров чистых функций"""
+
+    def __init__(self):
+        super().__init__(backend='')
+
+
+def measure(func: Callable[..., object], rounds: int, min_round_time: float = 0.01,
+            setup: Optional[Callable[[], tuple]] = None) -> Dict[str, float]:
+    """Замер в стиле pytest-benchmark: калибровка итераций и несколько раундов
+
+    Время одного вызова в микросекундах: min/median/mean/stddev. С setup
+    (как pedantic в pytest-benchmark) каждый раунд — один вызов func с
+    аргументами, подготовленными setup вне замера.
+    """
+    if setup:
+        func(*setup())  # прогрев
+        samples = []
+        for _ in range(rounds):
+            args = setup()
+            started = time.perf_counter()
+            func(*args)
+            samples.append((time.perf_counter() - started) * 1e6)
+        return summarize(samples, 1, rounds)
+
+    func()  # прогрев
+
+    iterations = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_round_time or iterations >= 1 << 16:
+            break
+        iterations *= 2
+
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        samples.append((time.perf_counter() - started) / iterations * 1e6)
+    return summarize(samples, iterations, rounds)
+
+
+def summarize(samples: List[float], iterations: int, rounds: int) -> Dict[str, float]:
+    return {
+        "min_us": round(min(samples), 3),
+        "median_us": round(statistics.median(samples), 3),
+        "mean_us": round(statistics.mean(samples), 3),
+        "stddev_us": round(statistics.stdev(samples), 3) if len(samples) > 1 else 0.0,
+        "iterations": iterations,
+        "rounds": rounds,
+    }
+
+
+def random_text(rng: random.Random, low: int, high: int) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def insert_messages(db: DatabaseManager, conn: sqlite3.Connection, batch: list):
+    """Пакетная вставка (chat_id, user_id, текст, ответ, эмоции, эмпатия) в обход add_message"""
+    # Полнотекстовый индекс пополняет DatabaseManager, а не триггер
+    cursor = conn.cursor()
+    last_id = cursor.execute("SELECT COALESCE(MAX(message_id), 0) FROM messages").fetchone()[0]
+    cursor.executemany(
+        "INSERT INTO messages (chat_key, user_id, message_text, response_text, emotions, "
+        "empathy_level) VALUES ((SELECT chat_key FROM chats WHERE chat_id = ?), ?, ?, ?, ?, ?)", batch
+    )
+    db._index_messages(cursor, "message_id > ?", (last_id,))
+
+
+def build_database(path: str, messages: int, seed: int = 0):
+    """База с заданным числом сообщений: пользователи по CHATS_PER_USER чатов по MESSAGES_PER_CHAT"""
+    rng = random.Random(seed)
+    db = DatabaseManager(path)  # схема и индексы
+
+    chats_total = max(1, messages // MESSAGES_PER_CHAT)
+    users_total = max(1, chats_total // CHATS_PER_USER)
+
+    conn = db._connect()
+    conn.executemany(
+        "INSERT INTO users (user_id, username) VALUES (?, ?)",
+        ((user_id, f"user{user_id}") for user_id in range(1, users_total + 1))
+    )
+
+    chats = [(f"{1 + i % users_total}_bench{i:07d}", 1 + i % users_total) for i in range(chats_total)]
+    conn.executemany(
+        "INSERT INTO chats (chat_id, user_id, chat_name, scenario, message_count, last_activity) "
+        "VALUES (?, ?, ?, 'Небесная Гостиница', ?, datetime('now', ?))",
+        ((chat_id, user_id, f"Чат {i}", MESSAGES_PER_CHAT, f"-{i} minutes")
+         for i, (chat_id, user_id) in enumerate(chats))
+    )
+
+    neutral = db._emotion_mask("нейтральное")
+    batch = []
+    for n in range(messages):
+        chat_id, user_id = chats[n % chats_total]
+        batch.append((chat_id, user_id, random_text(rng, 3, 15), random_text(rng, 10, 40),
+                      neutral, 35 + n % 50))
+        if len(batch) >= 10_000:
+            insert_messages(db, conn, batch)
+            batch = []
+    if batch:
+        insert_messages(db, conn, batch)
+
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+Benchmark = Union[Callable[[], object], Tuple[Callable[[], tuple], Callable[..., object]]]
+
+
+def database_benchmarks(db: DatabaseManager, rng: random.Random) -> Dict[str, Benchmark]:
+    """Замеряемые вызовы DatabaseManager на «типичном» пользователе и чате
+
+    Пара (setup, func) — разрушающий вызов: setup готовит ему чат вне замера.
+    """
+    conn = db._connect()
+    user_id, chat_id = conn.execute(
+        "SELECT user_id, chat_id FROM chats ORDER BY last_activity DESC LIMIT 1"
+    ).fetchone()
+    # Для архивации — другой чат того же пользователя, чтобы не трогать остальные замеры
+    archive_chat_id = conn.execute(
+        "SELECT chat_id FROM chats WHERE user_id = ? AND chat_id != ? ORDER BY last_activity DESC LIMIT 1",
+        (user_id, chat_id)
+    ).fetchone()[0]
+    message_ids = [row[0] for row in conn.execute(
+        "SELECT message_id FROM messages WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = ?) "
+        "ORDER BY message_id DESC LIMIT 50", (chat_id,)
+    )]
+    sample_text = conn.execute("SELECT odanna_text(message_text) FROM messages WHERE message_id = ?",
+                               (message_ids[10],)).fetchone()[0]
+    conn.close()
+
+    page = db.get_user_chats_page(user_id, 1)[0][0]
+    cursor = (page[4], page[0])
+
+    def forget_and_restore():
+        forgotten = db.forget_last_message(chat_id)
+        db.unignore_message_by_id(forgotten, user_id)
+
+    def ignore_and_restore():
+        db.ignore_message_by_id(message_ids[5], user_id)
+        db.unignore_message_by_id(message_ids[5], user_id)
+
+    def ignore_and_restore_by_text():
+        db.ignore_message(chat_id, sample_text)
+        db.unignore_message(chat_id, sample_text)
+
+    def filled_chat():
+        new_chat_id = db.create_chat(user_id, "Удаляемый")
+        conn = db._connect()
+        neutral = db._emotion_mask("нейтральное")
+        insert_messages(db, conn, [(new_chat_id, user_id, random_text(rng, 3, 15), random_text(rng, 10, 40),
+                                    neutral, 40) for _ in range(MESSAGES_PER_CHAT)])
+        conn.commit()
+        conn.close()
+        return (new_chat_id,)
+
+    def active_chat():
+        db.restore_chat(archive_chat_id)
+        return (archive_chat_id,)
+
+    def archived_chat():
+        db.archive_chat(archive_chat_id)
+        return (archive_chat_id,)
+
+    return {
+        "add_user": lambda: db.add_user(user_id, f"user{user_id}"),
+        "create_chat": lambda: db.create_chat(10 ** 9 + rng.randrange(10 ** 9), "Новый"),
+        "get_user_chats": lambda: db.get_user_chats(user_id),
+        "get_user_chats_page": lambda: db.get_user_chats_page(user_id, 10),
+        "get_user_chats_page_cursor": lambda: db.get_user_chats_page(user_id, 10, cursor),
+        "add_message": lambda: db.add_message(chat_id, user_id, random_text(rng, 3, 15),
+                                              random_text(rng, 10, 40), "нейтральное", 40),
+        "get_chat_history": lambda: db.get_chat_history(chat_id, 10),
+        "get_chat_messages_page": lambda: db.get_chat_messages_page(chat_id, 10),
+        "get_chat_messages_page_before": lambda: db.get_chat_messages_page(chat_id, 10, before_id=message_ids[20]),
+        "get_messages_by_ids": lambda: db.get_messages_by_ids(chat_id, message_ids[:3]),
+        "search_messages": lambda: db.search_messages(user_id, "гостиница повар"),
+        "find_message_id": lambda: db.find_message_id(chat_id, sample_text),
+        "ignore_unignore_by_id": ignore_and_restore,
+        "ignore_unignore_by_text": ignore_and_restore_by_text,
+        "forget_last_and_restore": forget_and_restore,
+        "get_chat_empathy_level": lambda: db.get_chat_empathy_level(chat_id),
+        "get_chat_scenario": lambda: db.get_chat_scenario(chat_id),
+        "update_chat_empathy": lambda: db.update_chat_empathy(chat_id, 50),
+        "restore_chat_noop": lambda: db.restore_chat(chat_id),
+        "archive_chat": (active_chat, db.archive_chat),
+        "restore_chat": (archived_chat, db.restore_chat),
+        "delete_chat": (filled_chat, db.delete_chat),
+        "get_response_lengths": lambda: db.get_response_lengths(),
+        "ping": db.ping,
+    }
+
+
+def helper_benchmarks(ai: AIManager) -> Dict[str, Callable[[], object]]:
+    """Чистые функции, выполняемые на каждом сообщении"""
+    rng = random.Random(1)
+    history = []
+    for _ in range(10):
+        history.append(f"Пользователь: {random_text(rng, 5, 20)}")
+        history.append(f"Оданна: {random_text(rng, 20, 60)}")
+    memories = [f"Пользователь: {random_text(rng, 5, 20)}\nОданна: {random_text(rng, 20, 60)}" for _ in range(3)]
+
+    typical_reply = random_text(rng, 40, 80)
+    scenario_prompt = "Пикник у реки\n" + random_text(rng, 150, 200)
+    # Враждебные входы для regex-удаления повторов: длинные повторы и текст почти без них
+    repetitive_reply = "ха" * 2500
+    phrase_loop = "Добро пожаловать в гостиницу. " * 200
+    no_repeats = "".join(chr(0x0430 + (i * 7) % 32) + chr(0x0430 + (i * 13) % 31) for i in range(1000))
+
+    return {
+        "analyze_emotion_short": lambda: ai.analyze_emotion("Мне сегодня грустно..."),
+        "analyze_emotion_long": lambda: ai.analyze_emotion(typical_reply * 3),
+        "calculate_empathy_level": lambda: ai.calculate_empathy_level("грусть, любопытство", 50, 7),
+        "build_context": lambda: ai._build_context("Как дела?", history, 50, "любопытство",
+                                                  "Небесная Гостиница", memories),
+        "build_context_custom_scenario": lambda: ai._build_context("Как дела?", history, 50, "любопытство",
+                                                                  "Пикник у реки", memories, scenario_prompt),
+        "post_process_typical": lambda: ai._post_process_response(typical_reply, 40, "грусть"),
+        "post_process_repetitive": lambda: ai._post_process_response(repetitive_reply, 70, "грусть"),
+        "post_process_phrase_loop": lambda: ai._post_process_response(phrase_loop, 50, "радость"),
+        "post_process_no_repeats": lambda: ai._post_process_response(no_repeats, 50, "нейтральное"),
+        "fallback_response": lambda: ai._fallback_response("Мне плохо", 60, "грусть"),
+        "generation_budget": lambda: ai.policy.max_new_tokens(25, 60, queue_depth=3),
+    }
+
+
+def run_benchmarks(sizes: List[int], rounds: int, fixtures_dir: str, only: Optional[str]) -> dict:
+    results = {"helpers": {}, "database": {}}
+
+    ai = HelperOnlyAIManager()
+    ai.policy.learn_reply_lengths([len(random_text(random.Random(i), 10, 40)) for i in range(1000)])
+    ai.policy.observe(new_tokens=80, seconds=4.0, reply_chars=170)
+    for name, func in helper_benchmarks(ai).items():
+        if only and only not in name:
+            continue
+        results["helpers"][name] = measure(func, rounds)
+        print(f"  {name:<36} {results['helpers'][name]['median_us']:>12.1f} мкс", file=sys.stderr)
+
+    for size in sizes:
+        fixture = os.path.join(fixtures_dir, f"micro_{size}.db")
+        if not os.path.exists(fixture):
+            print(f"Подготовка базы на {size} сообщений...", file=sys.stderr)
+            build_database(fixture + ".tmp", size)
+            os.replace(fixture + ".tmp", fixture)
+
+        # Копия, чтобы пишущие бенчмарки не портили кэшированную базу
+        work_path = os.path.join(fixtures_dir, f"work_{size}.db")
+        source = sqlite3.connect(fixture)
+        target = sqlite3.connect(work_path)
+        source.backup(target)
+        source.close()
+        target.close()
+
+        db = DatabaseManager(work_path)
+        results["database"][str(size)] = {}
+        for name, benchmark in database_benchmarks(db, random.Random(size)).items():
+            if only and only not in name:
+                continue
+            if isinstance(benchmark, tuple):
+                setup, func = benchmark
+                stats = measure(func, rounds, setup=setup)
+            else:
+                stats = measure(benchmark, rounds)
+            results["database"][str(size)][name] = stats
+            print(f"  [{size:>8}] {name:<36} {stats['median_us']:>12.1f} мкс", file=sys.stderr)
+
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(work_path + suffix):
+                os.unlink(work_path + suffix)
+        archive = os.path.join(fixtures_dir, f"work_{size}_archive.db")
+        if os.path.exists(archive):
+            os.unlink(archive)
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Регрессии медианы относительно базового файла"""
+    problems = []
+
+    def check(label: str, current: dict, base: dict):
+        for name, stats in current.items():
+            if name in base and stats["median_us"] > base[name]["median_us"] * (1 + tolerance):
+                problems.append(f"{label}{name}: {stats['median_us']} мкс > {base[name]['median_us']} мкс")
+
+    check("", results["helpers"], baseline.get("helpers", {}))
+    for size, benches in results["database"].items():
+        check(f"[{size}] ", benches, baseline.get("database", {}).get(size, {}))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки бота Оданна")
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="размеры баз (число сообщений)")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--fixtures-dir", default=os.path.join(tempfile.gettempdir(), "odanna_bench"),
+                        help="каталог для кэша подготовленных баз")
+    parser.add_argument("--only", help="запускать только бенчмарки, содержащие подстроку")
+    parser.add_argument("--save", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="базовый JSON; при регрессии код возврата 1")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение медианы (доля)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    os.makedirs(args.fixtures_dir, exist_ok=True)
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = run_benchmarks(sizes, args.rounds, args.fixtures_dir, args.only)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"❌ Регрессия: {problem}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк спекулятивного декодирования бота Оданна
+Генерирует ответы на типичные сообщения пользователей дважды — обычным
+model.generate и с черновой моделью (assistant_model) — с одинаковыми
+параметрами сэмплирования и сидами. Результат — доля принятых токенов
+черновика и ускорение по времени на токен в JSON.
+
+Пример:
+    python benchmark_speculative.py --draft-model microsoft/DialoGPT-small --rounds 3
+    python benchmark_speculative.py --num-tokens 3,5,8 --output speculative.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import Dict, List
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_load import MESSAGES
+from odanna_bot import MAX_NEW_TOKENS, MAX_PROMPT_TOKENS, MODEL_NAME, AIManager, TransformersBackend
+
+# Короткая история, чтобы промпты были похожи на боевые
+HISTORY = [
+    "Пользователь: Добрый вечер",
+    "Оданна: Добрый вечер. Гостиница рада гостю... пока гость соблюдает правила.",
+]
+
+
+class ForwardCounter:
+    """Считает прямые проходы модели через forward hook"""
+
+    def __init__(self, model):
+        self.calls = 0
+        self.handle = model.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        self.calls += 1
+
+    def reset(self):
+        self.calls = 0
+
+    def remove(self):
+        self.handle.remove()
+
+
+def build_prompts(ai: AIManager) -> List[str]:
+    """Контексты для каждого сообщения из типичного набора"""
+    prompts = []
+    for message in MESSAGES:
+        emotion = ai.analyze_emotion(message)
+        empathy = ai.calculate_empathy_level(emotion, 50, len(HISTORY))
+        prompts.append(ai._build_context(message, HISTORY, empathy, emotion, "default"))
+    return prompts
+
+
+def generate(backend: TransformersBackend, prompt: str, seed: int) -> Dict[str, float]:
+    """Один вызов генерации с боевыми параметрами"""
+    input_ids = backend.encode(prompt)[:MAX_PROMPT_TOKENS - MAX_NEW_TOKENS]
+    torch.manual_seed(seed)
+
+    started = time.perf_counter()
+    output_ids = backend.generate(input_ids, MAX_NEW_TOKENS)
+    elapsed = time.perf_counter() - started
+
+    return {"seconds": elapsed, "tokens": len(output_ids)}
+
+
+def run_mode(backend: TransformersBackend, prompts: List[str], rounds: int, seed: int,
+             main_counter: ForwardCounter, draft_counter: ForwardCounter = None) -> dict:
+    """Прогон всех промптов; с черновиком заодно оценивается доля принятых токенов
+
+    За один проход основная модель принимает совпавший префикс черновика и
+    добавляет свой токен, поэтому принятые = новые токены − проходы основной,
+    а предложенные = проходы черновой модели.
+    """
+    seconds, tokens, per_token = 0.0, 0, []
+    main_counter.reset()
+    if draft_counter:
+        draft_counter.reset()
+
+    for round_index in range(rounds):
+        for prompt_index, prompt in enumerate(prompts):
+            result = generate(backend, prompt, seed + round_index * len(prompts) + prompt_index)
+            seconds += result["seconds"]
+            tokens += result["tokens"]
+            if result["tokens"]:
+                per_token.append(result["seconds"] / result["tokens"] * 1000)
+
+    report = {
+        "generations": rounds * len(prompts),
+        "tokens": tokens,
+        "seconds": round(seconds, 3),
+        "tokens_per_s": round(tokens / seconds, 3) if seconds else 0.0,
+        "ms_per_token_median": round(statistics.median(per_token), 3) if per_token else 0.0,
+        "main_forward_passes": main_counter.calls,
+    }
+    if draft_counter:
+        proposed = draft_counter.calls
+        accepted = max(0, tokens - main_counter.calls)
+        report["draft_forward_passes"] = proposed
+        report["acceptance_rate"] = round(accepted / proposed, 4) if proposed else 0.0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк спекулятивного декодирования бота Оданна")
+    parser.add_argument("--model", default=MODEL_NAME, help="основная модель")
+    parser.add_argument("--draft-model", default="microsoft/DialoGPT-small", help="черновая модель")
+    parser.add_argument("--num-tokens", default="5", help="длины черновика через запятую")
+    parser.add_argument("--rounds", type=int, default=3, help="проходов по набору сообщений")
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads (0 — по умолчанию)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON-отчёта (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    ai = AIManager("transformers", args.model)
+    backend = ai.backend
+    if backend is None:
+        print("❌ Основная модель не загрузилась", file=sys.stderr)
+        sys.exit(1)
+
+    prompts = build_prompts(ai)
+    main_counter = ForwardCounter(backend.model)
+
+    # Без черновика: эталон для сравнения
+    draft_model = backend.draft_model
+    backend.draft_model = None
+    generate(backend, prompts[0], args.seed)  # прогрев
+    baseline = run_mode(backend, prompts, args.rounds, args.seed, main_counter)
+    print(f"  baseline       {baseline['ms_per_token_median']:>8.1f} мс/токен", file=sys.stderr)
+
+    if draft_model is None:
+        backend.load_draft_model(args.draft_model)
+        draft_model = backend.draft_model
+    if draft_model is None:
+        print(f"❌ Черновая модель {args.draft_model} не загрузилась", file=sys.stderr)
+        sys.exit(1)
+    draft_counter = ForwardCounter(draft_model)
+
+    speculative = {}
+    for num_tokens in [int(n) for n in args.num_tokens.split(",") if n]:
+        draft_model.generation_config.num_assistant_tokens = num_tokens
+        backend.draft_model = draft_model
+        generate(backend, prompts[0], args.seed)  # прогрев
+        stats = run_mode(backend, prompts, args.rounds, args.seed, main_counter, draft_counter)
+        if stats["ms_per_token_median"]:
+            stats["speedup"] = round(baseline["ms_per_token_median"] / stats["ms_per_token_median"], 3)
+        speculative[str(num_tokens)] = stats
+        print(f"  draft x{num_tokens:<8} {stats['ms_per_token_median']:>8.1f} мс/токен, "
+              f"принято {stats['acceptance_rate']:.0%}, ускорение {stats.get('speedup', 0):.2f}x", file=sys.stderr)
+
+    main_counter.remove()
+    draft_counter.remove()
+
+    report = {
+        "config": {
+            "model": args.model,
+            "draft_model": args.draft_model,
+            "rounds": args.rounds,
+            "prompts": len(prompts),
+            "threads": torch.get_num_threads(),
+            "seed": args.seed,
+        },
+        "baseline": baseline,
+        "speculative": speculative,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк компактного хранения сообщений бота Оданна
+Строит базу в прежнем формате (chat_id и строка эмоций в каждой реплике),
+переводит её копии в компактную запись без сжатия и со сжатием текстов
+и сравнивает: размер файла и таблицы messages, байты на сообщение,
+сообщений на страницу (чем больше, тем чаще история целиком попадает
+в кэш страниц) и задержку get_chat_history: на свежем соединении, как
+в боте (сюда входит разбор схемы, у новой базы она больше), и на одном
+открытом соединении — только сам запрос.
+
+Пример:
+    python benchmark_storage.py --messages 100000 --compression ,zlib,zstd --output storage.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_micro import MESSAGES_PER_CHAT, measure, random_text
+from odanna_bot import DatabaseManager
+
+LEGACY_SCHEMA = '''
+CREATE TABLE chats (chat_id TEXT PRIMARY KEY, user_id INTEGER, chat_name TEXT, scenario TEXT,
+                    empathy_level INTEGER DEFAULT 35, message_count INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP, is_archived BOOLEAN DEFAULT FALSE);
+CREATE TABLE messages (message_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT, user_id INTEGER,
+                       message_text TEXT, response_text TEXT, is_ignored BOOLEAN DEFAULT FALSE,
+                       emotion_analysis TEXT, empathy_level INTEGER,
+                       timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                       message_tokens BLOB, response_tokens BLOB, tokenizer_id TEXT);
+CREATE INDEX idx_messages_chat ON messages (chat_id, message_id);
+CREATE VIRTUAL TABLE messages_fts USING fts5(scope, message_text, response_text,
+                                             content='', tokenize='unicode61 remove_diacritics 2');
+'''
+
+# Типичные сочетания эмоций из AIManager.analyze_emotion
+EMOTION_ANALYSES = ["нейтральное", "радость", "грусть", "любопытство", "радость, любопытство", "грусть, многословность"]
+
+
+def build_legacy_database(path: str, messages: int, seed: int):
+    """База прежнего формата: чаты по MESSAGES_PER_CHAT реплик, ответы длиной в абзац"""
+    rng = random.Random(seed)
+    chats_total = max(1, messages // MESSAGES_PER_CHAT)
+    chats = [(f"{1 + i // 5}_20240101_{i:06d}", 1 + i // 5) for i in range(chats_total)]
+
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany("INSERT INTO chats (chat_id, user_id, chat_name, scenario) VALUES (?, ?, ?, ?)",
+                     [(chat_id, user_id, "Чат", "Небесная Гостиница") for chat_id, user_id in chats])
+    conn.executemany('''
+    INSERT INTO messages (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', ((*chats[n % chats_total], random_text(rng, 3, 15), random_text(rng, 20, 120),
+           rng.choice(EMOTION_ANALYSES), 35 + n % 50) for n in range(messages)))
+    # Полнотекстовый индекс прежнего формата, чтобы размеры файлов были сравнимы
+    conn.execute('''
+    INSERT INTO messages_fts (rowid, scope, message_text, response_text)
+    SELECT message_id, 'u' || user_id || ' c' || chat_id, message_text, response_text FROM messages
+    ''')
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    return chats[0][0]
+
+
+def table_stats(path: str, messages: int) -> dict:
+    """Размер файла и таблицы messages с индексами по dbstat"""
+    conn = sqlite3.connect(path)
+    pages = dict(conn.execute('''
+    SELECT name, SUM(pgsize) FROM dbstat
+    WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = 'messages')
+    GROUP BY name
+    '''))
+    leaf_pages = conn.execute("SELECT COUNT(*) FROM dbstat WHERE name = 'messages' AND pagetype = 'leaf'").fetchone()[0]
+    conn.close()
+    return {
+        "file_bytes": os.path.getsize(path),
+        "messages_bytes": pages.get("messages", 0),
+        "index_bytes": sum(size for name, size in pages.items() if name != "messages"),
+        "bytes_per_message": round(sum(pages.values()) / messages, 1),
+        "messages_per_page": round(messages / leaf_pages, 2) if leaf_pages else 0.0,
+    }
+
+
+class KeptConnection:
+    """Соединение, которое close() не закрывает: замер запроса без открытия базы"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        pass
+
+
+def legacy_history(connect, chat_id: str):
+    """get_chat_history прежнего формата"""
+    conn = connect()
+    rows = conn.execute('''
+    SELECT message_text, response_text, is_ignored, emotion_analysis, timestamp
+    FROM messages WHERE chat_id = ? ORDER BY message_id DESC LIMIT 20
+    ''', (chat_id,)).fetchall()
+    conn.close()
+    return rows
+
+
+def run_benchmark(messages: int, compressions: list, rounds: int, seed: int, work_dir: str) -> dict:
+    legacy_path = os.path.join(work_dir, "legacy.db")
+    chat_id = build_legacy_database(legacy_path, messages, seed)
+
+    def legacy_connect():
+        return sqlite3.connect(legacy_path)
+
+    kept = KeptConnection(legacy_connect())
+    results = {"legacy": {
+        **table_stats(legacy_path, messages),
+        "history_us": measure(lambda: legacy_history(legacy_connect, chat_id), rounds)["median_us"],
+        "history_query_us": measure(lambda: legacy_history(lambda: kept, chat_id), rounds)["median_us"],
+    }}
+    kept.conn.close()
+    print(f"  {'legacy':<10} {results['legacy']['bytes_per_message']:>8} байт/сообщ., "
+          f"{results['legacy']['messages_per_page']} сообщ./стр., "
+          f"запрос истории {results['legacy']['history_query_us']:.1f} мкс", file=sys.stderr)
+
+    for compression in compressions:
+        label = compression or "none"
+        path = os.path.join(work_dir, f"{label}.db")
+        shutil.copy(legacy_path, path)
+
+        started = time.perf_counter()
+        db = DatabaseManager(path, archive_path=os.path.join(work_dir, f"{label}_archive.db"),
+                             text_compression=compression)
+        migrate_seconds = time.perf_counter() - started
+
+        history = db.get_chat_history(chat_id)
+        assert history == [(*row[:3], db._emotion_text(db._emotion_mask(row[3])), row[4])
+                           for row in reversed(legacy_history(legacy_connect, chat_id))]
+
+        stats = table_stats(path, messages)
+        stats["migrate_s"] = round(migrate_seconds, 3)
+        stats["history_us"] = measure(lambda: db.get_chat_history(chat_id), rounds)["median_us"]
+        kept = KeptConnection(db._connect())
+        db._connect = lambda: kept
+        stats["history_query_us"] = measure(lambda: db.get_chat_history(chat_id), rounds)["median_us"]
+        kept.conn.close()
+        stats["size_ratio"] = round(stats["file_bytes"] / results["legacy"]["file_bytes"], 3)
+        results[label] = stats
+        print(f"  {label:<10} {stats['bytes_per_message']:>8} байт/сообщ., "
+              f"{stats['messages_per_page']} сообщ./стр., "
+              f"запрос истории {stats['history_query_us']:.1f} мкс", file=sys.stderr)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк компактного хранения сообщений бота Оданна")
+    parser.add_argument("--messages", type=int, default=50_000, help="сообщений в базе")
+    parser.add_argument("--compression", default=",zlib",
+                        help="способы сжатия через запятую (пусто — без сжатия): ,zlib,zstd")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="файл для JSON-отчёта (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmark(args.messages, args.compression.split(","), args.rounds, args.seed, work_dir)
+
+    report = {
+        "config": {"messages": args.messages, "rounds": args.rounds, "seed": args.seed},
+        "layouts": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,48 @@
 # -*- coding: utf-8 -*-
 """
 Telegram-бот "Оданна" - персонаж из аниме "Повар небесной гостиницы"
-Интегрирован с нейросетью Llama 3 через Hugging Face Transformers
+Интегрирован с языковой моделью через сменные бэкенды
+(Hugging Face Transformers, ONNX Runtime, GGUF через llama.cpp)
 """
 
 import os
 import sqlite3
 import json
+import base64
+import gzip
+import hashlib
+import struct
+import zlib
 import asyncio
 import logging
 import re
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+import queue
+import signal
+import threading
+import time
+import cProfile
+import pstats
+import itertools
+import math
+import socket
+import uuid
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer
+from aiohttp import web
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList, TextStreamer
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import (Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
+                          ContextTypes, filters)
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,7 +54,151 @@ logger = logging.getLogger(__name__)
 
 # Конфигурация
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'YOUR_BOT_TOKEN_HERE')
-DB_PATH = 'odanna_bot.db'
+DB_PATH = os.getenv('DB_PATH', 'odanna_bot.db')
+
+# Общее хранилище для нескольких узлов: postgres://… (пусто — SQLite-файл DB_PATH)
+DATABASE_URL = os.getenv('DATABASE_URL', '')
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '2'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '10'))
+PG_STATEMENT_CACHE = int(os.getenv('PG_STATEMENT_CACHE', '256'))  # подготовленных запросов на соединение
+
+# Размеры страниц в меню
+CHATS_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 5
+HISTORY_SNIPPET_LENGTH = 300
+SEARCH_PAGE_SIZE = 5
+SEARCH_QUERIES_SIZE = 4096  # пользователей, чей последний поисковый запрос помнится для листания
+
+# Сколько секунд ждать освобождения базы другим писателем
+DB_BUSY_TIMEOUT = 10
+
+# Долговременная семантическая память (пустая EMBEDDING_MODEL отключает её)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+MEMORY_DIR = os.getenv('MEMORY_DIR')  # без каталога индексы живут только в памяти процесса
+MEMORY_DTYPE = os.getenv('MEMORY_DTYPE', 'int8')  # int8 или float32
+MEMORY_TOP_K = int(os.getenv('MEMORY_TOP_K', '3'))
+MEMORY_BATCH_SIZE = 32
+MEMORY_FLUSH_INTERVAL = 60  # секунд между сбросами индексов на диск
+MEMORY_INDEX_CACHE_SIZE = int(os.getenv('MEMORY_INDEX_CACHE_SIZE', '1024'))  # индексов чатов в памяти
+
+# Архив неактивных чатов (холодное хранилище рядом с основной базой)
+ARCHIVE_DB_PATH = os.getenv('ARCHIVE_DB_PATH')  # по умолчанию <DB_PATH>_archive.db
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))  # 0 — не архивировать
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '0'))  # 0 — хранить вечно
+ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', str(6 * 3600)))  # секунд между запусками
+
+# Доставка ответов: обработанные update_id и исходящие ответы (outbox) хранятся в БД
+# вместе с репликой, поэтому повтор обновления не генерирует ответ заново,
+# а ответ, не ушедший из-за сбоя или перезапуска, досылается
+UPDATE_DEDUP_DAYS = int(os.getenv('UPDATE_DEDUP_DAYS', '7'))  # сколько помнить обработанные обновления
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS', '30'))  # столько отправка закреплена за процессом
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))  # попыток отправить ответ
+OUTBOX_INTERVAL = 5  # секунд между проходами досылки
+
+# Плавная остановка (SIGTERM при деплое): приём обновлений прекращается, начатые
+# ответы дописываются до DRAIN_TIMEOUT, а не начатые и не дописанные сообщения
+# остаются во входящих (inbox) и достаются следующему экземпляру
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '8'))  # меньше stop_grace_period Docker (10 с по умолчанию)
+INBOX_STALE_SECONDS = int(os.getenv('INBOX_STALE_SECONDS', '600'))  # входящие экземпляра, убитого без остановки
+
+# Статистика чатов копится при сохранении реплик; сообщения, сохранённые до
+# появления её таблиц, досчитываются в фоне пачками
+STATS_BACKFILL_BATCH = int(os.getenv('STATS_BACKFILL_BATCH', '5000'))
+STATS_TRAJECTORY_DAYS = 7  # дней траектории эмпатии на экране статистики
+
+# Выгрузка и загрузка данных пользователя (python odanna_bot.py --export / --import):
+# строк в пачке — и в блоке колоночного файла, и в одной транзакции загрузки
+EXPORT_BATCH = int(os.getenv('EXPORT_BATCH', '1000'))
+
+# Сжатие длинных текстов сообщений и ответов в SQLite: пусто — без сжатия,
+# zstd (нужен пакет zstandard, без него — zlib) или zlib. PostgreSQL сжимает
+# длинные значения сам (TOAST). Уже сжатые строки читаются при любой настройке
+TEXT_COMPRESSION = os.getenv('TEXT_COMPRESSION', '')
+TEXT_COMPRESS_MIN_BYTES = int(os.getenv('TEXT_COMPRESS_MIN_BYTES', '512'))  # короче не сжимаем
+
+# HTTP-сервер метрик и проверки здоровья
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+
+# Профилирование по запросу (оба порога 0 — выключено)
+PROFILE_EVERY_N = int(os.getenv('PROFILE_EVERY_N', '0'))  # профилировать каждое N-е обновление
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', '0'))  # и все обновления дольше порога
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join('logs', 'profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '100'))  # сколько последних дампов хранить
+PROFILE_TORCH = os.getenv('PROFILE_TORCH', '1') == '1'  # трассировка model.generate
+
+# Языковая модель: бэкенд исполнения, модель и устройство
+MODEL_BACKEND = os.getenv('MODEL_BACKEND', 'transformers')  # transformers, onnx или gguf
+MODEL_NAME = os.getenv('MODEL_NAME', 'microsoft/DialoGPT-medium')  # для gguf — путь к файлу .gguf
+DEVICE = os.getenv('DEVICE', 'auto')  # auto, cpu или cuda (onnx и gguf работают на CPU)
+MAX_PROMPT_TOKENS = 1024  # окно модели (n_positions у DialoGPT): промпт вместе с ответом
+MAX_NEW_TOKENS = 150  # потолок; фактический бюджет ответа выбирает GenerationPolicy
+# Промпт чата только дописывается с конца, чтобы KV-кэш досчитывал лишь новые
+# токены: шаблон сценария, история целыми репликами, сведения хода и сообщение
+PROMPT_PREFIX_TOKENS = int(os.getenv('PROMPT_PREFIX_TOKENS', '448'))  # шаблон: системный промпт со сценарием
+PROMPT_TURN_TOKENS = 160  # запас окна на сведения хода и сообщение, остальное — истории
+PROMPT_WINDOWS_SIZE = 4096  # чатов, чьё окно истории помнится между ходами
+REPLY_MAX_CHARS = 500  # длиннее ответ всё равно обрезается постобработкой
+GENERATION_SLO_MS = float(os.getenv('GENERATION_SLO_MS', '5000'))  # целевая задержка ответа
+GENERATION_MIN_TOKENS = int(os.getenv('GENERATION_MIN_TOKENS', '24'))  # меньше не урезаем даже под нагрузкой
+# Жёсткий предел ожидания модели: генерация останавливается чуть раньше и отдаёт
+# написанное, а не уложившийся вызов (зависание, очередь) заменяется запасным ответом
+GENERATION_TIMEOUT_MS = float(os.getenv('GENERATION_TIMEOUT_MS', str(GENERATION_SLO_MS)))
+GENERATION_STOP_MARGIN = 0.2  # секунд до предела на декодирование и постобработку
+# Предохранитель: при всплеске ошибок и упёршихся в предел генераций модель на
+# BREAKER_COOLDOWN секунд заменяется запасными ответами
+BREAKER_FAILURE_RATIO = float(os.getenv('BREAKER_FAILURE_RATIO', '0.5'))  # доля неудач в окне
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))
+BREAKER_WINDOW = 20  # последних генераций в окне
+BREAKER_MIN_CALLS = 5  # меньше исходов — не судим
+ONNX_DIR = os.getenv('ONNX_DIR', os.path.join('data', 'onnx'))  # кэш экспортированных графов
+ONNX_QUANTIZE = os.getenv('ONNX_QUANTIZE', '1') == '1'  # динамическое int8-квантование графа
+GGUF_THREADS = int(os.getenv('GGUF_THREADS', '0'))  # 0 — по числу ядер
+KV_CACHE_MB = int(os.getenv('KV_CACHE_MB', '512'))  # past_key_values активных чатов (0 — выключено)
+
+# Пользовательские сценарии: описание входит в промпт после системного,
+# шаблон «системный промпт + сценарий» собирается и токенизируется один раз
+SCENARIO_MAX_CHARS = int(os.getenv('SCENARIO_MAX_CHARS', '1500'))  # длиннее описание обрезается
+SCENARIO_NAME_MAX_CHARS = 64  # название — первая строка описания
+SCENARIO_DRAFT = "Пользовательский сценарий"  # у чата «с настройками», пока не пришло описание
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '256'))  # скомпилированных шаблонов в памяти
+
+# Спекулятивное декодирование: маленькая черновая модель предлагает токены,
+# основная проверяет их за один проход (пустая DRAFT_MODEL отключает)
+DRAFT_MODEL = os.getenv('DRAFT_MODEL', '')  # например, microsoft/DialoGPT-small
+DRAFT_NUM_TOKENS = int(os.getenv('DRAFT_NUM_TOKENS', '5'))  # начальная длина черновика
+
+# Пул заготовленных ответов на частые короткие реплики (приветствие, благодарность,
+# грусть, прощание): пополняется в простое, раздаётся мгновенно в час пик
+# и вместо запасных ответов, когда модель недоступна
+POOL_SIZE = int(os.getenv('POOL_SIZE', '5'))  # заготовок на намерение × эмпатию × сценарий (0 — выключено)
+POOL_TTL_HOURS = int(os.getenv('POOL_TTL_HOURS', '24'))  # старые заготовки генерируются заново
+POOL_MAX_SERVES = int(os.getenv('POOL_MAX_SERVES', '3'))  # после стольких показов заготовка заменяется
+POOL_PEAK_QUEUE = int(os.getenv('POOL_PEAK_QUEUE', '2'))  # с такой очереди генерации отвечать из пула
+POOL_IDLE_SECONDS = int(os.getenv('POOL_IDLE_SECONDS', '30'))  # тишина перед пополнением пула
+POOL_SCENARIOS = [s.strip() for s in os.getenv('POOL_SCENARIOS', 'Небесная Гостиница').split(',') if s.strip()]
+POOL_CHECK_INTERVAL = 5  # секунд между проверками простоя
+POOL_MAX_WORDS = 4  # в сообщении длиннее уже есть содержание, на него отвечает модель
+
+# Приоритеты обновлений: кнопки и команды идут быстрой полосой,
+# сообщения для модели — отдельной ограниченной полосой генерации
+FAST_LANE_SIZE = int(os.getenv('FAST_LANE_SIZE', '8'))  # одновременно обрабатываемых нажатий и команд
+LLM_LANE_SIZE = int(os.getenv('LLM_LANE_SIZE', '8'))  # одновременно принятых сообщений для модели
+LLM_WORKERS = int(os.getenv('LLM_WORKERS', '1'))  # потоков генерации (одновременных вызовов модели)
+
+# Очередь заданий генерации для нескольких узлов: фронтенды Telegram ставят
+# задания, узлы генерации (python odanna_bot.py --worker) их выполняют.
+# Пусто — модель вызывается в процессе бота; sqlite:путь — локальная очередь
+# в файле; redis://… — Redis Streams с группой потребителей
+JOB_QUEUE = os.getenv('JOB_QUEUE', '')
+JOB_VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', '120'))  # секунд до повторной выдачи задания
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))  # после стольких выдач задание считается сбойным
+JOB_RESULT_TIMEOUT = float(os.getenv('JOB_RESULT_TIMEOUT', '300'))  # сколько фронтенд ждёт ответа
+# Сторож узла: генерация дольше предела значит зависание — процесс завершается для перезапуска
+WORKER_HANG_SECONDS = float(os.getenv('WORKER_HANG_SECONDS', str(max(60.0, 3 * GENERATION_TIMEOUT_MS / 1000))))
+WORKER_HANG_EXIT_CODE = 75
+JOB_BLOCK_MS = 1000  # длительность одного ожидания задания или результата
+JOB_POLL_INTERVAL = 0.05  # шаг опроса локальной очереди, секунд
 
 # Системный промпт для Оданны
 ODANNA_SYSTEM_PROMPT = """Ты — **Оданна**, хозяин легендарной **"Небесной Гостиницы"**, нейтральной территории для богов и духов. Твоя сущность — могущественный демон. Веди себя согласно следующим правилам:
@@ -75,18 +246,873 @@ ODANNA_SYSTEM_PROMPT = """Ты — **Оданна**, хозяин легенда
 - **Анализ:** Оценивай эмоции, контекст и скрытые причины в сообщениях пользователя.
 - **Ответы:** Часто (70%) давай развернутый, по началу общения немного эмпатичный (35%), потом полу эмпатичный (50%) и эмпатичный ответ. Решать между% эмпатичности можешь ты или пользователь."""
 
-class DatabaseManager:
-    """Управление базой данных SQLite"""
+# Границы гистограмм задержек (секунды)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class MetricsRegistry:
+    """Минимальный реестр метрик в текстовом формате Prometheus
+    
+    Счётчики, гистограммы и gauge с метками; gauge можно задать функцией,
+    которая вызывается при каждом чтении /metrics.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self.buckets: Dict[str, Tuple[float, ...]] = {}
+        self.values: Dict[str, Dict[Tuple, object]] = {}
+        self.callbacks: Dict[str, Callable[[], float]] = {}
+    
+    def describe(self, name: str, metric_type: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.descriptions[name] = (metric_type, help_text)
+        self.values.setdefault(name, {})
+        if metric_type == 'histogram':
+            self.buckets[name] = buckets
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+    
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+    
+    def set_function(self, name: str, callback: Callable[[], float]):
+        """Gauge, значение которого вычисляется при чтении"""
+        self.callbacks[name] = callback
+    
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = self.buckets[name]
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = {"counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][bisect_left(buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+    
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замер длительности блока в гистограмму name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    @staticmethod
+    def _labels(key: Tuple, extra: Tuple = ()) -> str:
+        pairs = [f'{name}="{value}"' for name, value in key + extra]
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def render(self) -> str:
+        """Текстовое представление всех метрик (exposition format 0.0.4)"""
+        for name, callback in self.callbacks.items():
+            try:
+                self.set(name, callback())
+            except Exception as e:
+                logger.warning(f"Метрика {name} недоступна: {e}")
+        
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text) in self.descriptions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for key, value in self.values[name].items():
+                    if metric_type != 'histogram':
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets[name] + ("+Inf",), value["counts"]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(key, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{self._labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe('odanna_stage_seconds', 'histogram', 'Длительность этапов обработки сообщения')
+METRICS.describe('odanna_handle_message_seconds', 'histogram', 'Полное время обработки сообщения')
+METRICS.describe('odanna_callback_seconds', 'histogram', 'Время обработки нажатий на кнопки')
+METRICS.describe('odanna_generated_tokens_total', 'counter', 'Сгенерировано токенов')
+METRICS.describe('odanna_generation_tokens_per_second', 'histogram', 'Скорость генерации, токенов в секунду',
+                 buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+METRICS.describe('odanna_prompt_tokens', 'histogram', 'Длина промпта в токенах',
+                 buckets=(64, 128, 256, 512, 768, 1024, 2048, 4096))
+METRICS.describe('odanna_generation_budget_tokens', 'histogram', 'Разрешённая длина ответа в токенах',
+                 buckets=(16, 24, 32, 48, 64, 96, 128, 150))
+METRICS.describe('odanna_responses_total', 'counter', 'Ответы по источнику (model/fallback)')
+METRICS.describe('odanna_inflight_messages', 'gauge', 'Сообщения в обработке')
+METRICS.describe('odanna_memory_queue_depth', 'gauge', 'Реплики в очереди на индексацию памяти')
+METRICS.describe('odanna_model_loaded', 'gauge', 'Загружена ли языковая модель (1/0)')
+METRICS.describe('odanna_db_connections_total', 'counter', 'Открыто соединений с SQLite')
+METRICS.describe('odanna_db_size_bytes', 'gauge', 'Размер основной базы на диске')
+METRICS.describe('odanna_kv_cache_tokens_total', 'counter',
+                 'Токены промпта: взятые из KV-кэша чата, из общего префикса сценария и досчитанные')
+METRICS.describe('odanna_prompt_templates_compiled_total', 'counter', 'Собранные и токенизированные шаблоны сценариев')
+METRICS.describe('odanna_kv_cache_bytes', 'gauge', 'Память, занятая KV-кэшем чатов')
+METRICS.describe('odanna_response_pool_total', 'counter', 'Обращения к пулу заготовок (hit/miss) по намерению')
+METRICS.describe('odanna_response_pool_age_seconds', 'histogram', 'Возраст выданной из пула заготовки',
+                 buckets=(60, 300, 900, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 24 * 3600, 48 * 3600))
+METRICS.describe('odanna_response_pool_size', 'gauge', 'Свежие заготовки в пуле')
+METRICS.describe('odanna_response_pool_generated_total', 'counter', 'Заготовки, сгенерированные в простое')
+METRICS.describe('odanna_lane_wait_seconds', 'histogram', 'Ожидание места в полосе обработки (fast/llm)')
+METRICS.describe('odanna_lane_active', 'gauge', 'Обновления в обработке по полосам (fast/llm)')
+METRICS.describe('odanna_duplicate_updates_total', 'counter', 'Повторно доставленные и пропущенные обновления')
+METRICS.describe('odanna_outbox_total', 'counter', 'Попытки отправки ответов из outbox (sent/retry/rejected)')
+METRICS.describe('odanna_handoff_updates_total', 'counter', 'Сообщения, переданные следующему экземпляру при остановке')
+METRICS.describe('odanna_replayed_updates_total', 'counter', 'Сообщения, принятые от остановленного экземпляра')
+METRICS.describe('odanna_jobs_total', 'counter', 'Задания генерации по итогу (done/retry/failed)')
+METRICS.describe('odanna_job_seconds', 'histogram', 'Время от постановки задания до ответа узла генерации')
+METRICS.describe('odanna_job_queue_depth', 'gauge', 'Задания генерации в очереди')
+METRICS.describe('odanna_generation_timeouts_total', 'counter',
+                 'Генерации, упёршиеся в предел времени (stopped — остановлены с частью ответа, abandoned — не дождались)')
+METRICS.describe('odanna_abandoned_generations', 'gauge', 'Брошенные по пределу генерации, ещё занимающие поток')
+METRICS.describe('odanna_breaker_state', 'gauge', 'Предохранитель генерации: 0 — замкнут, 1 — разомкнут, 2 — пробный вызов')
+METRICS.describe('odanna_breaker_trips_total', 'counter', 'Срабатывания предохранителя генерации')
+METRICS.describe('odanna_worker_hangs_total', 'counter', 'Зависания узла генерации, после которых он перезапускается')
+
+
+class ProfileSession:
+    """Профиль одного обновления: cProfile и, при генерации, трасса torch.profiler"""
+    
+    def __init__(self, label: str, trace_torch: bool):
+        self.label = label
+        self.trace_torch = trace_torch
+        self.profiler = cProfile.Profile()
+        self.thread_profiles: List[cProfile.Profile] = []  # вызовы в потоках генерации
+        self.lock = threading.Lock()
+        self.torch_profile = None
+    
+    @contextmanager
+    def generation(self):
+        """Обёртка вокруг model.generate для записи трассы torch"""
+        if not self.trace_torch:
+            yield
+            return
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as prof:
+            yield
+        self.torch_profile = prof
+    
+    def run_in_thread(self, func: Callable, *args, **kwargs):
+        """Вызов в чужом потоке под своим cProfile: профиль сессии видит только поток цикла событий
+        
+        Профиль потока попадает в дамп, только если вызов закончился до него.
+        """
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.thread_profiles.append(profiler)
+    
+    def dump(self, directory: str, elapsed: float) -> str:
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        path = os.path.join(directory, f"{stamp}_{self.label}_{elapsed * 1000:.0f}ms")
+        stats = pstats.Stats(self.profiler)
+        with self.lock:
+            for profiler in self.thread_profiles:
+                stats.add(profiler)
+        stats.dump_stats(path + ".prof")
+        if self.torch_profile is not None:
+            self.torch_profile.export_chrome_trace(path + ".trace.json")
+        return path
+
+
+# Активная сессия профилирования текущего обновления (видна и в потоках asyncio.to_thread)
+CURRENT_PROFILE: ContextVar[Optional[ProfileSession]] = ContextVar('CURRENT_PROFILE', default=None)
+
+
+class RequestProfiler:
+    """Выборочное профилирование обновлений в PROFILE_DIR с ротацией
+    
+    Сохраняется каждое every_n-е обновление и любое медленнее slow_ms.
+    При выключенных порогах стоимость — одна проверка флага.
+    Одновременно профилируется только одно обновление.
+    """
+    
+    def __init__(self, every_n: int = PROFILE_EVERY_N, slow_ms: float = PROFILE_SLOW_MS,
+                 directory: str = PROFILE_DIR, keep: int = PROFILE_KEEP, trace_torch: bool = PROFILE_TORCH):
+        self.every_n = every_n
+        self.slow_ms = slow_ms
+        self.directory = directory
+        self.keep = keep
+        self.trace_torch = trace_torch
+        self.enabled = every_n > 0 or slow_ms > 0
+        self.counter = itertools.count(1)
+        self.active = threading.Lock()
+        
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            logger.info(f"Профилирование включено: каждое {every_n}-е обновление, порог {slow_ms} мс")
+    
+    @contextmanager
+    def profile(self, label: str):
+        if not self.enabled:
+            yield None
+            return
+        
+        sampled = self.every_n > 0 and next(self.counter) % self.every_n == 0
+        if not (sampled or self.slow_ms > 0) or not self.active.acquire(blocking=False):
+            yield None
+            return
+        
+        # Для порога по задержке трасса torch пишется только у выборочных обновлений
+        session = ProfileSession(label, self.trace_torch and sampled)
+        token = CURRENT_PROFILE.set(session)
+        started = time.perf_counter()
+        session.profiler.enable()
+        try:
+            yield session
+        finally:
+            session.profiler.disable()
+            elapsed = time.perf_counter() - started
+            CURRENT_PROFILE.reset(token)
+            self.active.release()
+            
+            if sampled or elapsed * 1000 >= self.slow_ms > 0:
+                try:
+                    session.dump(self.directory, elapsed)
+                    self._rotate()
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения профиля: {e}")
+    
+    def _rotate(self):
+        """Удаление самых старых дампов сверх лимита keep"""
+        dumps = sorted(
+            name for name in os.listdir(self.directory) if name.endswith(".prof")
+        )
+        for name in dumps[:max(0, len(dumps) - self.keep)]:
+            base = os.path.join(self.directory, name[:-len(".prof")])
+            for suffix in (".prof", ".trace.json"):
+                if os.path.exists(base + suffix):
+                    os.unlink(base + suffix)
+
+
+# Полнотекстовый индекс: колонка scope содержит токены владельца и чата
+# (u<user_id> c<chat_key>), чтобы поиск сразу сужался до нужной истории.
+# Буква «ё» приводится к «е» и в индексе, и в запросах. Индекс ведёт
+# DatabaseManager, а не триггеры: сжатый текст разжимает только Python, и
+# триггер с odanna_text ломал запись в messages любому другому соединению
+FTS_ROW_SQL = "SELECT message_id, user_id, chat_key, message_text, response_text FROM messages"
+FTS_INSERT_SQL = "INSERT INTO messages_fts (rowid, scope, message_text, response_text) VALUES (?, ?, ?, ?)"
+FTS_DELETE_SQL = ("INSERT INTO messages_fts (messages_fts, rowid, scope, message_text, response_text) "
+                  "VALUES ('delete', ?, ?, ?, ?)")
+
+
+def _fts_text(value) -> Optional[str]:
+    text = _unpack_text(value)
+    return text.replace('ё', 'е').replace('Ё', 'Е') if text is not None else None
+
+
+def _fts_row(message_id: int, user_id: Optional[int], chat_key: Optional[int], message_text, response_text) -> Tuple:
+    """Значения колонок FTS-индекса для строки FTS_ROW_SQL (тексты — как хранятся, возможно сжатые)"""
+    scope = f"u{user_id} c{chat_key}" if user_id is not None and chat_key is not None else None
+    return message_id, scope, _fts_text(message_text), _fts_text(response_text)
+
+
+# Кэш токенов реплик в messages: пересчитывается из текста, в архив не попадает
+TOKEN_CACHE_COLUMNS = ('message_tokens', 'response_tokens', 'tokenizer_id')
+
+
+def _pack_tokens(token_ids: Optional[List[int]]) -> Optional[bytes]:
+    """Идентификаторы токенов в BLOB (uint32, порядок байт little-endian)"""
+    if token_ids is None:
+        return None
+    return np.asarray(token_ids, dtype='<u4').tobytes()
+
+
+def _unpack_tokens(blob: Optional[bytes]) -> Optional[List[int]]:
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<u4').tolist()
+
+
+# Компактная запись messages: чат — целочисленным ключом chats.chat_key вместо
+# строки chat_id, эмоции — битовой маской по словарю emotions (бит i — EMOTIONS[i],
+# новые названия получают следующие биты). Наружу по-прежнему отдаются chat_id
+# и строка эмоций через «, » в порядке битов
+EMOTIONS = ('нейтральное', 'радость', 'грусть', 'любопытство', 'многословность', 'возбуждение')
+EMOTION_BITS = 63  # маска помещается в знаковое 64-битное целое
+EMOTION_TEXT_SQL = ("(SELECT group_concat(name, ', ') FROM "
+                    "(SELECT name FROM emotions WHERE {mask} & (1 << bit) ORDER BY bit))")
+CHAT_KEY_SQL = "(SELECT chat_key FROM chats WHERE chat_id = ?)"
+# Несжатые тексты отдаются без вызова Python-функции odanna_text
+TEXT_SQL = "CASE typeof({column}) WHEN 'blob' THEN odanna_text({column}) ELSE {column} END"
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _text_compression(method: str) -> str:
+    """Доступный способ сжатия текста: zstd без пакета zstandard заменяется на zlib"""
+    if method == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            logger.warning("TEXT_COMPRESSION=zstd, но пакет zstandard не установлен — используется zlib")
+            return 'zlib'
+    elif method not in ('', 'zlib'):
+        raise ValueError(f"Неизвестный способ сжатия текста: {method}")
+    return method
+
+
+def _pack_text(text: Optional[str], method: str, min_bytes: int = TEXT_COMPRESS_MIN_BYTES):
+    """Длинный текст — сжатым BLOB, если это экономит место; иначе строка как есть"""
+    if not method or text is None:
+        return text
+    raw = text.encode()
+    if len(raw) < min_bytes:
+        return text
+    if method == 'zstd':
+        import zstandard
+        packed = zstandard.ZstdCompressor(level=6).compress(raw)
+    else:
+        packed = zlib.compress(raw, 6)
+    return packed if len(packed) < len(raw) else text
+
+
+def _unpack_text(value):
+    """Обратное _pack_text (в SQLite — функция odanna_text); строки возвращаются без изменений"""
+    if not isinstance(value, bytes):
+        return value
+    if value[:4] == ZSTD_MAGIC:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(value).decode()
+    return zlib.decompress(value).decode()
+
+
+def _stats_deltas(turns) -> Tuple[Counter, Dict[Tuple[str, str], Tuple[int, int]]]:
+    """Приращения статистики по репликам (chat_id, user_id, emotion_analysis, empathy_level, время UTC)
+    
+    Для user_stats — счётчики messages, emotion:<эмоция> (из emotion_analysis)
+    и hour:<ЧЧ>; для chat_stats — сообщения и сумма эмпатии чата за день.
+    Все приращения складываются, поэтому порядок подсчёта не важен.
+    """
+    user_counts = Counter()
+    chat_days: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for chat_id, user_id, emotion_analysis, empathy_level, stamp in turns:
+        stamp = str(stamp)  # «ГГГГ-ММ-ДД ЧЧ:…» и у строк SQLite, и у datetime
+        user_counts[(user_id, 'messages')] += 1
+        user_counts[(user_id, f'hour:{stamp[11:13]}')] += 1
+        for emotion in (emotion_analysis or '').split(','):
+            if emotion.strip():
+                user_counts[(user_id, f'emotion:{emotion.strip()}')] += 1
+        messages, empathy_sum = chat_days.get((chat_id, stamp[:10]), (0, 0))
+        chat_days[(chat_id, stamp[:10])] = (messages + 1, empathy_sum + (empathy_level or 0))
+    return user_counts, chat_days
+
+
+# Колонки выгрузки по видам записей; сообщения идут после своего чата.
+# message_id не выгружается: на другом узле сообщения получают свои номера
+EXPORT_COLUMNS = {
+    'user': ('user_id', 'username', 'first_name', 'last_name', 'gender', 'created_at', 'last_activity'),
+    'chat': ('chat_id', 'user_id', 'chat_name', 'scenario', 'empathy_level', 'message_count',
+             'created_at', 'last_activity', 'scenario_prompt'),
+    'message': ('chat_id', 'user_id', 'message_text', 'response_text', 'is_ignored', 'emotion_analysis',
+                'empathy_level', 'timestamp'),
+}
+EXPORT_FORMATS = ('jsonl', 'columnar')
+COLUMNAR_MAGIC = b'ODANNA-COLUMNAR-1\n'
+
+
+def write_export(batches: Iterable[Tuple[str, List[Tuple]]], path: str, fmt: str = 'jsonl') -> Dict[str, int]:
+    """Запись пачек (вид, строки) в файл; возвращает число записей каждого вида
+    
+    jsonl — строка JSON на запись (сжимается gzip, если путь оканчивается на .gz);
+    columnar — после заголовка COLUMNAR_MAGIC блоки «длина (4 байта) + zlib(JSON)»,
+    в блоке значения пачки лежат по колонкам. Файл пишется по мере чтения пачек.
+    """
+    counts = Counter()
+    if fmt == 'columnar':
+        with open(path, 'wb') as f:
+            f.write(COLUMNAR_MAGIC)
+            for kind, rows in batches:
+                block = json.dumps({"type": kind, "columns": EXPORT_COLUMNS[kind],
+                                    "values": [list(column) for column in zip(*rows)]},
+                                   ensure_ascii=False, default=str)
+                packed = zlib.compress(block.encode())
+                f.write(struct.pack('>I', len(packed)))
+                f.write(packed)
+                counts[kind] += len(rows)
+    elif fmt == 'jsonl':
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            for kind, rows in batches:
+                columns = EXPORT_COLUMNS[kind]
+                for row in rows:
+                    f.write(json.dumps({"type": kind, **dict(zip(columns, row))}, ensure_ascii=False, default=str))
+                    f.write('\n')
+                counts[kind] += len(rows)
+    else:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    return dict(counts)
+
+
+def read_export(path: str, batch_size: int = EXPORT_BATCH) -> Iterator[Tuple[str, List[Tuple]]]:
+    """Чтение выгрузки любого формата (определяется по заголовку) пачками (вид, строки)"""
+    with open(path, 'rb') as f:
+        head = f.read(len(COLUMNAR_MAGIC))
+    
+    if head == COLUMNAR_MAGIC:
+        with open(path, 'rb') as f:
+            f.seek(len(COLUMNAR_MAGIC))
+            while True:
+                size = f.read(4)
+                if not size:
+                    return
+                block = json.loads(zlib.decompress(f.read(struct.unpack('>I', size)[0])))
+                values = dict(zip(block["columns"], block["values"]))
+                count = len(block["values"][0]) if block["values"] else 0
+                columns = [values.get(column, [None] * count) for column in EXPORT_COLUMNS[block["type"]]]
+                yield block["type"], list(zip(*columns))
+    
+    opener = gzip.open if head[:2] == b'\x1f\x8b' else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        kind, rows = None, []
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if rows and (record["type"] != kind or len(rows) >= batch_size):
+                yield kind, rows
+                rows = []
+            kind = record["type"]
+            rows.append(tuple(record.get(column) for column in EXPORT_COLUMNS[kind]))
+        if rows:
+            yield kind, rows
+
+
+class StorageBackend(ABC):
+    """Хранилище пользователей, чатов, сообщений, архива и пула заготовок
+    
+    Один набор методов у SQLite (DatabaseManager) и PostgreSQL
+    (PostgresStorage). Строки возвращаются кортежами, отметки времени —
+    строками «ГГГГ-ММ-ДД ЧЧ:ММ:СС» в UTC, как их хранит SQLite.
+    """
+    
+    fts_enabled = False
+    
+    @abstractmethod
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                 gender: str = 'unknown'):
+        ...
+    
+    @abstractmethod
+    def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница",
+                    scenario_prompt: Optional[str] = None) -> str:
+        ...
+    
+    @abstractmethod
+    def get_user_chats(self, user_id: int) -> List[Tuple]:
+        ...
+    
+    @abstractmethod
+    def get_user_chats_page(self, user_id: int, limit: int = 10, cursor: Optional[Tuple[str, str]] = None,
+                            backward: bool = False) -> Tuple[List[Tuple], bool, bool]:
+        ...
+    
+    @abstractmethod
+    def add_message(self, chat_id: str, user_id: int, message_text: str, response_text: str = None,
+                    emotion_analysis: str = None, empathy_level: int = 35,
+                    message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                    tokenizer_id: Optional[str] = None) -> int:
+        ...
+    
+    @abstractmethod
+    def get_chat_history(self, chat_id: str, limit: int = 20) -> List[Tuple]:
+        ...
+    
+    @abstractmethod
+    def get_history_turns(self, chat_id: str, limit: int, tokenizer_id: Optional[str] = None) -> List[Tuple]:
+        ...
+    
+    @abstractmethod
+    def set_message_tokens(self, tokens: List[Tuple[int, List[int], Optional[List[int]]]], tokenizer_id: str):
+        ...
+    
+    @abstractmethod
+    def get_response_lengths(self, limit: int = 1000) -> List[int]:
+        ...
+    
+    @abstractmethod
+    def get_chat_messages_page(self, chat_id: str, limit: int = 5, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None) -> Tuple[List[Tuple], bool, bool]:
+        ...
+    
+    @abstractmethod
+    def forget_last_message(self, chat_id: str) -> Optional[int]:
+        ...
+    
+    @abstractmethod
+    def _set_message_ignored(self, message_id: int, ignored: bool, user_id: Optional[int] = None,
+                             chat_id: Optional[str] = None) -> Optional[str]:
+        ...
+    
+    @abstractmethod
+    def search_messages(self, user_id: int, query: str, limit: int = 5,
+                        offset: int = 0) -> Tuple[List[Tuple], bool]:
+        ...
+    
+    @abstractmethod
+    def find_message_id(self, chat_id: str, message_text: str, ignored: bool = False) -> Optional[int]:
+        ...
+    
+    @abstractmethod
+    def get_messages_by_ids(self, chat_id: str, message_ids: List[int]) -> List[Tuple]:
+        ...
+    
+    @abstractmethod
+    def delete_chat(self, chat_id: str):
+        ...
+    
+    @abstractmethod
+    def archive_chat(self, chat_id: str) -> int:
+        ...
+    
+    @abstractmethod
+    def restore_chat(self, chat_id: str) -> bool:
+        ...
+    
+    @abstractmethod
+    def archive_inactive_chats(self, inactive_days: int = ARCHIVE_AFTER_DAYS) -> int:
+        ...
+    
+    @abstractmethod
+    def purge_expired_archives(self, retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+        ...
+    
+    @abstractmethod
+    def run_archive_maintenance(self, inactive_days: int = ARCHIVE_AFTER_DAYS,
+                                retention_days: int = ARCHIVE_RETENTION_DAYS):
+        ...
+    
+    @abstractmethod
+    def ping(self):
+        ...
+    
+    @abstractmethod
+    def size_bytes(self) -> int:
+        """Размер базы на диске (для метрик)"""
+    
+    @abstractmethod
+    def get_chat_owner(self, chat_id: str) -> Optional[int]:
+        """user_id владельца чата; None — чата нет"""
+    
+    @abstractmethod
+    def get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя; None — не выбран или удалён"""
+    
+    @abstractmethod
+    def set_current_chat(self, user_id: int, chat_id: str) -> Optional[str]:
+        """Сделать чат активным (видно всем узлам бота); возвращает прежний активный чат"""
+    
+    @abstractmethod
+    def get_chat_empathy_level(self, chat_id: str) -> int:
+        ...
+    
+    @abstractmethod
+    def update_chat_empathy(self, chat_id: str, empathy_level: int):
+        ...
+    
+    @abstractmethod
+    def get_chat_scenario(self, chat_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        ...
+    
+    @abstractmethod
+    def set_chat_scenario(self, chat_id: str, scenario: str, scenario_prompt: Optional[str]) -> bool:
+        ...
+    
+    @abstractmethod
+    def add_pooled_response(self, intent: str, empathy_bucket: int, scenario: str, response_text: str):
+        ...
+    
+    @abstractmethod
+    def take_pooled_response(self, intent: str, empathy_bucket: int, scenario: str,
+                             ttl_hours: int = POOL_TTL_HOURS,
+                             max_serves: int = POOL_MAX_SERVES) -> Optional[Tuple[str, float]]:
+        ...
+    
+    @abstractmethod
+    def count_pooled_responses(self, ttl_hours: int = POOL_TTL_HOURS) -> Dict[Tuple[str, int, str], int]:
+        ...
+    
+    @abstractmethod
+    def purge_stale_pool(self, ttl_hours: int = POOL_TTL_HOURS) -> int:
+        ...
+    
+    @abstractmethod
+    def is_update_processed(self, update_id: int) -> bool:
+        ...
+    
+    @abstractmethod
+    def add_reply(self, update_id: int, telegram_chat_id: int, chat_id: str, user_id: int, message_text: str,
+                  response_text: str, emotion_analysis: str, empathy_level: int,
+                  message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                  tokenizer_id: Optional[str] = None,
+                  lease_seconds: int = OUTBOX_LEASE_SECONDS) -> Optional[Tuple[int, int]]:
+        """Реплика, новый уровень эмпатии чата, отметка обновления и исходящий ответ — одной транзакцией
+        
+        Возвращает (message_id, outbox_id) или None, если обновление уже
+        обработано. Ответ закреплён за вызывающим на lease_seconds: он
+        отправляет его сам, досылка берёт его только после этого срока.
+        """
+    
+    @abstractmethod
+    def claim_outbox(self, limit: int = 20, lease_seconds: int = OUTBOX_LEASE_SECONDS,
+                     max_attempts: int = OUTBOX_MAX_ATTEMPTS) -> List[Tuple[int, int, int, str]]:
+        """Неотправленные ответы, ничьи или с истёкшим закреплением: (outbox_id, telegram_chat_id, message_id, текст)"""
+    
+    @abstractmethod
+    def mark_outbox_sent(self, outbox_id: int):
+        ...
+    
+    @abstractmethod
+    def purge_delivery_log(self, keep_days: int = UPDATE_DEDUP_DAYS) -> int:
+        """Удаление старых отметок обновлений и завершённых ответов outbox"""
+    
+    @abstractmethod
+    def add_inbox(self, update_id: int, payload: str, owner: str):
+        """Запомнить принятое сообщение (JSON обновления) до окончания его обработки"""
+    
+    @abstractmethod
+    def remove_inbox(self, update_id: int):
+        ...
+    
+    @abstractmethod
+    def release_inbox(self, owner: str) -> int:
+        """Отдать необработанные сообщения экземпляра другим экземплярам. Возвращает их число"""
+    
+    @abstractmethod
+    def claim_inbox(self, owner: str, stale_seconds: int = INBOX_STALE_SECONDS,
+                    limit: int = 100) -> List[Tuple[int, str]]:
+        """Забрать отданные сообщения и сообщения экземпляров, пропавших без остановки"""
+    
+    @abstractmethod
+    def get_user_stats(self, user_id: int) -> Dict[str, int]:
+        """Счётчики пользователя: messages, emotion:<эмоция>, hour:<ЧЧ> (UTC)"""
+    
+    @abstractmethod
+    def get_chat_stats(self, chat_id: str, days: int = STATS_TRAJECTORY_DAYS) -> List[Tuple[str, int, float]]:
+        """Последние days дней активности чата: (день, сообщений, средняя эмпатия), от старых к новым"""
+    
+    @abstractmethod
+    def backfill_stats(self, batch_size: int = STATS_BACKFILL_BATCH) -> int:
+        """Досчитать статистику следующей пачки старых сообщений; 0 — всё посчитано
+        
+        Старые — сохранённые до появления таблиц статистики (граница
+        запоминается при их создании); позиция хранится в БД, поэтому
+        прерванный подсчёт продолжается с того же места.
+        """
+    
+    @abstractmethod
+    def export_user(self, user_id: int, batch_size: int = EXPORT_BATCH) -> Iterator[Tuple[str, List[Tuple]]]:
+        """Данные пользователя пачками (вид, строки) с колонками EXPORT_COLUMNS
+        
+        Сначала пользователь, затем пачка чатов и сообщения каждого из них,
+        включая архивные. Сообщения читаются курсором по message_id, поэтому
+        в памяти не больше одной пачки, сколько бы их ни было.
+        """
+    
+    @abstractmethod
+    def import_user(self, batches: Iterable[Tuple[str, List[Tuple]]]) -> Dict[str, int]:
+        """Загрузка выгрузки export_user: пачка — одна транзакция с executemany
+        
+        Пользователь и чаты, уже существующие в базе, не перезаписываются, а
+        сообщения таких чатов пропускаются — повторная загрузка ничего не
+        дублирует. Возвращает число загруженных записей каждого вида и skipped.
+        """
+    
+    @abstractmethod
+    def _load_emotions(self):
+        """Перечитать словарь эмоций в self.emotion_bits (название → бит)"""
+    
+    @abstractmethod
+    def _register_emotions(self, names: List[str]):
+        """Добавить в словарь новые названия эмоций (отдельной транзакцией) и перечитать его"""
+    
+    def _emotion_mask(self, emotion_analysis: Optional[str]) -> Optional[int]:
+        """Строка эмоций через запятую → битовая маска; пустая строка и None — NULL
+        
+        Вызывается до начала транзакции записи: незнакомое название
+        регистрируется в словаре отдельной транзакцией.
+        """
+        names = [name.strip() for name in (emotion_analysis or '').split(',') if name.strip()]
+        if not names:
+            return None
+        
+        unknown = [name for name in names if name not in self.emotion_bits]
+        if unknown:
+            self._register_emotions(unknown)
+        
+        mask = 0
+        for name in names:
+            if name in self.emotion_bits:
+                mask |= 1 << self.emotion_bits[name]
+        return mask or None
+    
+    def _emotion_text(self, mask: Optional[int]) -> Optional[str]:
+        """Битовая маска → строка эмоций в порядке битов (для строк архива)"""
+        if not mask:
+            return None
+        if mask >> (max(self.emotion_bits.values(), default=-1) + 1):
+            self._load_emotions()
+        return ', '.join(name for name, bit in sorted(self.emotion_bits.items(), key=lambda item: item[1])
+                         if mask & (1 << bit)) or None
+    
+    def _archived_messages(self, payload: bytes, chat_key: int) -> Tuple[List[str], List[List]]:
+        """Строки архива в текущей раскладке messages с ключом чата chat_key
+        
+        Архивы, записанные до компактной записи, хранят chat_id и строку
+        emotion_analysis — они переводятся в chat_key и маску emotions.
+        """
+        columns, rows = self._unpack_rows(payload)
+        if 'emotion_analysis' in columns:
+            position = columns.index('emotion_analysis')
+            columns[position] = 'emotions'
+            for row in rows:
+                row[position] = self._emotion_mask(row[position])
+        
+        for column in ('chat_id', 'chat_key'):
+            if column in columns:
+                position = columns.index(column)
+                del columns[position]
+                for row in rows:
+                    del row[position]
+        
+        columns.append('chat_key')
+        for row in rows:
+            row.append(chat_key)
+        return columns, rows
+    
+    def _archived_export(self, chat_id: str, payload: bytes, batch_size: int) -> Iterator[Tuple[str, List[Tuple]]]:
+        """Сообщения архивного чата пачками в колонках выгрузки"""
+        columns, rows = self._unpack_rows(payload)
+        
+        def value(row, column):
+            if column == 'chat_id':
+                return chat_id
+            if column == 'emotion_analysis' and 'emotion_analysis' not in columns:
+                return self._emotion_text(row[columns.index('emotions')]) if 'emotions' in columns else None
+            if column not in columns:
+                return None
+            if column in ('message_text', 'response_text'):
+                return _unpack_text(row[columns.index(column)])
+            return row[columns.index(column)]
+        
+        for start in range(0, len(rows), batch_size):
+            yield 'message', [tuple(value(row, column) for column in EXPORT_COLUMNS['message'])
+                              for row in rows[start:start + batch_size]]
+    
+    def close(self):
+        """Освобождение соединений (SQLite открывает их на каждый вызов)"""
+    
+    def ignore_message(self, chat_id: str, message_text: str) -> Optional[int]:
+        """Пометить сообщение как игнорируемое
+        
+        Сообщение ищется по полнотекстовому индексу, поэтому текст может
+        совпадать неточно. Возвращает message_id забытого сообщения.
+        """
+        message_id = self.find_message_id(chat_id, message_text)
+        if message_id is None:
+            return None
+        
+        return message_id if self._set_message_ignored(message_id, True, chat_id=chat_id) else None
+    
+    def unignore_message(self, chat_id: str, message_text: str) -> Optional[int]:
+        """Убрать пометку игнорирования сообщения
+        
+        Восстанавливается одно сообщение — самое подходящее из забытых.
+        """
+        message_id = self.find_message_id(chat_id, message_text, ignored=True)
+        if message_id is None:
+            return None
+        
+        return message_id if self._set_message_ignored(message_id, False, chat_id=chat_id) else None
+    
+    def ignore_message_by_id(self, message_id: int, user_id: int) -> Optional[str]:
+        """Пометить сообщение пользователя как игнорируемое по его ID
+        
+        Возвращает chat_id сообщения или None, если сообщение не найдено,
+        принадлежит другому пользователю или уже было забыто.
+        """
+        return self._set_message_ignored(message_id, True, user_id=user_id)
+    
+    def unignore_message_by_id(self, message_id: int, user_id: int) -> Optional[str]:
+        """Вернуть забытое сообщение пользователя по его ID"""
+        return self._set_message_ignored(message_id, False, user_id=user_id)
+    
+    @staticmethod
+    def _search_words(text: str) -> List[str]:
+        """Слова поискового запроса в нижнем регистре, «ё» приравнена к «е»"""
+        return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+    
+    @staticmethod
+    def _pack_rows(columns: List[str], rows: List[Tuple]) -> bytes:
+        """Сжатие строк таблицы в один блок (JSON + zlib, BLOB-поля в base64)"""
+        def encode(value):
+            if isinstance(value, bytes):
+                return {"b64": base64.b64encode(value).decode()}
+            if isinstance(value, datetime):
+                return value.isoformat(sep=' ', timespec='seconds')
+            return value
+        
+        encoded = [[encode(value) for value in row] for row in rows]
+        return zlib.compress(json.dumps({"columns": columns, "rows": encoded}, ensure_ascii=False).encode(), 9)
+    
+    @staticmethod
+    def _unpack_rows(payload: bytes) -> Tuple[List[str], List[List]]:
+        data = json.loads(zlib.decompress(payload))
+        rows = [
+            [base64.b64decode(value["b64"]) if isinstance(value, dict) else value for value in row]
+            for row in data["rows"]
+        ]
+        return data["columns"], rows
+
+class DatabaseManager(StorageBackend):
+    """Хранилище в локальном файле SQLite"""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, archive_path: Optional[str] = ARCHIVE_DB_PATH,
+                 text_compression: str = TEXT_COMPRESSION):
         self.db_path = db_path
+        self.archive_path = archive_path or f"{os.path.splitext(db_path)[0]}_archive.db"
+        self.text_compression = _text_compression(text_compression)
+        self.emotion_bits: Dict[str, int] = {}
         self.init_db()
+        self._load_emotions()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие соединения с ожиданием блокировок других писателей
+        
+        На соединении регистрируется функция odanna_text: она разжимает
+        тексты сообщений в запросах и триггерах полнотекстового индекса.
+        """
+        METRICS.inc('odanna_db_connections_total')
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT)
+        conn.create_function('odanna_text', 1, _unpack_text, deterministic=True)
+        return conn
+    
+    def _pack_text(self, text: Optional[str]):
+        return _pack_text(text, self.text_compression)
     
     def init_db(self):
         """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        # Освобождённые страницы возвращаются постепенно (PRAGMA incremental_vacuum).
+        # Для существующей базы режим включается разовым VACUUM.
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            cursor.execute('VACUUM')
+        
+        # WAL: читатели не блокируют писателя и наоборот
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # Таблица пользователей
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -100,75 +1126,411 @@ class DatabaseManager:
         )
         ''')
         
-        # Таблица чатов
+        # Таблица чатов: chat_key — компактный ключ чата в messages
+        cursor.execute(self.CHATS_TABLE.format(name='chats'))
+        
+        # Активный чат пользователя хранится в базе, а не в памяти узла
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            chat_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            chat_name TEXT,
-            scenario TEXT,
-            empathy_level INTEGER DEFAULT 35,
-            message_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        CREATE TABLE IF NOT EXISTS current_chats (
+            user_id INTEGER PRIMARY KEY,
+            chat_key INTEGER NOT NULL
         )
         ''')
         
         # Таблица сообщений
+        cursor.execute(self.MESSAGES_TABLE.format(name='messages'))
+        
+        self._ensure_column(cursor, 'chats', 'is_archived', 'BOOLEAN DEFAULT FALSE')
+        # Описание пользовательского сценария (NULL — только название)
+        self._ensure_column(cursor, 'chats', 'scenario_prompt', 'TEXT')
+        
+        # Токены реплик «\nПользователь: …» и «\nОданна: …» и токенизатор, которым они получены
+        self._ensure_column(cursor, 'messages', 'message_tokens', 'BLOB')
+        self._ensure_column(cursor, 'messages', 'response_tokens', 'BLOB')
+        self._ensure_column(cursor, 'messages', 'tokenizer_id', 'TEXT')
+        
+        # Словарь эмоций: бит маски messages.emotions → название
         cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id TEXT,
-            user_id INTEGER,
-            message_text TEXT,
+        CREATE TABLE IF NOT EXISTS emotions (
+            bit INTEGER PRIMARY KEY,
+            name TEXT UNIQUE
+        )
+        ''')
+        cursor.executemany('INSERT OR IGNORE INTO emotions (bit, name) VALUES (?, ?)', enumerate(EMOTIONS))
+        conn.commit()
+        
+        # База старой версии: chat_id и emotion_analysis в каждой строке messages
+        cursor.execute('PRAGMA table_info(messages)')
+        if 'chat_id' in {row[1] for row in cursor.fetchall()}:
+            self._migrate_compact(conn)
+        
+        # Индексы для постраничной навигации по чатам и истории
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_chats_user_activity
+        ON chats (user_id, last_activity, chat_id)
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_chat_key
+        ON messages (chat_key, message_id)
+        ''')
+        
+        # Пул заготовленных ответов на частые короткие реплики
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_pool (
+            pool_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            intent TEXT,
+            empathy_bucket INTEGER,
+            scenario TEXT,
             response_text TEXT,
-            is_ignored BOOLEAN DEFAULT FALSE,
-            emotion_analysis TEXT,
-            empathy_level INTEGER,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (chat_id) REFERENCES chats (chat_id),
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
+            served_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_pool_slot
+        ON response_pool (intent, empathy_bucket, scenario, created_at)
+        ''')
         
-        conn.commit()
-        conn.close()
-    
-    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None, gender: str = 'unknown'):
-        """Добавление или обновление пользователя"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        # Доставка ответов: обработанные обновления Telegram и исходящие ответы
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            outbox_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_chat_id INTEGER,
+            message_id INTEGER,
+            response_text TEXT,
+            attempts INTEGER DEFAULT 0,
+            locked_until TIMESTAMP,
+            sent_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (sent_at, locked_until)
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inbox (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT,
+            owner TEXT,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
         
+        # Статистика: счётчики пользователя и эмпатия чата по дням (см. _stats_deltas)
         cursor.execute('''
-        INSERT OR REPLACE INTO users 
-        (user_id, username, first_name, last_name, gender, last_activity)
-        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (user_id, username, first_name, last_name, gender))
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER,
+            name TEXT,
+            value INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, name)
+        )
+        ''')
+        cursor.execute(self.CHAT_STATS_TABLE)
+        cursor.execute('PRAGMA table_info(chat_stats)')
+        if 'chat_id' in {row[1] for row in cursor.fetchall()}:
+            self._migrate_chat_stats(conn)
+        # Граница старых сообщений фиксируется один раз, при создании таблиц статистики
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_backfill (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER,
+            upto INTEGER
+        )
+        ''')
+        cursor.execute('''
+        INSERT OR IGNORE INTO stats_backfill (id, last_id, upto)
+        SELECT 1, 0, COALESCE(MAX(message_id), 0) FROM messages
+        ''')
+        
+        self.fts_enabled = self._init_fts(cursor)
         
         conn.commit()
         conn.close()
     
-    def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница") -> str:
-        """Создание нового чата"""
-        chat_id = f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    CHAT_STATS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS chat_stats (
+        chat_key INTEGER,
+        day TEXT,
+        messages INTEGER DEFAULT 0,
+        empathy_sum INTEGER DEFAULT 0,
+        PRIMARY KEY (chat_key, day)
+    )
+    '''
+    
+    CHATS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        chat_key INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT UNIQUE NOT NULL,
+        user_id INTEGER,
+        chat_name TEXT,
+        scenario TEXT,
+        empathy_level INTEGER DEFAULT 35,
+        message_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_archived BOOLEAN DEFAULT FALSE,
+        scenario_prompt TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    '''
+    
+    # Тексты — TEXT или сжатый BLOB (см. _pack_text), эмоции — маска по словарю emotions
+    MESSAGES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {name} (
+        message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_key INTEGER,
+        user_id INTEGER,
+        message_text TEXT,
+        response_text TEXT,
+        is_ignored BOOLEAN DEFAULT FALSE,
+        emotions INTEGER,
+        empathy_level INTEGER,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        message_tokens BLOB,
+        response_tokens BLOB,
+        tokenizer_id TEXT,
+        FOREIGN KEY (chat_key) REFERENCES chats (chat_key),
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    '''
+    
+    def _migrate_compact(self, conn: sqlite3.Connection):
+        """Перевод messages в компактную запись: chat_key, маска эмоций, сжатые тексты
         
-        conn = sqlite3.connect(self.db_path)
+        Таблицы chats и messages пересоздаются одной транзакцией (message_id
+        сохраняются), полнотекстовый индекс строится заново, освободившиеся
+        страницы возвращаются incremental vacuum.
+        """
         cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
         
-        cursor.execute('''
-        INSERT INTO chats (chat_id, user_id, chat_name, scenario)
-        VALUES (?, ?, ?, ?)
-        ''', (chat_id, user_id, chat_name, scenario))
+        # Другой процесс мог перевести базу, пока мы ждали блокировку
+        cursor.execute('PRAGMA table_info(messages)')
+        if 'chat_id' not in {row[1] for row in cursor.fetchall()}:
+            conn.commit()
+            return
         
-        conn.commit()
-        conn.close()
+        cursor.execute('SELECT COUNT(*) FROM messages')
+        count = cursor.fetchone()[0]
+        logger.info(f"Перевод {count} сообщений в компактную запись…")
         
-        return chat_id
-    
+        for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        cursor.execute('DROP TABLE IF EXISTS messages_fts')
+        
+        # Маски для каждой встреченной строки эмоций
+        cursor.execute('SELECT DISTINCT emotion_analysis FROM messages WHERE emotion_analysis IS NOT NULL')
+        analyses = [row[0] for row in cursor.fetchall()]
+        self._insert_emotions(cursor, sorted({name.strip() for analysis in analyses
+                                              for name in analysis.split(',') if name.strip()}))
+        cursor.execute('SELECT name, bit FROM emotions')
+        bits = dict(cursor.fetchall())
+        cursor.execute('CREATE TEMP TABLE emotion_masks (emotion_analysis TEXT PRIMARY KEY, mask INTEGER)')
+        cursor.executemany('INSERT INTO temp.emotion_masks VALUES (?, ?)', [
+            (analysis, sum({1 << bits[name.strip()] for name in analysis.split(',') if name.strip() in bits}) or None)
+            for analysis in analyses
+        ])
+        
+        cursor.execute('PRAGMA table_info(chats)')
+        if 'chat_key' not in {row[1] for row in cursor.fetchall()}:
+            columns = "chat_id, user_id, chat_name, scenario, empathy_level, message_count, " \
+                      "created_at, last_activity, is_archived, scenario_prompt"
+            cursor.execute(self.CHATS_TABLE.format(name='chats_compact'))
+            cursor.execute(f'''
+            INSERT INTO chats_compact ({columns})
+            SELECT {columns} FROM chats ORDER BY created_at, chat_id
+            ''')
+            cursor.execute('DROP TABLE chats')
+            cursor.execute('ALTER TABLE chats_compact RENAME TO chats')
+        
+        # Номера сообщений не должны повторяться после удалённых последних
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+        sequence = cursor.fetchone()
+        
+        conn.create_function('odanna_pack', 1, self._pack_text)
+        cursor.execute(self.MESSAGES_TABLE.format(name='messages_compact'))
+        cursor.execute('''
+        INSERT INTO messages_compact
+        (message_id, chat_key, user_id, message_text, response_text, is_ignored, emotions, empathy_level,
+         timestamp, message_tokens, response_tokens, tokenizer_id)
+        SELECT m.message_id, c.chat_key, m.user_id, odanna_pack(m.message_text), odanna_pack(m.response_text),
+               m.is_ignored, e.mask, m.empathy_level, m.timestamp, m.message_tokens, m.response_tokens,
+               m.tokenizer_id
+        FROM messages m
+        LEFT JOIN chats c ON c.chat_id = m.chat_id
+        LEFT JOIN temp.emotion_masks e ON e.emotion_analysis = m.emotion_analysis
+        ORDER BY m.message_id
+        ''')
+        cursor.execute('DROP TABLE messages')
+        cursor.execute('ALTER TABLE messages_compact RENAME TO messages')
+        if sequence:
+            cursor.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'messages'", sequence)
+        cursor.execute('DROP TABLE temp.emotion_masks')
+        
+        conn.commit()
+        conn.executescript('PRAGMA incremental_vacuum')  # execute() освобождает лишь одну страницу
+        logger.info("Сообщения переведены в компактную запись")
+    
+    def _migrate_chat_stats(self, conn):
+        """Перевод chat_stats старой версии с ключа chat_id на chats.chat_key"""
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        
+        # Другой процесс мог перевести таблицу, пока мы ждали блокировку
+        cursor.execute('PRAGMA table_info(chat_stats)')
+        if 'chat_id' not in {row[1] for row in cursor.fetchall()}:
+            conn.commit()
+            return
+        
+        cursor.execute('ALTER TABLE chat_stats RENAME TO chat_stats_by_id')
+        cursor.execute(self.CHAT_STATS_TABLE)
+        cursor.execute('''
+        INSERT INTO chat_stats (chat_key, day, messages, empathy_sum)
+        SELECT c.chat_key, s.day, s.messages, s.empathy_sum
+        FROM chat_stats_by_id s JOIN chats c ON c.chat_id = s.chat_id
+        ''')
+        cursor.execute('DROP TABLE chat_stats_by_id')
+        conn.commit()
+    
+    @staticmethod
+    def _insert_emotions(cursor, names: List[str]):
+        """Новые названия эмоций — следующими свободными битами (в текущей транзакции)"""
+        for name in names:
+            cursor.execute('''
+            INSERT OR IGNORE INTO emotions (bit, name)
+            SELECT COALESCE(MAX(bit), -1) + 1, ? FROM emotions
+            HAVING COALESCE(MAX(bit), -1) + 1 < ?
+            ''', (name, EMOTION_BITS))
+            if cursor.rowcount == 0:
+                cursor.execute('SELECT 1 FROM emotions WHERE name = ?', (name,))
+                if cursor.fetchone() is None:
+                    logger.warning(f"Словарь эмоций заполнен, «{name}» не сохраняется")
+    
+    def _load_emotions(self):
+        """Перечитать словарь эмоций"""
+        conn = self._connect()
+        self.emotion_bits = dict(conn.execute('SELECT name, bit FROM emotions').fetchall())
+        conn.close()
+    
+    def _register_emotions(self, names: List[str]):
+        """Добавить в словарь новые названия эмоций и перечитать его"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        self._insert_emotions(cursor, names)
+        
+        conn.commit()
+        conn.close()
+        self._load_emotions()
+    
+    @staticmethod
+    def _ensure_column(cursor, table: str, column: str, definition: str):
+        """Добавление колонки в таблицу, созданную старой версией бота"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in {row[1] for row in cursor.fetchall()}:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    
+    def _init_fts(self, cursor) -> bool:
+        """Создание полнотекстового индекса FTS5"""
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+            fts_exists = cursor.fetchone() is not None
+            
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                scope, message_text, response_text,
+                content='', tokenize='unicode61 remove_diacritics 2'
+            )
+            ''')
+            
+            # Триггеры прежних версий вызывали odanna_text (см. _index_messages)
+            for trigger in ('messages_fts_insert', 'messages_fts_delete', 'messages_fts_update'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            
+            # Индексируем сообщения, сохранённые до появления FTS
+            if not fts_exists:
+                cursor.executemany(FTS_INSERT_SQL, (
+                    _fts_row(*row) for row in cursor.connection.execute(FTS_ROW_SQL)
+                ))
+            
+            return True
+            
+        except sqlite3.OperationalError as e:
+            logger.warning(f"FTS5 недоступен, поиск будет работать без индекса: {e}")
+            return False
+    
+    def _index_messages(self, cursor, condition: str, params: Tuple, delete: bool = False):
+        """Добавить в FTS-индекс реплики messages, выбранные условием, или убрать их оттуда
+        
+        Вызывается в транзакции записи: после вставки или до удаления строк.
+        """
+        if self.fts_enabled:
+            cursor.execute(f'{FTS_ROW_SQL} WHERE {condition}', params)
+            cursor.executemany(FTS_DELETE_SQL if delete else FTS_INSERT_SQL,
+                               [_fts_row(*row) for row in cursor.fetchall()])
+    
+    @staticmethod
+    def _fts_terms(text: str) -> List[str]:
+        """Термы запроса FTS5: слова текста с поиском по префиксу"""
+        return [f'"{word}"*' for word in StorageBackend._search_words(text)]
+    
+    @staticmethod
+    def _fts_chat_scope(chat_key: int) -> str:
+        """Токен scope для ограничения поиска одним чатом"""
+        return f"c{int(chat_key)}"
+    
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None, gender: str = 'unknown'):
+        """Добавление или обновление пользователя"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        INSERT OR REPLACE INTO users 
+        (user_id, username, first_name, last_name, gender, last_activity)
+        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', (user_id, username, first_name, last_name, gender))
+        
+        conn.commit()
+        conn.close()
+    
+    def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница",
+                    scenario_prompt: Optional[str] = None) -> str:
+        """Создание нового чата
+        
+        chat_id — «<user_id>_<время до секунды>»; второй чат за ту же секунду
+        получает суффикс _2, третий — _3 и так далее. scenario_prompt —
+        описание пользовательского сценария.
+        """
+        base_id = f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        for attempt in itertools.count(1):
+            chat_id = base_id if attempt == 1 else f"{base_id}_{attempt}"
+            cursor.execute('''
+            INSERT OR IGNORE INTO chats (chat_id, user_id, chat_name, scenario, scenario_prompt)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, user_id, chat_name, scenario, scenario_prompt))
+            if cursor.rowcount:
+                break
+        
+        conn.commit()
+        conn.close()
+        
+        return chat_id
+    
     def get_user_chats(self, user_id: int) -> List[Tuple]:
         """Получение списка чатов пользователя"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -183,17 +1545,74 @@ class DatabaseManager:
         
         return chats
     
+    def get_user_chats_page(self, user_id: int, limit: int = 10, cursor: Optional[Tuple[str, str]] = None,
+                            backward: bool = False) -> Tuple[List[Tuple], bool, bool]:
+        """Страница списка чатов пользователя (keyset-пагинация по (last_activity, chat_id))
+        
+        cursor — (last_activity, chat_id) крайнего чата соседней страницы.
+        Возвращает (чаты, есть_предыдущая, есть_следующая).
+        """
+        conn = self._connect()
+        cursor_db = conn.cursor()
+        
+        if cursor is None:
+            cursor_db.execute('''
+            SELECT chat_id, chat_name, scenario, message_count, last_activity
+            FROM chats 
+            WHERE user_id = ?
+            ORDER BY last_activity DESC, chat_id DESC
+            LIMIT ?
+            ''', (user_id, limit + 1))
+        elif not backward:
+            cursor_db.execute('''
+            SELECT chat_id, chat_name, scenario, message_count, last_activity
+            FROM chats 
+            WHERE user_id = ? AND (last_activity, chat_id) < (?, ?)
+            ORDER BY last_activity DESC, chat_id DESC
+            LIMIT ?
+            ''', (user_id, cursor[0], cursor[1], limit + 1))
+        else:
+            cursor_db.execute('''
+            SELECT chat_id, chat_name, scenario, message_count, last_activity
+            FROM chats 
+            WHERE user_id = ? AND (last_activity, chat_id) > (?, ?)
+            ORDER BY last_activity ASC, chat_id ASC
+            LIMIT ?
+            ''', (user_id, cursor[0], cursor[1], limit + 1))
+        
+        chats = cursor_db.fetchall()
+        conn.close()
+        
+        has_more = len(chats) > limit
+        chats = chats[:limit]
+        
+        if backward:
+            return list(reversed(chats)), has_more, True
+        return chats, cursor is not None, has_more
+    
     def add_message(self, chat_id: str, user_id: int, message_text: str, response_text: str = None, 
-                   emotion_analysis: str = None, empathy_level: int = 35):
-        """Добавление сообщения в чат"""
-        conn = sqlite3.connect(self.db_path)
+                   emotion_analysis: str = None, empathy_level: int = 35,
+                   message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                   tokenizer_id: Optional[str] = None) -> int:
+        """Добавление сообщения в чат. Возвращает message_id
+        
+        Токены реплик (если переданы) сохраняются вместе с текстом, чтобы
+        не токенизировать историю заново при каждом ответе.
+        """
+        emotions = self._emotion_mask(emotion_analysis)
+        
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
+        cursor.execute(f'''
         INSERT INTO messages 
-        (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ''', (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level))
+        (chat_key, user_id, message_text, response_text, emotions, empathy_level,
+         message_tokens, response_tokens, tokenizer_id)
+        VALUES ({CHAT_KEY_SQL}, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (chat_id, user_id, self._pack_text(message_text), self._pack_text(response_text), emotions,
+              empathy_level, _pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id))
+        message_id = cursor.lastrowid
+        self._index_messages(cursor, 'message_id = ?', (message_id,))
         
         # Обновляем счетчик сообщений в чате
         cursor.execute('''
@@ -201,20 +1620,24 @@ class DatabaseManager:
         SET message_count = message_count + 1, last_activity = CURRENT_TIMESTAMP
         WHERE chat_id = ?
         ''', (chat_id,))
+        self._add_stats(cursor, [(chat_id, user_id, emotion_analysis, empathy_level, datetime.now(timezone.utc))])
         
         conn.commit()
         conn.close()
+        
+        return message_id
     
     def get_chat_history(self, chat_id: str, limit: int = 20) -> List[Tuple]:
         """Получение истории чата"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-        SELECT message_text, response_text, is_ignored, emotion_analysis, timestamp
+        cursor.execute(f'''
+        SELECT {TEXT_SQL.format(column='message_text')}, {TEXT_SQL.format(column='response_text')}, is_ignored,
+               {EMOTION_TEXT_SQL.format(mask='emotions')}, timestamp
         FROM messages 
-        WHERE chat_id = ? 
-        ORDER BY timestamp DESC 
+        WHERE chat_key = {CHAT_KEY_SQL}
+        ORDER BY message_id DESC 
         LIMIT ?
         ''', (chat_id, limit))
         
@@ -223,104 +1646,2726 @@ class DatabaseManager:
         
         return list(reversed(messages))
     
-    def ignore_message(self, chat_id: str, message_text: str):
-        """Пометить сообщение как игнорируемое"""
-        conn = sqlite3.connect(self.db_path)
+    def get_history_turns(self, chat_id: str, limit: int, tokenizer_id: Optional[str] = None) -> List[Tuple]:
+        """Последние реплики чата для контекста генерации вместе с кэшем токенов
+        
+        Возвращает хронологически (message_id, текст, ответ, игнорируется,
+        токены сообщения, токены ответа). Токены None, если они не сохранены
+        или получены другим токенизатором.
+        """
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('''
-        UPDATE messages 
-        SET is_ignored = TRUE 
-        WHERE chat_id = ? AND message_text = ?
-        ORDER BY timestamp DESC LIMIT 1
-        ''', (chat_id, message_text))
+        cursor.execute(f'''
+        SELECT message_id, {TEXT_SQL.format(column='message_text')}, {TEXT_SQL.format(column='response_text')}, is_ignored,
+               message_tokens, response_tokens, tokenizer_id
+        FROM messages 
+        WHERE chat_key = {CHAT_KEY_SQL}
+        ORDER BY message_id DESC 
+        LIMIT ?
+        ''', (chat_id, limit))
+        
+        rows = cursor.fetchall()
+        conn.close()
+        
+        turns = []
+        for message_id, text, response, is_ignored, message_tokens, response_tokens, row_tokenizer in reversed(rows):
+            if tokenizer_id is None or row_tokenizer != tokenizer_id:
+                message_tokens = response_tokens = None
+            turns.append((message_id, text, response, is_ignored,
+                          _unpack_tokens(message_tokens), _unpack_tokens(response_tokens)))
+        return turns
+    
+    def set_message_tokens(self, tokens: List[Tuple[int, List[int], Optional[List[int]]]], tokenizer_id: str):
+        """Сохранение токенов для реплик, записанных без них (старые сообщения,
+        смена модели). tokens — список (message_id, токены сообщения, токены ответа)
+        """
+        if not tokens:
+            return
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.executemany('''
+        UPDATE messages SET message_tokens = ?, response_tokens = ?, tokenizer_id = ?
+        WHERE message_id = ?
+        ''', [
+            (_pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id, message_id)
+            for message_id, message_tokens, response_tokens in tokens
+        ])
+        
+        conn.commit()
+        conn.close()
+    
+    def get_response_lengths(self, limit: int = 1000) -> List[int]:
+        """Длины последних принятых (не забытых) ответов в символах"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+        SELECT length({TEXT_SQL.format(column='response_text')})
+        FROM messages 
+        WHERE response_text IS NOT NULL AND NOT is_ignored
+        ORDER BY message_id DESC 
+        LIMIT ?
+        ''', (limit,))
+        
+        lengths = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        return lengths
+    
+    def get_chat_messages_page(self, chat_id: str, limit: int = 5, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None) -> Tuple[List[Tuple], bool, bool]:
+        """Страница истории чата (keyset-пагинация по message_id)
+        
+        Без курсоров возвращает самую новую страницу. Сообщения упорядочены
+        хронологически. Возвращает (сообщения, есть_старше, есть_новее).
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        columns = f"message_id, {TEXT_SQL.format(column='message_text')}, {TEXT_SQL.format(column='response_text')}, is_ignored, " \
+                  f"{EMOTION_TEXT_SQL.format(mask='emotions')}, timestamp"
+        
+        if after_id is not None:
+            cursor.execute(f'''
+            SELECT {columns}
+            FROM messages 
+            WHERE chat_key = {CHAT_KEY_SQL} AND message_id > ?
+            ORDER BY message_id ASC 
+            LIMIT ?
+            ''', (chat_id, after_id, limit + 1))
+        elif before_id is not None:
+            cursor.execute(f'''
+            SELECT {columns}
+            FROM messages 
+            WHERE chat_key = {CHAT_KEY_SQL} AND message_id < ?
+            ORDER BY message_id DESC 
+            LIMIT ?
+            ''', (chat_id, before_id, limit + 1))
+        else:
+            cursor.execute(f'''
+            SELECT {columns}
+            FROM messages 
+            WHERE chat_key = {CHAT_KEY_SQL}
+            ORDER BY message_id DESC 
+            LIMIT ?
+            ''', (chat_id, limit + 1))
+        
+        messages = cursor.fetchall()
+        conn.close()
+        
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        
+        if after_id is not None:
+            return messages, True, has_more
+        return list(reversed(messages)), has_more, before_id is not None
+    
+    def forget_last_message(self, chat_id: str) -> Optional[int]:
+        """Забыть последнее ещё не забытое сообщение чата
+        
+        Выбор и пометка выполняются в одной транзакции, поэтому
+        параллельные вызовы забывают разные сообщения.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute(f'''
+        SELECT message_id FROM messages 
+        WHERE chat_key = {CHAT_KEY_SQL} AND NOT is_ignored
+        ORDER BY message_id DESC 
+        LIMIT 1
+        ''', (chat_id,))
+        result = cursor.fetchone()
+        
+        if result:
+            cursor.execute('UPDATE messages SET is_ignored = TRUE WHERE message_id = ?', result)
         
         conn.commit()
         conn.close()
+        
+        return result[0] if result else None
     
-    def unignore_message(self, chat_id: str, message_text: str):
-        """Убрать пометку игнорирования сообщения"""
-        conn = sqlite3.connect(self.db_path)
+    def _set_message_ignored(self, message_id: int, ignored: bool, user_id: Optional[int] = None,
+                             chat_id: Optional[str] = None) -> Optional[str]:
+        """Смена флага is_ignored одного сообщения по первичному ключу
+        
+        user_id/chat_id ограничивают изменение сообщениями владельца или чата.
+        Возвращает chat_id, если флаг действительно изменился.
+        """
+        conn = self._connect()
         cursor = conn.cursor()
         
+        cursor.execute('BEGIN IMMEDIATE')
         cursor.execute('''
-        UPDATE messages 
-        SET is_ignored = FALSE 
-        WHERE chat_id = ? AND message_text = ?
-        ''', (chat_id, message_text))
+        SELECT c.chat_id FROM messages m
+        JOIN chats c ON c.chat_key = m.chat_key
+        WHERE m.message_id = ? AND m.is_ignored = ?
+          AND (? IS NULL OR m.user_id = ?) AND (? IS NULL OR c.chat_id = ?)
+        ''', (message_id, not ignored, user_id, user_id, chat_id, chat_id))
+        result = cursor.fetchone()
+        
+        if result:
+            cursor.execute('''
+            UPDATE messages 
+            SET is_ignored = ? 
+            WHERE message_id = ?
+            ''', (ignored, message_id))
         
         conn.commit()
         conn.close()
+        
+        return result[0] if result else None
+    
+    def search_messages(self, user_id: int, query: str, limit: int = 5,
+                        offset: int = 0) -> Tuple[List[Tuple], bool]:
+        """Ранжированный полнотекстовый поиск по истории пользователя
+        
+        Возвращает (результаты, есть_ещё); результат —
+        (message_id, chat_id, chat_name, message_text, response_text, timestamp).
+        """
+        terms = self._fts_terms(query)
+        if not terms:
+            return [], False
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        # «%» и «_» в запросе — обычные символы, а не шаблон LIKE
+        pattern = "%" + re.sub(r'([\\%_])', r'\\\1', query) + "%"
+        
+        if self.fts_enabled:
+            match = f"scope:u{int(user_id)} AND ({' AND '.join(terms)})"
+            cursor.execute(f'''
+            SELECT m.message_id, c.chat_id, c.chat_name, {TEXT_SQL.format(column='m.message_text')}, {TEXT_SQL.format(column='m.response_text')},
+                   m.timestamp
+            FROM messages_fts
+            JOIN messages m ON m.message_id = messages_fts.rowid
+            JOIN chats c ON c.chat_key = m.chat_key
+            WHERE messages_fts MATCH ? AND NOT m.is_ignored
+            ORDER BY bm25(messages_fts, 0.0, 2.0, 1.0), m.message_id DESC
+            LIMIT ? OFFSET ?
+            ''', (match, limit + 1, offset))
+        else:
+            cursor.execute(f'''
+            SELECT m.message_id, c.chat_id, c.chat_name, {TEXT_SQL.format(column='m.message_text')}, {TEXT_SQL.format(column='m.response_text')},
+                   m.timestamp
+            FROM messages m
+            JOIN chats c ON c.chat_key = m.chat_key
+            WHERE m.user_id = ? AND NOT m.is_ignored
+              AND ({TEXT_SQL.format(column='m.message_text')} LIKE ? ESCAPE '\\'
+                   OR {TEXT_SQL.format(column='m.response_text')} LIKE ? ESCAPE '\\')
+            ORDER BY m.message_id DESC
+            LIMIT ? OFFSET ?
+            ''', (user_id, pattern, pattern, limit + 1, offset))
+        
+        results = cursor.fetchall()
+        conn.close()
+        
+        return results[:limit], len(results) > limit
+    
+    def find_message_id(self, chat_id: str, message_text: str, ignored: bool = False) -> Optional[int]:
+        """Поиск сообщения пользователя по неточному тексту (для «забудь»)
+        
+        Точное совпадение важнее ранга; среди равных выигрывает самое новое.
+        В сообщении должны быть все слова текста: совпадение по одному слову
+        забыло бы постороннюю реплику, поэтому тогда — None.
+        ignored=True ищет среди уже забытых сообщений.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT chat_key FROM chats WHERE chat_id = ?', (chat_id,))
+        chat = cursor.fetchone()
+        if not chat:
+            conn.close()
+            return None
+        
+        terms = self._fts_terms(message_text)
+        candidates = []
+        
+        if self.fts_enabled and terms:
+            scope = self._fts_chat_scope(chat[0])
+            cursor.execute(f'''
+            SELECT m.message_id, {TEXT_SQL.format(column='m.message_text')}
+            FROM messages_fts
+            JOIN messages m ON m.message_id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND m.is_ignored = ?
+            ORDER BY bm25(messages_fts, 0.0, 1.0, 0.0), m.message_id DESC
+            LIMIT 20
+            ''', (f"scope:{scope} AND message_text:({' AND '.join(terms)})", ignored))
+            candidates = cursor.fetchall()
+        else:
+            cursor.execute(f'''
+            SELECT message_id, {TEXT_SQL.format(column='message_text')}
+            FROM messages 
+            WHERE chat_key = ? AND {TEXT_SQL.format(column='message_text')} = ? AND is_ignored = ?
+            ORDER BY message_id DESC
+            LIMIT 1
+            ''', (chat[0], message_text, ignored))
+            candidates = cursor.fetchall()
+        
+        conn.close()
+        
+        if not candidates:
+            return None
+        
+        wanted = message_text.strip().lower()
+        exact = [message_id for message_id, text in candidates if (text or '').strip().lower() == wanted]
+        return max(exact) if exact else candidates[0][0]
+    
+    def get_messages_by_ids(self, chat_id: str, message_ids: List[int]) -> List[Tuple]:
+        """Незабытые сообщения чата по списку ID в порядке этого списка
+        
+        Возвращает (message_id, message_text, response_text).
+        """
+        if not message_ids:
+            return []
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        placeholders = ", ".join("?" * len(message_ids))
+        cursor.execute(f'''
+        SELECT message_id, {TEXT_SQL.format(column='message_text')}, {TEXT_SQL.format(column='response_text')}
+        FROM messages 
+        WHERE message_id IN ({placeholders}) AND chat_key = {CHAT_KEY_SQL} AND NOT is_ignored
+        ''', (*message_ids, chat_id))
+        
+        rows = {row[0]: row for row in cursor.fetchall()}
+        conn.close()
+        
+        return [rows[message_id] for message_id in message_ids if message_id in rows]
     
     def delete_chat(self, chat_id: str):
         """Удаление чата и всех его сообщений"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect_archive()
         cursor = conn.cursor()
         
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        cursor.execute('BEGIN IMMEDIATE')
+        self._index_messages(cursor, f'chat_key = {CHAT_KEY_SQL}', (chat_id,), delete=True)
+        cursor.execute(f'DELETE FROM messages WHERE chat_key = {CHAT_KEY_SQL}', (chat_id,))
+        cursor.execute(f'DELETE FROM current_chats WHERE chat_key = {CHAT_KEY_SQL}', (chat_id,))
+        cursor.execute(f'DELETE FROM chat_stats WHERE chat_key = {CHAT_KEY_SQL}', (chat_id,))
         cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+        cursor.execute('DELETE FROM archive.archived_chats WHERE chat_id = ?', (chat_id,))
+        
+        conn.commit()
+        conn.close()
+    
+    def _connect_archive(self) -> sqlite3.Connection:
+        """Соединение с основной базой и подключённым архивом (схема archive)"""
+        conn = self._connect()
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS archive.archived_chats (
+            chat_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            message_count INTEGER,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            payload BLOB
+        )
+        ''')
+        return conn
+    
+    def archive_chat(self, chat_id: str) -> int:
+        """Перенос сообщений чата в сжатый архив. Возвращает число перенесённых сообщений
+        
+        Основная база и архив фиксируются по очереди (в режиме WAL транзакция
+        не атомарна между файлами): сначала запись в архив, затем удаление.
+        Сбой между шагами оставляет копию в обеих базах, а не потерю данных.
+        Удаляются только попавшие в архив сообщения: реплика, сохранённая
+        между шагами, остаётся в основной базе и сливается с архивом при
+        восстановлении.
+        """
+        conn = self._connect_archive()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT user_id, chat_key FROM chats WHERE chat_id = ? AND NOT is_archived', (chat_id,))
+        chat = cursor.fetchone()
+        if not chat:
+            conn.close()
+            return 0
+        
+        cursor.execute('SELECT * FROM messages WHERE chat_key = ? ORDER BY message_id', (chat[1],))
+        keep = [i for i, column in enumerate(cursor.description) if column[0] not in TOKEN_CACHE_COLUMNS]
+        columns = [cursor.description[i][0] for i in keep]
+        rows = [tuple(row[i] for i in keep) for row in cursor.fetchall()]
+        last_id = rows[-1][columns.index('message_id')] if rows else 0
+        
+        cursor.execute('''
+        INSERT OR REPLACE INTO archive.archived_chats (chat_id, user_id, message_count, payload)
+        VALUES (?, ?, ?, ?)
+        ''', (chat_id, chat[0], len(rows), self._pack_rows(columns, rows)))
+        conn.commit()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        self._index_messages(cursor, 'chat_key = ? AND message_id <= ?', (chat[1], last_id), delete=True)
+        cursor.execute('DELETE FROM messages WHERE chat_key = ? AND message_id <= ?', (chat[1], last_id))
+        cursor.execute('UPDATE chats SET is_archived = TRUE WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        conn.close()
+        
+        return len(rows)
+    
+    def restore_chat(self, chat_id: str) -> bool:
+        """Возврат архивного чата в основную базу; для активного чата — одна проверка по ключу"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT is_archived, chat_key FROM chats WHERE chat_id = ?', (chat_id,))
+        chat = cursor.fetchone()
+        conn.close()
+        
+        if not chat or not chat[0]:
+            return False
+        
+        conn = self._connect_archive()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT payload FROM archive.archived_chats WHERE chat_id = ?', (chat_id,))
+        archived = cursor.fetchone()
+        
+        if archived:
+            columns, rows = self._archived_messages(archived[0], chat[1])
+            
+            # Колонки, которых уже нет в схеме, пропускаем
+            cursor.execute('PRAGMA main.table_info(messages)')
+            known = {row[1] for row in cursor.fetchall()}
+            positions = [i for i, column in enumerate(columns) if column in known]
+            names = ", ".join(columns[i] for i in positions)
+            placeholders = ", ".join("?" * len(positions))
+            
+            # Реплики, уже бывшие в основной базе, не пропускаются INSERT OR IGNORE:
+            # чат переиндексируется целиком
+            cursor.execute('BEGIN IMMEDIATE')
+            self._index_messages(cursor, 'chat_key = ?', (chat[1],), delete=True)
+            cursor.executemany(
+                f'INSERT OR IGNORE INTO messages ({names}) VALUES ({placeholders})',
+                ([row[i] for i in positions] for row in rows)
+            )
+            self._index_messages(cursor, 'chat_key = ?', (chat[1],))
+        
+        cursor.execute('UPDATE chats SET is_archived = FALSE WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        
+        cursor.execute('DELETE FROM archive.archived_chats WHERE chat_id = ?', (chat_id,))
+        conn.commit()
+        conn.close()
+        
+        logger.info(f"Чат {chat_id} восстановлен из архива")
+        return True
+    
+    def archive_inactive_chats(self, inactive_days: int = ARCHIVE_AFTER_DAYS) -> int:
+        """Архивация чатов без активности дольше inactive_days. Возвращает число чатов"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT chat_id FROM chats 
+        WHERE NOT is_archived AND last_activity < datetime('now', ?)
+        ''', (f'-{int(inactive_days)} days',))
+        chat_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        
+        # Каждый чат — отдельная короткая транзакция, чтобы не держать блокировку
+        for chat_id in chat_ids:
+            self.archive_chat(chat_id)
+        
+        return len(chat_ids)
+    
+    def purge_expired_archives(self, retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+        """Удаление архивных чатов без активности дольше срока хранения"""
+        conn = self._connect_archive()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        SELECT chat_id FROM chats 
+        WHERE is_archived AND last_activity < datetime('now', ?)
+        ''', (f'-{int(retention_days)} days',))
+        chat_ids = [row[0] for row in cursor.fetchall()]
+        
+        cursor.executemany('DELETE FROM archive.archived_chats WHERE chat_id = ?', ((c,) for c in chat_ids))
+        conn.commit()
+        cursor.executemany(f'DELETE FROM chat_stats WHERE chat_key = {CHAT_KEY_SQL}', ((c,) for c in chat_ids))
+        cursor.executemany('DELETE FROM chats WHERE chat_id = ?', ((c,) for c in chat_ids))
+        conn.commit()
+        conn.close()
+        
+        return len(chat_ids)
+    
+    def run_archive_maintenance(self, inactive_days: int = ARCHIVE_AFTER_DAYS,
+                                retention_days: int = ARCHIVE_RETENTION_DAYS):
+        """Плановое обслуживание: архивация, очистка по сроку хранения, incremental vacuum"""
+        archived = self.archive_inactive_chats(inactive_days) if inactive_days > 0 else 0
+        purged = self.purge_expired_archives(retention_days) if retention_days > 0 else 0
+        
+        conn = self._connect_archive()
+        conn.executescript('PRAGMA main.incremental_vacuum')
+        if purged:
+            # Холодный архив сжимаем целиком: он невелик и редко читается
+            conn.execute('VACUUM archive')
+        conn.close()
+        
+        logger.info(f"Архивация: перенесено чатов {archived}, удалено по сроку хранения {purged}")
+        return archived, purged
+    
+    def ping(self):
+        """Проверка доступности базы"""
+        conn = self._connect()
+        conn.execute('SELECT 1').fetchone()
+        conn.close()
+    
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.db_path)
+    
+    def get_chat_owner(self, chat_id: str) -> Optional[int]:
+        """user_id владельца чата; None — чата нет"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT user_id FROM chats WHERE chat_id = ?', (chat_id,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result[0] if result else None
+    
+    def get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя; None — не выбран или удалён"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        SELECT c.chat_id FROM current_chats cc JOIN chats c ON c.chat_key = cc.chat_key
+        WHERE cc.user_id = ?
+        ''', (user_id,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result[0] if result else None
+    
+    def set_current_chat(self, user_id: int, chat_id: str) -> Optional[str]:
+        """Сделать чат активным (видно всем узлам бота); возвращает прежний активный чат"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+        SELECT c.chat_id FROM current_chats cc JOIN chats c ON c.chat_key = cc.chat_key
+        WHERE cc.user_id = ?
+        ''', (user_id,))
+        previous = cursor.fetchone()
+        cursor.execute('''
+        INSERT INTO current_chats (user_id, chat_key)
+        SELECT ?, chat_key FROM chats WHERE chat_id = ?
+        ON CONFLICT (user_id) DO UPDATE SET chat_key = excluded.chat_key
+        ''', (user_id, chat_id))
         
         conn.commit()
         conn.close()
+        return previous[0] if previous else None
     
     def get_chat_empathy_level(self, chat_id: str) -> int:
         """Получение уровня эмпатии для чата"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('SELECT empathy_level FROM chats WHERE chat_id = ?', (chat_id,))
         result = cursor.fetchone()
         conn.close()
         
-        return result[0] if result else 35
+        return result[0] if result else 35
+    
+    def get_chat_scenario(self, chat_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Название и описание сценария чата; None — чата нет"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT scenario, scenario_prompt FROM chats WHERE chat_id = ?', (chat_id,))
+        result = cursor.fetchone()
+        conn.close()
+        
+        return result
+    
+    def set_chat_scenario(self, chat_id: str, scenario: str, scenario_prompt: Optional[str]) -> bool:
+        """Замена сценария чата; False — чата нет"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        UPDATE chats
+        SET scenario = ?, scenario_prompt = ?
+        WHERE chat_id = ?
+        ''', (scenario, scenario_prompt, chat_id))
+        updated = cursor.rowcount > 0
+        
+        conn.commit()
+        conn.close()
+        
+        return updated
+    
+    def add_pooled_response(self, intent: str, empathy_bucket: int, scenario: str, response_text: str):
+        """Сохранение заготовленного ответа в пул"""
+        conn = self._connect()
+        conn.execute('''
+        INSERT INTO response_pool (intent, empathy_bucket, scenario, response_text)
+        VALUES (?, ?, ?, ?)
+        ''', (intent, empathy_bucket, scenario, response_text))
+        conn.commit()
+        conn.close()
+    
+    def take_pooled_response(self, intent: str, empathy_bucket: int, scenario: str,
+                             ttl_hours: int = POOL_TTL_HOURS,
+                             max_serves: int = POOL_MAX_SERVES) -> Optional[Tuple[str, float]]:
+        """Случайная свежая заготовка и её возраст в секундах
+        
+        Выбор и учёт показа выполняются в одной транзакции; заготовка,
+        показанная max_serves раз, удаляется, и простой пополнит пул новой.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+        SELECT pool_id, response_text, served_count,
+               (julianday('now') - julianday(created_at)) * 86400
+        FROM response_pool
+        WHERE intent = ? AND empathy_bucket = ? AND scenario = ? AND created_at >= datetime('now', ?)
+        ORDER BY random()
+        LIMIT 1
+        ''', (intent, empathy_bucket, scenario, f'-{int(ttl_hours)} hours'))
+        result = cursor.fetchone()
+        
+        if result:
+            pool_id, _, served_count, _ = result
+            if served_count + 1 >= max_serves:
+                cursor.execute('DELETE FROM response_pool WHERE pool_id = ?', (pool_id,))
+            else:
+                cursor.execute('UPDATE response_pool SET served_count = served_count + 1 WHERE pool_id = ?',
+                               (pool_id,))
+        
+        conn.commit()
+        conn.close()
+        
+        return (result[1], max(0.0, result[3])) if result else None
+    
+    def count_pooled_responses(self, ttl_hours: int = POOL_TTL_HOURS) -> Dict[Tuple[str, int, str], int]:
+        """Число свежих заготовок по ячейкам (намерение, эмпатия, сценарий)"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        SELECT intent, empathy_bucket, scenario, COUNT(*) FROM response_pool
+        WHERE created_at >= datetime('now', ?)
+        GROUP BY intent, empathy_bucket, scenario
+        ''', (f'-{int(ttl_hours)} hours',))
+        counts = {(intent, bucket, scenario): count for intent, bucket, scenario, count in cursor.fetchall()}
+        conn.close()
+        
+        return counts
+    
+    def purge_stale_pool(self, ttl_hours: int = POOL_TTL_HOURS) -> int:
+        """Удаление устаревших заготовок. Возвращает число удалённых"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        DELETE FROM response_pool WHERE created_at < datetime('now', ?)
+        ''', (f'-{int(ttl_hours)} hours',))
+        deleted = cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        
+        return deleted
+    
+    def is_update_processed(self, update_id: int) -> bool:
+        """Сохранён ли уже ответ на обновление Telegram"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1 FROM processed_updates WHERE update_id = ?', (update_id,))
+        processed = cursor.fetchone() is not None
+        conn.close()
+        return processed
+    
+    def add_reply(self, update_id: int, telegram_chat_id: int, chat_id: str, user_id: int, message_text: str,
+                  response_text: str, emotion_analysis: str, empathy_level: int,
+                  message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                  tokenizer_id: Optional[str] = None,
+                  lease_seconds: int = OUTBOX_LEASE_SECONDS) -> Optional[Tuple[int, int]]:
+        """Реплика, отметка обновления и исходящий ответ одной транзакцией (см. StorageBackend)"""
+        emotions = self._emotion_mask(emotion_analysis)
+        
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('INSERT OR IGNORE INTO processed_updates (update_id) VALUES (?)', (update_id,))
+        if cursor.rowcount == 0:
+            conn.rollback()
+            conn.close()
+            return None
+        
+        cursor.execute(f'''
+        INSERT INTO messages 
+        (chat_key, user_id, message_text, response_text, emotions, empathy_level,
+         message_tokens, response_tokens, tokenizer_id)
+        VALUES ({CHAT_KEY_SQL}, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (chat_id, user_id, self._pack_text(message_text), self._pack_text(response_text), emotions,
+              empathy_level, _pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id))
+        message_id = cursor.lastrowid
+        self._index_messages(cursor, 'message_id = ?', (message_id,))
+        
+        cursor.execute('''
+        UPDATE chats 
+        SET message_count = message_count + 1, last_activity = CURRENT_TIMESTAMP, empathy_level = ?
+        WHERE chat_id = ?
+        ''', (empathy_level, chat_id))
+        self._add_stats(cursor, [(chat_id, user_id, emotion_analysis, empathy_level, datetime.now(timezone.utc))])
+        
+        cursor.execute('''
+        INSERT INTO outbox (telegram_chat_id, message_id, response_text, attempts, locked_until)
+        VALUES (?, ?, ?, 1, datetime('now', ?))
+        ''', (telegram_chat_id, message_id, response_text, f'+{int(lease_seconds)} seconds'))
+        outbox_id = cursor.lastrowid
+        
+        conn.commit()
+        conn.close()
+        
+        return message_id, outbox_id
+    
+    def claim_outbox(self, limit: int = 20, lease_seconds: int = OUTBOX_LEASE_SECONDS,
+                     max_attempts: int = OUTBOX_MAX_ATTEMPTS) -> List[Tuple[int, int, int, str]]:
+        """Неотправленные ответы для досылки; каждый закрепляется на lease_seconds"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+        SELECT outbox_id, telegram_chat_id, message_id, response_text
+        FROM outbox
+        WHERE sent_at IS NULL AND attempts < ? AND (locked_until IS NULL OR locked_until <= datetime('now'))
+        ORDER BY outbox_id
+        LIMIT ?
+        ''', (max_attempts, limit))
+        rows = cursor.fetchall()
+        
+        cursor.executemany('''
+        UPDATE outbox SET attempts = attempts + 1, locked_until = datetime('now', ?)
+        WHERE outbox_id = ?
+        ''', ((f'+{int(lease_seconds)} seconds', row[0]) for row in rows))
+        
+        conn.commit()
+        conn.close()
+        
+        return rows
+    
+    def mark_outbox_sent(self, outbox_id: int):
+        """Ответ доставлен в Telegram"""
+        conn = self._connect()
+        conn.execute('UPDATE outbox SET sent_at = CURRENT_TIMESTAMP WHERE outbox_id = ?', (outbox_id,))
+        conn.commit()
+        conn.close()
+    
+    def purge_delivery_log(self, keep_days: int = UPDATE_DEDUP_DAYS) -> int:
+        """Удаление старых отметок обновлений и завершённых ответов outbox"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        since = f'-{int(keep_days)} days'
+        cursor.execute('DELETE FROM processed_updates WHERE processed_at < datetime(\'now\', ?)', (since,))
+        deleted = cursor.rowcount
+        cursor.execute('''
+        DELETE FROM outbox
+        WHERE created_at < datetime('now', ?) AND (sent_at IS NOT NULL OR attempts >= ?)
+        ''', (since, OUTBOX_MAX_ATTEMPTS))
+        deleted += cursor.rowcount
+        
+        conn.commit()
+        conn.close()
+        
+        return deleted
+    
+    def add_inbox(self, update_id: int, payload: str, owner: str):
+        """Запомнить принятое сообщение до окончания его обработки"""
+        conn = self._connect()
+        conn.execute('''
+        INSERT INTO inbox (update_id, payload, owner) VALUES (?, ?, ?)
+        ON CONFLICT (update_id) DO UPDATE SET owner = excluded.owner, received_at = CURRENT_TIMESTAMP
+        ''', (update_id, payload, owner))
+        conn.commit()
+        conn.close()
+    
+    def remove_inbox(self, update_id: int):
+        conn = self._connect()
+        conn.execute('DELETE FROM inbox WHERE update_id = ?', (update_id,))
+        conn.commit()
+        conn.close()
+    
+    def release_inbox(self, owner: str) -> int:
+        """Отдать необработанные сообщения экземпляра другим экземплярам"""
+        conn = self._connect()
+        released = conn.execute('UPDATE inbox SET owner = NULL WHERE owner = ?', (owner,)).rowcount
+        conn.commit()
+        conn.close()
+        return released
+    
+    def claim_inbox(self, owner: str, stale_seconds: int = INBOX_STALE_SECONDS,
+                    limit: int = 100) -> List[Tuple[int, str]]:
+        """Забрать отданные сообщения и сообщения экземпляров, пропавших без остановки"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''
+        SELECT update_id, payload FROM inbox
+        WHERE owner IS NULL OR received_at < datetime('now', ?)
+        ORDER BY update_id
+        LIMIT ?
+        ''', (f'-{int(stale_seconds)} seconds', limit))
+        rows = cursor.fetchall()
+        cursor.executemany('''
+        UPDATE inbox SET owner = ?, received_at = CURRENT_TIMESTAMP WHERE update_id = ?
+        ''', ((owner, update_id) for update_id, _ in rows))
+        
+        conn.commit()
+        conn.close()
+        
+        return rows
+    
+    def _add_stats(self, cursor, turns):
+        """Прибавить реплики к статистике в текущей транзакции"""
+        user_counts, chat_days = _stats_deltas(turns)
+        cursor.executemany('''
+        INSERT INTO user_stats (user_id, name, value) VALUES (?, ?, ?)
+        ON CONFLICT (user_id, name) DO UPDATE SET value = user_stats.value + excluded.value
+        ''', ((user_id, name, value) for (user_id, name), value in user_counts.items()))
+        cursor.executemany('''
+        INSERT INTO chat_stats (chat_key, day, messages, empathy_sum)
+        SELECT chat_key, ?, ?, ? FROM chats WHERE chat_id = ?
+        ON CONFLICT (chat_key, day) DO UPDATE SET
+            messages = chat_stats.messages + excluded.messages,
+            empathy_sum = chat_stats.empathy_sum + excluded.empathy_sum
+        ''', ((day, messages, empathy_sum, chat_id)
+              for (chat_id, day), (messages, empathy_sum) in chat_days.items()))
+    
+    def get_user_stats(self, user_id: int) -> Dict[str, int]:
+        """Счётчики пользователя: messages, emotion:<эмоция>, hour:<ЧЧ> (UTC)"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT name, value FROM user_stats WHERE user_id = ?', (user_id,))
+        stats = dict(cursor.fetchall())
+        conn.close()
+        
+        return stats
+    
+    def get_chat_stats(self, chat_id: str, days: int = STATS_TRAJECTORY_DAYS) -> List[Tuple[str, int, float]]:
+        """Последние days дней активности чата: (день, сообщений, средняя эмпатия), от старых к новым"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute(f'''
+        SELECT day, messages, empathy_sum FROM chat_stats
+        WHERE chat_key = {CHAT_KEY_SQL}
+        ORDER BY day DESC
+        LIMIT ?
+        ''', (chat_id, days))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [(day, messages, empathy_sum / messages if messages else 0.0)
+                for day, messages, empathy_sum in reversed(rows)]
+    
+    def backfill_stats(self, batch_size: int = STATS_BACKFILL_BATCH) -> int:
+        """Досчитать статистику следующей пачки старых сообщений; 0 — всё посчитано"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT last_id, upto FROM stats_backfill WHERE id = 1')
+        last_id, upto = cursor.fetchone()
+        if last_id >= upto:
+            conn.rollback()
+            conn.close()
+            return 0
+        
+        cursor.execute(f'''
+        SELECT m.message_id, c.chat_id, m.user_id, {EMOTION_TEXT_SQL.format(mask='m.emotions')},
+               m.empathy_level, m.timestamp
+        FROM messages m
+        LEFT JOIN chats c ON c.chat_key = m.chat_key
+        WHERE m.message_id > ? AND m.message_id <= ?
+        ORDER BY m.message_id
+        LIMIT ?
+        ''', (last_id, upto, batch_size))
+        rows = cursor.fetchall()
+        self._add_stats(cursor, (row[1:] for row in rows))
+        # Короткая пачка — дальше до границы сообщений нет (удалены или в архиве)
+        last_id = rows[-1][0] if len(rows) == batch_size else upto
+        cursor.execute('UPDATE stats_backfill SET last_id = ? WHERE id = 1', (last_id,))
+        
+        conn.commit()
+        conn.close()
+        
+        return len(rows)
+    
+    def export_user(self, user_id: int, batch_size: int = EXPORT_BATCH) -> Iterator[Tuple[str, List[Tuple]]]:
+        """Данные пользователя пачками (вид, строки) с колонками EXPORT_COLUMNS"""
+        conn = self._connect_archive()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(EXPORT_COLUMNS['user'])} FROM users WHERE user_id = ?", (user_id,))
+            user = cursor.fetchone()
+            if user is None:
+                return
+            yield 'user', [user]
+            
+            chats = conn.cursor()
+            chats.execute(f'''
+            SELECT {', '.join(EXPORT_COLUMNS['chat'])}, is_archived FROM chats
+            WHERE user_id = ?
+            ORDER BY chat_id
+            ''', (user_id,))
+            while True:
+                batch = chats.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield 'chat', [row[:-1] for row in batch]
+                
+                for row in batch:
+                    chat_id, is_archived = row[0], row[-1]
+                    if is_archived:
+                        cursor.execute('SELECT payload FROM archive.archived_chats WHERE chat_id = ?', (chat_id,))
+                        archived = cursor.fetchone()
+                        if archived:
+                            yield from self._archived_export(chat_id, archived[0], batch_size)
+                        continue
+                    
+                    cursor.execute(f'''
+                    SELECT ?, user_id, {TEXT_SQL.format(column='message_text')}, {TEXT_SQL.format(column='response_text')}, is_ignored,
+                           {EMOTION_TEXT_SQL.format(mask='emotions')}, empathy_level, timestamp
+                    FROM messages
+                    WHERE chat_key = {CHAT_KEY_SQL}
+                    ORDER BY message_id
+                    ''', (chat_id, chat_id))
+                    while True:
+                        messages = cursor.fetchmany(batch_size)
+                        if not messages:
+                            break
+                        yield 'message', messages
+        finally:
+            conn.close()
+    
+    def import_user(self, batches: Iterable[Tuple[str, List[Tuple]]]) -> Dict[str, int]:
+        """Загрузка выгрузки export_user: пачка — одна транзакция с executemany"""
+        counts = Counter()
+        new_chats = set()
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        try:
+            for kind, rows in batches:
+                columns = EXPORT_COLUMNS[kind]
+                if kind == 'message':
+                    # Сообщения приводятся к компактной записи до начала транзакции
+                    skipped = len(rows)
+                    rows = [row for row in rows if row[0] in new_chats]
+                    counts['skipped'] += skipped - len(rows)
+                    stats = [(row[0], row[1], row[5], row[6], row[7]) for row in rows]
+                    rows = [(row[0], row[1], self._pack_text(row[2]), self._pack_text(row[3]), row[4],
+                             self._emotion_mask(row[5]), row[6], row[7]) for row in rows]
+                
+                cursor.execute('BEGIN IMMEDIATE')
+                
+                if kind == 'chat':
+                    chat_ids = [row[0] for row in rows]
+                    cursor.execute(f"SELECT chat_id FROM chats WHERE chat_id IN ({', '.join('?' * len(chat_ids))})",
+                                   chat_ids)
+                    existing = {row[0] for row in cursor.fetchall()}
+                    new_chats.update(set(chat_ids) - existing)
+                    counts['skipped'] += len(existing)
+                    rows = [row for row in rows if row[0] not in existing]
+                
+                if kind == 'message':
+                    cursor.execute('SELECT COALESCE(MAX(message_id), 0) FROM messages')
+                    last_id = cursor.fetchone()[0]
+                    cursor.executemany(f'''
+                    INSERT INTO messages
+                    (chat_key, user_id, message_text, response_text, is_ignored, emotions, empathy_level, timestamp)
+                    VALUES ({CHAT_KEY_SQL}, ?, ?, ?, ?, ?, ?, ?)
+                    ''', rows)
+                    self._index_messages(cursor, 'message_id > ?', (last_id,))
+                    self._add_stats(cursor, stats)
+                else:
+                    cursor.executemany(f'''
+                    INSERT OR IGNORE INTO {kind}s ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                    ''', rows)
+                counts[kind] += len(rows)
+                
+                conn.commit()
+        finally:
+            conn.close()
+        
+        return dict(counts)
+    
+    def update_chat_empathy(self, chat_id: str, empathy_level: int):
+        """Обновление уровня эмпатии чата"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+        UPDATE chats 
+        SET empathy_level = ?
+        WHERE chat_id = ?
+        ''', (empathy_level, chat_id))
+        
+        conn.commit()
+        conn.close()
+
+# Текущее время UTC в PostgreSQL; хранится с точностью до секунды, как CURRENT_TIMESTAMP в SQLite
+PG_NOW = "(now() AT TIME ZONE 'utc')"
+PG_NOW_SECONDS = f"date_trunc('second', {PG_NOW})"
+PG_TIME_FORMAT = 'YYYY-MM-DD HH24:MI:SS'
+PG_EXPORT_TIMES = ('created_at', 'last_activity', 'timestamp')  # колонки выгрузки с типом TIMESTAMP
+PG_EMOTION_TEXT = "(SELECT string_agg(name, ', ' ORDER BY bit) FROM emotions WHERE {mask} & (1::bigint << bit) <> 0)"
+
+# Словарь эмоций для маски messages.emotions (см. EMOTIONS)
+PG_EMOTIONS = '''
+CREATE TABLE IF NOT EXISTS emotions (
+    bit INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+
+INSERT INTO emotions (bit, name) VALUES %s ON CONFLICT DO NOTHING;
+''' % ', '.join(f"({bit}, '{name}')" for bit, name in enumerate(EMOTIONS))
+
+# Перевод базы старой версии (chat_id и emotion_analysis в каждой строке messages)
+# в компактную запись. UPDATE переписывает все строки messages: место старых версий
+# строк autovacuum отдаёт под новые записи, а вернуть его ОС можно VACUUM FULL messages
+PG_MIGRATE_COMPACT = f'''
+{PG_EMOTIONS}
+
+ALTER TABLE chats ADD COLUMN chat_key BIGSERIAL UNIQUE;
+ALTER TABLE messages ADD COLUMN chat_key BIGINT, ADD COLUMN emotions BIGINT;
+
+INSERT INTO emotions (bit, name)
+SELECT bit, name FROM (
+    SELECT (SELECT COALESCE(MAX(bit), -1) FROM emotions) + row_number() OVER (ORDER BY name) AS bit, name
+    FROM (SELECT DISTINCT btrim(unnest(string_to_array(emotion_analysis, ','))) AS name FROM messages) names
+    WHERE name <> '' AND name NOT IN (SELECT name FROM emotions)
+) numbered
+WHERE bit < {EMOTION_BITS};
+
+UPDATE messages m SET
+    chat_key = (SELECT c.chat_key FROM chats c WHERE c.chat_id = m.chat_id),
+    emotions = (
+        SELECT bit_or(1::bigint << e.bit) FROM emotions e
+        WHERE e.name IN (SELECT btrim(unnest(string_to_array(m.emotion_analysis, ','))))
+    );
+
+ALTER TABLE messages DROP COLUMN chat_id, DROP COLUMN emotion_analysis;
+'''
+
+# Статистика чата старой версии: ключ chat_id → chats.chat_key
+PG_MIGRATE_CHAT_STATS = '''
+ALTER TABLE chat_stats ADD COLUMN chat_key BIGINT;
+UPDATE chat_stats s SET chat_key = c.chat_key FROM chats c WHERE c.chat_id = s.chat_id;
+DELETE FROM chat_stats WHERE chat_key IS NULL;
+ALTER TABLE chat_stats DROP COLUMN chat_id, ADD PRIMARY KEY (chat_key, day);
+'''
+
+# Схема PostgreSQL. Внешние ключи не объявлены, как не соблюдаются они и в SQLite;
+# полнотекстовый индекс — сгенерированная колонка tsvector (сообщение весит больше ответа)
+PG_SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS users (
+    user_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    gender TEXT DEFAULT 'unknown',
+    created_at TIMESTAMP DEFAULT {PG_NOW_SECONDS},
+    last_activity TIMESTAMP DEFAULT {PG_NOW_SECONDS}
+);
+
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    chat_key BIGSERIAL UNIQUE,
+    user_id BIGINT,
+    chat_name TEXT,
+    scenario TEXT,
+    empathy_level INTEGER DEFAULT 35,
+    message_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT {PG_NOW_SECONDS},
+    last_activity TIMESTAMP DEFAULT {PG_NOW_SECONDS},
+    is_archived BOOLEAN DEFAULT FALSE,
+    scenario_prompt TEXT
+);
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS scenario_prompt TEXT;
+
+CREATE TABLE IF NOT EXISTS current_chats (
+    user_id BIGINT PRIMARY KEY,
+    chat_key BIGINT NOT NULL
+);
+
+{PG_EMOTIONS}
+
+CREATE TABLE IF NOT EXISTS messages (
+    message_id BIGSERIAL PRIMARY KEY,
+    chat_key BIGINT,
+    user_id BIGINT,
+    message_text TEXT,
+    response_text TEXT,
+    is_ignored BOOLEAN DEFAULT FALSE,
+    emotions BIGINT,
+    empathy_level INTEGER,
+    timestamp TIMESTAMP DEFAULT {PG_NOW_SECONDS},
+    message_tokens BYTEA,
+    response_tokens BYTEA,
+    tokenizer_id TEXT,
+    search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', translate(coalesce(message_text, ''), 'Ёё', 'Ее')), 'A') ||
+        setweight(to_tsvector('simple', translate(coalesce(response_text, ''), 'Ёё', 'Ее')), 'B')
+    ) STORED
+);
+
+CREATE INDEX IF NOT EXISTS idx_chats_user_activity ON chats (user_id, last_activity, chat_id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_key ON messages (chat_key, message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+
+CREATE TABLE IF NOT EXISTS archived_chats (
+    chat_id TEXT PRIMARY KEY,
+    user_id BIGINT,
+    message_count INTEGER,
+    archived_at TIMESTAMP DEFAULT {PG_NOW_SECONDS},
+    payload BYTEA
+);
+
+CREATE TABLE IF NOT EXISTS response_pool (
+    pool_id BIGSERIAL PRIMARY KEY,
+    intent TEXT,
+    empathy_bucket INTEGER,
+    scenario TEXT,
+    response_text TEXT,
+    served_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT {PG_NOW_SECONDS}
+);
+
+CREATE INDEX IF NOT EXISTS idx_response_pool_slot ON response_pool (intent, empathy_bucket, scenario, created_at);
+
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    processed_at TIMESTAMP DEFAULT {PG_NOW_SECONDS}
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    outbox_id BIGSERIAL PRIMARY KEY,
+    telegram_chat_id BIGINT,
+    message_id BIGINT,
+    response_text TEXT,
+    attempts INTEGER DEFAULT 0,
+    locked_until TIMESTAMP,
+    sent_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT {PG_NOW_SECONDS}
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (outbox_id) WHERE sent_at IS NULL;
+
+CREATE TABLE IF NOT EXISTS inbox (
+    update_id BIGINT PRIMARY KEY,
+    payload TEXT,
+    owner TEXT,
+    received_at TIMESTAMP DEFAULT {PG_NOW_SECONDS}
+);
+
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id BIGINT,
+    name TEXT,
+    value BIGINT DEFAULT 0,
+    PRIMARY KEY (user_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_key BIGINT,
+    day TEXT,
+    messages BIGINT DEFAULT 0,
+    empathy_sum BIGINT DEFAULT 0,
+    PRIMARY KEY (chat_key, day)
+);
+
+CREATE TABLE IF NOT EXISTS stats_backfill (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    last_id BIGINT,
+    upto BIGINT
+);
+
+INSERT INTO stats_backfill (id, last_id, upto)
+SELECT 1, 0, COALESCE(MAX(message_id), 0) FROM messages
+ON CONFLICT (id) DO NOTHING;
+'''
+
+class PostgresStorage(StorageBackend):
+    """Хранилище в PostgreSQL: одна база на несколько узлов бота
+    
+    Работает на asyncpg с пулом соединений; запросы подготавливаются на
+    сервере и кэшируются на каждом соединении (PG_STATEMENT_CACHE). Цикл
+    событий хранилища живёт в своём потоке, а методы того же набора, что у
+    DatabaseManager, синхронно ждут результат корутины — поэтому хранилищем
+    одинаково пользуются обработчики, поток памяти и поток генерации.
+    """
+    
+    fts_enabled = True
+    
+    def __init__(self, dsn: str, schema: Optional[str] = None,
+                 min_size: int = PG_POOL_MIN, max_size: int = PG_POOL_MAX):
+        import asyncpg
+        
+        self.dsn = dsn
+        self.schema = schema
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="odanna-postgres", daemon=True)
+        self.thread.start()
+        
+        async def open_pool():
+            if schema:
+                conn = await asyncpg.connect(dsn)
+                await conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+                await conn.close()
+            return await asyncpg.create_pool(
+                dsn, min_size=min_size, max_size=max_size,
+                statement_cache_size=PG_STATEMENT_CACHE,
+                server_settings={'search_path': schema} if schema else None
+            )
+        
+        self.pool = self._run(open_pool())
+        self.emotion_bits: Dict[str, int] = {}
+        self.init_db()
+        self._load_emotions()
+    
+    def _run(self, coroutine):
+        """Выполнение корутины в цикле хранилища с ожиданием результата"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+    
+    def _fetch(self, query: str, *args) -> List[Tuple]:
+        return [tuple(row) for row in self._run(self.pool.fetch(query, *args))]
+    
+    def _fetchrow(self, query: str, *args) -> Optional[Tuple]:
+        row = self._run(self.pool.fetchrow(query, *args))
+        return tuple(row) if row is not None else None
+    
+    def _fetchval(self, query: str, *args):
+        return self._run(self.pool.fetchval(query, *args))
+    
+    def _execute(self, query: str, *args) -> int:
+        """Выполнение запроса; возвращает число затронутых строк"""
+        status = self._run(self.pool.execute(query, *args))
+        return int(status.split()[-1]) if status.split()[-1].isdigit() else 0
+    
+    def _transaction(self, work: Callable):
+        """work(conn) — корутина, выполняемая в одной транзакции"""
+        async def run():
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    return await work(conn)
+        return self._run(run())
+    
+    def init_db(self):
+        """Создание схемы; узлы, стартующие одновременно, ждут друг друга на advisory-блокировке"""
+        async def create(conn):
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('odanna_schema'))")
+            if await conn.fetchval('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'messages' AND column_name = 'chat_id'
+            '''):
+                logger.info("Перевод сообщений в компактную запись…")
+                await conn.execute(PG_MIGRATE_COMPACT)
+            await conn.execute(PG_SCHEMA)
+            if await conn.fetchval('''
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'chat_stats' AND column_name = 'chat_id'
+            '''):
+                await conn.execute(PG_MIGRATE_CHAT_STATS)
+        self._transaction(create)
+    
+    def _load_emotions(self):
+        """Перечитать словарь эмоций"""
+        self.emotion_bits = dict(self._fetch('SELECT name, bit FROM emotions'))
+    
+    def _register_emotions(self, names: List[str]):
+        """Добавить в словарь новые названия эмоций и перечитать его"""
+        async def register(conn):
+            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('odanna_emotions'))")
+            for name in names:
+                await conn.execute('''
+                INSERT INTO emotions (bit, name)
+                SELECT COALESCE(MAX(bit), -1) + 1, $1 FROM emotions
+                HAVING COALESCE(MAX(bit), -1) + 1 < $2
+                ON CONFLICT DO NOTHING
+                ''', name, EMOTION_BITS)
+        
+        self._transaction(register)
+        self._load_emotions()
+    
+    def close(self):
+        self._run(self.pool.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+    
+    @staticmethod
+    def _tsquery(text: str, operator: str = ' & ', weight: str = '') -> Optional[str]:
+        """Запрос to_tsquery: слова текста с поиском по префиксу"""
+        words = StorageBackend._search_words(text)
+        return operator.join(f"{word}:*{weight}" for word in words) if words else None
+    
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None,
+                 gender: str = 'unknown'):
+        """Добавление или обновление пользователя"""
+        self._execute(f'''
+        INSERT INTO users (user_id, username, first_name, last_name, gender, last_activity)
+        VALUES ($1, $2, $3, $4, $5, {PG_NOW_SECONDS})
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = EXCLUDED.username, first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name, gender = EXCLUDED.gender,
+            last_activity = EXCLUDED.last_activity
+        ''', user_id, username, first_name, last_name, gender)
+    
+    def create_chat(self, user_id: int, chat_name: str, scenario: str = "Небесная Гостиница",
+                    scenario_prompt: Optional[str] = None) -> str:
+        """Создание нового чата (одинаковое время получает суффикс _2, _3…, см. DatabaseManager)"""
+        base_id = f"{user_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        for attempt in itertools.count(1):
+            chat_id = base_id if attempt == 1 else f"{base_id}_{attempt}"
+            if self._execute('''
+            INSERT INTO chats (chat_id, user_id, chat_name, scenario, scenario_prompt)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (chat_id) DO NOTHING
+            ''', chat_id, user_id, chat_name, scenario, scenario_prompt):
+                return chat_id
+    
+    def get_user_chats(self, user_id: int) -> List[Tuple]:
+        """Получение списка чатов пользователя"""
+        return self._fetch(f'''
+        SELECT chat_id, chat_name, scenario, message_count, to_char(last_activity, '{PG_TIME_FORMAT}')
+        FROM chats
+        WHERE user_id = $1
+        ORDER BY last_activity DESC
+        ''', user_id)
+    
+    def get_user_chats_page(self, user_id: int, limit: int = 10, cursor: Optional[Tuple[str, str]] = None,
+                            backward: bool = False) -> Tuple[List[Tuple], bool, bool]:
+        """Страница списка чатов пользователя (keyset-пагинация по (last_activity, chat_id))"""
+        columns = f"chat_id, chat_name, scenario, message_count, to_char(last_activity, '{PG_TIME_FORMAT}')"
+        
+        if cursor is None:
+            chats = self._fetch(f'''
+            SELECT {columns} FROM chats
+            WHERE user_id = $1
+            ORDER BY last_activity DESC, chat_id DESC
+            LIMIT $2
+            ''', user_id, limit + 1)
+        elif not backward:
+            chats = self._fetch(f'''
+            SELECT {columns} FROM chats
+            WHERE user_id = $1 AND (last_activity, chat_id) < ($2::text::timestamp, $3)
+            ORDER BY last_activity DESC, chat_id DESC
+            LIMIT $4
+            ''', user_id, cursor[0], cursor[1], limit + 1)
+        else:
+            chats = self._fetch(f'''
+            SELECT {columns} FROM chats
+            WHERE user_id = $1 AND (last_activity, chat_id) > ($2::text::timestamp, $3)
+            ORDER BY last_activity ASC, chat_id ASC
+            LIMIT $4
+            ''', user_id, cursor[0], cursor[1], limit + 1)
+        
+        has_more = len(chats) > limit
+        chats = chats[:limit]
+        
+        if backward:
+            return list(reversed(chats)), has_more, True
+        return chats, cursor is not None, has_more
+    
+    def add_message(self, chat_id: str, user_id: int, message_text: str, response_text: str = None,
+                    emotion_analysis: str = None, empathy_level: int = 35,
+                    message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                    tokenizer_id: Optional[str] = None) -> int:
+        """Добавление сообщения в чат. Возвращает message_id"""
+        emotions = self._emotion_mask(emotion_analysis)
+        
+        async def add(conn):
+            message_id = await conn.fetchval('''
+            INSERT INTO messages
+            (chat_key, user_id, message_text, response_text, emotions, empathy_level,
+             message_tokens, response_tokens, tokenizer_id)
+            VALUES ((SELECT chat_key FROM chats WHERE chat_id = $1), $2, $3, $4, $5, $6, $7, $8, $9)
+            RETURNING message_id
+            ''', chat_id, user_id, message_text, response_text, emotions, empathy_level,
+                _pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id)
+            await conn.execute(f'''
+            UPDATE chats
+            SET message_count = message_count + 1, last_activity = {PG_NOW_SECONDS}
+            WHERE chat_id = $1
+            ''', chat_id)
+            await self._add_stats(conn, [(chat_id, user_id, emotion_analysis, empathy_level,
+                                          datetime.now(timezone.utc))])
+            return message_id
+        
+        return self._transaction(add)
+    
+    def get_chat_history(self, chat_id: str, limit: int = 20) -> List[Tuple]:
+        """Получение истории чата"""
+        messages = self._fetch(f'''
+        SELECT message_text, response_text, is_ignored, {PG_EMOTION_TEXT.format(mask='emotions')},
+               to_char(timestamp, '{PG_TIME_FORMAT}')
+        FROM messages
+        WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)
+        ORDER BY message_id DESC
+        LIMIT $2
+        ''', chat_id, limit)
+        return list(reversed(messages))
+    
+    def get_history_turns(self, chat_id: str, limit: int, tokenizer_id: Optional[str] = None) -> List[Tuple]:
+        """Последние реплики чата для контекста генерации вместе с кэшем токенов"""
+        rows = self._fetch('''
+        SELECT message_id, message_text, response_text, is_ignored, message_tokens, response_tokens, tokenizer_id
+        FROM messages
+        WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)
+        ORDER BY message_id DESC
+        LIMIT $2
+        ''', chat_id, limit)
+        
+        turns = []
+        for message_id, text, response, is_ignored, message_tokens, response_tokens, row_tokenizer in reversed(rows):
+            if tokenizer_id is None or row_tokenizer != tokenizer_id:
+                message_tokens = response_tokens = None
+            turns.append((message_id, text, response, is_ignored,
+                          _unpack_tokens(message_tokens), _unpack_tokens(response_tokens)))
+        return turns
+    
+    def set_message_tokens(self, tokens: List[Tuple[int, List[int], Optional[List[int]]]], tokenizer_id: str):
+        """Сохранение токенов для реплик, записанных без них"""
+        if not tokens:
+            return
+        self._run(self.pool.executemany('''
+        UPDATE messages SET message_tokens = $1, response_tokens = $2, tokenizer_id = $3
+        WHERE message_id = $4
+        ''', [
+            (_pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id, message_id)
+            for message_id, message_tokens, response_tokens in tokens
+        ]))
+    
+    def get_response_lengths(self, limit: int = 1000) -> List[int]:
+        """Длины последних принятых (не забытых) ответов в символах"""
+        return [row[0] for row in self._fetch('''
+        SELECT char_length(response_text)
+        FROM messages
+        WHERE response_text IS NOT NULL AND NOT is_ignored
+        ORDER BY message_id DESC
+        LIMIT $1
+        ''', limit)]
+    
+    def get_chat_messages_page(self, chat_id: str, limit: int = 5, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None) -> Tuple[List[Tuple], bool, bool]:
+        """Страница истории чата (keyset-пагинация по message_id)"""
+        columns = f"message_id, message_text, response_text, is_ignored, {PG_EMOTION_TEXT.format(mask='emotions')}, " \
+                  f"to_char(timestamp, '{PG_TIME_FORMAT}')"
+        
+        if after_id is not None:
+            messages = self._fetch(f'''
+            SELECT {columns} FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND message_id > $2
+            ORDER BY message_id ASC
+            LIMIT $3
+            ''', chat_id, after_id, limit + 1)
+        elif before_id is not None:
+            messages = self._fetch(f'''
+            SELECT {columns} FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND message_id < $2
+            ORDER BY message_id DESC
+            LIMIT $3
+            ''', chat_id, before_id, limit + 1)
+        else:
+            messages = self._fetch(f'''
+            SELECT {columns} FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)
+            ORDER BY message_id DESC
+            LIMIT $2
+            ''', chat_id, limit + 1)
+        
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        
+        if after_id is not None:
+            return messages, True, has_more
+        return list(reversed(messages)), has_more, before_id is not None
+    
+    def forget_last_message(self, chat_id: str) -> Optional[int]:
+        """Забыть последнее ещё не забытое сообщение чата
+        
+        Строка блокируется при выборе (SKIP LOCKED), поэтому параллельные
+        вызовы забывают разные сообщения.
+        """
+        return self._fetchval('''
+        UPDATE messages SET is_ignored = TRUE
+        WHERE message_id = (
+            SELECT message_id FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND NOT is_ignored
+            ORDER BY message_id DESC
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING message_id
+        ''', chat_id)
+    
+    def _set_message_ignored(self, message_id: int, ignored: bool, user_id: Optional[int] = None,
+                             chat_id: Optional[str] = None) -> Optional[str]:
+        """Смена флага is_ignored одного сообщения; возвращает chat_id, если флаг изменился"""
+        return self._fetchval('''
+        UPDATE messages m SET is_ignored = $2
+        FROM chats c
+        WHERE c.chat_key = m.chat_key AND m.message_id = $1 AND m.is_ignored = NOT $2
+          AND ($3::bigint IS NULL OR m.user_id = $3) AND ($4::text IS NULL OR c.chat_id = $4)
+        RETURNING c.chat_id
+        ''', message_id, ignored, user_id, chat_id)
+    
+    def search_messages(self, user_id: int, query: str, limit: int = 5,
+                        offset: int = 0) -> Tuple[List[Tuple], bool]:
+        """Ранжированный полнотекстовый поиск по истории пользователя"""
+        tsquery = self._tsquery(query)
+        if not tsquery:
+            return [], False
+        
+        results = self._fetch(f'''
+        SELECT m.message_id, c.chat_id, c.chat_name, m.message_text, m.response_text,
+               to_char(m.timestamp, '{PG_TIME_FORMAT}')
+        FROM messages m
+        JOIN chats c ON c.chat_key = m.chat_key
+        WHERE m.user_id = $1 AND NOT m.is_ignored AND m.search_vector @@ to_tsquery('simple', $2)
+        ORDER BY ts_rank(m.search_vector, to_tsquery('simple', $2)) DESC, m.message_id DESC
+        LIMIT $3 OFFSET $4
+        ''', user_id, tsquery, limit + 1, offset)
+        
+        return results[:limit], len(results) > limit
+    
+    def find_message_id(self, chat_id: str, message_text: str, ignored: bool = False) -> Optional[int]:
+        """Поиск сообщения пользователя по неточному тексту (для «забудь»)
+        
+        Сравниваются только слова сообщений (вес A), не ответов; нужны все
+        слова текста, иначе None (см. DatabaseManager).
+        """
+        candidates = []
+        
+        if self._search_words(message_text):
+            candidates = self._fetch('''
+            SELECT message_id, message_text
+            FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND is_ignored = $2
+              AND search_vector @@ to_tsquery('simple', $3)
+            ORDER BY ts_rank(search_vector, to_tsquery('simple', $3)) DESC, message_id DESC
+            LIMIT 20
+            ''', chat_id, ignored, self._tsquery(message_text, ' & ', weight='A'))
+        else:
+            candidates = self._fetch('''
+            SELECT message_id, message_text
+            FROM messages
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND message_text = $2 AND is_ignored = $3
+            ORDER BY message_id DESC
+            LIMIT 1
+            ''', chat_id, message_text, ignored)
+        
+        if not candidates:
+            return None
+        
+        wanted = message_text.strip().lower()
+        exact = [message_id for message_id, text in candidates if (text or '').strip().lower() == wanted]
+        return max(exact) if exact else candidates[0][0]
+    
+    def get_messages_by_ids(self, chat_id: str, message_ids: List[int]) -> List[Tuple]:
+        """Незабытые сообщения чата по списку ID в порядке этого списка"""
+        if not message_ids:
+            return []
+        
+        rows = {row[0]: row for row in self._fetch('''
+        SELECT message_id, message_text, response_text
+        FROM messages
+        WHERE message_id = ANY($1::bigint[]) AND chat_key = (SELECT chat_key FROM chats WHERE chat_id = $2)
+          AND NOT is_ignored
+        ''', list(message_ids), chat_id)}
+        
+        return [rows[message_id] for message_id in message_ids if message_id in rows]
+    
+    def delete_chat(self, chat_id: str):
+        """Удаление чата, всех его сообщений и архива"""
+        async def delete(conn):
+            await conn.execute('DELETE FROM messages WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)',
+                               chat_id)
+            await conn.execute('DELETE FROM current_chats WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)',
+                               chat_id)
+            await conn.execute('DELETE FROM chat_stats WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)',
+                               chat_id)
+            await conn.execute('DELETE FROM chats WHERE chat_id = $1', chat_id)
+            await conn.execute('DELETE FROM archived_chats WHERE chat_id = $1', chat_id)
+        self._transaction(delete)
+    
+    @staticmethod
+    async def _message_columns(conn) -> List[str]:
+        """Хранимые колонки messages (без сгенерированного search_vector)"""
+        rows = await conn.fetch('''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'messages' AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+        ''')
+        return [row[0] for row in rows]
+    
+    def archive_chat(self, chat_id: str) -> int:
+        """Перенос сообщений чата в сжатый архив (одна транзакция). Возвращает число сообщений
+        
+        Удаляются только прочитанные сообщения: в READ COMMITTED реплика,
+        зафиксированная после чтения, иначе пропала бы без архива.
+        """
+        async def archive(conn):
+            chat = await conn.fetchrow(
+                'SELECT user_id, chat_key FROM chats WHERE chat_id = $1 AND NOT is_archived FOR UPDATE', chat_id
+            )
+            if not chat:
+                return 0
+            
+            columns = [c for c in await self._message_columns(conn) if c not in TOKEN_CACHE_COLUMNS]
+            rows = [tuple(row) for row in await conn.fetch(
+                f'SELECT {", ".join(columns)} FROM messages WHERE chat_key = $1 ORDER BY message_id', chat[1]
+            )]
+            
+            await conn.execute('''
+            INSERT INTO archived_chats (chat_id, user_id, message_count, payload)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                user_id = EXCLUDED.user_id, message_count = EXCLUDED.message_count,
+                archived_at = EXCLUDED.archived_at, payload = EXCLUDED.payload
+            ''', chat_id, chat[0], len(rows), self._pack_rows(columns, rows))
+            last_id = rows[-1][columns.index('message_id')] if rows else 0
+            await conn.execute('DELETE FROM messages WHERE chat_key = $1 AND message_id <= $2', chat[1], last_id)
+            await conn.execute('UPDATE chats SET is_archived = TRUE WHERE chat_id = $1', chat_id)
+            return len(rows)
+        
+        return self._transaction(archive)
+    
+    def restore_chat(self, chat_id: str) -> bool:
+        """Возврат архивного чата; для активного чата — одна проверка по ключу"""
+        chat = self._fetchrow('SELECT is_archived, chat_key FROM chats WHERE chat_id = $1', chat_id)
+        if not chat or not chat[0]:
+            return False
+        
+        # Архив приводится к текущей записи до транзакции: незнакомые эмоции регистрируются отдельно
+        payload = self._fetchval('SELECT payload FROM archived_chats WHERE chat_id = $1', chat_id)
+        archived = self._archived_messages(payload, chat[1]) if payload else None
+        
+        async def restore(conn):
+            if archived:
+                columns, rows = archived
+                
+                # Колонки, которых уже нет в схеме, пропускаем; типы приводит json_populate_recordset
+                known = set(await self._message_columns(conn))
+                names = ", ".join(column for column in columns if column in known)
+                if rows and names:
+                    await conn.execute(f'''
+                    INSERT INTO messages ({names})
+                    SELECT {names} FROM json_populate_recordset(NULL::messages, $1::json)
+                    ON CONFLICT (message_id) DO NOTHING
+                    ''', json.dumps([dict(zip(columns, row)) for row in rows], ensure_ascii=False))
+            
+            await conn.execute('UPDATE chats SET is_archived = FALSE WHERE chat_id = $1', chat_id)
+            await conn.execute('DELETE FROM archived_chats WHERE chat_id = $1', chat_id)
+        
+        self._transaction(restore)
+        logger.info(f"Чат {chat_id} восстановлен из архива")
+        return True
+    
+    def archive_inactive_chats(self, inactive_days: int = ARCHIVE_AFTER_DAYS) -> int:
+        """Архивация чатов без активности дольше inactive_days. Возвращает число чатов"""
+        chat_ids = [row[0] for row in self._fetch(f'''
+        SELECT chat_id FROM chats
+        WHERE NOT is_archived AND last_activity < {PG_NOW} - make_interval(days => $1)
+        ''', int(inactive_days))]
+        
+        for chat_id in chat_ids:
+            self.archive_chat(chat_id)
+        
+        return len(chat_ids)
+    
+    def purge_expired_archives(self, retention_days: int = ARCHIVE_RETENTION_DAYS) -> int:
+        """Удаление архивных чатов без активности дольше срока хранения"""
+        async def purge(conn):
+            rows = await conn.fetch(f'''
+            DELETE FROM chats
+            WHERE is_archived AND last_activity < {PG_NOW} - make_interval(days => $1)
+            RETURNING chat_id, chat_key
+            ''', int(retention_days))
+            chat_ids = [row[0] for row in rows]
+            await conn.execute('DELETE FROM archived_chats WHERE chat_id = ANY($1::text[])', chat_ids)
+            await conn.execute('DELETE FROM chat_stats WHERE chat_key = ANY($1::bigint[])', [row[1] for row in rows])
+            return len(chat_ids)
+        
+        return self._transaction(purge)
+    
+    def run_archive_maintenance(self, inactive_days: int = ARCHIVE_AFTER_DAYS,
+                                retention_days: int = ARCHIVE_RETENTION_DAYS):
+        """Плановое обслуживание: архивация и очистка по сроку хранения (место возвращает autovacuum)"""
+        archived = self.archive_inactive_chats(inactive_days) if inactive_days > 0 else 0
+        purged = self.purge_expired_archives(retention_days) if retention_days > 0 else 0
+        
+        logger.info(f"Архивация: перенесено чатов {archived}, удалено по сроку хранения {purged}")
+        return archived, purged
+    
+    def ping(self):
+        """Проверка доступности базы"""
+        self._fetchval('SELECT 1')
+    
+    def size_bytes(self) -> int:
+        return self._fetchval('SELECT pg_database_size(current_database())')
+    
+    def get_chat_owner(self, chat_id: str) -> Optional[int]:
+        """user_id владельца чата; None — чата нет"""
+        return self._fetchval('SELECT user_id FROM chats WHERE chat_id = $1', chat_id)
+    
+    def get_current_chat(self, user_id: int) -> Optional[str]:
+        """Активный чат пользователя; None — не выбран или удалён"""
+        return self._fetchval('''
+        SELECT c.chat_id FROM current_chats cc JOIN chats c ON c.chat_key = cc.chat_key
+        WHERE cc.user_id = $1
+        ''', user_id)
+    
+    def set_current_chat(self, user_id: int, chat_id: str) -> Optional[str]:
+        """Сделать чат активным (видно всем узлам бота); возвращает прежний активный чат"""
+        async def switch(conn):
+            previous = await conn.fetchval('''
+            SELECT c.chat_id FROM current_chats cc JOIN chats c ON c.chat_key = cc.chat_key
+            WHERE cc.user_id = $1
+            FOR UPDATE OF cc
+            ''', user_id)
+            await conn.execute('''
+            INSERT INTO current_chats (user_id, chat_key)
+            SELECT $1, chat_key FROM chats WHERE chat_id = $2
+            ON CONFLICT (user_id) DO UPDATE SET chat_key = EXCLUDED.chat_key
+            ''', user_id, chat_id)
+            return previous
+        return self._transaction(switch)
+    
+    def get_chat_empathy_level(self, chat_id: str) -> int:
+        """Получение уровня эмпатии для чата"""
+        level = self._fetchval('SELECT empathy_level FROM chats WHERE chat_id = $1', chat_id)
+        return level if level is not None else 35
+    
+    def update_chat_empathy(self, chat_id: str, empathy_level: int):
+        """Обновление уровня эмпатии чата"""
+        self._execute('UPDATE chats SET empathy_level = $1 WHERE chat_id = $2', empathy_level, chat_id)
+    
+    def get_chat_scenario(self, chat_id: str) -> Optional[Tuple[str, Optional[str]]]:
+        """Название и описание сценария чата; None — чата нет"""
+        return self._fetchrow('SELECT scenario, scenario_prompt FROM chats WHERE chat_id = $1', chat_id)
+    
+    def set_chat_scenario(self, chat_id: str, scenario: str, scenario_prompt: Optional[str]) -> bool:
+        """Замена сценария чата; False — чата нет"""
+        return self._execute('UPDATE chats SET scenario = $1, scenario_prompt = $2 WHERE chat_id = $3',
+                             scenario, scenario_prompt, chat_id) > 0
+    
+    def add_pooled_response(self, intent: str, empathy_bucket: int, scenario: str, response_text: str):
+        """Сохранение заготовленного ответа в пул"""
+        self._execute('''
+        INSERT INTO response_pool (intent, empathy_bucket, scenario, response_text)
+        VALUES ($1, $2, $3, $4)
+        ''', intent, empathy_bucket, scenario, response_text)
+    
+    def take_pooled_response(self, intent: str, empathy_bucket: int, scenario: str,
+                             ttl_hours: int = POOL_TTL_HOURS,
+                             max_serves: int = POOL_MAX_SERVES) -> Optional[Tuple[str, float]]:
+        """Случайная свежая заготовка и её возраст в секундах (см. DatabaseManager)"""
+        async def take(conn):
+            row = await conn.fetchrow(f'''
+            SELECT pool_id, response_text, served_count,
+                   extract(epoch FROM {PG_NOW} - created_at)::float8
+            FROM response_pool
+            WHERE intent = $1 AND empathy_bucket = $2 AND scenario = $3
+              AND created_at >= {PG_NOW} - make_interval(hours => $4)
+            ORDER BY random()
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+            ''', intent, empathy_bucket, scenario, int(ttl_hours))
+            if row is None:
+                return None
+            
+            pool_id, response_text, served_count, age_seconds = row
+            if served_count + 1 >= max_serves:
+                await conn.execute('DELETE FROM response_pool WHERE pool_id = $1', pool_id)
+            else:
+                await conn.execute('UPDATE response_pool SET served_count = served_count + 1 WHERE pool_id = $1',
+                                   pool_id)
+            return response_text, max(0.0, age_seconds)
+        
+        return self._transaction(take)
+    
+    def count_pooled_responses(self, ttl_hours: int = POOL_TTL_HOURS) -> Dict[Tuple[str, int, str], int]:
+        """Число свежих заготовок по ячейкам (намерение, эмпатия, сценарий)"""
+        rows = self._fetch(f'''
+        SELECT intent, empathy_bucket, scenario, COUNT(*) FROM response_pool
+        WHERE created_at >= {PG_NOW} - make_interval(hours => $1)
+        GROUP BY intent, empathy_bucket, scenario
+        ''', int(ttl_hours))
+        return {(intent, bucket, scenario): count for intent, bucket, scenario, count in rows}
+    
+    def purge_stale_pool(self, ttl_hours: int = POOL_TTL_HOURS) -> int:
+        """Удаление устаревших заготовок. Возвращает число удалённых"""
+        return self._execute(f'''
+        DELETE FROM response_pool WHERE created_at < {PG_NOW} - make_interval(hours => $1)
+        ''', int(ttl_hours))
+    
+    def is_update_processed(self, update_id: int) -> bool:
+        """Сохранён ли уже ответ на обновление Telegram"""
+        return bool(self._fetchval('SELECT 1 FROM processed_updates WHERE update_id = $1', update_id))
+    
+    def add_reply(self, update_id: int, telegram_chat_id: int, chat_id: str, user_id: int, message_text: str,
+                  response_text: str, emotion_analysis: str, empathy_level: int,
+                  message_tokens: Optional[List[int]] = None, response_tokens: Optional[List[int]] = None,
+                  tokenizer_id: Optional[str] = None,
+                  lease_seconds: int = OUTBOX_LEASE_SECONDS) -> Optional[Tuple[int, int]]:
+        """Реплика, отметка обновления и исходящий ответ одной транзакцией (см. StorageBackend)"""
+        emotions = self._emotion_mask(emotion_analysis)
+        
+        async def add(conn):
+            if await conn.fetchval('''
+            INSERT INTO processed_updates (update_id) VALUES ($1)
+            ON CONFLICT DO NOTHING
+            RETURNING update_id
+            ''', update_id) is None:
+                return None
+            
+            message_id = await conn.fetchval('''
+            INSERT INTO messages
+            (chat_key, user_id, message_text, response_text, emotions, empathy_level,
+             message_tokens, response_tokens, tokenizer_id)
+            VALUES ((SELECT chat_key FROM chats WHERE chat_id = $1), $2, $3, $4, $5, $6, $7, $8, $9)
+            RETURNING message_id
+            ''', chat_id, user_id, message_text, response_text, emotions, empathy_level,
+                _pack_tokens(message_tokens), _pack_tokens(response_tokens), tokenizer_id)
+            await conn.execute(f'''
+            UPDATE chats
+            SET message_count = message_count + 1, last_activity = {PG_NOW_SECONDS}, empathy_level = $2
+            WHERE chat_id = $1
+            ''', chat_id, empathy_level)
+            await self._add_stats(conn, [(chat_id, user_id, emotion_analysis, empathy_level,
+                                          datetime.now(timezone.utc))])
+            outbox_id = await conn.fetchval(f'''
+            INSERT INTO outbox (telegram_chat_id, message_id, response_text, attempts, locked_until)
+            VALUES ($1, $2, $3, 1, {PG_NOW} + make_interval(secs => $4))
+            RETURNING outbox_id
+            ''', telegram_chat_id, message_id, response_text, int(lease_seconds))
+            return message_id, outbox_id
+        
+        return self._transaction(add)
+    
+    def claim_outbox(self, limit: int = 20, lease_seconds: int = OUTBOX_LEASE_SECONDS,
+                     max_attempts: int = OUTBOX_MAX_ATTEMPTS) -> List[Tuple[int, int, int, str]]:
+        """Неотправленные ответы для досылки; строки, которые досылает другой узел, пропускаются"""
+        rows = self._fetch(f'''
+        UPDATE outbox SET attempts = attempts + 1, locked_until = {PG_NOW} + make_interval(secs => $3)
+        WHERE outbox_id IN (
+            SELECT outbox_id FROM outbox
+            WHERE sent_at IS NULL AND attempts < $1 AND (locked_until IS NULL OR locked_until <= {PG_NOW})
+            ORDER BY outbox_id
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING outbox_id, telegram_chat_id, message_id, response_text
+        ''', max_attempts, limit, int(lease_seconds))
+        return sorted(rows)
+    
+    def mark_outbox_sent(self, outbox_id: int):
+        """Ответ доставлен в Telegram"""
+        self._execute(f'UPDATE outbox SET sent_at = {PG_NOW_SECONDS} WHERE outbox_id = $1', outbox_id)
+    
+    def purge_delivery_log(self, keep_days: int = UPDATE_DEDUP_DAYS) -> int:
+        """Удаление старых отметок обновлений и завершённых ответов outbox"""
+        async def purge(conn):
+            since = f"{PG_NOW} - make_interval(days => $1)"
+            updates = await conn.execute(f'DELETE FROM processed_updates WHERE processed_at < {since}',
+                                         int(keep_days))
+            outbox = await conn.execute(f'''
+            DELETE FROM outbox WHERE created_at < {since} AND (sent_at IS NOT NULL OR attempts >= $2)
+            ''', int(keep_days), OUTBOX_MAX_ATTEMPTS)
+            return int(updates.split()[-1]) + int(outbox.split()[-1])
+        
+        return self._transaction(purge)
+    
+    def add_inbox(self, update_id: int, payload: str, owner: str):
+        """Запомнить принятое сообщение до окончания его обработки"""
+        self._execute(f'''
+        INSERT INTO inbox (update_id, payload, owner) VALUES ($1, $2, $3)
+        ON CONFLICT (update_id) DO UPDATE SET owner = EXCLUDED.owner, received_at = {PG_NOW_SECONDS}
+        ''', update_id, payload, owner)
+    
+    def remove_inbox(self, update_id: int):
+        self._execute('DELETE FROM inbox WHERE update_id = $1', update_id)
+    
+    def release_inbox(self, owner: str) -> int:
+        """Отдать необработанные сообщения экземпляра другим экземплярам"""
+        return self._execute('UPDATE inbox SET owner = NULL WHERE owner = $1', owner)
+    
+    def claim_inbox(self, owner: str, stale_seconds: int = INBOX_STALE_SECONDS,
+                    limit: int = 100) -> List[Tuple[int, str]]:
+        """Забрать отданные сообщения и сообщения экземпляров, пропавших без остановки"""
+        rows = self._fetch(f'''
+        UPDATE inbox SET owner = $1, received_at = {PG_NOW_SECONDS}
+        WHERE update_id IN (
+            SELECT update_id FROM inbox
+            WHERE owner IS NULL OR received_at < {PG_NOW} - make_interval(secs => $2)
+            ORDER BY update_id
+            LIMIT $3
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING update_id, payload
+        ''', owner, int(stale_seconds), limit)
+        return sorted(rows)
+    
+    @staticmethod
+    async def _add_stats(conn, turns):
+        """Прибавить реплики к статистике в текущей транзакции"""
+        user_counts, chat_days = _stats_deltas(turns)
+        await conn.executemany('''
+        INSERT INTO user_stats (user_id, name, value) VALUES ($1, $2, $3)
+        ON CONFLICT (user_id, name) DO UPDATE SET value = user_stats.value + EXCLUDED.value
+        ''', [(user_id, name, value) for (user_id, name), value in user_counts.items()])
+        await conn.executemany('''
+        INSERT INTO chat_stats (chat_key, day, messages, empathy_sum)
+        SELECT chat_key, $2, $3, $4 FROM chats WHERE chat_id = $1
+        ON CONFLICT (chat_key, day) DO UPDATE SET
+            messages = chat_stats.messages + EXCLUDED.messages,
+            empathy_sum = chat_stats.empathy_sum + EXCLUDED.empathy_sum
+        ''', [(chat_id, day, messages, empathy_sum)
+              for (chat_id, day), (messages, empathy_sum) in chat_days.items()])
+    
+    def get_user_stats(self, user_id: int) -> Dict[str, int]:
+        """Счётчики пользователя: messages, emotion:<эмоция>, hour:<ЧЧ> (UTC)"""
+        return dict(self._fetch('SELECT name, value FROM user_stats WHERE user_id = $1', user_id))
+    
+    def get_chat_stats(self, chat_id: str, days: int = STATS_TRAJECTORY_DAYS) -> List[Tuple[str, int, float]]:
+        """Последние days дней активности чата: (день, сообщений, средняя эмпатия), от старых к новым"""
+        rows = self._fetch('''
+        SELECT day, messages, empathy_sum FROM chat_stats
+        WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1)
+        ORDER BY day DESC
+        LIMIT $2
+        ''', chat_id, days)
+        return [(day, messages, empathy_sum / messages if messages else 0.0)
+                for day, messages, empathy_sum in reversed(rows)]
+    
+    def backfill_stats(self, batch_size: int = STATS_BACKFILL_BATCH) -> int:
+        """Досчитать статистику следующей пачки старых сообщений; 0 — всё посчитано"""
+        async def backfill(conn):
+            last_id, upto = await conn.fetchrow('SELECT last_id, upto FROM stats_backfill WHERE id = 1 FOR UPDATE')
+            if last_id >= upto:
+                return 0
+            rows = await conn.fetch(f'''
+            SELECT m.message_id, c.chat_id, m.user_id, {PG_EMOTION_TEXT.format(mask='m.emotions')},
+                   m.empathy_level, m.timestamp
+            FROM messages m
+            LEFT JOIN chats c ON c.chat_key = m.chat_key
+            WHERE m.message_id > $1 AND m.message_id <= $2
+            ORDER BY m.message_id
+            LIMIT $3
+            ''', last_id, upto, batch_size)
+            await self._add_stats(conn, [tuple(row)[1:] for row in rows])
+            # Короткая пачка — дальше до границы сообщений нет (удалены или в архиве)
+            last_id = rows[-1][0] if len(rows) == batch_size else upto
+            await conn.execute('UPDATE stats_backfill SET last_id = $1 WHERE id = 1', last_id)
+            return len(rows)
+        
+        return self._transaction(backfill)
+    
+    @staticmethod
+    def _export_select(kind: str) -> str:
+        """Колонки выгрузки в SELECT: время — строкой, как в SQLite
+        
+        В запросе сообщений chat_id — параметр $1, эмоции раскрываются из маски.
+        """
+        expressions = {'chat_id': '$1::text', 'emotion_analysis': PG_EMOTION_TEXT.format(mask='emotions')}
+        return ', '.join(f"to_char({column}, '{PG_TIME_FORMAT}')" if column in PG_EXPORT_TIMES
+                         else expressions[column] if kind == 'message' and column in expressions else column
+                         for column in EXPORT_COLUMNS[kind])
+    
+    def export_user(self, user_id: int, batch_size: int = EXPORT_BATCH) -> Iterator[Tuple[str, List[Tuple]]]:
+        """Данные пользователя пачками (вид, строки); чаты и сообщения — по ключу после последней пачки"""
+        user = self._fetchrow(f"SELECT {self._export_select('user')} FROM users WHERE user_id = $1", user_id)
+        if user is None:
+            return
+        yield 'user', [user]
+        
+        last_chat = ''
+        while True:
+            chats = self._fetch(f'''
+            SELECT {self._export_select('chat')}, is_archived FROM chats
+            WHERE user_id = $1 AND chat_id > $2
+            ORDER BY chat_id
+            LIMIT $3
+            ''', user_id, last_chat, batch_size)
+            if not chats:
+                return
+            last_chat = chats[-1][0]
+            yield 'chat', [row[:-1] for row in chats]
+            
+            for row in chats:
+                chat_id, is_archived = row[0], row[-1]
+                if is_archived:
+                    payload = self._fetchval('SELECT payload FROM archived_chats WHERE chat_id = $1', chat_id)
+                    if payload:
+                        yield from self._archived_export(chat_id, payload, batch_size)
+                    continue
+                
+                last_message = 0
+                while True:
+                    messages = self._fetch(f'''
+                    SELECT message_id, {self._export_select('message')} FROM messages
+                    WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = $1) AND message_id > $2
+                    ORDER BY message_id
+                    LIMIT $3
+                    ''', chat_id, last_message, batch_size)
+                    if not messages:
+                        break
+                    last_message = messages[-1][0]
+                    yield 'message', [message[1:] for message in messages]
+    
+    def import_user(self, batches: Iterable[Tuple[str, List[Tuple]]]) -> Dict[str, int]:
+        """Загрузка выгрузки export_user: пачка — одна транзакция с executemany"""
+        counts = Counter()
+        new_chats = set()
+        
+        for kind, rows in batches:
+            columns = list(EXPORT_COLUMNS[kind])
+            values = [f'${i}::text::timestamp' if column in PG_EXPORT_TIMES else f'${i}'
+                      for i, column in enumerate(columns, 1)]
+            stats = []
+            if kind == 'message':
+                # Компактная запись: ключ чата по chat_id, маска вместо строки эмоций
+                # (до транзакции); is_ignored из выгрузки SQLite — 0/1
+                columns[0], values[0] = 'chat_key', '(SELECT chat_key FROM chats WHERE chat_id = $1)'
+                columns[5] = 'emotions'
+                loaded = [row for row in rows if row[0] in new_chats]
+                counts['skipped'] += len(rows) - len(loaded)
+                stats = [(row[0], row[1], row[5], row[6], row[7]) for row in loaded]
+                rows = [row[:4] + (bool(row[4]), self._emotion_mask(row[5])) + row[6:] for row in loaded]
+            
+            async def load(conn):
+                batch = rows
+                if kind == 'chat':
+                    existing = {row[0] for row in await conn.fetch(
+                        'SELECT chat_id FROM chats WHERE chat_id = ANY($1::text[])', [row[0] for row in rows])}
+                    batch = [row for row in rows if row[0] not in existing]
+                await conn.executemany(f'''
+                INSERT INTO {kind}s ({', '.join(columns)}) VALUES ({', '.join(values)})
+                ON CONFLICT DO NOTHING
+                ''', batch)
+                await self._add_stats(conn, stats)
+                return batch
+            
+            loaded = self._transaction(load)
+            if kind == 'chat':
+                new_chats.update(row[0] for row in loaded)
+                counts['skipped'] += len(rows) - len(loaded)
+            counts[kind] += len(loaded)
+        
+        return dict(counts)
+
+def create_storage(database_url: str = DATABASE_URL, db_path: str = DB_PATH) -> StorageBackend:
+    """Хранилище по настройкам: postgres://… — PostgreSQL, иначе SQLite-файл db_path"""
+    if database_url.startswith(('postgres://', 'postgresql://')):
+        return PostgresStorage(database_url)
+    return DatabaseManager(db_path)
+
+class ModelBackend(ABC):
+    """Базовый бэкенд языковой модели
+    
+    Бэкенд загружает модель с токенизатором и продолжает последовательность
+    идентификаторов токенов. Сэмплирование у всех одинаковое: temperature=0.8,
+    do_sample=True, top_k=50.
+    """
+    
+    name = ""
+    
+    def __init__(self, model_name: str, device: str = "auto"):
+        self.model_name = model_name
+        self.device = device
+    
+    @abstractmethod
+    def load(self):
+        """Загрузка модели и токенизатора (исключение — модель недоступна)"""
+    
+    @abstractmethod
+    def encode(self, text: str) -> List[int]:
+        ...
+    
+    @abstractmethod
+    def decode(self, token_ids: List[int]) -> str:
+        ...
+    
+    @abstractmethod
+    def generate(self, input_ids: List[int], max_new_tokens: int, session_key: Optional[str] = None,
+                 stop_sequences: Optional[List[List[int]]] = None, max_time: Optional[float] = None,
+                 prefix_key: Optional[str] = None, prefix_length: int = 0) -> List[int]:
+        """Только новые токены продолжения, без промпта
+        
+        session_key — чат, для которого бэкенд может переиспользовать
+        вычисления над общим с прошлым промптом префиксом. Первые prefix_length
+        токенов — шаблон сценария, общий для всех его чатов: его вычисления
+        можно держать один раз под prefix_key. Генерация
+        останавливается на любой из stop_sequences, сама она в ответ не входит,
+        и через max_time секунд — тогда возвращается уже написанное.
+        """
+    
+    def invalidate_session(self, session_key: str):
+        """Сброс переиспользуемого состояния чата (история изменилась или чат закрыт)"""
+    
+    @property
+    def tokenizer_id(self) -> str:
+        """Метка токенизатора: токены в БД годятся, только пока она совпадает"""
+        return f"{self.name}:{self.model_name}"
+
+def _cut_at_stop(token_ids: List[int], stop_sequences: Optional[List[List[int]]]) -> List[int]:
+    """Обрезать продолжение перед первой стоп-последовательностью"""
+    end = len(token_ids)
+    for sequence in stop_sequences or []:
+        for start in range(len(token_ids) - len(sequence) + 1):
+            if start >= end:
+                break
+            if token_ids[start:start + len(sequence)] == sequence:
+                end = start
+                break
+    return token_ids[:end]
+
+
+class StopOnSequences(StoppingCriteria):
+    """Остановка model.generate, как только в продолжении появилась стоп-последовательность"""
+    
+    def __init__(self, stop_sequences: List[List[int]], prompt_length: int):
+        self.stop_sequences = stop_sequences
+        self.prompt_length = prompt_length
+    
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        # Проверяется всё продолжение: черновая модель добавляет по несколько токенов за шаг
+        generated = input_ids[0, self.prompt_length:].tolist()
+        return len(_cut_at_stop(generated, self.stop_sequences)) < len(generated)
+
+
+class SessionKVCache:
+    """KV-кэш последнего промпта каждого чата с LRU-вытеснением по бюджету памяти
+    
+    Хранятся токены промпта и его past_key_values. Новый промпт берёт из
+    кэша только общий префикс, поэтому изменившаяся история обрезает кэш, а не
+    подменяет контекст; явный сброс нужен, чтобы не держать лишнюю память.
+    """
+    
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.sessions: OrderedDict = OrderedDict()  # ключ → (токены, past_key_values, байты)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+    
+    def lookup(self, key: str, input_ids: List[int]) -> Tuple[int, Optional[Tuple]]:
+        """Длина переиспользуемого префикса и past_key_values, обрезанные до неё
+        
+        Последний токен промпта всегда остаётся несчитанным: generate
+        начинает с него.
+        """
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None:
+                return 0, None
+            self.sessions.move_to_end(key)
+        
+        cached_ids, past, _ = entry
+        length = min(len(cached_ids), len(input_ids) - 1)
+        if length <= 0:
+            return 0, None
+        mismatches = np.flatnonzero(np.asarray(cached_ids[:length]) != np.asarray(input_ids[:length]))
+        prefix = int(mismatches[0]) if len(mismatches) else length
+        if prefix == 0:
+            return 0, None
+        
+        # Срезы тензоров — представления, исходный кэш остаётся целым
+        return prefix, tuple(tuple(tensor[:, :, :prefix] for tensor in layer) for layer in past)
+    
+    def store(self, key: str, token_ids: List[int], past: Tuple):
+        nbytes = sum(tensor.nbytes for layer in past for tensor in layer)
+        with self.lock:
+            self._drop(key)
+            if nbytes > self.budget_bytes:
+                return
+            self.sessions[key] = (list(token_ids), past, nbytes)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.budget_bytes:
+                _, (_, _, evicted_bytes) = self.sessions.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+    
+    def invalidate(self, key: str):
+        with self.lock:
+            self._drop(key)
+    
+    def _drop(self, key: str):
+        entry = self.sessions.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+class TransformersBackend(ModelBackend):
+    """Eager PyTorch через transformers (CPU или CUDA)"""
+    
+    name = "transformers"
+    
+    def __init__(self, model_name: str, device: str = "auto"):
+        super().__init__(model_name, device)
+        self.model = None
+        self.tokenizer = None
+        self.draft_model = None
+        self.kv_cache = SessionKVCache(KV_CACHE_MB * 1024 * 1024) if KV_CACHE_MB > 0 else None
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.torch_device = torch.device(device)
+    
+    def load(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        
+        # Добавляем pad_token если его нет
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        self.model = self._load_model()
+        
+        if DRAFT_MODEL:
+            self.load_draft_model(DRAFT_MODEL)
+    
+    def _load_model(self):
+        cuda = self.torch_device.type == "cuda"
+        model = AutoModelForCausalLM.from_pretrained(
+            self.model_name,
+            torch_dtype=torch.float16 if cuda else torch.float32,
+            device_map="auto" if cuda else None
+        )
+        model.eval()
+        return model
+    
+    def load_draft_model(self, model_name: str, num_tokens: int = DRAFT_NUM_TOKENS):
+        """Загрузка черновой модели для спекулятивного декодирования
+        
+        Черновая модель должна делить словарь с основной (DialoGPT-small
+        для DialoGPT-medium). При любой ошибке генерация идёт без неё.
+        """
+        try:
+            logger.info(f"Загрузка черновой модели {model_name}...")
+            
+            draft_model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=self.model.dtype
+            ).to(self.model.device)
+            draft_model.eval()
+            
+            if draft_model.config.vocab_size != self.model.config.vocab_size:
+                logger.warning(f"Словарь {model_name} не совпадает с основной моделью, черновик отключён")
+                return
+            
+            # Сколько токенов черновик предлагает за шаг; эвристика transformers
+            # подстраивает длину по доле принятых токенов
+            draft_model.generation_config.num_assistant_tokens = num_tokens
+            draft_model.generation_config.num_assistant_tokens_schedule = "heuristic"
+            
+            self.draft_model = draft_model
+            logger.info("Черновая модель загружена, спекулятивное декодирование включено")
+            
+        except Exception as e:
+            logger.error(f"Ошибка загрузки черновой модели: {e}")
+            self.draft_model = None
+    
+    @property
+    def tokenizer_id(self) -> str:
+        # transformers и onnx пользуются одним токенизатором Hugging Face
+        return f"hf:{self.model_name}"
+    
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text)
+    
+    def decode(self, token_ids: List[int]) -> str:
+        return self.tokenizer.decode(token_ids, skip_special_tokens=True)
+    
+    def generate(self, input_ids: List[int], max_new_tokens: int, session_key: Optional[str] = None,
+                 stop_sequences: Optional[List[List[int]]] = None, max_time: Optional[float] = None,
+                 prefix_key: Optional[str] = None, prefix_length: int = 0) -> List[int]:
+        started = time.monotonic()
+        inputs = torch.tensor([input_ids], device=self.model.device)
+        kwargs = self._generation_kwargs(len(input_ids), max_new_tokens)
+        if stop_sequences:
+            kwargs['stopping_criteria'] = StoppingCriteriaList([StopOnSequences(stop_sequences, len(input_ids))])
+        with torch.no_grad():
+            # С черновой моделью transformers сам управляет кэшем обеих моделей
+            if session_key is not None and self.kv_cache is not None and self.draft_model is None:
+                past = self._prefill(session_key, input_ids, prefix_key, prefix_length)
+                if past is not None:
+                    kwargs['past_key_values'] = past
+            if max_time is not None:
+                # MaxTimeCriteria проверяется после каждого шага декодирования; префилл уже потратил часть
+                kwargs['max_time'] = max(0.0, max_time - (time.monotonic() - started))
+            outputs = self.model.generate(inputs, attention_mask=torch.ones_like(inputs), **kwargs)
+        return _cut_at_stop(outputs[0, len(input_ids):].tolist(), stop_sequences)
+    
+    def _prefill(self, session_key: str, input_ids: List[int], prefix_key: Optional[str] = None,
+                 prefix_length: int = 0) -> Optional[Tuple]:
+        """past_key_values для всех токенов промпта, кроме последнего
+        
+        Префикс, совпавший с прошлым промптом чата, берётся из кэша,
+        досчитывается только остаток. Новый чат (или сброшенный) начинает с
+        записи prefix_key — шаблона сценария, посчитанного любым его чатом.
+        """
+        if len(input_ids) < 2:
+            return None
+        
+        prefix, past = self.kv_cache.lookup(session_key, input_ids)
+        source = "reused"
+        shared = None
+        if prefix_key is not None and prefix < prefix_length:
+            shared, shared_past = self.kv_cache.lookup(prefix_key, input_ids)
+            if shared > prefix:
+                prefix, past, source = shared, shared_past, "shared"
+        METRICS.inc('odanna_kv_cache_tokens_total', prefix, result=source)
+        METRICS.inc('odanna_kv_cache_tokens_total', len(input_ids) - 1 - prefix, result="prefilled")
+        
+        if prefix < len(input_ids) - 1:
+            rest = torch.tensor([input_ids[prefix:-1]], device=self.model.device)
+            attention_mask = torch.ones((1, len(input_ids) - 1), dtype=torch.long, device=self.model.device)
+            outputs = self.model(rest, past_key_values=past, attention_mask=attention_mask, use_cache=True)
+            past = outputs.past_key_values
+        
+        # Шаблон сохраняется копией: срез держал бы в памяти весь кэш чата
+        if shared is not None and shared < prefix_length < len(input_ids):
+            self.kv_cache.store(prefix_key, input_ids[:prefix_length],
+                                tuple(tuple(tensor[:, :, :prefix_length].clone() for tensor in layer)
+                                      for layer in past))
+        self.kv_cache.store(session_key, input_ids[:-1], past)
+        return past
+    
+    def invalidate_session(self, session_key: str):
+        if self.kv_cache is not None:
+            self.kv_cache.invalidate(session_key)
+    
+    def _generation_kwargs(self, prompt_length: int, max_new_tokens: int = MAX_NEW_TOKENS) -> Dict:
+        """Параметры model.generate
+        
+        С черновой моделью transformers проверяет её токены сэмплированием
+        из распределения основной модели, поэтому temperature=0.8 и
+        do_sample=True дают те же ответы по распределению, что и без неё.
+        """
+        kwargs = {
+            'max_length': prompt_length + max_new_tokens,
+            'num_return_sequences': 1,
+            'temperature': 0.8,
+            'do_sample': True,
+            'pad_token_id': self.tokenizer.eos_token_id,
+            'eos_token_id': self.tokenizer.eos_token_id,
+        }
+        if self.draft_model is not None:
+            kwargs['assistant_model'] = self.draft_model
+        return kwargs
+
+class OnnxRuntimeBackend(TransformersBackend):
+    """ONNX Runtime на CPU: экспорт через optimum, оптимизация графа и int8
+    
+    Экспорт выполняется один раз и кэшируется в ONNX_DIR. Модель ORT
+    совместима с model.generate, поэтому генерация общая с TransformersBackend.
+    """
+    
+    name = "onnx"
+    
+    def load(self):
+        # Формат past_key_values графа ONNX другой, переиспользование кэша не поддерживается
+        self.kv_cache = None
+        self.torch_device = torch.device("cpu")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self._load_model()
+    
+    def _load_model(self):
+        from optimum.onnxruntime import ORTModelForCausalLM, ORTOptimizer, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+        
+        cache_dir = os.path.join(ONNX_DIR, self.model_name.replace('/', '--'))
+        optimized_dir = os.path.join(cache_dir, 'optimized')
+        quantized_dir = os.path.join(cache_dir, 'quantized')
+        model_dir = quantized_dir if ONNX_QUANTIZE else optimized_dir
+        
+        if not os.path.isdir(optimized_dir):
+            logger.info(f"Экспорт {self.model_name} в ONNX (однократно)...")
+            exported = ORTModelForCausalLM.from_pretrained(self.model_name, export=True, use_cache=True)
+            optimizer = ORTOptimizer.from_pretrained(exported)
+            optimizer.optimize(
+                OptimizationConfig(optimization_level=2, optimize_for_gpu=False),
+                save_dir=optimized_dir
+            )
+        
+        if ONNX_QUANTIZE and not os.path.isdir(quantized_dir):
+            logger.info("Динамическое int8-квантование графа ONNX...")
+            quantizer = ORTQuantizer.from_pretrained(optimized_dir, file_name=self._onnx_file(optimized_dir))
+            quantizer.quantize(
+                AutoQuantizationConfig.avx2(is_static=False, per_channel=False),
+                save_dir=quantized_dir
+            )
+            self.tokenizer.save_pretrained(quantized_dir)
+        
+        return ORTModelForCausalLM.from_pretrained(
+            model_dir,
+            file_name=self._onnx_file(model_dir),
+            use_cache=True,
+            provider="CPUExecutionProvider"
+        )
+    
+    @staticmethod
+    def _onnx_file(directory: str) -> str:
+        """Файл графа в каталоге экспорта (имя зависит от версии optimum)"""
+        return sorted(name for name in os.listdir(directory) if name.endswith('.onnx'))[0]
+
+class GgufBackend(ModelBackend):
+    """Квантованная GGUF-модель через llama.cpp (llama-cpp-python, CPU)
+    
+    MODEL_NAME — путь к файлу .gguf; токенизатор берётся из самого файла.
+    """
+    
+    name = "gguf"
+    
+    def __init__(self, model_name: str, device: str = "auto"):
+        super().__init__(model_name, device)
+        self.llm = None
+        self.lock = threading.Lock()  # контекст llama.cpp нельзя использовать из двух потоков
+    
+    def load(self):
+        from llama_cpp import Llama
+        
+        self.llm = Llama(
+            model_path=self.model_name,
+            n_ctx=MAX_PROMPT_TOKENS + MAX_NEW_TOKENS,
+            n_threads=GGUF_THREADS or None,
+            verbose=False
+        )
+    
+    def encode(self, text: str) -> List[int]:
+        return self.llm.tokenize(text.encode('utf-8'), add_bos=False)
+    
+    def decode(self, token_ids: List[int]) -> str:
+        return self.llm.detokenize(token_ids).decode('utf-8', errors='ignore')
+    
+    def generate(self, input_ids: List[int], max_new_tokens: int, session_key: Optional[str] = None,
+                 stop_sequences: Optional[List[List[int]]] = None, max_time: Optional[float] = None,
+                 prefix_key: Optional[str] = None, prefix_length: int = 0) -> List[int]:
+        # llama.cpp сам переиспользует общий префикс с предыдущим вызовом
+        stop_at = time.monotonic() + max_time if max_time is not None else math.inf
+        eos_token_id = self.llm.token_eos()
+        new_tokens = []
+        with self.lock:
+            # Те же параметры, что у transformers по умолчанию: без top_p/min_p и штрафа за повтор
+            for token in self.llm.generate(input_ids, temp=0.8, top_k=50, top_p=1.0, min_p=0.0,
+                                           repeat_penalty=1.0, reset=True):
+                if token == eos_token_id:
+                    break
+                new_tokens.append(token)
+                if len(new_tokens) >= max_new_tokens:
+                    break
+                if stop_sequences and any(new_tokens[-len(sequence):] == sequence for sequence in stop_sequences):
+                    break
+                if time.monotonic() >= stop_at:
+                    break
+        return _cut_at_stop(new_tokens, stop_sequences)
+
+# Бэкенды по значению MODEL_BACKEND
+MODEL_BACKENDS = {
+    'transformers': TransformersBackend,
+    'onnx': OnnxRuntimeBackend,
+    'gguf': GgufBackend,
+}
+
+class GenerationPolicy:
+    """Бюджет генерации ответа
+    
+    Длина ответа выбирается так, чтобы не тратить токены на текст, который
+    потом выбросит постобработка, и уложиться в GENERATION_SLO_MS при текущей
+    очереди. Типичная длина принятых (не забытых) ответов и скорость модели
+    (токены в секунду, символы на токен) уточняются по ходу работы.
+    """
+    
+    def __init__(self, slo_ms: float = GENERATION_SLO_MS, min_tokens: int = GENERATION_MIN_TOKENS,
+                 max_tokens: int = MAX_NEW_TOKENS):
+        self.slo_ms = slo_ms
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.reply_lengths = deque(maxlen=1000)  # длины принятых ответов в символах
+        self.tokens_per_second: Optional[float] = None
+        self.chars_per_token = 2.0  # кириллица в словаре GPT-2 — примерно 2 символа на токен
+        self._typical_chars: Optional[float] = None  # кэш перцентиля, сбрасывается новыми длинами
+        self.lock = threading.Lock()
+    
+    def learn_reply_lengths(self, lengths: List[int]):
+        """Длины сохранённых ответов (например, из БД при запуске)"""
+        with self.lock:
+            self.reply_lengths.extend(length for length in lengths if length)
+            self._typical_chars = None
+    
+    def observe(self, new_tokens: int, seconds: float, reply_chars: int, truncated: bool = False):
+        """Учесть завершённую генерацию: скорость модели и плотность токенов
+        
+        Ответ, упёршийся в бюджет, считается как максимальный: иначе бюджет
+        подстраивался бы под собственные обрезанные ответы и только сжимался.
+        """
+        if new_tokens <= 0:
+            return
+        with self.lock:
+            if seconds > 0:
+                speed = new_tokens / seconds
+                self.tokens_per_second = speed if self.tokens_per_second is None else \
+                    0.8 * self.tokens_per_second + 0.2 * speed
+            if reply_chars > 0:
+                self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * (reply_chars / new_tokens)
+            self.reply_lengths.append(REPLY_MAX_CHARS if truncated else min(reply_chars, REPLY_MAX_CHARS))
+            self._typical_chars = None
     
-    def update_chat_empathy(self, chat_id: str, empathy_level: int):
-        """Обновление уровня эмпатии чата"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def max_new_tokens(self, message_length: int, empathy_level: int, queue_depth: int = 0) -> int:
+        """Сколько новых токенов разрешить ответу
         
-        cursor.execute('''
-        UPDATE chats 
-        SET empathy_level = ?
-        WHERE chat_id = ?
-        ''', (empathy_level, chat_id))
+        queue_depth — сколько сообщений ждут генерации вместе с этим.
+        """
+        with self.lock:
+            # Обычно принимаемая длина (90-й перцентиль), но не больше, чем переживёт постобработку
+            if self._typical_chars is None:
+                self._typical_chars = float(np.percentile(self.reply_lengths, 90)) \
+                    if len(self.reply_lengths) >= 20 else REPLY_MAX_CHARS
+            target_chars = self._typical_chars
+            tokens_per_second = self.tokens_per_second
+            chars_per_token = self.chars_per_token
         
-        conn.commit()
-        conn.close()
+        # Тёплые ответы длиннее холодных; на короткую реплику — короткий ответ
+        target_chars *= 0.8 + empathy_level / 200
+        if message_length < 20:
+            target_chars *= 0.8
+        elif message_length > 200:
+            target_chars *= 1.2
+        
+        budget = math.ceil(min(target_chars, REPLY_MAX_CHARS) / chars_per_token)
+        
+        # Генерации идут по очереди: ответ должен успеть вместе с теми, кто впереди
+        if tokens_per_second:
+            budget = min(budget, int(tokens_per_second * self.slo_ms / 1000 / (queue_depth + 1)))
+        
+        return max(self.min_tokens, min(self.max_tokens, budget))
+
+class CircuitBreaker:
+    """Предохранитель генерации
+    
+    Помнит исходы последних window генераций; неудача — ошибка, генерация,
+    упёршаяся в GENERATION_TIMEOUT_MS, или ответ узла, не пришедший к сроку.
+    Когда неудач не меньше failure_ratio (и исходов не меньше min_calls),
+    предохранитель размыкается и на cooldown секунд модель заменяется
+    запасными ответами. Затем пропускается одна пробная генерация: успех
+    замыкает предохранитель, неудача размыкает снова.
+    """
+    
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+    
+    def __init__(self, failure_ratio: float = BREAKER_FAILURE_RATIO, cooldown: float = BREAKER_COOLDOWN,
+                 window: int = BREAKER_WINDOW, min_calls: int = BREAKER_MIN_CALLS):
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.min_calls = min_calls
+        self.outcomes = deque(maxlen=window)
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.trial_started: Optional[float] = None  # пробная генерация в полуразомкнутом состоянии
+        self.lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """Можно ли звать модель; False — отвечать запасной репликой"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                # Пробный вызов, исход которого так и не пришёл, через cooldown заменяется новым
+                if self.trial_started is not None and now - self.trial_started < self.cooldown:
+                    return False
+                self.trial_started = now
+            return self.state != self.OPEN
+    
+    def available(self) -> bool:
+        """Подсказка без побочных эффектов: пропустит ли allow() вызов сейчас"""
+        with self.lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return self.state == self.CLOSED or self.trial_started is None
+    
+    def record(self, ok: bool):
+        """Исход генерации, разрешённой allow()"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.trial_started = None
+                if ok:
+                    self.state = self.CLOSED
+                    logger.info("Предохранитель генерации замкнут: пробный ответ успешен")
+                else:
+                    self._open()
+            elif self.state == self.CLOSED:
+                # Исходы брошенных генераций, досчитавших после размыкания, не учитываются
+                self.outcomes.append(ok)
+                failures = self.outcomes.count(False)
+                if len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+                    self._open()
+    
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        METRICS.inc('odanna_breaker_trips_total')
+        logger.warning(f"Предохранитель генерации разомкнут на {self.cooldown:.0f} с: запасные ответы")
+
+
+# Намерения коротких реплик для пула ответов: шаблон и типичное сообщение,
+# на которое генерируются заготовки. Порядок задаёт приоритет
+# («Привет, мне грустно» — это грусть, а не приветствие)
+POOL_INTENTS = {
+    'sadness': (re.compile(r'\b(?:грустн\w*|печальн\w*|тоскливо|одиноко|плохо|устал\w*)\b', re.IGNORECASE),
+                "Мне сегодня грустно..."),
+    'thanks': (re.compile(r'\b(?:спасибо|благодар\w*|спс)\b', re.IGNORECASE),
+               "Спасибо вам!"),
+    'farewell': (re.compile(r'\b(?:пока|до свидания|до встречи|спокойной ночи)\b', re.IGNORECASE),
+                 "Спокойной ночи, Оданна."),
+    'greeting': (re.compile(r'\b(?:привет\w*|здравствуй\w*|добр(?:ый|ое) (?:вечер|день|утро))\b', re.IGNORECASE),
+                 "Добрый вечер, Оданна!"),
+}
+
+# Уровни эмпатии, для которых готовятся заготовки
+POOL_EMPATHY_BUCKETS = (35, 50, 70, 85)
+
+
+def _empathy_bucket(empathy_level: int) -> int:
+    """Ближайший снизу уровень эмпатии пула"""
+    return max((bucket for bucket in POOL_EMPATHY_BUCKETS if bucket <= empathy_level),
+               default=POOL_EMPATHY_BUCKETS[0])
+
+
+class PromptTemplate:
+    """Неизменная часть контекста чата: системный промпт и блок сценария
+    
+    Собирается один раз на сценарий; scenario_ids — токены блока сценария,
+    prefix_ids — начало каждого промпта: системный промпт, урезанный с конца
+    так, чтобы вместе с блоком сценария уложиться в PROMPT_PREFIX_TOKENS
+    (оба None, пока модель не загружена). prefix_key зависит только от текста
+    шаблона: под ним бэкенд держит KV-кэш префикса, общий для всех чатов
+    сценария, а изменённое описание получает новый ключ.
+    """
+    
+    def __init__(self, scenario: str, scenario_prompt: Optional[str] = None):
+        self.scenario = scenario
+        self.scenario_prompt = scenario_prompt
+        self.block = f"\nСценарий: {scenario}"
+        if scenario_prompt and scenario_prompt != scenario:
+            self.block += f"\nОписание сценария: {scenario_prompt}"
+        self.text = f"{ODANNA_SYSTEM_PROMPT}\n{self.block}"
+        self.prefix_key = "scenario:" + hashlib.sha1(self.text.encode('utf-8')).hexdigest()[:16]
+        self.scenario_ids: Optional[Tuple[int, ...]] = None
+        self.prefix_ids: Optional[Tuple[int, ...]] = None
+
+def _parse_scenario(text: str) -> Tuple[str, Optional[str]]:
+    """Название и описание сценария из текста пользователя
+    
+    Название — первая строка, описание — весь текст до SCENARIO_MAX_CHARS
+    символов; если он и есть название, описания нет (None).
+    """
+    description = text.strip()[:SCENARIO_MAX_CHARS]
+    name = description.split("\n", 1)[0].strip()[:SCENARIO_NAME_MAX_CHARS]
+    return name, (description if description != name else None)
 
 class AIManager:
     """Управление нейросетью для генерации ответов"""
     
-    def __init__(self):
-        self.model = None
-        self.tokenizer = None
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.load_model()
+    def __init__(self, backend: str = MODEL_BACKEND, model_name: str = MODEL_NAME, device: str = DEVICE):
+        self.backend = None
+        self.policy = GenerationPolicy()
+        self.breaker = CircuitBreaker()
+        self._token_cache: Dict[str, Tuple[int, ...]] = {}
+        self._templates: OrderedDict = OrderedDict()  # (сценарий, описание) → PromptTemplate
+        self._templates_lock = threading.Lock()
+        self._history_windows: OrderedDict = OrderedDict()  # чат → токены строк истории прошлого промпта
+        self._windows_lock = threading.Lock()
+        if backend:  # пустой бэкенд — без модели (фронтенд с очередью заданий)
+            self.load_model(backend, model_name, device)
     
-    def load_model(self):
-        """Загрузка модели Llama 3"""
+    def load_model(self, backend: str, model_name: str, device: str = DEVICE):
+        """Загрузка модели выбранным бэкендом"""
         try:
-            model_name = "microsoft/DialoGPT-medium"  # Альтернатива для бесплатного использования
+            if backend not in MODEL_BACKENDS:
+                raise ValueError(f"неизвестный бэкенд {backend!r}, доступны: {', '.join(MODEL_BACKENDS)}")
             
-            logger.info(f"Загрузка модели {model_name}...")
+            logger.info(f"Загрузка модели {model_name} ({backend})...")
             
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                device_map="auto" if torch.cuda.is_available() else None
-            )
-            
-            # Добавляем pad_token если его нет
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
+            model_backend = MODEL_BACKENDS[backend](model_name, device)
+            model_backend.load()
+            self.backend = model_backend
+            self._token_cache = {}
+            with self._templates_lock:
+                self._templates.clear()
+            with self._windows_lock:
+                self._history_windows.clear()
             
             logger.info("Модель успешно загружена!")
             
         except Exception as e:
             logger.error(f"Ошибка загрузки модели: {e}")
-            self.model = None
-            self.tokenizer = None
+            self.backend = None
+    
+    @property
+    def tokenizer_id(self) -> Optional[str]:
+        """Метка токенизатора для кэша токенов в БД (None — модель не загружена)"""
+        return self.backend.tokenizer_id if self.backend else None
+    
+    def forget_session(self, chat_id: str):
+        """Сбросить KV-кэш чата: история изменилась или пользователь ушёл в другой чат"""
+        with self._windows_lock:
+            self._history_windows.pop(chat_id, None)
+        if self.backend is not None:
+            self.backend.invalidate_session(chat_id)
+    
+    def scenario_template(self, scenario: str, scenario_prompt: Optional[str] = None) -> PromptTemplate:
+        """Скомпилированный шаблон сценария из LRU-кэша на TEMPLATE_CACHE_SIZE записей"""
+        key = (scenario, scenario_prompt)
+        with self._templates_lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+        
+        template = PromptTemplate(scenario, scenario_prompt)
+        if self.backend is not None:
+            template.scenario_ids = tuple(self.backend.encode("\n" + template.block))
+            # Окно считается по потолку ответа, поэтому граница шаблона не сдвигается от хода к ходу
+            size = min(PROMPT_PREFIX_TOKENS, MAX_PROMPT_TOKENS - MAX_NEW_TOKENS - PROMPT_TURN_TOKENS)
+            system_ids = self._encode_cached(ODANNA_SYSTEM_PROMPT)
+            template.prefix_ids = (system_ids[:max(0, size - len(template.scenario_ids))]
+                                   + template.scenario_ids)[:size]
+        with self._templates_lock:
+            self._templates[key] = template
+            while len(self._templates) > TEMPLATE_CACHE_SIZE:
+                self._templates.popitem(last=False)
+        METRICS.inc('odanna_prompt_templates_compiled_total')
+        return template
+    
+    def invalidate_scenario(self, scenario: str, scenario_prompt: Optional[str] = None):
+        """Забыть шаблон изменённого сценария и KV-кэш его префикса"""
+        with self._templates_lock:
+            template = self._templates.pop((scenario, scenario_prompt), None)
+        if template is not None and self.backend is not None:
+            self.backend.invalidate_session(template.prefix_key)
+    
+    def encode_turn(self, speaker: str, text: str) -> List[int]:
+        """Токены строки истории «\nГоворящий: текст» — в таком виде она входит в контекст"""
+        return self.backend.encode(f"\n{speaker}: {text}")
     
     def analyze_emotion(self, text: str) -> str:
         """Анализ эмоций в тексте"""
@@ -346,6 +4391,15 @@ class AIManager:
         
         return ', '.join(emotions) if emotions else 'нейтральное'
     
+    def detect_intent(self, text: str) -> Optional[str]:
+        """Намерение короткой малоинформативной реплики (ключ POOL_INTENTS) или None"""
+        if '?' in text or len(text.split()) > POOL_MAX_WORDS:
+            return None
+        for intent, (pattern, _) in POOL_INTENTS.items():
+            if pattern.search(text):
+                return intent
+        return None
+    
     def calculate_empathy_level(self, emotion: str, current_level: int, message_count: int) -> int:
         """Расчет уровня эмпатии"""
         # Начальная эмпатия
@@ -367,60 +4421,146 @@ class AIManager:
         return max(35, min(85, base_level))
     
     def generate_odanna_response(self, user_message: str, chat_history: List[str], 
-                                empathy_level: int, emotion: str, scenario: str) -> str:
-        """Генерация ответа в стиле Оданны"""
+                                empathy_level: int, emotion: str, scenario: str,
+                                memories: Optional[List[str]] = None,
+                                history_tokens: Optional[List[Optional[List[int]]]] = None,
+                                message_tokens: Optional[List[int]] = None,
+                                session_key: Optional[str] = None,
+                                queue_depth: int = 0, deadline: Optional[float] = None,
+                                scenario_prompt: Optional[str] = None) -> str:
+        """Генерация ответа в стиле Оданны
+        
+        history_tokens — готовые токены строк chat_history (см. encode_turn),
+        message_tokens — токены текущего сообщения; чего нет, токенизируется здесь.
+        session_key — чат, чей KV-кэш можно переиспользовать.
+        scenario_prompt — описание пользовательского сценария (None — только название).
+        queue_depth — сколько ещё сообщений ждут ответа (для бюджета генерации).
+        deadline — момент time.monotonic(), к которому ответ должен быть готов.
+        """
         
-        if not self.model or not self.tokenizer:
+        if self.backend is None or not self.breaker.allow():
+            METRICS.inc('odanna_responses_total', source="fallback")
             return self._fallback_response(user_message, empathy_level, emotion)
         
+        if deadline is None:
+            deadline = time.monotonic() + GENERATION_TIMEOUT_MS / 1000
         try:
-            # Формируем контекст для генерации
-            context = self._build_context(user_message, chat_history, empathy_level, emotion, scenario)
-            
-            # Токенизация
-            inputs = self.tokenizer.encode(context, return_tensors='pt', max_length=1024, truncation=True)
-            inputs = inputs.to(self.device)
-            
-            # Генерация
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    inputs,
-                    max_length=inputs.shape[1] + 150,
-                    num_return_sequences=1,
-                    temperature=0.8,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id
-                )
+            response = self._generate(user_message, chat_history, empathy_level, emotion, scenario,
+                                      memories, history_tokens, message_tokens, session_key, queue_depth,
+                                      deadline, scenario_prompt)
+            ok = time.monotonic() < deadline - GENERATION_STOP_MARGIN
+            METRICS.inc('odanna_responses_total', source="model")
             
-            # Декодирование ответа
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-            response = response[len(context):].strip()
+        except Exception as e:
+            logger.error(f"Ошибка генерации ответа: {e!r}")
+            response, ok = None, False
+            METRICS.inc('odanna_responses_total', source="fallback")
+        
+        # После срока ответа исход уже учёл тот, кто его не дождался (OdannaBot._generate_response)
+        if time.monotonic() < deadline:
+            self.breaker.record(ok)
+        return response if response is not None else self._fallback_response(user_message, empathy_level, emotion)
+    
+    def generate_pool_response(self, intent: str, empathy_level: int, scenario: str) -> Optional[str]:
+        """Заготовка для пула: ответ модели на типичное сообщение намерения без истории
+        
+        None, если модель недоступна или ошиблась: запасные ответы в пул не попадают.
+        """
+        if self.backend is None or self.breaker.state != CircuitBreaker.CLOSED:
+            return None
+        
+        user_message = POOL_INTENTS[intent][1]
+        try:
+            return self._generate(user_message, [], empathy_level, self.analyze_emotion(user_message), scenario)
+        except Exception as e:
+            logger.error(f"Ошибка генерации заготовки ({intent}, {empathy_level}): {e}")
+            return None
+    
+    def _generate(self, user_message: str, chat_history: List[str], empathy_level: int, emotion: str,
+                  scenario: str, memories: Optional[List[str]] = None,
+                  history_tokens: Optional[List[Optional[List[int]]]] = None,
+                  message_tokens: Optional[List[int]] = None,
+                  session_key: Optional[str] = None, queue_depth: int = 0,
+                  deadline: Optional[float] = None, scenario_prompt: Optional[str] = None) -> str:
+        """Генерация моделью без запасного ответа: ошибки уходят вызывающему
+        
+        К моменту deadline (time.monotonic()) генерация останавливается и
+        отдаёт написанное; если он прошёл до начала — TimeoutError.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + GENERATION_TIMEOUT_MS / 1000
+        # Бюджет ответа по нагрузке, длине сообщения и эмпатии; реплика
+        # за пользователя («\nПользователь:») завершает генерацию
+        max_new_tokens = self.policy.max_new_tokens(len(user_message), empathy_level, queue_depth)
+        METRICS.observe('odanna_generation_budget_tokens', max_new_tokens)
+        stop_sequences = [list(self._encode_cached("\nПользователь:"))]
+        
+        # Контекст собирается сразу из токенов: история и служебные части уже токенизированы
+        with METRICS.timer('odanna_stage_seconds', stage="tokenize"):
+            template = self.scenario_template(scenario, scenario_prompt)
+            input_ids = self._build_input_ids(user_message, chat_history, empathy_level, emotion,
+                                              scenario, memories, history_tokens, message_tokens,
+                                              scenario_prompt, max_new_tokens, session_key)
+        METRICS.observe('odanna_prompt_tokens', len(input_ids))
+        
+        # Общий KV-префикс сценария: промпт всегда начинается с template.prefix_ids,
+        # а они определяются текстом шаблона, поэтому ключ шаблона подходит и им
+        prefix_key, prefix_length = template.prefix_key, len(template.prefix_ids)
+        
+        # Генерация (с трассой torch, если обновление профилируется)
+        max_time = deadline - time.monotonic() - GENERATION_STOP_MARGIN
+        if max_time <= 0:
+            raise TimeoutError("срок ответа истёк до начала генерации")
+        session = CURRENT_PROFILE.get()
+        started = time.perf_counter()
+        with session.generation() if session else nullcontext():
+            output_ids = self.backend.generate(input_ids, max_new_tokens, session_key, stop_sequences, max_time,
+                                               prefix_key, prefix_length)
+        elapsed = time.perf_counter() - started
+        if elapsed >= max_time:
+            METRICS.inc('odanna_generation_timeouts_total', result="stopped")
+        new_tokens = len(output_ids)
+        METRICS.observe('odanna_stage_seconds', elapsed, stage="generate")
+        METRICS.inc('odanna_generated_tokens_total', new_tokens)
+        if elapsed > 0:
+            METRICS.observe('odanna_generation_tokens_per_second', new_tokens / elapsed)
+        
+        with METRICS.timer('odanna_stage_seconds', stage="postprocess"):
+            # Декодирование ответа (бэкенд возвращает только новые токены)
+            response = self.backend.decode(output_ids).strip()
+            self.policy.observe(new_tokens, elapsed, len(response), truncated=new_tokens >= max_new_tokens)
             
             # Постобработка ответа
-            response = self._post_process_response(response, empathy_level, emotion)
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Ошибка генерации ответа: {e}")
-            return self._fallback_response(user_message, empathy_level, emotion)
+            return self._post_process_response(response, empathy_level, emotion)
     
-    def _build_context(self, user_message: str, chat_history: List[str], 
-                      empathy_level: int, emotion: str, scenario: str) -> str:
-        """Построение контекста для генерации"""
+    def _context_header(self, empathy_level: int, emotion: str,
+                        memories: Optional[List[str]] = None) -> List[str]:
+        """Сведения текущего хода: идут после истории разговора, перед сообщением"""
         
         context_parts = [
-            ODANNA_SYSTEM_PROMPT,
-            f"\nСценарий: {scenario}",
             f"\nУровень эмпатии: {empathy_level}%",
             f"\nЭмоциональное состояние собеседника: {emotion}",
-            "\nИстория разговора:"
         ]
         
-        # Добавляем историю чата
-        for msg in chat_history[-5:]:  # Последние 5 сообщений
-            context_parts.append(msg)
+        # Давние реплики, близкие по смыслу к текущему сообщению
+        if memories:
+            context_parts.append("\nВоспоминания о прошлых беседах:")
+            context_parts.extend(memories)
+        
+        return context_parts
+    
+    def _build_context(self, user_message: str, chat_history: List[str], 
+                      empathy_level: int, emotion: str, scenario: str,
+                      memories: Optional[List[str]] = None,
+                      scenario_prompt: Optional[str] = None) -> str:
+        """Построение контекста для генерации (целиком, без урезания под окно модели)"""
+        
+        template = self.scenario_template(scenario, scenario_prompt)
+        context_parts = [template.text, "\nИстория разговора:"]
+        
+        # Сначала история чата, сведения хода меняются и идут после неё
+        context_parts.extend(chat_history)
+        context_parts.extend(self._context_header(empathy_level, emotion, memories))
         
         context_parts.extend([
             f"\nПользователь: {user_message}",
@@ -429,12 +4569,104 @@ class AIManager:
         
         return "\n".join(context_parts)
     
+    def _build_input_ids(self, user_message: str, chat_history: List[str],
+                         empathy_level: int, emotion: str, scenario: str,
+                         memories: Optional[List[str]] = None,
+                         history_tokens: Optional[List[Optional[List[int]]]] = None,
+                         message_tokens: Optional[List[int]] = None,
+                         scenario_prompt: Optional[str] = None,
+                         max_new_tokens: int = MAX_NEW_TOKENS,
+                         session_key: Optional[str] = None) -> List[int]:
+        """Токены контекста _build_context, собранные из готовых кусков
+        
+        Каждая часть после первой входит в контекст как «\n» + часть, поэтому
+        строка истории — это ровно токены encode_turn. Промпт вместе с ответом
+        должен уместиться в окно модели MAX_PROMPT_TOKENS (дальше у GPT-2 нет
+        позиций). Окно считается по потолку MAX_NEW_TOKENS, а шаблон сценария
+        берётся готовым (template.prefix_ids), поэтому начало промпта одно и
+        то же на каждом ходу; история урезается только целыми старыми
+        репликами (см. _history_window), сведения хода идут после неё.
+        """
+        template = self.scenario_template(scenario, scenario_prompt)
+        limit = MAX_PROMPT_TOKENS - max(max_new_tokens, MAX_NEW_TOKENS)
+        head = list(template.prefix_ids) + list(self._encode_cached("\n\nИстория разговора:"))
+        
+        if message_tokens is None:
+            message_tokens = self.encode_turn("Пользователь", user_message)
+        tail = []
+        for part in self._context_header(empathy_level, emotion, memories):
+            tail.extend(self._encode_cached("\n" + part))
+        tail.extend(self._encode_cached("\n"))
+        tail.extend(message_tokens)
+        tail.extend(self._encode_cached("\n\nОданна:"))
+        tail = tail[-(limit - len(head)):]
+        
+        lines = [tuple(tokens) if tokens is not None else tuple(self.backend.encode("\n" + line))
+                 for line, tokens in zip(chat_history, history_tokens or [None] * len(chat_history))]
+        # Сведения хода длиннее запаса (длинное сообщение) теснят историю только в этом ходу
+        budget = max(0, limit - len(head) - max(len(tail), PROMPT_TURN_TOKENS))
+        window = self._history_window(session_key, chat_history, lines, budget)
+        return head + [token for line in window for token in line] + tail
+    
+    def _history_window(self, session_key: Optional[str], chat_history: List[str],
+                        lines: List[Tuple[int, ...]], budget: int) -> List[Tuple[int, ...]]:
+        """Строки истории в промпте: прошлое окно чата, дописанное новыми репликами
+        
+        Пока окно session_key находится в chat_history целиком и вместе с новыми
+        строками умещается в budget токенов, промпт чата лишь растёт с конца.
+        Иначе окно начинается заново с реплики пользователя: берутся последние
+        целые реплики не больше чем на половину бюджета и половину переданной
+        истории, чтобы следующим ходам было куда расти, а KV-кэш чата
+        сбрасывается. Без session_key — сколько уместится.
+        """
+        suffix = [0] * (len(lines) + 1)
+        for i in range(len(lines) - 1, -1, -1):
+            suffix[i] = suffix[i + 1] + len(lines[i])
+        
+        with self._windows_lock:
+            previous = self._history_windows.get(session_key) if session_key is not None else None
+        
+        # Одинаковые реплики могут повторяться: прошлое окно — последнее совпадение;
+        # пустое окно (новый чат) растёт с начала переданной истории
+        start = None
+        if previous is not None:
+            for i in range(len(lines) - len(previous), -1, -1) if previous else [0]:
+                if tuple(lines[i:i + len(previous)]) == previous:
+                    start = i if suffix[i] <= budget else None
+                    break
+        
+        if start is None:
+            turn_starts = [i for i, line in enumerate(chat_history) if line.startswith("Пользователь:")]
+            fitting = [i for i in turn_starts if suffix[i] <= budget] + [len(lines)]
+            roomy = [i for i in fitting[:-1] if suffix[i] <= budget // 2 and i >= len(lines) // 2]
+            start = (roomy if session_key is not None and roomy else fitting)[0]
+            if previous is not None:
+                self.backend.invalidate_session(session_key)
+        
+        window = lines[start:]
+        if session_key is not None:
+            with self._windows_lock:
+                self._history_windows[session_key] = tuple(window)
+                self._history_windows.move_to_end(session_key)
+                while len(self._history_windows) > PROMPT_WINDOWS_SIZE:
+                    self._history_windows.popitem(last=False)
+        return window
+    
+    def _encode_cached(self, text: str) -> Tuple[int, ...]:
+        """Токены повторяющихся частей контекста: системного промпта и служебных строк"""
+        tokens = self._token_cache.get(text)
+        if tokens is None:
+            if len(self._token_cache) >= 1024:
+                self._token_cache.clear()
+            tokens = self._token_cache[text] = tuple(self.backend.encode(text))
+        return tokens
+    
     def _post_process_response(self, response: str, empathy_level: int, emotion: str) -> str:
         """Постобработка ответа для соответствия характеру Оданны"""
         
         # Убираем лишние повторы и обрезаем длинные ответы
         response = re.sub(r'(.+?)\1+', r'\1', response)  # Убираем повторы
-        response = response[:500]  # Ограничиваем длину
+        response = response[:REPLY_MAX_CHARS]  # Ограничиваем длину
         
         # Добавляем характерные элементы Оданны
         honorifics = ["", "-сан", "-кун", "-чан"]
@@ -457,58 +4689,855 @@ class AIManager:
             if not any(ending in response for ending in ironic_endings):
                 response += ironic_endings[len(response) % len(ironic_endings)]
         
-        return response.strip()
+        return response.strip()
+    
+    def _fallback_response(self, user_message: str, empathy_level: int, emotion: str) -> str:
+        """Запасные ответы при недоступности модели"""
+        
+        responses = {
+            35: [
+                "Интересно... *пристально смотрит красными глазами* Продолжайте.",
+                "Ваши слова... заслуживают внимания. Что ещё вас беспокоит?",
+                "Хм. *легкий наклон головы* Я слушаю."
+            ],
+            50: [
+                "Понимаю ваше состояние. В Небесной Гостинице мы знаем цену словам.",
+                "Ваши переживания не остались незамеченными. Расскажите больше.",
+                "Каждый гость заслуживает внимания. Я здесь, чтобы выслушать."
+            ],
+            70: [
+                "Ваши слова тронули даже демона вроде меня. Не держите всё в себе.",
+                "Позвольте мне проявить заботу, как подобает хозяину гостиницы.",
+                "В моих глазах вы видите понимание. Доверьтесь мне."
+            ]
+        }
+        
+        # Выбираем ближайший уровень эмпатии
+        closest_level = min(responses.keys(), key=lambda x: abs(x - empathy_level))
+        level_responses = responses[closest_level]
+        
+        # Модификация на основе эмоций
+        if "грусть" in emotion:
+            return "Печаль... она знакома даже демонам. *мягко кладет руку на плечо* Расскажите мне о своих переживаниях."
+        elif "радость" in emotion:
+            return "*едва заметная улыбка* Радость украшает любого гостя. Что принесло вам столько света?"
+        elif "возбуждение" in emotion:
+            return "*поднимает бровь* Какая энергия... Надеюсь, она направлена в нужное русло?"
+        
+        return level_responses[len(user_message) % len(level_responses)]
+
+class ChatMemoryIndex:
+    """Векторный индекс реплик одного чата
+    
+    Векторы хранятся как float32 либо как int8 с масштабом на строку.
+    Основной блок может быть отображён в память (np.load mmap_mode='r'),
+    новые векторы копятся отдельными блоками и сливаются пачками.
+    """
+    
+    SCORE_CHUNK_ROWS = 4096
+    MAX_PENDING_BLOCKS = 64
+    
+    def __init__(self, dim: int, dtype: str = 'int8'):
+        self.dim = dim
+        self.dtype = dtype
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, dim), dtype=self.vector_dtype(dtype))
+        self.scales = np.empty(0, dtype=np.float32)
+        self.pending = []  # [(ids, vectors, scales)] — ещё не слитые блоки
+        self.max_id = 0
+        self.dirty = False
+    
+    @staticmethod
+    def vector_dtype(dtype: str) -> np.dtype:
+        return np.dtype(np.int8 if dtype == 'int8' else np.float32)
+    
+    def __len__(self) -> int:
+        return len(self.ids) + sum(len(block[0]) for block in self.pending)
+    
+    def add(self, ids: List[int], embeddings: np.ndarray):
+        """Добавление нормированных векторов; уже проиндексированные ID пропускаются
+        
+        ID не обязаны расти: догоняющая индексация истории добавляет старые
+        реплики после новых. Проверка по всем ID нужна только для них.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        keep = ids > self.max_id
+        if not keep.all():
+            known = np.concatenate([self.ids] + [block[0] for block in self.pending])
+            keep |= ~np.isin(ids, known)
+        if not keep.any():
+            return
+        ids, embeddings = ids[keep], embeddings[keep].astype(np.float32)
+        
+        if self.dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            vectors = np.round(embeddings / scales[:, None]).astype(np.int8)
+        else:
+            scales = np.ones(len(ids), dtype=np.float32)
+            vectors = embeddings
+        
+        self.pending.append((ids, vectors, scales.astype(np.float32)))
+        self.max_id = max(self.max_id, int(ids.max()))
+        self.dirty = True
+        
+        if len(self.pending) > self.MAX_PENDING_BLOCKS:
+            self._merge()
+    
+    def _merge(self):
+        """Слияние накопленных блоков с основным"""
+        if not self.pending:
+            return
+        self.ids = np.concatenate([self.ids] + [block[0] for block in self.pending])
+        self.vectors = np.concatenate([self.vectors] + [block[1] for block in self.pending])
+        self.scales = np.concatenate([self.scales] + [block[2] for block in self.pending])
+        self.pending = []
+    
+    def _scores(self, vectors: np.ndarray, scales: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """Косинусная близость (векторы нормированы) блоками, помещающимися в кэш"""
+        if self.dtype != 'int8':
+            return vectors @ query
+        
+        scores = np.empty(len(vectors), dtype=np.float32)
+        for start in range(0, len(vectors), self.SCORE_CHUNK_ROWS):
+            chunk = vectors[start:start + self.SCORE_CHUNK_ROWS]
+            scores[start:start + len(chunk)] = chunk.astype(np.float32) @ query
+        return scores * scales
+    
+    def search(self, query: np.ndarray, k: int, exclude_ids=()) -> List[int]:
+        """ID k ближайших реплик, от самой похожей"""
+        if len(self) == 0 or k <= 0:
+            return []
+        
+        query = query.astype(np.float32)
+        blocks = [(self.ids, self.vectors, self.scales)] + self.pending
+        ids = np.concatenate([block[0] for block in blocks])
+        scores = np.concatenate([self._scores(block[1], block[2], query) for block in blocks])
+        
+        if exclude_ids:
+            scores[np.isin(ids, list(exclude_ids))] = -np.inf
+        
+        k = min(k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [int(ids[i]) for i in top if np.isfinite(scores[i])]
+    
+    def save(self, path_prefix: str):
+        """Атомарная запись индекса в три .npy файла"""
+        self._merge()
+        for suffix, array in (("ids", self.ids), ("vec", self.vectors), ("scale", self.scales)):
+            tmp_path = f"{path_prefix}.{suffix}.tmp.npy"
+            np.save(tmp_path, array)
+            os.replace(tmp_path, f"{path_prefix}.{suffix}.npy")
+        self.dirty = False
+    
+    @classmethod
+    def load(cls, path_prefix: str, dim: int, dtype: str) -> Optional['ChatMemoryIndex']:
+        """Загрузка индекса с отображением файлов в память"""
+        if not os.path.exists(f"{path_prefix}.ids.npy"):
+            return None
+        index = cls(dim, dtype)
+        index.ids = np.load(f"{path_prefix}.ids.npy", mmap_mode='r')
+        index.vectors = np.load(f"{path_prefix}.vec.npy", mmap_mode='r')
+        index.scales = np.load(f"{path_prefix}.scale.npy", mmap_mode='r')
+        if index.vectors.shape[1:] != (dim,) or index.vectors.dtype != cls.vector_dtype(dtype):
+            logger.warning(f"Индекс памяти {path_prefix} несовместим с моделью, будет перестроен")
+            return None
+        index.max_id = int(index.ids.max()) if len(index.ids) else 0
+        return index
+
+
+class SemanticMemory:
+    """Долговременная память чатов: эмбеддинги реплик и поиск похожих
+    
+    Реплики встают в очередь и кодируются пачками в фоновом потоке,
+    на горячем пути кодируется только текущее сообщение пользователя.
+    """
+    
+    def __init__(self, db: 'StorageBackend', model_name: str = EMBEDDING_MODEL,
+                 storage_dir: Optional[str] = MEMORY_DIR, dtype: str = MEMORY_DTYPE,
+                 max_indexes: int = MEMORY_INDEX_CACHE_SIZE):
+        self.db = db
+        self.storage_dir = storage_dir
+        self.dtype = dtype
+        self.max_indexes = max_indexes
+        self.model = None
+        self.dim = None
+        self.indexes: OrderedDict = OrderedDict()  # chat_id → ChatMemoryIndex, LRU
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.last_flush = time.monotonic()
+        
+        self.load_model(model_name)
+        
+        if self.enabled:
+            if storage_dir:
+                os.makedirs(storage_dir, exist_ok=True)
+            threading.Thread(target=self._worker, name="semantic-memory", daemon=True).start()
+    
+    @property
+    def enabled(self) -> bool:
+        return self.model is not None
+    
+    def load_model(self, model_name: str):
+        """Загрузка небольшой локальной модели эмбеддингов (CPU)"""
+        if not model_name:
+            logger.info("Семантическая память отключена")
+            return
+        
+        try:
+            from sentence_transformers import SentenceTransformer
+            
+            logger.info(f"Загрузка модели эмбеддингов {model_name}...")
+            self.model = SentenceTransformer(model_name, device="cpu")
+            self.dim = self.model.get_sentence_embedding_dimension()
+            logger.info("Модель эмбеддингов загружена!")
+            
+        except Exception as e:
+            logger.error(f"Ошибка загрузки модели эмбеддингов: {e}")
+            self.model = None
+    
+    @staticmethod
+    def turn_text(message_text: str, response_text: Optional[str]) -> str:
+        """Текст реплики в том же виде, что и в истории разговора"""
+        text = f"Пользователь: {message_text}"
+        if response_text:
+            text += f"\nОданна: {response_text}"
+        return text
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(
+            texts, batch_size=MEMORY_BATCH_SIZE, normalize_embeddings=True, convert_to_numpy=True
+        )
+    
+    def add_turn(self, chat_id: str, message_id: int, message_text: str, response_text: Optional[str]):
+        """Поставить реплику в очередь на индексацию"""
+        if self.enabled:
+            self.queue.put(("turn", chat_id, message_id, self.turn_text(message_text, response_text)))
+    
+    def recall(self, chat_id: str, text: str, k: int = MEMORY_TOP_K, exclude_ids=()) -> List[str]:
+        """Тексты k прошлых реплик чата, наиболее близких по смыслу к text"""
+        if not self.enabled or k <= 0:
+            return []
+        
+        query = self._encode([text])[0]
+        with self.lock:
+            message_ids = self._get_index(chat_id).search(query, k, exclude_ids)
+        
+        if not message_ids:
+            return []
+        
+        # Забытые и удалённые реплики отсеиваются по актуальному состоянию БД
+        turns = self.db.get_messages_by_ids(chat_id, message_ids)
+        return [self.turn_text(msg_text, response_text) for _, msg_text, response_text in turns]
+    
+    def _index_path(self, chat_id: str) -> Optional[str]:
+        return os.path.join(self.storage_dir, chat_id) if self.storage_dir else None
+    
+    def _get_index(self, chat_id: str) -> ChatMemoryIndex:
+        """Индекс чата из LRU-кэша на max_indexes записей (вызывать под lock)
+        
+        При первом обращении индекс догоняет историю из БД. Граница догоняющей
+        индексации берётся сразу, до первых новых реплик: иначе они подняли бы
+        max_id, и история между ними и индексом на диске не попала бы в индекс.
+        Вытесненный индекс сбрасывается на диск; без каталога он строится
+        заново из БД при следующем обращении.
+        """
+        index = self.indexes.get(chat_id)
+        if index is not None:
+            self.indexes.move_to_end(chat_id)
+            return index
+        
+        path = self._index_path(chat_id)
+        index = (ChatMemoryIndex.load(path, self.dim, self.dtype) if path else None) \
+            or ChatMemoryIndex(self.dim, self.dtype)
+        self.indexes[chat_id] = index
+        self.queue.put(("backfill", chat_id, index.max_id))
+        
+        while len(self.indexes) > self.max_indexes:
+            evicted_id, evicted = self.indexes.popitem(last=False)
+            if self.storage_dir and evicted.dirty:
+                evicted.save(self._index_path(evicted_id))
+        return index
+    
+    def _worker(self):
+        """Фоновая индексация: собирает очередь в пачки и кодирует их"""
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MEMORY_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get(timeout=0.05))
+                except queue.Empty:
+                    break
+            
+            try:
+                turns = []
+                for item in batch:
+                    if item[0] == "turn":
+                        turns.append(item[1:])
+                    else:
+                        self._index_turns(turns)
+                        turns = []
+                        self._backfill(*item[1:])
+                self._index_turns(turns)
+                
+                if time.monotonic() - self.last_flush > MEMORY_FLUSH_INTERVAL:
+                    self.flush()
+                    
+            except Exception as e:
+                logger.error(f"Ошибка индексации памяти: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+    
+    def _index_turns(self, turns: List[Tuple[str, int, str]]):
+        if not turns:
+            return
+        
+        embeddings = self._encode([text for _, _, text in turns])
+        
+        with self.lock:
+            for chat_id in dict.fromkeys(chat_id for chat_id, _, _ in turns):
+                rows = [i for i, turn in enumerate(turns) if turn[0] == chat_id]
+                self._get_index(chat_id).add([turns[i][1] for i in rows], embeddings[rows])
+    
+    def _backfill(self, chat_id: str, after_id: int):
+        """Индексация сообщений чата после after_id, сохранённых до появления индекса"""
+        has_newer = True
+        while has_newer:
+            messages, _, has_newer = self.db.get_chat_messages_page(
+                chat_id, MEMORY_BATCH_SIZE, after_id=after_id
+            )
+            if not messages:
+                break
+            self._index_turns([
+                (chat_id, message_id, self.turn_text(msg_text, response_text))
+                for message_id, msg_text, response_text, _, _, _ in messages
+            ])
+            after_id = messages[-1][0]
+    
+    def drain(self, timeout: float):
+        """Дождаться индексации очереди (не дольше timeout) и сбросить индексы на диск
+        
+        Что не успело проиндексироваться, догонит из БД следующий запуск.
+        """
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.flush()
+    
+    def forget_chat(self, chat_id: str):
+        """Убрать индекс удалённого чата из кэша и с диска"""
+        with self.lock:
+            self.indexes.pop(chat_id, None)
+            path = self._index_path(chat_id)
+            if path:
+                for suffix in ("ids", "vec", "scale"):
+                    if os.path.exists(f"{path}.{suffix}.npy"):
+                        os.unlink(f"{path}.{suffix}.npy")
+    
+    def flush(self):
+        """Сброс изменённых индексов на диск"""
+        self.last_flush = time.monotonic()
+        if not self.storage_dir:
+            return
+        
+        with self.lock:
+            for chat_id, index in self.indexes.items():
+                if index.dirty:
+                    index.save(self._index_path(chat_id))
+
+
+class PriorityUpdateProcessor(BaseUpdateProcessor):
+    """Две полосы обработки обновлений Telegram
+    
+    Нажатия кнопок и команды только читают и правят БД — они идут быстрой
+    полосой со своим лимитом и не ждут генерацию. Текстовые сообщения идут
+    полосой генерации; сообщения одного пользователя в ней обрабатываются
+    по порядку. Общий лимит PTB задан с запасом: очереди держат семафоры
+    полос, поэтому переполненная полоса генерации не занимает мест быстрой.
+    
+    on_receive вызывается для сообщения в потоке сразу при получении;
+    места в очереди пользователя и в полосе занимаются без ожидания записи
+    (порядок сообщений сохраняется), а обработка ждёт её завершения.
+    При остановке (draining) сообщения, не дождавшиеся полосы, не
+    обрабатываются — они остаются для следующего экземпляра.
+    """
+    
+    MAX_PENDING_UPDATES = 4096
+    
+    def __init__(self, fast_lane_size: int = FAST_LANE_SIZE, llm_lane_size: int = LLM_LANE_SIZE,
+                 on_receive: Optional[Callable[[object], None]] = None):
+        super().__init__(self.MAX_PENDING_UPDATES)
+        self.lanes = {
+            "fast": asyncio.Semaphore(fast_lane_size),
+            "llm": asyncio.Semaphore(llm_lane_size),
+        }
+        self.user_locks: Dict[int, asyncio.Lock] = {}
+        self.user_waiters: Dict[int, int] = {}
+        self.on_receive = on_receive
+        self.active = set()  # задачи обновлений в обработке или в ожидании полосы
+        self.draining = False
+        self.skipped = 0  # сообщения, оставленные следующему экземпляру
+    
+    @staticmethod
+    def lane(update: object) -> str:
+        """Полоса обновления: llm для текстовых сообщений, fast для остального"""
+        message = getattr(update, 'message', None)
+        text = getattr(message, 'text', None)
+        return "llm" if text and not text.startswith('/') else "fast"
+    
+    async def do_process_update(self, update: object, coroutine):
+        lane = self.lane(update)
+        user = getattr(update, 'effective_user', None)
+        started = time.perf_counter()
+        received = None
+        if lane == "llm" and self.on_receive:
+            received = asyncio.ensure_future(asyncio.to_thread(self.on_receive, update))
+        
+        task = asyncio.current_task()
+        self.active.add(task)
+        try:
+            if self.draining and lane == "llm":
+                if received:
+                    await received
+                return self._hand_off(coroutine)
+            async with self._user_turn(user.id if lane == "llm" and user else None):
+                async with self.lanes[lane]:
+                    if received:
+                        await received
+                    if self.draining and lane == "llm":
+                        return self._hand_off(coroutine)
+                    METRICS.observe('odanna_lane_wait_seconds', time.perf_counter() - started, lane=lane)
+                    METRICS.inc('odanna_lane_active', lane=lane)
+                    try:
+                        await coroutine
+                    finally:
+                        METRICS.inc('odanna_lane_active', -1, lane=lane)
+        except asyncio.CancelledError:
+            # Остановка прервала ожидание или генерацию: сообщение остаётся во входящих,
+            # а для PTB обработка завершена (иначе Application.stop ждёт task_done вечно)
+            if not self.draining:
+                raise
+            coroutine.close()
+        finally:
+            self.active.discard(task)
+    
+    def _hand_off(self, coroutine):
+        """Сообщение не обрабатывается — его получит следующий экземпляр"""
+        coroutine.close()
+        self.skipped += 1
+        METRICS.inc('odanna_handoff_updates_total')
+    
+    @asynccontextmanager
+    async def _user_turn(self, user_id: Optional[int]):
+        """Очередь сообщений одного пользователя; замок удаляется с последним ожидающим"""
+        if user_id is None:
+            yield
+            return
+        
+        lock = self.user_locks.setdefault(user_id, asyncio.Lock())
+        self.user_waiters[user_id] = self.user_waiters.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.user_waiters[user_id] -= 1
+            if not self.user_waiters[user_id]:
+                del self.user_waiters[user_id]
+                del self.user_locks[user_id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+class JobQueue(ABC):
+    """Надёжная очередь заданий генерации между фронтендами и узлами генерации
+    
+    Задание выдаётся одному узлу и возвращается в очередь, если узел не
+    подтвердил его за JOB_VISIBILITY_TIMEOUT (упал или завис). Результат
+    приходит в очередь ответов фронтенда reply_to, поставившего задание.
+    """
+    
+    @abstractmethod
+    def enqueue(self, job_id: str, reply_to: str, inputs: dict):
+        ...
+    
+    @abstractmethod
+    def claim(self, consumer: str, block_ms: int = JOB_BLOCK_MS) -> Optional[Tuple[str, str, dict, int]]:
+        """Взять задание: (job_id, reply_to, inputs, номер выдачи) или None, если очередь пуста"""
+    
+    @abstractmethod
+    def complete(self, job_id: str, reply_to: str, result: dict):
+        """Отправить результат фронтенду и подтвердить задание"""
+    
+    @abstractmethod
+    def retry(self, job_id: str, consumer: str):
+        """Вернуть задание в очередь сразу, не дожидаясь таймаута видимости"""
+    
+    @abstractmethod
+    def fetch_results(self, reply_to: str, block_ms: int = JOB_BLOCK_MS) -> List[Tuple[str, dict]]:
+        """Забрать готовые результаты фронтенда: [(job_id, result)]"""
+    
+    @abstractmethod
+    def depth(self) -> int:
+        """Задания, ещё не выполненные ни одним узлом"""
+    
+    def close(self):
+        pass
+
+class SQLiteJobQueue(JobQueue):
+    """Очередь в локальном файле SQLite — для фронтенда и узлов генерации на одной машине"""
+    
+    def __init__(self, path: str, visibility_timeout: int = JOB_VISIBILITY_TIMEOUT):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            reply_to TEXT,
+            inputs TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            claimed_by TEXT,
+            claimed_at REAL,
+            result TEXT,
+            created_at REAL
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_reply ON jobs (reply_to, status)')
+        conn.commit()
+        conn.close()
+    
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT)
+    
+    def enqueue(self, job_id: str, reply_to: str, inputs: dict):
+        conn = self._connect()
+        conn.execute('INSERT INTO jobs (job_id, reply_to, inputs, created_at) VALUES (?, ?, ?, ?)',
+                     (job_id, reply_to, json.dumps(inputs, ensure_ascii=False), time.time()))
+        conn.commit()
+        conn.close()
+    
+    def claim(self, consumer: str, block_ms: int = JOB_BLOCK_MS) -> Optional[Tuple[str, str, dict, int]]:
+        deadline = time.monotonic() + block_ms / 1000
+        while True:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = conn.execute('''
+            SELECT job_id, reply_to, inputs, attempts FROM jobs
+            WHERE status = 'pending' OR (status = 'claimed' AND claimed_at < ?)
+            ORDER BY created_at
+            LIMIT 1
+            ''', (now - self.visibility_timeout,)).fetchone()
+            if row:
+                conn.execute('''
+                UPDATE jobs SET status = 'claimed', attempts = attempts + 1, claimed_by = ?, claimed_at = ?
+                WHERE job_id = ?
+                ''', (consumer, now, row[0]))
+            conn.commit()
+            conn.close()
+            
+            if row:
+                job_id, reply_to, inputs, attempts = row
+                return job_id, reply_to, json.loads(inputs), attempts + 1
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(JOB_POLL_INTERVAL)
+    
+    def complete(self, job_id: str, reply_to: str, result: dict):
+        # Задание, выданное повторно после таймаута, завершает первый ответивший узел
+        conn = self._connect()
+        conn.execute("UPDATE jobs SET status = 'done', result = ? WHERE job_id = ? AND status != 'done'",
+                     (json.dumps(result, ensure_ascii=False), job_id))
+        conn.commit()
+        conn.close()
+    
+    def retry(self, job_id: str, consumer: str):
+        conn = self._connect()
+        conn.execute("UPDATE jobs SET status = 'pending' WHERE job_id = ? AND status = 'claimed' AND claimed_by = ?",
+                     (job_id, consumer))
+        conn.commit()
+        conn.close()
+    
+    def fetch_results(self, reply_to: str, block_ms: int = JOB_BLOCK_MS) -> List[Tuple[str, dict]]:
+        deadline = time.monotonic() + block_ms / 1000
+        while True:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute("SELECT job_id, result FROM jobs WHERE reply_to = ? AND status = 'done'",
+                                (reply_to,)).fetchall()
+            conn.executemany('DELETE FROM jobs WHERE job_id = ?', ((job_id,) for job_id, _ in rows))
+            conn.commit()
+            conn.close()
+            
+            if rows or time.monotonic() >= deadline:
+                return [(job_id, json.loads(result)) for job_id, result in rows]
+            time.sleep(JOB_POLL_INTERVAL)
+    
+    def depth(self) -> int:
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM jobs WHERE status != 'done'").fetchone()[0]
+        conn.close()
+        return count
+
+class RedisJobQueue(JobQueue):
+    """Очередь на Redis Streams: узлы генерации — потребители одной группы
+    
+    Задания читаются XREADGROUP и подтверждаются XACK; неподтверждённые
+    дольше таймаута видимости забирает другой узел через XAUTOCLAIM, а номер
+    выдачи — счётчик доставок из списка ожидающих (XPENDING). Результаты
+    пишутся в поток ответов фронтенда.
+    """
+    
+    def __init__(self, url: str, stream: str = "odanna:jobs", group: str = "odanna-workers",
+                 visibility_timeout: int = JOB_VISIBILITY_TIMEOUT, client=None):
+        import redis
+        
+        self.redis = client or redis.Redis.from_url(url, decode_responses=True)
+        self.stream = stream
+        self.group = group
+        self.visibility_timeout = visibility_timeout
+        self.entry_ids: Dict[str, str] = {}  # job_id → id записи в потоке для выданных этому процессу
+        
+        try:
+            self.redis.xgroup_create(stream, group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+    
+    def _results_stream(self, reply_to: str) -> str:
+        return f"odanna:results:{reply_to}"
+    
+    def enqueue(self, job_id: str, reply_to: str, inputs: dict):
+        self.redis.xadd(self.stream, {
+            "job_id": job_id, "reply_to": reply_to, "inputs": json.dumps(inputs, ensure_ascii=False)
+        })
+    
+    def claim(self, consumer: str, block_ms: int = JOB_BLOCK_MS) -> Optional[Tuple[str, str, dict, int]]:
+        # Сначала задания, брошенные упавшими узлами, затем новые
+        _, entries, *_ = self.redis.xautoclaim(self.stream, self.group, consumer,
+                                               min_idle_time=self.visibility_timeout * 1000, count=1)
+        if not entries:
+            response = self.redis.xreadgroup(self.group, consumer, {self.stream: '>'}, count=1, block=block_ms)
+            entries = response[0][1] if response else []
+        if not entries:
+            return None
+        
+        entry_id, fields = entries[0]
+        pending = self.redis.xpending_range(self.stream, self.group, min=entry_id, max=entry_id, count=1)
+        attempts = pending[0]['times_delivered'] if pending else 1
+        self.entry_ids[fields["job_id"]] = entry_id
+        return fields["job_id"], fields["reply_to"], json.loads(fields["inputs"]), attempts
+    
+    def complete(self, job_id: str, reply_to: str, result: dict):
+        entry_id = self.entry_ids.pop(job_id)
+        pipeline = self.redis.pipeline()
+        pipeline.xadd(self._results_stream(reply_to),
+                      {"job_id": job_id, "result": json.dumps(result, ensure_ascii=False)},
+                      maxlen=10000, approximate=True)
+        pipeline.xack(self.stream, self.group, entry_id)
+        pipeline.xdel(self.stream, entry_id)
+        pipeline.execute()
+    
+    def retry(self, job_id: str, consumer: str):
+        # Задание остаётся неподтверждённым, но сразу считается простаивающим для XAUTOCLAIM
+        entry_id = self.entry_ids.pop(job_id)
+        self.redis.xclaim(self.stream, self.group, consumer, 0, [entry_id],
+                          idle=self.visibility_timeout * 1000, justid=True)
+    
+    def fetch_results(self, reply_to: str, block_ms: int = JOB_BLOCK_MS) -> List[Tuple[str, dict]]:
+        stream = self._results_stream(reply_to)
+        response = self.redis.xread({stream: '0'}, block=block_ms)
+        entries = response[0][1] if response else []
+        if entries:
+            self.redis.xdel(stream, *[entry_id for entry_id, _ in entries])
+        return [(fields["job_id"], json.loads(fields["result"])) for _, fields in entries]
+    
+    def depth(self) -> int:
+        return self.redis.xlen(self.stream)
+    
+    def close(self):
+        self.redis.close()
+
+def create_job_queue(url: str = JOB_QUEUE) -> Optional[JobQueue]:
+    """Очередь заданий по настройке JOB_QUEUE; None — генерация в процессе бота"""
+    if not url:
+        return None
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisJobQueue(url)
+    if url.startswith('sqlite:'):
+        return SQLiteJobQueue(url[len('sqlite:'):])
+    raise ValueError(f"неизвестная очередь заданий {url!r}: ожидается sqlite:путь или redis://…")
+
+class InferenceWorker:
+    """Узел генерации: берёт задания из очереди и отвечает фронтенду
+    
+    Состояния между заданиями не хранит (кроме KV-кэша чатов), поэтому
+    пропускная способность растёт с числом узлов. Сбой генерации возвращает
+    задание в очередь; после JOB_MAX_ATTEMPTS выдач фронтенд получает ошибку
+    и отвечает запасной репликой.
+    """
+    
+    def __init__(self, job_queue: JobQueue, ai: AIManager, consumer: Optional[str] = None,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, hang_seconds: float = WORKER_HANG_SECONDS):
+        self.job_queue = job_queue
+        self.ai = ai
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.max_attempts = max_attempts
+        self.hang_seconds = hang_seconds
+        self.busy_since: Optional[float] = None  # начало текущей генерации (для сторожа)
+        self.stopped = threading.Event()
+    
+    def process_one(self, block_ms: int = JOB_BLOCK_MS) -> bool:
+        """Выполнить одно задание; False, если очередь пуста"""
+        job = self.job_queue.claim(self.consumer, block_ms)
+        if job is None:
+            return False
+        
+        job_id, reply_to, inputs, attempts = job
+        if attempts > self.max_attempts:
+            # Задание роняло узлы или зависало: дальше не пробуем
+            METRICS.inc('odanna_jobs_total', result="failed")
+            self.job_queue.complete(job_id, reply_to, {"error": "превышено число попыток"})
+            return True
+        
+        # Фронтенд уже ответил запасной репликой — генерировать незачем
+        deadline_at = inputs.pop('deadline_at', None)
+        if deadline_at is not None:
+            if time.time() >= deadline_at:
+                METRICS.inc('odanna_jobs_total', result="expired")
+                self.job_queue.complete(job_id, reply_to, {"error": "срок ответа истёк"})
+                return True
+            inputs['deadline'] = time.monotonic() + deadline_at - time.time()
+        
+        # Токены фронтенда подходят, только если у узла тот же токенизатор
+        if inputs.pop('tokenizer_id', None) != self.ai.tokenizer_id:
+            inputs['history_tokens'] = inputs['message_tokens'] = None
+        
+        self.busy_since = time.monotonic()
+        try:
+            response = self.ai._generate(**inputs)
+        except Exception as e:
+            logger.error(f"Ошибка задания {job_id} (попытка {attempts}): {e}")
+            if attempts >= self.max_attempts:
+                METRICS.inc('odanna_jobs_total', result="failed")
+                self.job_queue.complete(job_id, reply_to, {"error": str(e)})
+            else:
+                METRICS.inc('odanna_jobs_total', result="retry")
+                self.job_queue.retry(job_id, self.consumer)
+            return True
+        finally:
+            self.busy_since = None
+        
+        METRICS.inc('odanna_responses_total', source="model")
+        METRICS.inc('odanna_jobs_total', result="done")
+        self.job_queue.complete(job_id, reply_to, {"response": response})
+        return True
     
-    def _fallback_response(self, user_message: str, empathy_level: int, emotion: str) -> str:
-        """Запасные ответы при недоступности модели"""
+    def run(self):
+        """Цикл узла до stop(); /metrics и /healthz — на порту PORT"""
+        METRICS.set_function('odanna_model_loaded', lambda: int(self.ai.backend is not None))
+        METRICS.set_function('odanna_job_queue_depth', self.job_queue.depth)
+        threading.Thread(target=self._serve_http, name="odanna-worker-http", daemon=True).start()
+        threading.Thread(target=self._watchdog_loop, name="odanna-worker-watchdog", daemon=True).start()
         
-        responses = {
-            35: [
-                "Интересно... *пристально смотрит красными глазами* Продолжайте.",
-                "Ваши слова... заслуживают внимания. Что ещё вас беспокоит?",
-                "Хм. *легкий наклон головы* Я слушаю."
-            ],
-            50: [
-                "Понимаю ваше состояние. В Небесной Гостинице мы знаем цену словам.",
-                "Ваши переживания не остались незамеченными. Расскажите больше.",
-                "Каждый гость заслуживает внимания. Я здесь, чтобы выслушать."
-            ],
-            70: [
-                "Ваши слова тронули даже демона вроде меня. Не держите всё в себе.",
-                "Позвольте мне проявить заботу, как подобает хозяину гостиницы.",
-                "В моих глазах вы видите понимание. Доверьтесь мне."
-            ]
-        }
+        logger.info(f"Узел генерации {self.consumer} ждёт заданий")
+        while not self.stopped.is_set():
+            try:
+                self.process_one()
+            except Exception as e:
+                logger.error(f"Ошибка очереди заданий: {e}")
+                time.sleep(1)
+        self.job_queue.close()
+    
+    def stop(self):
+        self.stopped.set()
+    
+    def check_hang(self) -> bool:
+        """True, если текущая генерация идёт дольше hang_seconds
         
-        # Выбираем ближайший уровень эмпатии
-        closest_level = min(responses.keys(), key=lambda x: abs(x - empathy_level))
-        level_responses = responses[closest_level]
+        Поток с model.generate не прервать, поэтому зависший узел завершает
+        процесс: его перезапускает Docker (restart: unless-stopped), а задание
+        после JOB_VISIBILITY_TIMEOUT достаётся другому узлу с учётом попыток.
+        """
+        busy_since = self.busy_since
+        return busy_since is not None and time.monotonic() - busy_since > self.hang_seconds
+    
+    def _watchdog_loop(self):
+        while not self.stopped.wait(1):
+            if self.check_hang():
+                METRICS.inc('odanna_worker_hangs_total')
+                logger.critical(f"Генерация идёт дольше {self.hang_seconds:.0f} с, узел перезапускается")
+                logging.shutdown()
+                os._exit(WORKER_HANG_EXIT_CODE)
+    
+    def _serve_http(self):
+        async def metrics(request: web.Request) -> web.Response:
+            return web.Response(text=METRICS.render(), content_type='text/plain', charset='utf-8')
         
-        # Модификация на основе эмоций
-        if "грусть" in emotion:
-            return "Печаль... она знакома даже демонам. *мягко кладет руку на плечо* Расскажите мне о своих переживаниях."
-        elif "радость" in emotion:
-            return "*едва заметная улыбка* Радость украшает любого гостя. Что принесло вам столько света?"
-        elif "возбуждение" in emotion:
-            return "*поднимает бровь* Какая энергия... Надеюсь, она направлена в нужное русло?"
+        async def healthz(request: web.Request) -> web.Response:
+            healthy = self.ai.backend is not None
+            return web.json_response({"status": "ok" if healthy else "fail", "model_loaded": healthy},
+                                     status=200 if healthy else 503)
         
-        return level_responses[len(user_message) % len(level_responses)]
+        app = web.Application()
+        app.router.add_get('/metrics', metrics)
+        app.router.add_get('/healthz', healthz)
+        web.run_app(app, host=HOST, port=PORT, print=None, handle_signals=False)
+
+def _markdown_snippet(text: Optional[str], length: Optional[int] = HISTORY_SNIPPET_LENGTH) -> str:
+    """Текст пользователя или модели для сообщения с parse_mode='Markdown'
+    
+    Без экранирования одна «_» или «*» ломает разбор всего сообщения, и
+    Telegram его отклоняет. Обрезка идёт до экранирования, чтобы не
+    разорвать «\\_» пополам.
+    """
+    return escape_markdown((text or "")[:length], version=1)
 
 class OdannaBot:
     """Основной класс бота Оданна"""
     
-    def __init__(self, token: str):
+    def __init__(self, token: str, db: Optional[StorageBackend] = None, ai: Optional[AIManager] = None,
+                 memory: Optional[SemanticMemory] = None, job_queue: Optional[JobQueue] = None):
         self.token = token
-        self.db = DatabaseManager(DB_PATH)
-        self.ai = AIManager()
-        self.current_chats = {}  # {user_id: current_chat_id}
+        self.db = db or create_storage()
+        self.ai = ai or AIManager()
+        self.memory = memory or SemanticMemory(self.db)
+        self.search_queries: OrderedDict = OrderedDict()  # {user_id: последний поисковый запрос}, LRU
+        self.application = None
+        self.profiler = RequestProfiler()
+        self.inflight = 0  # сообщения в обработке (для бюджета генерации)
+        self.last_message_at = time.monotonic()  # для пополнения пула заготовок в простое
+        # Вызовы модели идут в своих потоках, цикл событий остаётся свободным для меню
+        self.llm_executor = ThreadPoolExecutor(max_workers=LLM_WORKERS, thread_name_prefix="odanna-llm")
+        self.generation_timeout = GENERATION_TIMEOUT_MS / 1000  # дольше ответа модели не ждём
+        # С очередью заданий генерируют узлы --worker, а бот ждёт их ответы
+        self.job_queue = job_queue
+        # Свой для каждого запуска: адрес ответов узлов генерации и владелец входящих
+        self.instance_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.pending_jobs: Dict[str, asyncio.Future] = {}
+        self.results_task: Optional[asyncio.Task] = None
+        self.updates_in_progress = set()  # update_id сообщений в обработке (повтор, пришедший во время неё)
+        self.background_tasks: List[asyncio.Task] = []
+        
+        # Типичная длина принятых ответов для бюджета генерации
+        self.ai.policy.learn_reply_lengths(self.db.get_response_lengths())
         
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /start"""
         user = update.effective_user
         
         # Добавляем/обновляем пользователя в БД
-        self.db.add_user(
+        await asyncio.to_thread(
+            self.db.add_user,
             user_id=user.id,
             username=user.username,
             first_name=user.first_name,
@@ -539,23 +5568,111 @@ class OdannaBot:
             parse_mode='Markdown'
         )
     
+    async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /search <текст>"""
+        user_id = update.effective_user.id
+        search_text = " ".join(context.args).strip() if context.args else ""
+        
+        if not search_text:
+            await update.message.reply_text(
+                "*поднимает бровь* Что именно найти? Например: `/search гостиница`",
+                parse_mode='Markdown'
+            )
+            return
+        
+        self.search_queries[user_id] = search_text
+        self.search_queries.move_to_end(user_id)
+        while len(self.search_queries) > SEARCH_QUERIES_SIZE:
+            self.search_queries.popitem(last=False)
+        message, reply_markup = await asyncio.to_thread(self._render_search_results, user_id, 0)
+        
+        await update.message.reply_text(
+            message,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+    
+    async def scenario_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /scenario [описание]: показать или изменить сценарий активного чата"""
+        user_id = update.effective_user.id
+        chat_id = await asyncio.to_thread(self.db.get_current_chat, user_id)
+        if not chat_id:
+            await update.message.reply_text(
+                "*слегка наклоняет голову* Сначала выберите чат или просто напишите мне.",
+                parse_mode='Markdown'
+            )
+            return
+        
+        # context.args теряет переводы строк, а первая строка описания — название
+        description = update.message.text.split(maxsplit=1)[1:]
+        if not description:
+            scenario, scenario_prompt = await asyncio.to_thread(self.db.get_chat_scenario, chat_id) or ("Небесная Гостиница", None)
+            # Описание пишет пользователь, поэтому без разметки Markdown
+            await update.message.reply_text(
+                f"Сценарий этого чата: {scenario}\n\n"
+                + (f"{scenario_prompt}\n\n" if scenario_prompt else "")
+                + "Изменить: /scenario и описание (первая строка — название)"
+            )
+            return
+        
+        await self._set_scenario(update.message, chat_id, description[0])
+    
+    async def _set_scenario(self, message, chat_id: str, text: str):
+        """Сохранить сценарий чата из текста пользователя и ответить подтверждением"""
+        scenario, scenario_prompt = _parse_scenario(text)
+        previous = await asyncio.to_thread(self.db.get_chat_scenario, chat_id)
+        await asyncio.to_thread(self.db.set_chat_scenario, chat_id, scenario, scenario_prompt)
+        if previous is not None and previous != (scenario, scenario_prompt):
+            self.ai.invalidate_scenario(*previous)
+        # Начало промпта изменилось, KV-кэш чата больше не совпадёт
+        self.ai.forget_session(chat_id)
+        
+        await message.reply_text(
+            f"Сценарий «{scenario}» принят 🎭\n\n"
+            "Что ж... правила гостиницы остаются в силе, а остальное — как вы описали."
+        )
+    
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка нажатий на кнопки"""
         query = update.callback_query
-        await query.answer()
-        
-        user_id = query.from_user.id
-        data = query.data
         
+        with METRICS.timer('odanna_callback_seconds'), \
+                self.profiler.profile(f"callback_{update.update_id}"):
+            await query.answer()
+            await self._dispatch_callback(query, query.from_user.id, query.data)
+    
+    async def _dispatch_callback(self, query, user_id: int, data: str):
+        """Выбор обработчика по callback_data"""
         if data == "create_chat":
             await self._show_create_chat_menu(query)
             
         elif data == "list_chats":
             await self._show_chats_list(query, user_id)
             
+        elif data.startswith("chats_"):
+            await self._handle_chats_page(query, user_id, data)
+            
+        elif data.startswith("hist_"):
+            await self._handle_history_page(query, user_id, data)
+            
+        elif data == "forget_last":
+            await self._handle_forget_last(query, user_id)
+            
+        elif data.startswith("forget_"):
+            await self._handle_forget_button(query, user_id, int(data[len("forget_"):]), True)
+            
+        elif data.startswith("unforget_"):
+            await self._handle_forget_button(query, user_id, int(data[len("unforget_"):]), False)
+            
+        elif data.startswith("search_"):
+            await self._show_search_results(query, user_id, int(data[len("search_"):]))
+            
         elif data == "settings":
             await self._show_settings(query, user_id)
             
+        elif data == "show_stats":
+            await self._show_stats(query, user_id)
+            
         elif data.startswith("create_"):
             await self._handle_create_chat(query, user_id, data)
             
@@ -594,9 +5711,12 @@ class OdannaBot:
             parse_mode='Markdown'
         )
     
-    async def _show_chats_list(self, query, user_id: int):
+    async def _show_chats_list(self, query, user_id: int, cursor: Optional[Tuple[str, str]] = None,
+                               backward: bool = False):
         """Показать список чатов пользователя"""
-        chats = self.db.get_user_chats(user_id)
+        chats, has_prev, has_next = await asyncio.to_thread(
+            self.db.get_user_chats_page, user_id, CHATS_PAGE_SIZE, cursor, backward
+        )
         
         if not chats:
             keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")]]
@@ -616,10 +5736,25 @@ class OdannaBot:
             return
         
         keyboard = []
-        for chat_id, chat_name, scenario, msg_count, last_activity in chats[:10]:  # Показываем только 10 последних
+        for chat_id, chat_name, scenario, msg_count, last_activity in chats:
             button_text = f"💬 {chat_name} ({msg_count} сообщ.)"
             keyboard.append([InlineKeyboardButton(button_text, callback_data=f"chat_select_{chat_id}")])
         
+        # Курсоры страниц: (last_activity, chat_id) первого и последнего чата
+        navigation = []
+        if has_prev:
+            first_chat_id, _, _, _, first_activity = chats[0]
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Новее", callback_data=f"chats_prev_{first_activity}|{first_chat_id}"
+            ))
+        if has_next:
+            last_chat_id, _, _, _, last_activity = chats[-1]
+            navigation.append(InlineKeyboardButton(
+                "Старее ➡️", callback_data=f"chats_next_{last_activity}|{last_chat_id}"
+            ))
+        if navigation:
+            keyboard.append(navigation)
+        
         keyboard.append([InlineKeyboardButton("◀️ Назад", callback_data="back_to_main")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -635,13 +5770,102 @@ class OdannaBot:
             parse_mode='Markdown'
         )
     
+    async def _handle_chats_page(self, query, user_id: int, data: str):
+        """Переход между страницами списка чатов"""
+        _, direction, cursor_data = data.split('_', 2)
+        last_activity, _, chat_id = cursor_data.partition('|')
+        
+        await self._show_chats_list(
+            query, user_id, (last_activity, chat_id), backward=(direction == "prev")
+        )
+    
+    async def _show_search_results(self, query, user_id: int, offset: int):
+        """Показать страницу результатов поиска"""
+        message, reply_markup = await asyncio.to_thread(self._render_search_results, user_id, offset)
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
+    
+    def _render_search_results(self, user_id: int, offset: int) -> Tuple[str, InlineKeyboardMarkup]:
+        """Текст и клавиатура страницы результатов поиска"""
+        search_text = self.search_queries.get(user_id, "")
+        results, has_more = self.db.search_messages(user_id, search_text, SEARCH_PAGE_SIZE, offset)
+        
+        results_text = ""
+        for message_id, chat_id, chat_name, msg_text, response_text, timestamp in results:
+            results_text += (
+                f"💬 _{_markdown_snippet(chat_name, None)}_, {timestamp}\n"
+                f"👤 {_markdown_snippet(msg_text)}\n"
+                f"🏮 {_markdown_snippet(response_text)}\n\n"
+            )
+        
+        navigation = []
+        if offset > 0:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Назад", callback_data=f"search_{max(0, offset - SEARCH_PAGE_SIZE)}"
+            ))
+        if has_more:
+            navigation.append(InlineKeyboardButton(
+                "Дальше ➡️", callback_data=f"search_{offset + SEARCH_PAGE_SIZE}"
+            ))
+        
+        keyboard = []
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("◀️ В главное меню", callback_data="back_to_main")])
+        
+        message = f"""*Поиск по истории* 🔎
+
+{results_text if results_text else '*качает головой* Ничего похожего в записях гостиницы нет.'}"""
+        
+        return message, InlineKeyboardMarkup(keyboard)
+    
+    async def _handle_forget_last(self, query, user_id: int):
+        """Забыть последнее сообщение активного чата (кнопка в настройках)"""
+        current_chat_id = await asyncio.to_thread(self.db.get_current_chat, user_id)
+        message_id = await asyncio.to_thread(self.db.forget_last_message, current_chat_id) if current_chat_id else None
+        if message_id is not None:
+            self.ai.forget_session(current_chat_id)
+        
+        keyboard = []
+        if message_id is not None:
+            keyboard.append([InlineKeyboardButton("↩️ Вспомнить", callback_data=f"unforget_{message_id}")])
+            message = "*спокойно кивает* Последних слов здесь не было."
+        else:
+            message = "*поднимает бровь* Забывать пока нечего."
+        keyboard.append([InlineKeyboardButton("◀️ К настройкам", callback_data="settings")])
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown'
+        )
+    
+    async def _handle_forget_button(self, query, user_id: int, message_id: int, forget: bool):
+        """Кнопка «забыть/вспомнить» под конкретным ответом"""
+        if forget:
+            changed = await asyncio.to_thread(self.db.ignore_message_by_id, message_id, user_id)
+        else:
+            changed = await asyncio.to_thread(self.db.unignore_message_by_id, message_id, user_id)
+        
+        if changed is None:
+            return
+        self.ai.forget_session(changed)
+        
+        await query.edit_message_reply_markup(
+            reply_markup=self._forget_markup(message_id, forgotten=forget)
+        )
+    
     async def _show_settings(self, query, user_id: int):
         """Показать настройки"""
-        current_chat_id = self.current_chats.get(user_id)
+        current_chat_id = await asyncio.to_thread(self.db.get_current_chat, user_id)
         current_empathy = 50
         
         if current_chat_id:
-            current_empathy = self.db.get_chat_empathy_level(current_chat_id)
+            current_empathy = await asyncio.to_thread(self.db.get_chat_empathy_level, current_chat_id)
         
         keyboard = [
             [InlineKeyboardButton(f"😊 Эмпатия: {current_empathy}%", callback_data="empathy_menu")],
@@ -667,12 +5891,51 @@ class OdannaBot:
             parse_mode='Markdown'
         )
     
+    async def _show_stats(self, query, user_id: int):
+        """Статистика пользователя и траектория эмпатии активного чата (из готовых счётчиков)"""
+        stats = await asyncio.to_thread(self.db.get_user_stats, user_id)
+        total = stats.get('messages', 0)
+        
+        if not total:
+            message = "*Статистика* 📊\n\n*пожимает плечами* Мы ещё не беседовали."
+        else:
+            emotions = Counter({name[len('emotion:'):]: value for name, value in stats.items()
+                                if name.startswith('emotion:')})
+            hours = Counter({name[len('hour:'):]: value for name, value in stats.items()
+                             if name.startswith('hour:')})
+            emotion_lines = "\n".join(f"• {emotion}: {value * 100 // total}%"
+                                      for emotion, value in emotions.most_common(5)) or "• пока не замечены"
+            hour_lines = ", ".join(f"{hour}:00" for hour, _ in hours.most_common(3))
+            message = f"""*Статистика* 📊
+
+**Сообщений:** {total}
+
+**Эмоции:**
+{emotion_lines}
+
+**Самые активные часы (UTC):** {hour_lines}"""
+            
+            current_chat_id = await asyncio.to_thread(self.db.get_current_chat, user_id)
+            trajectory = await asyncio.to_thread(self.db.get_chat_stats, current_chat_id) if current_chat_id else []
+            if trajectory:
+                days = "\n".join(f"• {day[8:10]}.{day[5:7]}: {average:.0f}% ({messages} сообщ.)"
+                                 for day, messages, average in trajectory)
+                message += f"\n\n**Эмпатия активного чата по дням:**\n{days}"
+        
+        keyboard = [[InlineKeyboardButton("◀️ К настройкам", callback_data="settings")]]
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode='Markdown'
+        )
+    
     async def _handle_create_chat(self, query, user_id: int, data: str):
         """Обработка создания чата"""
         if data == "create_default":
             chat_name = f"Чат от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            chat_id = self.db.create_chat(user_id, chat_name)
-            self.current_chats[user_id] = chat_id
+            chat_id = await asyncio.to_thread(self.db.create_chat, user_id, chat_name)
+            await self._set_current_chat(user_id, chat_id)
             
             message = """*Новый чат создан* ✨
 
@@ -689,38 +5952,43 @@ class OdannaBot:
             await query.edit_message_text(message, parse_mode='Markdown')
             
         elif data == "create_custom":
-            # Здесь можно добавить форму для создания чата с настройками
-            # Пока используем упрощенную версию
+            # Следующее сообщение пользователя станет описанием сценария (см. _process_message)
             chat_name = f"Чат (настройки) от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            chat_id = self.db.create_chat(user_id, chat_name, "Пользовательский сценарий")
-            self.current_chats[user_id] = chat_id
+            chat_id = await asyncio.to_thread(self.db.create_chat, user_id, chat_name, SCENARIO_DRAFT)
+            await self._set_current_chat(user_id, chat_id)
             
             message = """*Чат с настройками создан* 🎭
 
 *внимательно изучает*
 
-Опишите ситуацию или сценарий, в рамках которого хотите общаться. Я адаптируюсь под ваши потребности...
+Опишите ситуацию или сценарий, в рамках которого хотите общаться. Первая строка станет названием. Я адаптируюсь под ваши потребности...
 
-В разумных пределах, разумеется."""
+В разумных пределах, разумеется. Изменить сценарий позже можно командой /scenario."""
             
             await query.edit_message_text(message, parse_mode='Markdown')
     
     async def _handle_chat_action(self, query, user_id: int, data: str):
         """Обработка действий с чатами"""
-        parts = data.split('_')
+        # chat_id сам содержит подчёркивания, поэтому делим только дважды
+        parts = data.split('_', 2)
         action = parts[1]
         chat_id = parts[2] if len(parts) > 2 else None
         
+        # callback_data можно подделать: чужой чат не показываем
+        if not await self._check_chat_owner(query, user_id, chat_id):
+            return
+        
         if action == "select":
-            self.current_chats[user_id] = chat_id
+            await asyncio.to_thread(self.db.restore_chat, chat_id)
+            await self._set_current_chat(user_id, chat_id)
             
             # Показываем последние сообщения чата
-            history = self.db.get_chat_history(chat_id, 5)
+            history = await asyncio.to_thread(self.db.get_chat_history, chat_id, 5)
             
             history_text = ""
             for msg_text, response_text, is_ignored, emotion, timestamp in history:
                 if not is_ignored:
-                    history_text += f"👤 {msg_text}\n🏮 {response_text}\n\n"
+                    history_text += f"👤 {_markdown_snippet(msg_text, None)}\n🏮 {_markdown_snippet(response_text, None)}\n\n"
             
             keyboard = [
                 [InlineKeyboardButton("📜 Показать всю историю", callback_data=f"chat_history_{chat_id}")],
@@ -745,6 +6013,82 @@ class OdannaBot:
                 reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
+            
+        elif action == "history":
+            await self._show_chat_history(query, chat_id)
+        
+        elif action == "delete":
+            await asyncio.to_thread(self.db.delete_chat, chat_id)
+            # Индекс памяти и KV-кэш удалённого чата больше не понадобятся
+            await asyncio.to_thread(self.memory.forget_chat, chat_id)
+            self.ai.forget_session(chat_id)
+            
+            keyboard = [[InlineKeyboardButton("◀️ К списку чатов", callback_data="list_chats")]]
+            await query.edit_message_text(
+                "*молча кивает* Чат удалён. Гостиница о нём больше не помнит.",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='Markdown'
+            )
+    
+    async def _check_chat_owner(self, query, user_id: int, chat_id: Optional[str]) -> bool:
+        """Чат принадлежит пользователю; иначе ответ «чата нет» и False"""
+        if chat_id is not None and await asyncio.to_thread(self.db.get_chat_owner, chat_id) == user_id:
+            return True
+        await query.edit_message_text("*качает головой* Такого чата в гостинице нет.", parse_mode='Markdown')
+        return False
+    
+    async def _handle_history_page(self, query, user_id: int, data: str):
+        """Переход между страницами истории чата"""
+        _, direction, message_id, chat_id = data.split('_', 3)
+        if not await self._check_chat_owner(query, user_id, chat_id):
+            return
+        
+        if direction == "older":
+            await self._show_chat_history(query, chat_id, before_id=int(message_id))
+        else:
+            await self._show_chat_history(query, chat_id, after_id=int(message_id))
+    
+    async def _show_chat_history(self, query, chat_id: str, before_id: Optional[int] = None,
+                                 after_id: Optional[int] = None):
+        """Показать одну страницу истории чата"""
+        messages, has_older, has_newer = await asyncio.to_thread(
+            self.db.get_chat_messages_page, chat_id, HISTORY_PAGE_SIZE, before_id, after_id
+        )
+        
+        history_text = ""
+        for message_id, msg_text, response_text, is_ignored, emotion, timestamp in messages:
+            if is_ignored:
+                history_text += f"🕳 _{timestamp}: забыто_\n\n"
+            else:
+                history_text += f"👤 {_markdown_snippet(msg_text)}\n🏮 {_markdown_snippet(response_text)}\n\n"
+        
+        navigation = []
+        if has_older:
+            navigation.append(InlineKeyboardButton(
+                "⬅️ Раньше", callback_data=f"hist_older_{messages[0][0]}_{chat_id}"
+            ))
+        if has_newer:
+            navigation.append(InlineKeyboardButton(
+                "Позже ➡️", callback_data=f"hist_newer_{messages[-1][0]}_{chat_id}"
+            ))
+        
+        keyboard = []
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("◀️ К чату", callback_data=f"chat_select_{chat_id}")])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        message = f"""*История чата* 📜
+
+{history_text if history_text else 'История пуста'}
+
+*перелистывает страницы гостевой книги*"""
+        
+        await query.edit_message_text(
+            message,
+            reply_markup=reply_markup,
+            parse_mode='Markdown'
+        )
     
     async def _show_main_menu(self, query):
         """Показать главное меню"""
@@ -771,25 +6115,69 @@ class OdannaBot:
     
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка обычных сообщений"""
+        # Telegram может доставить обновление повторно: ответ на него уже сохранён или готовится
+        if update.update_id in self.updates_in_progress:
+            METRICS.inc('odanna_duplicate_updates_total')
+            return
+        if await asyncio.to_thread(self.db.is_update_processed, update.update_id):
+            METRICS.inc('odanna_duplicate_updates_total')
+            logger.info(f"Обновление {update.update_id} уже обработано, пропускаем")
+            await asyncio.to_thread(self.db.remove_inbox, update.update_id)
+            return
+        
+        METRICS.inc('odanna_inflight_messages')
+        self.inflight += 1
+        self.last_message_at = time.monotonic()
+        self.updates_in_progress.add(update.update_id)
+        try:
+            with METRICS.timer('odanna_handle_message_seconds'), \
+                    self.profiler.profile(f"message_{update.update_id}"):
+                await self._process_message(update)
+        except asyncio.CancelledError:
+            # Ответ не дописан к концу остановки: сообщение остаётся во входящих для следующего экземпляра
+            raise
+        except Exception:
+            await asyncio.to_thread(self.db.remove_inbox, update.update_id)
+            raise
+        else:
+            await asyncio.to_thread(self.db.remove_inbox, update.update_id)
+        finally:
+            self.updates_in_progress.discard(update.update_id)
+            self.inflight -= 1
+            METRICS.inc('odanna_inflight_messages', -1)
+    
+    async def _process_message(self, update: Update):
+        """Обработка сообщения по этапам, каждый из которых замеряется"""
         user = update.effective_user
         user_message = update.message.text
         user_id = user.id
         
-        # Обновляем информацию о пользователе
-        self.db.add_user(
-            user_id=user_id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
+        with METRICS.timer('odanna_stage_seconds', stage="db_user"):
+            # Обновляем информацию о пользователе
+            await asyncio.to_thread(
+                self.db.add_user,
+                user_id=user_id,
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name
+            )
+            
+            # Проверяем, есть ли активный чат
+            current_chat_id = await asyncio.to_thread(self.db.get_current_chat, user_id)
+            if not current_chat_id:
+                # Создаем новый чат автоматически
+                chat_name = f"Авточат от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+                current_chat_id = await asyncio.to_thread(self.db.create_chat, user_id, chat_name)
+                await self._set_current_chat(user_id, current_chat_id)
+            else:
+                # Чат мог уйти в архив, пока пользователь молчал
+                await asyncio.to_thread(self.db.restore_chat, current_chat_id)
         
-        # Проверяем, есть ли активный чат
-        current_chat_id = self.current_chats.get(user_id)
-        if not current_chat_id:
-            # Создаем новый чат автоматически
-            chat_name = f"Авточат от {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            current_chat_id = self.db.create_chat(user_id, chat_name)
-            self.current_chats[user_id] = current_chat_id
+        # Первое сообщение в чате «с настройками» — описание его сценария
+        chat_scenario = await asyncio.to_thread(self.db.get_chat_scenario, current_chat_id)
+        if chat_scenario == (SCENARIO_DRAFT, None):
+            await self._set_scenario(update.message, current_chat_id, user_message)
+            return
         
         # Проверяем команды "забыть"
         if user_message.lower().startswith('забудь'):
@@ -797,48 +6185,297 @@ class OdannaBot:
             return
         
         # Анализируем эмоции сообщения
-        emotion = self.ai.analyze_emotion(user_message)
+        with METRICS.timer('odanna_stage_seconds', stage="analyze_emotion"):
+            emotion = self.ai.analyze_emotion(user_message)
         
-        # Получаем текущий уровень эмпатии
-        current_empathy = self.db.get_chat_empathy_level(current_chat_id)
+        with METRICS.timer('odanna_stage_seconds', stage="db_read"):
+            # Получаем текущий уровень эмпатии чата
+            current_empathy = await asyncio.to_thread(self.db.get_chat_empathy_level, current_chat_id)
+            scenario, scenario_prompt = chat_scenario or ("Небесная Гостиница", None)
+            
+            # Получаем историю чата вместе с сохранёнными токенами реплик
+            tokenizer_id = self.ai.tokenizer_id
+            chat_history = await asyncio.to_thread(self.db.get_history_turns, current_chat_id, 10, tokenizer_id)
         
-        # Получаем историю чата
-        chat_history = self.db.get_chat_history(current_chat_id, 10)
         history_text = []
-        for msg_text, response_text, is_ignored, _, _ in chat_history:
-            if not is_ignored:
+        history_tokens = []
+        missing_tokens = []
+        with METRICS.timer('odanna_stage_seconds', stage="tokenize_history"):
+            for message_id, msg_text, response_text, is_ignored, msg_tokens, resp_tokens in chat_history:
+                if is_ignored:
+                    continue
+                # Реплики без кэша (старые сообщения, другая модель) токенизируются один раз
+                if tokenizer_id and msg_tokens is None:
+                    msg_tokens = self.ai.encode_turn("Пользователь", msg_text)
+                    resp_tokens = self.ai.encode_turn("Оданна", response_text) if response_text else None
+                    missing_tokens.append((message_id, msg_tokens, resp_tokens))
                 history_text.append(f"Пользователь: {msg_text}")
+                history_tokens.append(msg_tokens)
                 if response_text:
                     history_text.append(f"Оданна: {response_text}")
+                    history_tokens.append(resp_tokens)
+            
+            message_tokens = self.ai.encode_turn("Пользователь", user_message) if tokenizer_id else None
         
         # Рассчитываем новый уровень эмпатии
         message_count = len(chat_history) + 1
         new_empathy = self.ai.calculate_empathy_level(emotion, current_empathy, message_count)
         
-        # Генерируем ответ
-        response = self.ai.generate_odanna_response(
-            user_message=user_message,
-            chat_history=history_text,
-            empathy_level=new_empathy,
-            emotion=emotion,
-            scenario="Небесная Гостиница"
-        )
+        # На приветствие, благодарность и т.п. в час пик отвечает заготовка из пула;
+        # заготовки знают только название сценария, описанному отвечает модель
+        with METRICS.timer('odanna_stage_seconds', stage="response_pool"):
+            response = await asyncio.to_thread(
+                self._pooled_response, user_message, new_empathy, scenario
+            ) if scenario_prompt is None else None
+        
+        if response is None:
+            # Вспоминаем давние реплики, не вошедшие в недавнюю историю
+            with METRICS.timer('odanna_stage_seconds', stage="memory_recall"):
+                memories = await asyncio.to_thread(
+                    self.memory.recall,
+                    current_chat_id, user_message, exclude_ids={row[0] for row in chat_history}
+                )
+            
+            # Генерируем ответ в потоке генерации или на узле генерации
+            response = await self._generate_response(
+                user_message=user_message,
+                chat_history=history_text,
+                empathy_level=new_empathy,
+                emotion=emotion,
+                scenario=scenario,
+                scenario_prompt=scenario_prompt,
+                memories=memories,
+                history_tokens=history_tokens if tokenizer_id else None,
+                message_tokens=message_tokens,
+                session_key=current_chat_id,
+                queue_depth=self.inflight - 1
+            )
+        
+        response_tokens = self.ai.encode_turn("Оданна", response) if tokenizer_id else None
+        
+        with METRICS.timer('odanna_stage_seconds', stage="db_write"):
+            # Реплика с токенами, новый уровень эмпатии, отметка обновления и исходящий
+            # ответ сохраняются одной транзакцией: после сбоя ответ не теряется и не генерируется заново
+            stored = await asyncio.to_thread(
+                self.db.add_reply,
+                update_id=update.update_id,
+                telegram_chat_id=update.effective_chat.id,
+                chat_id=current_chat_id,
+                user_id=user_id,
+                message_text=user_message,
+                response_text=response,
+                emotion_analysis=emotion,
+                empathy_level=new_empathy,
+                message_tokens=message_tokens,
+                response_tokens=response_tokens,
+                tokenizer_id=tokenizer_id
+            )
+            if stored is None:
+                # Повтор обновления успел обработать другой узел
+                METRICS.inc('odanna_duplicate_updates_total')
+                return
+            message_id, outbox_id = stored
+            await asyncio.to_thread(self.db.set_message_tokens, missing_tokens, tokenizer_id)
+            
+            self.memory.add_turn(current_chat_id, message_id, user_message, response)
+        
+        # Отправляем ответ с кнопкой «забыть это»; не ушедший ответ дошлёт _outbox_loop
+        with METRICS.timer('odanna_stage_seconds', stage="telegram_send"):
+            await self._deliver(update.get_bot(), outbox_id, update.effective_chat.id, message_id, response)
+    
+    async def _deliver(self, bot, outbox_id: int, telegram_chat_id: int, message_id: int, text: str) -> bool:
+        """Отправка ответа из outbox; True, если Telegram его принял
+        
+        Разметку в ответе пишет модель: если Telegram её не разобрал, ответ
+        уходит простым текстом. BadRequest не лечится повтором — такой ответ
+        снимается с досылки, остальные сбои досылаются позже.
+        """
+        try:
+            try:
+                await bot.send_message(
+                    telegram_chat_id,
+                    text,
+                    reply_markup=self._forget_markup(message_id),
+                    parse_mode='Markdown'
+                )
+            except BadRequest as e:
+                logger.warning(f"Ответ {outbox_id} не принят с разметкой, отправляем простым текстом: {e}")
+                await bot.send_message(telegram_chat_id, text, reply_markup=self._forget_markup(message_id))
+        except BadRequest as e:
+            METRICS.inc('odanna_outbox_total', result="rejected")
+            logger.error(f"Telegram отклонил ответ {outbox_id}, досылки не будет: {e}")
+            await asyncio.to_thread(self.db.mark_outbox_sent, outbox_id)
+            return False
+        except Exception as e:
+            METRICS.inc('odanna_outbox_total', result="retry")
+            logger.warning(f"Ответ {outbox_id} не отправлен, повторим позже: {e}")
+            return False
+        
+        await asyncio.to_thread(self.db.mark_outbox_sent, outbox_id)
+        METRICS.inc('odanna_outbox_total', result="sent")
+        return True
+    
+    async def _generate_response(self, **inputs) -> str:
+        """Ответ модели: в своём потоке генерации или через очередь заданий
         
-        # Сохраняем сообщение и ответ в БД
-        self.db.add_message(
-            chat_id=current_chat_id,
-            user_id=user_id,
-            message_text=user_message,
-            response_text=response,
-            emotion_analysis=emotion,
-            empathy_level=new_empathy
+        Дольше generation_timeout ответа не ждём: запасная реплика, а
+        исход учитывает предохранитель генерации.
+        """
+        timeout = self.generation_timeout
+        deadline = time.monotonic() + timeout
+        breaker = self.ai.breaker
+        
+        if self.job_queue is None:
+            if not breaker.available():
+                return self._breaker_fallback(inputs)
+            try:
+                # Этапы токенизации и генерации замеряет AIManager
+                return await self._run_llm(self.ai.generate_odanna_response, **inputs, deadline=deadline,
+                                           timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Генерация не уложилась в {timeout:.1f} с, запасной ответ")
+                breaker.record(False)
+                return self._breaker_fallback(inputs)
+        
+        if not breaker.allow():
+            return self._breaker_fallback(inputs)
+        
+        job_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending_jobs[job_id] = future
+        if self.results_task is None or self.results_task.done():
+            self.results_task = asyncio.create_task(self._results_loop())
+        
+        started = time.perf_counter()
+        try:
+            with METRICS.timer('odanna_stage_seconds', stage="job_queue"):
+                # Срок — по часам, общим с узлом: время в очереди тоже входит в предел
+                await asyncio.to_thread(self.job_queue.enqueue, job_id, self.instance_id,
+                                        {**inputs, "tokenizer_id": self.ai.tokenizer_id,
+                                         "deadline_at": time.time() + deadline - time.monotonic()})
+                result = await asyncio.wait_for(future, min(JOB_RESULT_TIMEOUT, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            METRICS.inc('odanna_generation_timeouts_total', result="abandoned")
+            logger.warning(f"Узел генерации не ответил на задание {job_id} за {timeout:.1f} с")
+            result = {"error": "срок ответа истёк"}
+        except Exception as e:
+            logger.error(f"Задание генерации {job_id} не выполнено: {e!r}")
+            result = {"error": repr(e)}
+        finally:
+            self.pending_jobs.pop(job_id, None)
+        METRICS.observe('odanna_job_seconds', time.perf_counter() - started)
+        
+        breaker.record("response" in result and time.monotonic() < deadline - GENERATION_STOP_MARGIN)
+        if "response" in result:
+            return result["response"]
+        METRICS.inc('odanna_responses_total', source="fallback")
+        return self.ai._fallback_response(inputs["user_message"], inputs["empathy_level"], inputs["emotion"])
+    
+    def _breaker_fallback(self, inputs: Dict) -> str:
+        """Запасная реплика вместо модели, не уложившейся в срок или отключённой предохранителем"""
+        METRICS.inc('odanna_responses_total', source="fallback")
+        return self.ai._fallback_response(inputs["user_message"], inputs["empathy_level"], inputs["emotion"])
+    
+    async def _results_loop(self):
+        """Раздача результатов узлов генерации ожидающим сообщениям; работает, пока есть задания"""
+        while self.pending_jobs:
+            try:
+                results = await asyncio.to_thread(self.job_queue.fetch_results, self.instance_id)
+            except Exception as e:
+                logger.error(f"Ошибка чтения результатов генерации: {e}")
+                await asyncio.sleep(1)
+                continue
+            for job_id, result in results:
+                future = self.pending_jobs.get(job_id)
+                if future is not None and not future.done():
+                    future.set_result(result)
+    
+    async def _run_llm(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """Вызов модели в потоке генерации с контекстом текущего обновления; при профилировании
+        поток пишет свой cProfile, который сливается с профилем обновления
+        
+        Через timeout секунд — asyncio.TimeoutError. Ещё не начатый вызов
+        отменяется; начатый прервать нельзя, он досчитывает в фоне и виден
+        в odanna_abandoned_generations.
+        """
+        session = CURRENT_PROFILE.get()
+        if session is not None:
+            func, args = session.run_in_thread, (func, *args)
+        future = self.llm_executor.submit(copy_context().run, func, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            METRICS.inc('odanna_generation_timeouts_total', result="abandoned")
+            if not future.cancel():
+                METRICS.inc('odanna_abandoned_generations')
+                future.add_done_callback(lambda _: METRICS.inc('odanna_abandoned_generations', -1))
+            raise
+    
+    def _pooled_response(self, user_message: str, empathy_level: int, scenario: str) -> Optional[str]:
+        """Заготовка из пула для короткой реплики, если модель занята или недоступна"""
+        if POOL_SIZE <= 0:
+            return None
+        intent = self.ai.detect_intent(user_message)
+        if intent is None:
+            return None
+        # Свободная модель ответит с учётом истории — заготовки только для пика
+        model_available = self.ai.backend is not None or self.job_queue is not None
+        if model_available and self.inflight - 1 < POOL_PEAK_QUEUE:
+            return None
+        
+        pooled = self.db.take_pooled_response(intent, _empathy_bucket(empathy_level), scenario)
+        METRICS.inc('odanna_response_pool_total', result="hit" if pooled else "miss", intent=intent)
+        if pooled is None:
+            return None
+        
+        response, age_seconds = pooled
+        METRICS.observe('odanna_response_pool_age_seconds', age_seconds)
+        METRICS.inc('odanna_responses_total', source="pool")
+        return response
+    
+    def refill_response_pool(self, limit: int = 1) -> int:
+        """Догенерировать до limit заготовок в самые пустые ячейки пула
+        
+        Возвращает число добавленных заготовок.
+        """
+        self.db.purge_stale_pool()
+        counts = self.db.count_pooled_responses()
+        slots = sorted(
+            (counts.get((intent, bucket, scenario), 0), intent, bucket, scenario)
+            for scenario in POOL_SCENARIOS for intent in POOL_INTENTS for bucket in POOL_EMPATHY_BUCKETS
         )
         
-        # Обновляем уровень эмпатии чата
-        self.db.update_chat_empathy(current_chat_id, new_empathy)
+        added = 0
+        for count, intent, bucket, scenario in slots:
+            if count >= POOL_SIZE or added >= limit:
+                break
+            response = self.ai.generate_pool_response(intent, bucket, scenario)
+            if not response:
+                break
+            self.db.add_pooled_response(intent, bucket, scenario, response)
+            METRICS.inc('odanna_response_pool_generated_total', intent=intent)
+            added += 1
         
-        # Отправляем ответ
-        await update.message.reply_text(response, parse_mode='Markdown')
+        return added
+    
+    def _is_idle(self) -> bool:
+        """Нет сообщений в обработке и давно не было новых"""
+        return self.inflight == 0 and time.monotonic() - self.last_message_at >= POOL_IDLE_SECONDS
+    
+    async def _set_current_chat(self, user_id: int, chat_id: str):
+        """Сделать чат активным для всех узлов бота; KV-кэш покинутого чата больше не нужен"""
+        previous_chat_id = await asyncio.to_thread(self.db.set_current_chat, user_id, chat_id)
+        if previous_chat_id and previous_chat_id != chat_id:
+            self.ai.forget_session(previous_chat_id)
+    
+    @staticmethod
+    def _forget_markup(message_id: int, forgotten: bool = False) -> InlineKeyboardMarkup:
+        """Кнопка под ответом: забыть или вернуть конкретный обмен репликами"""
+        if forgotten:
+            button = InlineKeyboardButton("↩️ Вспомнить", callback_data=f"unforget_{message_id}")
+        else:
+            button = InlineKeyboardButton("🔄 Забыть это", callback_data=f"forget_{message_id}")
+        return InlineKeyboardMarkup([[button]])
     
     async def _handle_forget_command(self, update: Update, chat_id: str, message: str):
         """Обработка команды забыть сообщение"""
@@ -846,8 +6483,10 @@ class OdannaBot:
         forget_text = message[6:].strip()  # Убираем "забудь "
         
         if forget_text:
-            # Помечаем сообщение как игнорируемое
-            self.db.ignore_message(chat_id, forget_text)
+            # Помечаем сообщение как игнорируемое (поиск по неточному совпадению)
+            forgotten_id = await asyncio.to_thread(self.db.ignore_message, chat_id, forget_text)
+            if forgotten_id is not None:
+                self.ai.forget_session(chat_id)
             
             responses = [
                 "*спокойно кивает* Как пожелаете. Этих слов здесь не было.",
@@ -855,29 +6494,268 @@ class OdannaBot:
                 "*легкая усмешка* Забыто... хотя демоны помнят всё."
             ]
             
-            response = responses[len(forget_text) % len(responses)]
+            if forgotten_id is not None:
+                response = responses[len(forget_text) % len(responses)]
+            else:
+                response = "*задумчиво смотрит* Таких слов в нашей беседе не звучало."
         else:
             response = "*поднимает бровь* Что именно забыть? Уточните свою просьбу."
         
         await update.message.reply_text(response, parse_mode='Markdown')
     
-    def run(self):
-        """Запуск бота"""
-        application = Application.builder().token(self.token).build()
+    async def _post_init(self, application: Application):
+        """Фоновые задачи, запускаемые вместе с ботом"""
+        self.application = application
+        self.background_tasks = [
+            asyncio.create_task(self._archive_loop()),
+            asyncio.create_task(self._outbox_loop()),
+            asyncio.create_task(self._stats_backfill_loop()),
+        ]
+        if POOL_SIZE > 0:
+            self.background_tasks.append(asyncio.create_task(self._pool_loop()))
+        await self._start_http_server()
+    
+    def _record_update(self, update: Update):
+        """Запись принятого сообщения во входящие (до ожидания полосы генерации)"""
+        try:
+            self.db.add_inbox(update.update_id, update.to_json(), self.instance_id)
+        except Exception as e:
+            logger.error(f"Не удалось записать обновление {update.update_id} во входящие: {e}")
+    
+    async def _replay_inbox(self, application: Application) -> int:
+        """Поставить в очередь сообщения, отданные остановленным экземпляром. Возвращает их число"""
+        rows = await asyncio.to_thread(self.db.claim_inbox, self.instance_id)
+        for update_id, payload in rows:
+            application.update_queue.put_nowait(Update.de_json(json.loads(payload), application.bot))
+        if rows:
+            METRICS.inc('odanna_replayed_updates_total', len(rows))
+            logger.info(f"Принято сообщений от остановленного экземпляра: {len(rows)}")
+        return len(rows)
+    
+    async def graceful_shutdown(self, application: Application, timeout: float = DRAIN_TIMEOUT) -> Tuple[int, int]:
+        """Плавная остановка: новые обновления не принимаются, начатые ответы дописываются
+        
+        Не дописанные за timeout и не начатые сообщения остаются во входящих
+        и достаются следующему экземпляру; ответы, уже сохранённые в outbox,
+        дошлёт любой экземпляр. Возвращает (дописано, передано).
+        """
+        started = time.monotonic()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        
+        processor = application.update_processor
+        processor.draining = True
+        skipped = processor.skipped
+        active = {task for task in processor.active if not task.done()}
+        finished, unfinished = await asyncio.wait(active, timeout=timeout) if active else (set(), set())
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*unfinished, return_exceptions=True)
+        drained = len(finished) - (processor.skipped - skipped)
+        
+        for task in self.background_tasks:
+            task.cancel()
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        
+        # Обновления, полученные до остановки приёма, только записываются во входящие
+        if application.running:
+            await application.stop()
+        handed_off = await asyncio.to_thread(self.db.release_inbox, self.instance_id)
+        
+        # Отложенная запись: индексы памяти, потоки генерации, очередь заданий
+        remaining = max(0.0, timeout - (time.monotonic() - started))
+        await asyncio.to_thread(self.memory.drain, remaining)
+        self.llm_executor.shutdown(wait=False, cancel_futures=True)
+        if self.job_queue is not None:
+            self.job_queue.close()
+        
+        logger.info(f"Остановка за {time.monotonic() - started:.1f} с: дописано ответов {drained}, "
+                    f"передано следующему экземпляру {handed_off}")
+        return drained, handed_off
+    
+    def _register_metric_callbacks(self):
+        """Gauge, значения которых считываются в момент запроса /metrics"""
+        METRICS.set_function('odanna_model_loaded', lambda: int(self.ai.backend is not None))
+        METRICS.set_function('odanna_memory_queue_depth', lambda: self.memory.queue.qsize())
+        METRICS.set_function('odanna_db_size_bytes', self.db.size_bytes)
+        METRICS.set_function(
+            'odanna_kv_cache_bytes',
+            lambda: getattr(getattr(self.ai.backend, 'kv_cache', None), 'total_bytes', 0)
+        )
+        METRICS.set_function('odanna_response_pool_size', lambda: sum(self.db.count_pooled_responses().values()))
+        METRICS.set_function('odanna_breaker_state', lambda: self.ai.breaker.state)
+    
+    async def _start_http_server(self):
+        """HTTP-сервер с /metrics и /healthz на порту PORT"""
+        self._register_metric_callbacks()
+        
+        app = web.Application()
+        app.router.add_get('/metrics', self._metrics_endpoint)
+        app.router.add_get('/healthz', self._healthz_endpoint)
+        
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, HOST, PORT).start()
+        logger.info(f"Метрики доступны на http://{HOST}:{PORT}/metrics")
+    
+    async def _metrics_endpoint(self, request: web.Request) -> web.Response:
+        # Часть gauge считывается из базы в момент запроса
+        return web.Response(text=await asyncio.to_thread(METRICS.render), content_type='text/plain', charset='utf-8')
+    
+    async def _healthz_endpoint(self, request: web.Request) -> web.Response:
+        """Здоровье: база отвечает и приём обновлений запущен; модель — справочно"""
+        checks = {"model_loaded": self.ai.backend is not None}
+        
+        try:
+            await asyncio.to_thread(self.db.ping)
+            checks["database"] = True
+        except Exception as e:
+            logger.error(f"Проверка базы не прошла: {e}")
+            checks["database"] = False
+        
+        updater = self.application.updater if self.application else None
+        checks["polling"] = bool(updater and updater.running)
+        
+        healthy = checks["database"] and checks["polling"]
+        return web.json_response(
+            {"status": "ok" if healthy else "fail", **checks},
+            status=200 if healthy else 503
+        )
+    
+    async def _archive_loop(self):
+        """Периодическое перемещение неактивных чатов в архив"""
+        while True:
+            try:
+                await asyncio.to_thread(self.db.run_archive_maintenance)
+                await asyncio.to_thread(self.db.purge_delivery_log)
+            except Exception as e:
+                logger.error(f"Ошибка архивации: {e}")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+    
+    async def _outbox_loop(self):
+        """Досылка ответов, не ушедших в Telegram (сбой сети, перезапуск процесса),
+        и приём сообщений, отданных остановленными экземплярами"""
+        while True:
+            try:
+                for outbox_id, telegram_chat_id, message_id, text in await asyncio.to_thread(self.db.claim_outbox):
+                    await self._deliver(self.application.bot, outbox_id, telegram_chat_id, message_id, text)
+                await self._replay_inbox(self.application)
+            except Exception as e:
+                logger.error(f"Ошибка досылки ответов: {e}")
+            await asyncio.sleep(OUTBOX_INTERVAL)
+    
+    async def _stats_backfill_loop(self):
+        """Досчёт статистики сообщений, сохранённых до её появления; пачка — одна короткая транзакция"""
+        total = 0
+        while True:
+            try:
+                counted = await asyncio.to_thread(self.db.backfill_stats)
+            except Exception as e:
+                logger.error(f"Ошибка досчёта статистики: {e}")
+                await asyncio.sleep(ARCHIVE_INTERVAL)
+                continue
+            if not counted:
+                break
+            total += counted
+        if total:
+            logger.info(f"Статистика досчитана по старым сообщениям: {total}")
+    
+    async def _pool_loop(self):
+        """Пополнение пула заготовок в простое — по одной, чтобы не задерживать сообщения"""
+        while True:
+            await asyncio.sleep(POOL_CHECK_INTERVAL)
+            if self.ai.backend is None or not self._is_idle():
+                continue
+            try:
+                await self._run_llm(self.refill_response_pool)
+            except Exception as e:
+                logger.error(f"Ошибка пополнения пула ответов: {e}")
+    
+    def build_application(self, base_url: Optional[str] = None) -> Application:
+        """Сборка приложения с обработчиками; base_url — для тестового Bot API"""
+        builder = Application.builder().token(self.token) \
+            .concurrent_updates(PriorityUpdateProcessor(on_receive=self._record_update))
+        if base_url:
+            builder = builder.base_url(base_url)
+        application = builder.build()
         
         # Добавляем обработчики
         application.add_handler(CommandHandler("start", self.start_command))
+        application.add_handler(CommandHandler("search", self.search_command))
+        application.add_handler(CommandHandler("scenario", self.scenario_command))
         application.add_handler(CallbackQueryHandler(self.button_callback))
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
         
+        return application
+    
+    def run(self):
+        """Запуск бота до SIGTERM/SIGINT с плавной остановкой"""
+        asyncio.run(self._run_until_stopped())
+    
+    async def _run_until_stopped(self):
+        application = self.build_application()
+        
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, stopping.set)
+        
+        await application.initialize()
+        await self._post_init(application)
+        await application.start()
+        await application.updater.start_polling()
         logger.info("Бот Оданна запущен!")
-        application.run_polling()
+        
+        await stopping.wait()
+        logger.info("Получен сигнал остановки")
+        await self.graceful_shutdown(application)
+        await application.shutdown()
+        self.db.close()
 
 # Точка входа
 if __name__ == '__main__':
-    if BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Telegram-бот Оданна")
+    parser.add_argument("--worker", action="store_true", help="узел генерации: выполнять задания из JOB_QUEUE")
+    parser.add_argument("--export", type=int, metavar="USER_ID", help="выгрузить чаты и сообщения пользователя")
+    parser.add_argument("--import", dest="import_path", metavar="FILE", help="загрузить выгрузку в хранилище")
+    parser.add_argument("--output", help="файл выгрузки (по умолчанию odanna_<USER_ID>.jsonl или .odx)")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl", help="формат выгрузки")
+    args = parser.parse_args()
+    
+    job_queue = None if args.export is not None or args.import_path else create_job_queue()
+    
+    if args.export is not None:
+        storage = create_storage()
+        output = args.output or f"odanna_{args.export}.{'odx' if args.format == 'columnar' else 'jsonl'}"
+        started = time.perf_counter()
+        counts = write_export(storage.export_user(args.export), output, args.format)
+        storage.close()
+        if not counts:
+            print(f"❌ Пользователь {args.export} не найден")
+        else:
+            print(f"✅ {output}: чатов {counts.get('chat', 0)}, сообщений {counts.get('message', 0)} "
+                  f"за {time.perf_counter() - started:.1f} с")
+    elif args.import_path:
+        storage = create_storage()
+        started = time.perf_counter()
+        counts = storage.import_user(read_export(args.import_path))
+        storage.close()
+        print(f"✅ Загружено чатов {counts.get('chat', 0)}, сообщений {counts.get('message', 0)}, "
+              f"пропущено существующих {counts.get('skipped', 0)} за {time.perf_counter() - started:.1f} с")
+    elif args.worker:
+        if job_queue is None:
+            print("❌ Ошибка: для узла генерации задайте очередь JOB_QUEUE (sqlite:путь или redis://…)")
+        else:
+            worker = InferenceWorker(job_queue, AIManager())
+            # Текущее задание дописывается; взятые, но не начатые вернутся в очередь по таймауту видимости
+            signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+            worker.run()
+    elif BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
         print("❌ Ошибка: Установите токен бота в переменную окружения BOT_TOKEN")
         print("Пример: export BOT_TOKEN='your_bot_token_here'")
     else:
-        bot = OdannaBot(BOT_TOKEN)
-        bot.run()
\ No newline at end of file
+        # Модель нужна только узлам генерации
+        bot = OdannaBot(BOT_TOKEN, ai=AIManager(backend='') if job_queue else None, job_queue=job_queue)
+        bot.run()
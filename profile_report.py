@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сводка по профилям обновлений, записанным ботом Оданна
+(PROFILE_EVERY_N / PROFILE_SLOW_MS). Показывает список дампов и самые
+дорогие функции — по одному профилю или суммарно по нескольким последним.
+
+Пример:
+    python profile_report.py                      # logs/profiles, 10 последних
+    python profile_report.py /app/logs/profiles --last 1 --top 40 --sort tottime
+"""
+
+import argparse
+import os
+import pstats
+import re
+import sys
+
+PROFILE_NAME = re.compile(r"^(?P<stamp>\d{8}_\d{6}_\d+)_(?P<label>.+)_(?P<elapsed>\d+)ms\.prof$")
+
+
+def list_profiles(directory: str):
+    """Дампы каталога от старых к новым: (путь, метка, мс, есть ли трасса torch)"""
+    profiles = []
+    for name in sorted(os.listdir(directory)):
+        match = PROFILE_NAME.match(name)
+        if not match:
+            continue
+        path = os.path.join(directory, name)
+        trace = path[:-len(".prof")] + ".trace.json"
+        profiles.append((path, match["label"], int(match["elapsed"]), os.path.exists(trace)))
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сводка профилей бота Оданна")
+    parser.add_argument("directory", nargs="?", default=os.path.join("logs", "profiles"))
+    parser.add_argument("--last", type=int, default=10, help="сколько последних профилей объединить")
+    parser.add_argument("--label", help="только профили с меткой, содержащей подстроку (message, callback)")
+    parser.add_argument("--top", type=int, default=25, help="сколько функций показать")
+    parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"❌ Каталог {args.directory} не найден", file=sys.stderr)
+        sys.exit(1)
+
+    profiles = list_profiles(args.directory)
+    if args.label:
+        profiles = [p for p in profiles if args.label in p[1]]
+    profiles = profiles[-args.last:]
+
+    if not profiles:
+        print("Профилей пока нет")
+        return
+
+    print(f"📂 {args.directory}: профилей в сводке — {len(profiles)}\n")
+    for path, label, elapsed, has_trace in profiles:
+        trace_mark = "  + trace torch" if has_trace else ""
+        print(f"  {elapsed:>8} мс  {label:<28} {os.path.basename(path)}{trace_mark}")
+    print()
+
+    stats = pstats.Stats(*[path for path, _, _, _ in profiles])
+    stats.strip_dirs().sort_stats(args.sort).print_stats(args.top)
+
+    traces = [path[:-len(".prof")] + ".trace.json" for path, _, _, has_trace in profiles if has_trace]
+    if traces:
+        print("Трассы torch.profiler (открыть в chrome://tracing или Perfetto):")
+        for trace in traces:
+            print(f"  {trace}")
+
+
+if __name__ == "__main__":
+    main()
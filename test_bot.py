@@ -9,9 +9,48 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from odanna_bot import DatabaseManager, AIManager, OdannaBot
+from odanna_bot import (DatabaseManager, AIManager, OdannaBot, ChatMemoryIndex, MetricsRegistry, RequestProfiler,
+                        ModelBackend, TransformersBackend, MODEL_BACKENDS, MAX_PROMPT_TOKENS, MAX_NEW_TOKENS,
+                        ODANNA_SYSTEM_PROMPT, SessionKVCache, SemanticMemory, GenerationPolicy,
+                        PriorityUpdateProcessor, StorageBackend, PostgresStorage, JobQueue, SQLiteJobQueue, RedisJobQueue,
+                        InferenceWorker, CircuitBreaker, read_export, write_export, _cut_at_stop,
+                        _parse_scenario, SCENARIO_MAX_CHARS, PROMPT_PREFIX_TOKENS, SEARCH_QUERIES_SIZE)
+from telegram.error import BadRequest
+from types import SimpleNamespace
+import asyncio
+import numpy as np
+import pstats
 import sqlite3
 import tempfile
+import threading
+import time
+
+class EchoBackend(ModelBackend):
+    """Символы вместо токенов и заранее известный ответ"""
+    name = "echo"
+    
+    def load(self):
+        pass
+    
+    def encode(self, text):
+        return [ord(char) for char in text]
+    
+    def decode(self, token_ids):
+        return "".join(chr(token) for token in token_ids)
+    
+    # Модель продолжает диалог за пользователя — это отрезается стоп-последовательностью
+    reply = "Добро пожаловать в гостиницу\nПользователь: а дальше?"
+    
+    def generate(self, input_ids, max_new_tokens, session_key=None, stop_sequences=None, max_time=None,
+                 prefix_key=None, prefix_length=0):
+        self.prompt_length = len(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.session_key = session_key
+        self.prefix_key, self.prefix_length = prefix_key, prefix_length
+        return _cut_at_stop(self.encode(self.reply), stop_sequences)
+    
+    def invalidate_session(self, session_key):
+        self.invalidated = getattr(self, "invalidated", []) + [session_key]
 
 def test_database():
     """Тест базы данных"""
@@ -143,7 +182,7 @@ def test_memory_system():
         cursor = conn.cursor()
         cursor.execute('''
             SELECT is_ignored FROM messages 
-            WHERE chat_id = ? AND message_text = ?
+            WHERE chat_key = (SELECT chat_key FROM chats WHERE chat_id = ?) AND message_text = ?
         ''', (chat_id, "Расскажи о себе"))
         result = cursor.fetchone()
         conn.close()
@@ -160,6 +199,1776 @@ def test_memory_system():
     finally:
         os.unlink(db_path)
 
+def test_pagination():
+    """Тест постраничной навигации по чатам и истории"""
+    print("\n📑 Тестирование пагинации...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        db = DatabaseManager(db_path)
+        db.add_user(12345, "test_user")
+        
+        # Чаты с разным временем активности
+        conn = sqlite3.connect(db_path)
+        for i in range(25):
+            conn.execute('''
+                INSERT INTO chats (chat_id, user_id, chat_name, scenario, last_activity)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (f"12345_chat{i:02d}", 12345, f"Чат {i}", "Небесная Гостиница",
+                  f"2025-01-01 12:00:{i // 2:02d}"))
+        conn.commit()
+        conn.close()
+        
+        page1, has_prev, has_next = db.get_user_chats_page(12345, 10)
+        assert [c[0] for c in page1] == [f"12345_chat{i:02d}" for i in range(24, 14, -1)]
+        assert not has_prev and has_next
+        
+        cursor = (page1[-1][4], page1[-1][0])
+        page2, has_prev, has_next = db.get_user_chats_page(12345, 10, cursor)
+        assert [c[0] for c in page2] == [f"12345_chat{i:02d}" for i in range(14, 4, -1)]
+        assert has_prev and has_next
+        
+        cursor = (page2[-1][4], page2[-1][0])
+        page3, has_prev, has_next = db.get_user_chats_page(12345, 10, cursor)
+        assert len(page3) == 5 and has_prev and not has_next
+        
+        cursor = (page3[0][4], page3[0][0])
+        back, has_prev, has_next = db.get_user_chats_page(12345, 10, cursor, backward=True)
+        assert back == page2 and has_prev and has_next
+        print("✅ Страницы чатов корректны")
+        
+        chat_id = db.create_chat(12345, "История")
+        for i in range(12):
+            db.add_message(chat_id, 12345, f"Сообщение {i}", f"Ответ {i}", "нейтральное", 40)
+        
+        newest, has_older, has_newer = db.get_chat_messages_page(chat_id, 5)
+        assert [m[1] for m in newest] == [f"Сообщение {i}" for i in range(7, 12)]
+        assert has_older and not has_newer
+        
+        older, has_older, has_newer = db.get_chat_messages_page(chat_id, 5, before_id=newest[0][0])
+        assert [m[1] for m in older] == [f"Сообщение {i}" for i in range(2, 7)]
+        assert has_older and has_newer
+        
+        oldest, has_older, has_newer = db.get_chat_messages_page(chat_id, 5, before_id=older[0][0])
+        assert len(oldest) == 2 and not has_older and has_newer
+        
+        newer, has_older, has_newer = db.get_chat_messages_page(chat_id, 5, after_id=oldest[-1][0])
+        assert newer == older
+        print("✅ Страницы истории корректны")
+        
+        class RecordingQuery:
+            async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+                self.text = text
+        
+        # Разметка в репликах экранируется, чужая история по подделанной кнопке не показывается
+        db.add_message(chat_id, 12345, "snake_case и *звёздочка", "`код", "нейтральное", 40)
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=SemanticMemory(db, model_name=""))
+        query = RecordingQuery()
+        asyncio.run(bot._dispatch_callback(query, 12345, f"hist_older_{10 ** 9}_{chat_id}"))
+        assert "snake\\_case и \\*звёздочка" in query.text and "\\`код" in query.text
+        asyncio.run(bot._dispatch_callback(query, 67890, f"hist_older_{10 ** 9}_{chat_id}"))
+        assert "Сообщение" not in query.text and "нет" in query.text
+        asyncio.run(bot._dispatch_callback(query, 67890, f"chat_history_{chat_id}"))
+        assert "Сообщение" not in query.text
+        asyncio.run(bot._dispatch_callback(query, 67890, f"chat_select_{chat_id}"))
+        assert "Сообщение" not in query.text and db.get_current_chat(67890) is None
+        print("✅ История показывается только владельцу чата, разметка экранирована")
+        
+        print("🎉 Тест пагинации пройден!")
+        
+    finally:
+        os.unlink(db_path)
+
+def test_search():
+    """Тест полнотекстового поиска и неточного «забудь»"""
+    print("\n🔎 Тестирование поиска...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        db = DatabaseManager(db_path)
+        assert db.fts_enabled
+        
+        db.add_user(12345, "test_user")
+        db.add_user(67890, "other_user")
+        chat_id = db.create_chat(12345, "Поиск")
+        other_chat_id = db.create_chat(67890, "Чужой")
+        
+        db.add_message(chat_id, 12345, "Расскажи про Небесную Гостиницу", "Это место для богов.", "любопытство", 40)
+        db.add_message(chat_id, 12345, "Я купил ёлку к празднику", "Любопытно.", "радость", 40)
+        db.add_message(chat_id, 12345, "Как работает кухня гостиницы?", "Спросите повара.", "любопытство", 40)
+        db.add_message(other_chat_id, 67890, "Гостиница мне снилась", "Хм.", "нейтральное", 40)
+        
+        results, has_more = db.search_messages(12345, "гостиниц")
+        assert len(results) == 2 and not has_more
+        assert all(r[1] == chat_id for r in results)
+        print("✅ Поиск ограничен историей пользователя")
+        
+        results, _ = db.search_messages(12345, "елку")
+        assert [r[3] for r in results] == ["Я купил ёлку к празднику"]
+        print("✅ Поиск не различает «е» и «ё»")
+        
+        page1, has_more = db.search_messages(12345, "гостиниц", limit=1)
+        page2, _ = db.search_messages(12345, "гостиниц", limit=1, offset=1)
+        assert has_more and page1[0][0] != page2[0][0]
+        print("✅ Результаты разбиты на страницы")
+        
+        # Неточное совпадение для «забудь»
+        forgotten_id = db.ignore_message(chat_id, "про небесную гостиницу")
+        assert forgotten_id == results[0][0] - 1
+        results, _ = db.search_messages(12345, "небесн")
+        assert results == []
+        assert db.ignore_message(chat_id, "совсем другое") is None
+        assert db.ignore_message(chat_id, "кухня ресторана") is None
+        print("✅ «Забудь» находит сообщение по неточному тексту, но не по одному общему слову")
+        
+        # Разметка в найденных репликах и названии чата экранируется
+        markdown_chat_id = db.create_chat(12345, "my_chat")
+        db.add_message(markdown_chat_id, 12345, "Скидка 50% на *ужин", "`счёт_готов", "радость", 40)
+        db.add_message(markdown_chat_id, 12345, "Скидка 500 на ужин", "Хорошо.", "радость", 40)
+        
+        class RecordingQuery:
+            async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+                self.text = text
+        
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=SemanticMemory(db, model_name=""))
+        bot.search_queries[12345] = "скидка"
+        query = RecordingQuery()
+        asyncio.run(bot._dispatch_callback(query, 12345, "search_0"))
+        assert "_my\\_chat_" in query.text and "\\*ужин" in query.text and "\\`счёт\\_готов" in query.text
+        print("✅ Результаты поиска экранированы")
+        
+        # Последние запросы помнятся только для ограниченного числа пользователей
+        class Message:
+            async def reply_text(self, text, reply_markup=None, parse_mode=None):
+                self.text = text
+        
+        def search(user_id, text):
+            update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=Message())
+            asyncio.run(bot.search_command(update, SimpleNamespace(args=text.split())))
+        
+        bot.search_queries.update((user_id, "ужин") for user_id in range(SEARCH_QUERIES_SIZE))
+        search(0, "скидка")
+        search(12345, "скидка")
+        assert len(bot.search_queries) == SEARCH_QUERIES_SIZE
+        assert 1 not in bot.search_queries and list(bot.search_queries)[-2:] == [0, 12345]
+        print("✅ Кэш поисковых запросов ограничен (LRU)")
+        
+        # Без FTS «%» в запросе — обычный символ, а не шаблон LIKE
+        db.fts_enabled = False
+        results, _ = db.search_messages(12345, "50%")
+        assert [r[3] for r in results] == ["Скидка 50% на *ужин"]
+        db.fts_enabled = True
+        print("✅ Запасной поиск LIKE экранирует «%» и «_»")
+        
+        # Индекс строится для базы, созданной до появления FTS
+        conn = sqlite3.connect(db_path)
+        conn.execute("DROP TABLE messages_fts")
+        conn.commit()
+        conn.close()
+        db = DatabaseManager(db_path)
+        results, _ = db.search_messages(12345, "кухня")
+        assert len(results) == 1
+        print("✅ Существующие сообщения проиндексированы")
+        
+        print("🎉 Тест поиска пройден!")
+        
+    finally:
+        os.unlink(db_path)
+
+def test_forget_by_id():
+    """Тест забывания по ID сообщения, в том числе параллельного"""
+    print("\n🔄 Тестирование забывания по ID...")
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        db = DatabaseManager(db_path)
+        db.add_user(12345, "test_user")
+        chat_id = db.create_chat(12345, "Забывание")
+        
+        # Одинаковые тексты: забывается и возвращается ровно одно сообщение
+        first_id = db.add_message(chat_id, 12345, "Повтор", "Ответ 1", "нейтральное", 40)
+        second_id = db.add_message(chat_id, 12345, "Повтор", "Ответ 2", "нейтральное", 40)
+        assert db.ignore_message(chat_id, "Повтор") == second_id
+        assert db.ignore_message(chat_id, "Повтор") == first_id
+        assert db.unignore_message(chat_id, "Повтор") == second_id
+        history = db.get_chat_history(chat_id)
+        assert [row[2] for row in history] == [1, 0]
+        print("✅ Дубликаты забываются и возвращаются по одному")
+        
+        # Чужое сообщение не трогаем, повторное забывание ничего не меняет
+        assert db.ignore_message_by_id(second_id, 67890) is None
+        assert db.ignore_message_by_id(second_id, 12345) == chat_id
+        assert db.ignore_message_by_id(second_id, 12345) is None
+        assert db.unignore_message_by_id(second_id, 12345) == chat_id
+        print("✅ Забывание по ID проверяет владельца")
+        
+        message_ids = [
+            db.add_message(chat_id, 12345, f"Сообщение {i}", f"Ответ {i}", "нейтральное", 40)
+            for i in range(40)
+        ]
+        
+        # Параллельные «забыть последнее» забывают разные сообщения
+        forgotten = []
+        lock = threading.Lock()
+        
+        def forget_last():
+            message_id = db.forget_last_message(chat_id)
+            with lock:
+                forgotten.append(message_id)
+        
+        threads = [threading.Thread(target=forget_last) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert sorted(forgotten) == message_ids[-20:]
+        print("✅ Параллельные «забыть последнее» не конфликтуют")
+        
+        # Параллельное забывание одного ID удаётся ровно один раз
+        results = []
+        
+        def forget_one():
+            changed = db.ignore_message_by_id(message_ids[0], 12345)
+            with lock:
+                results.append(changed)
+        
+        threads = [threading.Thread(target=forget_one) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        assert results.count(chat_id) == 1 and results.count(None) == 9
+        print("✅ Параллельное забывание одного сообщения атомарно")
+        
+        print("🎉 Тест забывания по ID пройден!")
+        
+    finally:
+        os.unlink(db_path)
+
+def test_memory_index():
+    """Тест векторного индекса долговременной памяти"""
+    print("\n🧭 Тестирование индекса памяти...")
+    
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 64)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    ids = list(range(1, 501))
+    
+    for dtype in ("float32", "int8"):
+        index = ChatMemoryIndex(64, dtype)
+        index.add(ids[:300], embeddings[:300])
+        index.add(ids[300:], embeddings[300:])
+        index.add(ids[:10], embeddings[:10])  # повтор не дублирует записи
+        assert len(index) == 500
+        
+        # Догоняющая индексация добавляет старые реплики после новых
+        backfilled = ChatMemoryIndex(64, dtype)
+        backfilled.add(ids[450:], embeddings[450:])
+        backfilled.add(ids, embeddings)
+        assert len(backfilled) == 500 and backfilled.max_id == 500
+        
+        query = embeddings[41] + 0.05 * embeddings[99]
+        assert index.search(query, 3)[0] == 42
+        assert 42 not in index.search(query, 3, exclude_ids={42})
+        print(f"✅ Поиск ближайших реплик ({dtype})")
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "12345_chat")
+            index.save(path)
+            loaded = ChatMemoryIndex.load(path, 64, dtype)
+            assert isinstance(loaded.vectors, np.memmap)
+            assert loaded.search(query, 5) == index.search(query, 5)
+            assert ChatMemoryIndex.load(path, 32, dtype) is None
+        print(f"✅ Индекс сохраняется и читается через mmap ({dtype})")
+    
+    class HashEncoder:
+        """Детерминированные «эмбеддинги» вместо модели"""
+        def encode(self, texts, **kwargs):
+            vectors = np.array([np.random.default_rng(sum(map(ord, text))).normal(size=16) for text in texts])
+            return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+    
+    with tempfile.NamedTemporaryFile(suffix='.db', delete=False) as temp_db:
+        db_path = temp_db.name
+    
+    try:
+        db = DatabaseManager(db_path)
+        db.add_user(12345, "test_user")
+        chat_id = db.create_chat(12345, "Память")
+        other_chat_id = db.create_chat(12345, "Другая память")
+        for i in range(5):
+            db.add_message(chat_id, 12345, f"Старая реплика {i}", "Помню.", "нейтральное", 40)
+        new_id = db.add_message(chat_id, 12345, "Новая реплика", "Помню.", "нейтральное", 40)
+        
+        memory = SemanticMemory(db, model_name="", storage_dir=None, max_indexes=1)
+        memory.model, memory.dim = HashEncoder(), 16
+        
+        # Новая реплика индексируется раньше, чем догоняется история чата
+        memory._index_turns([(chat_id, new_id, memory.turn_text("Новая реплика", "Помню."))])
+        item = memory.queue.get()
+        memory._backfill(*item[1:])
+        assert len(memory.indexes[chat_id]) == 6
+        print("✅ История догоняется, даже если новые реплики проиндексированы раньше")
+        
+        with memory.lock:
+            memory._get_index(other_chat_id)
+        assert list(memory.indexes) == [other_chat_id]
+        print("✅ Кэш индексов чатов ограничен (LRU)")
+        
+        # Удаление чата убирает его индекс из кэша и с диска
+        class Query:
+            async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+                self.text = text
+        
+        with tempfile.TemporaryDirectory() as memory_dir:
+            memory = SemanticMemory(db, model_name="", storage_dir=memory_dir)
+            memory.model, memory.dim = HashEncoder(), 16
+            memory._index_turns([(chat_id, new_id, memory.turn_text("Новая реплика", "Помню."))])
+            memory._index_turns([(other_chat_id, new_id, memory.turn_text("Чужая реплика", "Помню."))])
+            memory.flush()
+            assert len(os.listdir(memory_dir)) == 6
+            
+            bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=memory)
+            query = Query()
+            asyncio.run(bot._dispatch_callback(query, 12345, f"chat_delete_{chat_id}"))
+            assert "удалён" in query.text and db.get_chat_owner(chat_id) is None
+            assert list(memory.indexes) == [other_chat_id]
+            assert sorted(os.listdir(memory_dir)) == [f"{other_chat_id}.{suffix}.npy"
+                                                      for suffix in ("ids", "scale", "vec")]
+        print("✅ Удалённый чат не оставляет индекса памяти")
+        
+    finally:
+        os.unlink(db_path)
+    
+    print("🎉 Тест индекса памяти пройден!")
+
+def test_archive():
+    """Тест архивации неактивных чатов"""
+    print("\n🗄 Тестирование архива...")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_path = os.path.join(temp_dir, "odanna_bot.db")
+        db = DatabaseManager(db_path)
+        db.add_user(12345, "test_user")
+        
+        old_chat = db.create_chat(12345, "Старый")
+        fresh_chat = old_chat + "_fresh"
+        conn = sqlite3.connect(db_path)
+        conn.execute("INSERT INTO chats (chat_id, user_id, chat_name) VALUES (?, 12345, 'Свежий')", (fresh_chat,))
+        conn.commit()
+        conn.close()
+        
+        ids = [db.add_message(old_chat, 12345, f"Давнее {i}", f"Ответ {i}", "грусть", 50) for i in range(50)]
+        db.add_message(fresh_chat, 12345, "Недавнее", "Ответ", "радость", 40)
+        db.ignore_message_by_id(ids[3], 12345)
+        
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE chats SET last_activity = datetime('now', '-90 days') WHERE chat_id = ?", (old_chat,))
+        conn.commit()
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        conn.close()
+        
+        archived, purged = db.run_archive_maintenance(inactive_days=30, retention_days=0)
+        assert (archived, purged) == (1, 0)
+        assert db.get_chat_history(old_chat) == []
+        assert len(db.get_chat_history(fresh_chat)) == 1
+        assert os.path.exists(os.path.join(temp_dir, "odanna_bot_archive.db"))
+        print("✅ Неактивный чат перенесён в архив")
+        
+        # Архивный чат остаётся в списке и восстанавливается при выборе
+        chats, _, _ = db.get_user_chats_page(12345)
+        assert old_chat in [chat[0] for chat in chats]
+        assert db.restore_chat(old_chat)
+        assert not db.restore_chat(old_chat)
+        history, _, _ = db.get_chat_messages_page(old_chat, 100)
+        assert [row[0] for row in history] == ids
+        assert [row[0] for row in history if row[3]] == [ids[3]]
+        results, _ = db.search_messages(12345, "давнее", limit=100)
+        assert len(results) == 49
+        print("✅ Чат восстановлен с исходными ID и пометками")
+        
+        # Срок хранения: архивные чаты старше него удаляются
+        db.archive_chat(old_chat)
+        archived, purged = db.run_archive_maintenance(inactive_days=30, retention_days=60)
+        assert purged == 1
+        chats, _, _ = db.get_user_chats_page(12345)
+        assert [chat[0] for chat in chats] == [fresh_chat]
+        print("✅ Просроченные архивы удалены")
+        
+        # Реплика, сохранённая между записью архива и удалением, не теряется
+        racing_chat = db.create_chat(12345, "Гонка")
+        racing_ids = [db.add_message(racing_chat, 12345, f"До архива {i}", "Ответ", "радость", 40) for i in range(3)]
+        pack_rows = db._pack_rows
+        
+        def pack_with_insert(columns, rows):
+            racing_ids.append(db.add_message(racing_chat, 12345, "Во время архивации", "Ответ", "радость", 40))
+            return pack_rows(columns, rows)
+        
+        db._pack_rows = pack_with_insert
+        try:
+            assert db.archive_chat(racing_chat) == 3
+        finally:
+            del db._pack_rows
+        assert [row[0] for row in db.get_chat_history(racing_chat)] == ["Во время архивации"]
+        assert db.restore_chat(racing_chat)
+        history, _, _ = db.get_chat_messages_page(racing_chat, 100)
+        assert [row[0] for row in history] == racing_ids
+        print("✅ Сообщение, пришедшее во время архивации, сохраняется")
+        
+        print("🎉 Тест архива пройден!")
+
+def test_metrics():
+    """Тест реестра метрик"""
+    print("\n📈 Тестирование метрик...")
+    
+    metrics = MetricsRegistry()
+    metrics.describe('test_seconds', 'histogram', 'Тестовая гистограмма', buckets=(0.1, 1))
+    metrics.describe('test_total', 'counter', 'Тестовый счётчик')
+    metrics.describe('test_loaded', 'gauge', 'Тестовый gauge')
+    
+    metrics.observe('test_seconds', 0.05, stage="a")
+    metrics.observe('test_seconds', 0.5, stage="a")
+    metrics.observe('test_seconds', 5, stage="a")
+    metrics.inc('test_total', 3, source="model")
+    metrics.set_function('test_loaded', lambda: 1)
+    
+    text = metrics.render()
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'test_seconds_bucket{stage="a",le="1"} 2' in text
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'test_seconds_count{stage="a"} 3' in text
+    assert 'test_total{source="model"} 3' in text
+    assert 'test_loaded 1' in text
+    print("✅ Метрики отображаются в формате Prometheus")
+    
+    print("🎉 Тест метрик пройден!")
+
+def test_profiler():
+    """Тест выборочного профилирования с ротацией"""
+    print("\n🔬 Тестирование профилировщика...")
+    
+    disabled = RequestProfiler(every_n=0, slow_ms=0)
+    with disabled.profile("message_1") as session:
+        assert session is None
+    print("✅ Выключенный профилировщик ничего не делает")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profiler = RequestProfiler(every_n=2, slow_ms=0, directory=temp_dir, keep=3, trace_torch=False)
+        for i in range(10):
+            with profiler.profile(f"message_{i}"):
+                sum(range(1000))
+        dumps = sorted(os.listdir(temp_dir))
+        assert len(dumps) == 3 and all(name.endswith(".prof") for name in dumps)
+        assert "message_9" in dumps[-1]
+        print("✅ Каждое N-е обновление сохраняется, старые дампы удаляются")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        profiler = RequestProfiler(every_n=0, slow_ms=20, directory=temp_dir, trace_torch=False)
+        with profiler.profile("fast"):
+            pass
+        with profiler.profile("slow"):
+            time.sleep(0.03)
+        dumps = os.listdir(temp_dir)
+        assert len(dumps) == 1 and "_slow_" in dumps[0]
+        print("✅ Медленные обновления сохраняются по порогу")
+    
+    # Генерация идёт в своём потоке: её вызовы тоже попадают в профиль обновления
+    def generation_step():
+        return sum(range(1000))
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=SemanticMemory(db, model_name=""))
+        bot.profiler = RequestProfiler(every_n=1, slow_ms=0, directory=os.path.join(temp_dir, "profiles"),
+                                       trace_torch=False)
+        
+        async def profiled():
+            with bot.profiler.profile("message_1"):
+                return await bot._run_llm(generation_step)
+        
+        assert asyncio.run(profiled()) == sum(range(1000))
+        [dump] = os.listdir(bot.profiler.directory)
+        functions = {name for _, _, name in pstats.Stats(os.path.join(bot.profiler.directory, dump)).stats}
+        assert "generation_step" in functions and "profiled" in functions
+        print("✅ Вызовы в потоке генерации попадают в профиль")
+    
+    print("🎉 Тест профилировщика пройден!")
+
+def test_model_backends():
+    """Тест выбора бэкенда языковой модели"""
+    print("\n🔌 Тестирование бэкендов модели...")
+    
+    # Неизвестный бэкенд — работаем на заготовленных ответах
+    ai = AIManager("tensorrt", "microsoft/DialoGPT-medium")
+    assert ai.backend is None
+    assert ai.generate_odanna_response("Привет", [], 50, "нейтральное", "default")
+    print("✅ Неизвестный бэкенд не роняет бота")
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+        assert isinstance(ai.backend, EchoBackend) and ai.backend.model_name == "echo-model"
+        
+        response = ai.generate_odanna_response("Привет", [], 50, "нейтральное", "default")
+        context = ai._build_context("Привет", [], 50, "нейтральное", "default")
+        # В ответ попадают только новые токены, а не промпт
+        assert "Добро пожаловать в гостиницу" in response
+        assert "Оданна" not in response
+        template = ai.scenario_template("default")
+        assert ai.backend.prompt_length == len(template.prefix_ids) + len(context) - len(template.text)
+        # Промпт с ответом не выходит за позиции модели (n_positions = MAX_PROMPT_TOKENS)
+        assert ai.backend.prompt_length + ai.backend.max_new_tokens <= MAX_PROMPT_TOKENS
+        print("✅ Бэкенд из реестра выбирается по имени и получает промпт")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    # Неполный бэкенд падает при создании, а не на первом сообщении
+    class HalfBackend(ModelBackend):
+        def load(self):
+            pass
+    
+    try:
+        HalfBackend("half-model")
+        assert False, "бэкенд без encode/decode/generate создан"
+    except TypeError:
+        pass
+    print("✅ Неполный бэкенд не создаётся")
+    
+    print("🎉 Тест бэкендов модели пройден!")
+
+def test_token_cache():
+    """Тест сохранённых токенов реплик и сборки контекста из них"""
+    print("\n🧩 Тестирование кэша токенов...")
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        db.add_user(12345, "test_user")
+        chat_id = db.create_chat(12345, "Токены")
+        
+        # Сообщение с токенами и старое сообщение без них
+        old_id = db.add_message(chat_id, 12345, "Давнее", "Ответ давний", "нейтральное", 40)
+        new_id = db.add_message(chat_id, 12345, "Привет", "Добрый вечер", "радость", 50,
+                                message_tokens=ai.encode_turn("Пользователь", "Привет"),
+                                response_tokens=ai.encode_turn("Оданна", "Добрый вечер"),
+                                tokenizer_id=ai.tokenizer_id)
+        
+        turns = db.get_history_turns(chat_id, 10, ai.tokenizer_id)
+        assert [turn[0] for turn in turns] == [old_id, new_id]
+        assert turns[0][4] is None and turns[0][5] is None
+        assert ai.backend.decode(turns[1][4]) == "\nПользователь: Привет"
+        assert ai.backend.decode(turns[1][5]) == "\nОданна: Добрый вечер"
+        print("✅ Токены сохраняются вместе с сообщением")
+        
+        # Токены другого токенизатора не используются
+        assert db.get_history_turns(chat_id, 10, "hf:other-model")[1][4] is None
+        
+        db.set_message_tokens([(old_id, ai.encode_turn("Пользователь", "Давнее"), None)], ai.tokenizer_id)
+        assert ai.backend.decode(db.get_history_turns(chat_id, 10, ai.tokenizer_id)[0][4]) == "\nПользователь: Давнее"
+        print("✅ Старые реплики дотокенизируются один раз")
+        
+        # Кэш токенов не уходит в архив, текст восстанавливается целиком
+        assert db.archive_chat(chat_id) == 2
+        assert db.restore_chat(chat_id)
+        restored = db.get_history_turns(chat_id, 10, ai.tokenizer_id)
+        assert [(turn[1], turn[2], turn[4]) for turn in restored] == [
+            ("Давнее", "Ответ давний", None), ("Привет", "Добрый вечер", None)
+        ]
+        print("✅ Архив хранит только текст")
+    
+    # Контекст из готовых токенов совпадает с токенизацией всей строки
+    history = ["Пользователь: Привет", "Оданна: Добрый вечер", "Пользователь: Как дела?"]
+    history_tokens = [ai.encode_turn(*line.split(": ", 1)) for line in history]
+    history_tokens[1] = None  # часть строк без кэша
+    memories = ["Пользователь: Давнее"]
+    
+    ids = ai._build_input_ids("Спасибо", history, 60, "радость", "Гостиница", memories, history_tokens)
+    context = ai._build_context("Спасибо", history, 60, "радость", "Гостиница", memories)
+    dialogue = context[len(ODANNA_SYSTEM_PROMPT):]
+    system_length = PROMPT_PREFIX_TOKENS - len(ai.scenario_template("Гостиница").scenario_ids)
+    assert ai.backend.decode(ids) == ODANNA_SYSTEM_PROMPT[:system_length] + dialogue
+    # Окно считается по потолку ответа: бюджет хода не сдвигает границы промпта
+    for max_new_tokens in (24, MAX_NEW_TOKENS):
+        assert ai._build_input_ids("Спасибо", history, 60, "радость", "Гостиница", memories, history_tokens,
+                                   max_new_tokens=max_new_tokens) == ids
+    assert len(ids) + MAX_NEW_TOKENS <= MAX_PROMPT_TOKENS
+    print("✅ Контекст собирается из токенов, урезается системный промпт, а не диалог")
+    
+    print("🎉 Тест кэша токенов пройден!")
+
+def test_kv_cache():
+    """Тест KV-кэша чатов"""
+    print("\n⚡ Тестирование KV-кэша...")
+    
+    def past_for(length):
+        # Два слоя (key, value) формы (batch, heads, seq, head_dim)
+        return tuple(
+            (np.full((1, 2, length, 4), layer, np.float32), np.full((1, 2, length, 4), -layer, np.float32))
+            for layer in range(2)
+        )
+    
+    entry_bytes = sum(tensor.nbytes for layer in past_for(10) for tensor in layer)
+    cache = SessionKVCache(budget_bytes=2 * entry_bytes)
+    prompt = list(range(11))
+    cache.store("chat_a", prompt[:-1], past_for(10))
+    
+    # Следующий ход: прошлый промпт + новые токены — весь старый префикс из кэша
+    prefix, past = cache.lookup("chat_a", prompt + [100, 101])
+    assert prefix == 10 and past[1][0].shape == (1, 2, 10, 4)
+    
+    # Тот же промпт: последний токен всегда досчитывается
+    assert cache.lookup("chat_a", prompt[:6])[0] == 5
+    
+    # Изменившаяся история (забытая реплика) обрезает кэш до общего префикса
+    changed = prompt[:4] + [42] + prompt[5:]
+    prefix, past = cache.lookup("chat_a", changed)
+    assert prefix == 4 and past[0][1].shape[2] == 4
+    assert cache.lookup("chat_b", prompt) == (0, None)
+    print("✅ Переиспользуется только общий префикс")
+    
+    # LRU: при нехватке бюджета вытесняется давно не использованный чат
+    cache.store("chat_b", prompt[:-1], past_for(10))
+    cache.lookup("chat_a", prompt)
+    cache.store("chat_c", prompt[:-1], past_for(10))
+    assert list(cache.sessions) == ["chat_a", "chat_c"]
+    assert cache.total_bytes == 2 * entry_bytes
+    
+    cache.invalidate("chat_a")
+    assert list(cache.sessions) == ["chat_c"] and cache.total_bytes == entry_bytes
+    print("✅ Бюджет памяти соблюдается, вытеснение по LRU")
+    
+    # Бот сбрасывает кэш при смене чата и при «забудь»
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        db.add_user(12345, "user", "Пользователь")
+        chat_a, chat_b = db.create_chat(12345, "Чат А"), db.create_chat(12345, "Чат Б")
+        for chat_id in (chat_a, chat_a, chat_b):
+            asyncio.run(bot._set_current_chat(12345, chat_id))
+        assert ai.backend.invalidated == [chat_a] and db.get_current_chat(12345) == chat_b
+        
+        ai.generate_odanna_response("Привет", [], 50, "нейтральное", "default", session_key=chat_b)
+        assert ai.backend.session_key == chat_b
+        print("✅ Смена чата сбрасывает KV-кэш прежнего чата")
+    
+    # Промпт хода продолжает прошлый: досчитываются только новые реплики и сведения хода
+    def prompt(message, history, turn):
+        ids = ai._build_input_ids(message, history, 40 + 10 * turn, ai.analyze_emotion(message), "default",
+                                  [f"Пользователь: давнее {turn}"], session_key="chat_c")
+        assert len(ids) + MAX_NEW_TOKENS <= MAX_PROMPT_TOKENS
+        return ai.backend.decode(ids)
+    
+    def continues(first, second):
+        return second.startswith(first[:first.index("\n\nУровень эмпатии")])
+    
+    history, prompts = [], []
+    for turn, (message, reply) in enumerate([("Добрый вечер", "Добро пожаловать."), ("Как дела?", "Неплохо."),
+                                             ("Спасибо!", "Пожалуйста.")]):
+        prompts.append(prompt(message, list(history), turn))
+        history += [f"Пользователь: {message}", f"Оданна: {reply}"]
+    assert all(continues(first, second) for first, second in zip(prompts, prompts[1:]))
+    assert "\nОданна: Неплохо.\n\nУровень эмпатии" in prompts[-1]
+    print("✅ Промпт следующего хода начинается с прошлого")
+    
+    # Не уместившись, история теряет целые старые реплики, KV-кэш чата сбрасывается
+    ai.backend.invalidated = []
+    history += [f"Пользователь: {'длинная реплика ' * 6}", "Оданна: Ясно."] * 3
+    trimmed = prompt("Ещё", history, 3)
+    assert ai.backend.invalidated == ["chat_c"]
+    dialogue = trimmed[trimmed.index("История разговора:"):]
+    assert "Добрый вечер" not in dialogue and dialogue.startswith("История разговора:\nПользователь: длинная")
+    history += ["Пользователь: Ещё", "Оданна: Да."]
+    assert continues(trimmed, prompt("И ещё", history, 4)) and ai.backend.invalidated == ["chat_c"]
+    print("✅ Старые реплики отбрасываются целиком, дальше промпт снова растёт с конца")
+    
+    print("🎉 Тест KV-кэша пройден!")
+
+def test_scenarios():
+    """Тест пользовательских сценариев и скомпилированных шаблонов промпта"""
+    print("\n🎭 Тестирование сценариев...")
+    
+    # Название — первая строка, описание ограничено SCENARIO_MAX_CHARS
+    assert _parse_scenario("  Чайная  ") == ("Чайная", None)
+    name, prompt = _parse_scenario("Пикник у реки\n" + "Оданна ловит рыбу. " * 200)
+    assert name == "Пикник у реки" and len(prompt) == SCENARIO_MAX_CHARS and prompt.startswith(name)
+    print("✅ Описание делится на название и текст")
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    # Один шаблон на сценарий, его блок токенизирован заранее
+    template = ai.scenario_template(name, prompt)
+    assert ai.scenario_template(name, prompt) is template
+    assert ai.scenario_template("Небесная Гостиница").prefix_key != template.prefix_key
+    assert ai.scenario_template(name, prompt + "!").prefix_key != template.prefix_key
+    assert ai.backend.decode(template.scenario_ids) == "\n" + template.block
+    
+    # Описание входит в промпт; не уместившись, урезается системный промпт, затем конец описания
+    context = ai._build_context("Привет", [], 50, "нейтральное", name, None, prompt)
+    ids = ai._build_input_ids("Привет", [], 50, "нейтральное", name, None, scenario_prompt=prompt)
+    assert context.startswith(template.text) and f"Описание сценария: {prompt}" in context
+    assert template.prefix_ids == template.scenario_ids[:PROMPT_PREFIX_TOKENS]
+    assert ai.backend.decode(ids) == ("\n" + template.block)[:PROMPT_PREFIX_TOKENS] + context[len(template.text):]
+    print("✅ Описание сценария входит в промпт")
+    
+    # Шаблон — общий KV-префикс всех чатов сценария и при окне по умолчанию,
+    # хотя системный промпт в него не помещается (как у DialoGPT)
+    assert len(ODANNA_SYSTEM_PROMPT) > MAX_PROMPT_TOKENS - MAX_NEW_TOKENS
+    for scenario, scenario_prompt in (("Небесная Гостиница", None), (name, prompt)):
+        shared = ai.scenario_template(scenario, scenario_prompt)
+        for chat in ("chat_a", "chat_b"):
+            ai.generate_odanna_response("Привет", [], 50, "нейтральное", scenario, session_key=chat,
+                                        scenario_prompt=scenario_prompt)
+            assert ai.backend.session_key == chat and ai.backend.prefix_key == shared.prefix_key
+            assert ai.backend.prefix_length == len(shared.prefix_ids) > 0
+    print("✅ Общий KV-префикс сценария используется при окне модели по умолчанию")
+    
+    class CountingModel:
+        """Модель, считающая досчитанные токены промпта"""
+        device = "cpu"
+        computed = 0
+        
+        def __call__(self, rest, past_key_values=None, attention_mask=None, use_cache=True):
+            import torch
+            self.computed += rest.shape[1]
+            length = attention_mask.shape[1]
+            return SimpleNamespace(past_key_values=tuple(
+                (torch.zeros(1, 2, length, 4), torch.zeros(1, 2, length, 4)) for _ in range(2)
+            ))
+    
+    backend = TransformersBackend("microsoft/DialoGPT-medium", "cpu")
+    backend.model = CountingModel()
+    backend.kv_cache = SessionKVCache(budget_bytes=1 << 20)
+    scenario_ids = list(range(100, 140))
+    backend._prefill("chat_a", scenario_ids + [1, 2, 3], "scenario:a", 40)
+    assert backend.model.computed == 42
+    # Новый чат того же сценария досчитывает только свою часть
+    past = backend._prefill("chat_b", scenario_ids + [7, 8], "scenario:a", 40)
+    assert backend.model.computed == 43 and past[0][0].shape[2] == 41
+    assert backend.kv_cache.sessions["scenario:a"][0] == scenario_ids
+    # Другой сценарий префикс не делит
+    backend._prefill("chat_c", list(range(200, 240)) + [1, 2], "scenario:b", 40)
+    assert backend.model.computed == 43 + 41
+    print("✅ Префикс сценария считается один раз на все его чаты")
+    
+    # Изменённый сценарий: прежний шаблон и его KV-префикс забываются
+    ai.invalidate_scenario(name, prompt)
+    assert ai.backend.invalidated[-1] == template.prefix_key
+    assert ai.scenario_template(name, prompt) is not template
+    
+    class Message:
+        def __init__(self, text):
+            self.text = text
+            self.replies = []
+        
+        async def reply_text(self, text, parse_mode=None, reply_markup=None):
+            self.replies.append(text)
+    
+    class Query:
+        async def edit_message_text(self, text, parse_mode=None, reply_markup=None):
+            self.text = text
+    
+    def update(update_id, text):
+        return SimpleNamespace(
+            update_id=update_id,
+            effective_user=SimpleNamespace(id=701, username="guest", first_name="Гость", last_name=None),
+            effective_chat=SimpleNamespace(id=701),
+            message=Message(text),
+            get_bot=lambda: None,
+        )
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        
+        # Чат «с настройками»: следующее сообщение — описание сценария, а не реплика
+        asyncio.run(bot._handle_create_chat(Query(), 701, "create_custom"))
+        chat_id = db.get_current_chat(701)
+        description = update(1, "Пикник у реки\nОданна ловит рыбу")
+        asyncio.run(bot.handle_message(description, None))
+        assert db.get_chat_scenario(chat_id) == ("Пикник у реки", "Пикник у реки\nОданна ловит рыбу")
+        assert "Пикник у реки" in description.message.replies[0]
+        assert db.get_chat_history(chat_id) == [] and db.get_current_chat(701) == chat_id
+        print("✅ Описание сценария собирается после создания чата")
+        
+        # /scenario показывает и меняет сценарий активного чата
+        ai.backend.invalidated = []
+        command = update(2, "/scenario")
+        asyncio.run(bot.scenario_command(command, None))
+        assert "Оданна ловит рыбу" in command.message.replies[0]
+        old_template = ai.scenario_template("Пикник у реки", "Пикник у реки\nОданна ловит рыбу")
+        asyncio.run(bot.scenario_command(update(3, "/scenario Чайная\nДождь стучит по крыше"), None))
+        assert db.get_chat_scenario(chat_id) == ("Чайная", "Чайная\nДождь стучит по крыше")
+        assert ai.backend.invalidated == [old_template.prefix_key, chat_id]
+        print("✅ /scenario меняет сценарий и сбрасывает кэши")
+    
+    print("🎉 Тест сценариев пройден!")
+
+def test_generation_policy():
+    """Тест бюджета генерации"""
+    print("\n📏 Тестирование бюджета генерации...")
+    
+    policy = GenerationPolicy(slo_ms=5000, min_tokens=24, max_tokens=150)
+    
+    # Без статистики — потолок: 500 символов всё равно больше 150 токенов
+    assert policy.max_new_tokens(50, 50) == 150
+    
+    # Типичные принятые ответы ~100 символов (≈2 символа на токен)
+    policy.learn_reply_lengths([100] * 200)
+    typical = policy.max_new_tokens(50, 50)
+    assert 45 <= typical <= 60
+    assert policy.max_new_tokens(5, 50) < typical < policy.max_new_tokens(300, 50)
+    assert policy.max_new_tokens(50, 35) < typical < policy.max_new_tokens(50, 85)
+    print(f"✅ Бюджет по длине принятых ответов: {typical} токенов")
+    
+    # Модель даёт ~10 токенов/с: при очереди бюджет ужимается ради SLO, но не ниже минимума
+    policy.observe(new_tokens=50, seconds=5.0, reply_chars=100)
+    assert policy.max_new_tokens(300, 85, queue_depth=0) <= 50
+    assert policy.max_new_tokens(300, 85, queue_depth=1) == 25
+    assert policy.max_new_tokens(300, 85, queue_depth=5) == 24
+    print("✅ Под нагрузкой бюджет уменьшается до SLO")
+    
+    # Обрезанные бюджетом ответы тянут оценку длины вверх, а не вниз
+    before = policy.max_new_tokens(50, 50)
+    policy = GenerationPolicy(slo_ms=5000, min_tokens=24, max_tokens=150)
+    policy.learn_reply_lengths([100] * 200)
+    for _ in range(50):
+        policy.observe(new_tokens=40, seconds=0.4, reply_chars=80, truncated=True)
+    assert policy.max_new_tokens(50, 50) > before
+    print("✅ Обрезанные ответы не сжимают бюджет")
+    
+    # Стоп-последовательность отрезает реплику, которую модель начала за пользователя
+    assert _cut_at_stop([1, 2, 3, 9, 9, 4], [[9, 9]]) == [1, 2, 3]
+    assert _cut_at_stop([1, 2, 3], [[9, 9]]) == [1, 2, 3]
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    response = ai.generate_odanna_response("Привет", [], 50, "нейтральное", "default", queue_depth=2)
+    assert "Пользователь" not in response and "Добро пожаловать в гостиницу" in response
+    assert 24 <= ai.backend.max_new_tokens <= 150
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        db.add_user(12345, "test_user")
+        chat_id = db.create_chat(12345, "Длины")
+        db.add_message(chat_id, 12345, "Привет", "Добрый вечер", "радость", 50)
+        db.add_message(chat_id, 12345, "Ещё", "x" * 300, "нейтральное", 50)
+        db.ignore_message_by_id(db.add_message(chat_id, 12345, "Забудь", "y" * 50, "нейтральное", 50), 12345)
+        assert sorted(db.get_response_lengths()) == [12, 300]
+    print("✅ Генерация останавливается на реплике за пользователя")
+    
+    print("🎉 Тест бюджета генерации пройден!")
+
+def test_speculative_decoding():
+    """Тест параметров генерации с черновой моделью"""
+    print("\n🏃 Тестирование спекулятивного декодирования...")
+    
+    class FakeTokenizer:
+        eos_token_id = 50256
+    
+    backend = TransformersBackend("microsoft/DialoGPT-medium", "cpu")
+    backend.tokenizer = FakeTokenizer()
+    
+    # Без черновика — прежние параметры сэмплирования
+    kwargs = backend._generation_kwargs(100)
+    assert kwargs['max_length'] == 250
+    assert kwargs['do_sample'] is True and kwargs['temperature'] == 0.8
+    assert 'assistant_model' not in kwargs
+    print("✅ Без черновой модели генерация не меняется")
+    
+    # С черновиком сэмплирование то же, добавляется только assistant_model
+    draft = object()
+    backend.draft_model = draft
+    speculative = backend._generation_kwargs(100)
+    assert speculative.pop('assistant_model') is draft
+    assert speculative == kwargs
+    print("✅ Черновая модель передаётся в generate с теми же параметрами")
+    
+    print("🎉 Тест спекулятивного декодирования пройден!")
+
+def test_response_pool():
+    """Тест пула заготовленных ответов"""
+    print("\n🍱 Тестирование пула заготовок...")
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    # Короткие реплики распознаются, содержательные и вопросы — нет
+    assert ai.detect_intent("Привет!") == "greeting"
+    assert ai.detect_intent("Привет, мне грустно") == "sadness"
+    assert ai.detect_intent("Спасибо") == "thanks"
+    assert ai.detect_intent("Покажи меню") is None
+    assert ai.detect_intent("Спасибо за ужин, было очень вкусно!") is None
+    assert ai.detect_intent("Привет, как дела?") is None
+    print("✅ Намерения коротких реплик определяются")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        
+        # Простой: заготовки генерируются в самые пустые ячейки
+        assert bot.refill_response_pool(limit=3) == 3
+        counts = db.count_pooled_responses()
+        assert len(counts) == 3 and set(counts.values()) == {1}
+        print("✅ Пул пополняется в простое")
+        
+        # Без нагрузки отвечает модель, в пик — заготовка
+        db.add_pooled_response("greeting", 50, "Небесная Гостиница", "*кивает* Добрый вечер.")
+        assert bot._pooled_response("Привет!", 55, "Небесная Гостиница") is None
+        bot.inflight = 3
+        assert bot._pooled_response("Привет!", 55, "Небесная Гостиница") == "*кивает* Добрый вечер."
+        assert bot._pooled_response("Привет!", 85, "Небесная Гостиница") is None  # пустая ячейка
+        assert bot._pooled_response("Расскажи о себе", 55, "Небесная Гостиница") is None
+        
+        # Показанная POOL_MAX_SERVES раз заготовка уходит из пула
+        assert db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=3)[0]
+        assert db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=3)[0]
+        assert db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=3) is None
+        print("✅ В час пик отвечает пул, заготовки ротируются")
+        
+        # Устаревшие заготовки удаляются и не выдаются
+        conn = sqlite3.connect(db.db_path)
+        conn.execute("UPDATE response_pool SET created_at = datetime('now', '-2 days')")
+        conn.commit()
+        conn.close()
+        assert db.take_pooled_response("farewell", 35, "Небесная Гостиница", ttl_hours=24) is None
+        assert db.purge_stale_pool(ttl_hours=24) == 3
+        
+        # Без модели пул заменяет запасные ответы, но сам не пополняется
+        bot.inflight = 1
+        db.add_pooled_response("thanks", 35, "Небесная Гостиница", "*едва заметно улыбается*")
+        ai.backend = None
+        assert bot._pooled_response("Спасибо", 35, "Небесная Гостиница") == "*едва заметно улыбается*"
+        assert bot.refill_response_pool() == 0
+        print("✅ Без модели пул заменяет запасные ответы")
+    
+    print("🎉 Тест пула заготовок пройден!")
+
+def test_priority_lanes():
+    """Тест быстрой полосы для меню и полосы генерации"""
+    print("\n🚦 Тестирование полос обработки...")
+    
+    def update(user_id, text=None):
+        return SimpleNamespace(message=SimpleNamespace(text=text) if text is not None else None,
+                               effective_user=SimpleNamespace(id=user_id))
+    
+    assert PriorityUpdateProcessor.lane(update(1, "Привет")) == "llm"
+    assert PriorityUpdateProcessor.lane(update(1, "/start")) == "fast"
+    assert PriorityUpdateProcessor.lane(update(1)) == "fast"  # нажатие кнопки
+    print("✅ Сообщения идут в полосу генерации, кнопки и команды — в быструю")
+    
+    async def scenario():
+        processor = PriorityUpdateProcessor(fast_lane_size=2, llm_lane_size=1)
+        release = asyncio.Event()
+        order = []
+        
+        async def generation(name):
+            order.append(f"{name}:start")
+            await release.wait()
+            order.append(f"{name}:end")
+        
+        async def menu():
+            order.append("menu")
+        
+        # Полоса генерации занята, второе сообщение ждёт своей очереди
+        first = asyncio.create_task(processor.process_update(update(1, "раз"), generation("a")))
+        second = asyncio.create_task(processor.process_update(update(2, "два"), generation("b")))
+        await asyncio.sleep(0.01)
+        
+        # Меню отвечает сразу, не дожидаясь генерации
+        await asyncio.wait_for(processor.process_update(update(3), menu()), timeout=1)
+        assert order == ["a:start", "menu"]
+        
+        release.set()
+        await asyncio.gather(first, second)
+        assert order == ["a:start", "menu", "a:end", "b:start", "b:end"]
+        assert not processor.user_locks
+    
+    asyncio.run(scenario())
+    print("✅ Меню не ждёт занятую полосу генерации")
+    
+    # Генерация в отдельном потоке не блокирует цикл событий
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager("echo", "нет"), memory=SemanticMemory(db, model_name=""))
+        
+        async def responsiveness():
+            generation = asyncio.create_task(bot._run_llm(time.sleep, 0.3))
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            assert time.perf_counter() - started < 0.2
+            await generation
+        
+        asyncio.run(responsiveness())
+        bot.llm_executor.shutdown()
+    print("✅ Модель вызывается вне цикла событий")
+    
+    print("🎉 Тест полос обработки пройден!")
+
+def check_storage(db):
+    """Общий набор проверок хранилища: одинаковое поведение на любом бэкенде"""
+    db.ping()
+    db.add_user(501, "guest", "Гость", gender="female")
+    db.add_user(501, "guest2", "Гость")
+    db.add_user(502, "other", "Другой")
+    chat_id = db.create_chat(501, "Ужин", "Небесная Гостиница")
+    other_chat = db.create_chat(502, "Чужой")
+    
+    assert db.get_user_chats(501)[0][:4] == (chat_id, "Ужин", "Небесная Гостиница", 0)
+    assert db.get_chat_owner(chat_id) == 501 and db.get_chat_owner("нет_такого") is None
+    
+    # Активный чат общий для всех узлов бота: хранится в базе
+    assert db.get_current_chat(501) is None
+    assert db.set_current_chat(501, other_chat) is None and db.get_current_chat(501) == other_chat
+    assert db.set_current_chat(501, chat_id) == other_chat and db.get_current_chat(501) == chat_id
+    assert db.get_chat_empathy_level(chat_id) == 35
+    db.update_chat_empathy(chat_id, 70)
+    assert db.get_chat_empathy_level(chat_id) == 70
+    
+    first = db.add_message(chat_id, 501, "Как приготовить ужин?", "Ёжики к ужину не подаются", "радость", 50,
+                           message_tokens=[1, 2], response_tokens=[3], tokenizer_id="tok")
+    second = db.add_message(chat_id, 501, "Спасибо за ужин", "Пожалуйста")
+    third = db.add_message(chat_id, 501, "Доброй ночи", None)
+    db.add_message(other_chat, 502, "Ужин был чужой", "Да")
+    assert first < second < third
+    assert db.get_user_chats(501)[0][3] == 3
+    
+    # Статистика копится вместе с репликами; старых сообщений для досчёта нет
+    stats = db.get_user_stats(501)
+    assert stats["messages"] == 3 and stats["emotion:радость"] == 1
+    assert sum(value for name, value in stats.items() if name.startswith("hour:")) == 3
+    [(day, messages, average)] = db.get_chat_stats(chat_id)
+    assert len(day) == 10 and messages == 3 and average == 40.0
+    assert db.backfill_stats() == 0
+    
+    # История и кэш токенов
+    history = db.get_chat_history(chat_id)
+    assert [row[0] for row in history] == ["Как приготовить ужин?", "Спасибо за ужин", "Доброй ночи"]
+    assert len(history[0][4]) == 19  # «ГГГГ-ММ-ДД ЧЧ:ММ:СС»
+    turns = db.get_history_turns(chat_id, 10, "tok")
+    assert turns[0][4:] == ([1, 2], [3]) and turns[1][4:] == (None, None)
+    assert db.get_history_turns(chat_id, 10, "other")[0][4:] == (None, None)
+    db.set_message_tokens([(second, [7], [8, 9])], "tok")
+    assert db.get_history_turns(chat_id, 2, "tok")[0][4:] == ([7], [8, 9])
+    assert 10 in db.get_response_lengths()
+    
+    # Страницы истории и списка чатов
+    page, has_older, has_newer = db.get_chat_messages_page(chat_id, limit=2)
+    assert [row[0] for row in page] == [second, third] and has_older and not has_newer
+    page, has_older, has_newer = db.get_chat_messages_page(chat_id, limit=2, before_id=second)
+    assert [row[0] for row in page] == [first] and not has_older and has_newer
+    page, _, has_newer = db.get_chat_messages_page(chat_id, limit=2, after_id=first)
+    assert [row[0] for row in page] == [second, third] and not has_newer
+    chats, has_previous, has_next = db.get_user_chats_page(501, limit=1)
+    assert [row[0] for row in chats] == [chat_id] and not has_previous and not has_next
+    cursor = (chats[0][4], chats[0][0])
+    assert db.get_user_chats_page(501, limit=1, cursor=cursor)[0] == []
+    assert db.get_user_chats_page(501, limit=1, cursor=cursor, backward=True)[0] == []
+    
+    # Поиск: префиксы, «ё», только свои сообщения
+    results, has_more = db.search_messages(501, "ужин")
+    assert {row[0] for row in results} == {first, second} and not has_more
+    assert db.search_messages(501, "ежики")[0][0][0] == first
+    assert db.search_messages(501, "!!!") == ([], False)
+    assert db.find_message_id(chat_id, "спасибо за ужин") == second
+    assert db.find_message_id(chat_id, "ужин приготовить") == first
+    assert db.get_messages_by_ids(chat_id, [third, first, 10 ** 9])[0][0] == third
+    
+    # Забывание и возврат
+    assert db.forget_last_message(chat_id) == third
+    assert db.forget_last_message(chat_id) == second
+    assert db.find_message_id(chat_id, "спасибо за ужин", ignored=True) == second
+    assert db.unignore_message(chat_id, "спасибо за ужин")
+    assert db.ignore_message_by_id(first, 502) is None
+    assert db.ignore_message_by_id(first, 501) == chat_id
+    assert db.ignore_message_by_id(first, 501) is None
+    assert db.unignore_message_by_id(first, 501) == chat_id
+    assert db.get_messages_by_ids(chat_id, [first, second, third]) == [
+        (first, "Как приготовить ужин?", "Ёжики к ужину не подаются"),
+        (second, "Спасибо за ужин", "Пожалуйста"),
+    ]
+    
+    # Доставка: повтор обновления не сохраняет вторую реплику, ответ ждёт отправки
+    reply_chat = db.create_chat(503, "Доставка")
+    assert not db.is_update_processed(900)
+    message_id, outbox_id = db.add_reply(900, 77, reply_chat, 503, "Привет", "*кивает*", "радость", 60)
+    assert db.is_update_processed(900)
+    assert db.add_reply(900, 77, reply_chat, 503, "Привет", "*кивает*", "радость", 60) is None
+    assert db.get_chat_empathy_level(reply_chat) == 60 and db.get_user_chats(503)[0][3] == 1
+    assert db.claim_outbox() == []  # ответ закреплён за обработчиком, который его отправляет
+    db.mark_outbox_sent(outbox_id)
+    late_id, late_outbox = db.add_reply(901, 77, reply_chat, 503, "Пока", "*молчит*", "нейтральное", 60,
+                                        lease_seconds=0)
+    assert db.claim_outbox(lease_seconds=0, max_attempts=3) == [(late_outbox, 77, late_id, "*молчит*")]
+    assert len(db.claim_outbox(lease_seconds=0, max_attempts=3)) == 1
+    assert db.claim_outbox(lease_seconds=0, max_attempts=3) == []  # попытки исчерпаны
+    
+    # Входящие: сообщения работающего экземпляра чужим не отдаются, отпущенные — забираются
+    db.add_inbox(910, '{"update_id": 910}', "old")
+    db.add_inbox(911, '{"update_id": 911}', "old")
+    assert db.claim_inbox("new") == []
+    db.remove_inbox(910)
+    assert db.release_inbox("old") == 1
+    assert db.claim_inbox("new") == [(911, '{"update_id": 911}')]
+    assert db.claim_inbox("other") == [] and db.release_inbox("old") == 0
+    db.remove_inbox(911)
+    
+    # Архив: сообщения уходят и возвращаются без потерь
+    before = db.get_chat_history(chat_id)
+    assert db.archive_chat(chat_id) == 3
+    assert db.archive_chat(chat_id) == 0
+    assert db.get_chat_history(chat_id) == []
+    # Выгрузка читает архивный чат из архива; повторная загрузка существующего ничего не дублирует
+    exported = list(db.export_user(501, batch_size=2))
+    assert [(kind, len(rows)) for kind, rows in exported] == [("user", 1), ("chat", 1), ("message", 2), ("message", 1)]
+    assert exported[2][1][0][:3] == (chat_id, 501, "Как приготовить ужин?")
+    assert list(db.export_user(404)) == []
+    assert db.restore_chat(chat_id)
+    assert not db.restore_chat(chat_id)
+    assert db.get_chat_history(chat_id) == before
+    assert db.import_user(exported) == {"user": 1, "chat": 0, "message": 0, "skipped": 4}
+    assert db.run_archive_maintenance(inactive_days=30, retention_days=90) == (0, 0)
+    time.sleep(1.1)  # время активности хранится с точностью до секунды
+    assert db.archive_inactive_chats(0) == 3 and db.purge_expired_archives(0) == 3
+    assert db.purge_delivery_log(0) == 3  # две отметки обновлений и отправленный ответ
+    db.delete_chat(chat_id)
+    assert db.get_user_chats(501) == [] and db.get_current_chat(501) is None
+    assert db.get_chat_stats(chat_id) == []
+    
+    # Загрузка удалённого чата возвращает его как был
+    assert db.import_user(exported) == {"user": 1, "chat": 1, "message": 3, "skipped": 0}
+    assert db.get_chat_history(chat_id) == before
+    assert db.get_user_chats(501)[0][:4] == (chat_id, "Ужин", "Небесная Гостиница", 3)
+    assert db.get_chat_stats(chat_id)[0][1] == 3
+    db.delete_chat(chat_id)
+    
+    # Чаты, созданные подряд, не сталкиваются; незнакомая эмоция пополняет справочник
+    chat_ids = [db.create_chat(504, f"Чат {i}") for i in range(3)]
+    assert len(set(chat_ids)) == 3
+    db.add_message(chat_ids[0], 504, "Тоскливо", "*молчит*", "тоска, радость", 40)
+    db.add_message(chat_ids[1], 504, "Тоскливо", "*молчит*", "", 40)
+    assert db.get_chat_history(chat_ids[0])[0][3] == "радость, тоска"
+    assert db.get_chat_history(chat_ids[1])[0][3] is None
+    assert db.get_user_stats(504)["emotion:тоска"] == 1
+    assert db.archive_chat(chat_ids[0]) == 1 and db.restore_chat(chat_ids[0])
+    assert db.get_chat_history(chat_ids[0])[0][3] == "радость, тоска"
+    for chat in chat_ids:
+        db.delete_chat(chat)
+    
+    # Сценарий чата: описание хранится рядом с названием и переживает выгрузку
+    db.add_user(505, "scene")
+    scene_chat = db.create_chat(505, "Сцена", "Пикник", "Пикник\nОданна выбрался к реке")
+    assert db.get_chat_scenario(scene_chat) == ("Пикник", "Пикник\nОданна выбрался к реке")
+    assert db.get_chat_scenario("нет_такого") is None
+    exported = list(db.export_user(505))
+    db.delete_chat(scene_chat)
+    assert db.import_user(exported)["chat"] == 1
+    assert db.get_chat_scenario(scene_chat) == ("Пикник", "Пикник\nОданна выбрался к реке")
+    assert db.set_chat_scenario(scene_chat, "Чайная", None)
+    assert not db.set_chat_scenario("нет_такого", "Чайная", None)
+    assert db.get_chat_scenario(scene_chat) == ("Чайная", None)
+    assert db.get_user_chats(505)[0][2] == "Чайная"
+    db.delete_chat(scene_chat)
+    
+    # Пул заготовок
+    db.add_pooled_response("greeting", 50, "Небесная Гостиница", "*кивает*")
+    assert db.count_pooled_responses() == {("greeting", 50, "Небесная Гостиница"): 1}
+    text, age = db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=2)
+    assert text == "*кивает*" and age >= 0
+    assert db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=2)
+    assert db.take_pooled_response("greeting", 50, "Небесная Гостиница", max_serves=2) is None
+    assert db.purge_stale_pool() == 0
+    assert db.size_bytes() > 0
+
+def postgres_dsn():
+    """DSN тестовой базы PostgreSQL: TEST_POSTGRES_DSN или локальный pgserver, если установлен"""
+    if os.getenv("TEST_POSTGRES_DSN"):
+        return os.environ["TEST_POSTGRES_DSN"]
+    try:
+        import asyncpg  # noqa: F401
+        import pgserver
+    except ImportError:
+        return None
+    return pgserver.get_server(tempfile.mkdtemp(prefix="odanna_pg_"), cleanup_mode="stop").get_uri()
+
+def test_storage_conformance():
+    """Тест одинакового поведения хранилищ SQLite и PostgreSQL"""
+    print("\n🗄️ Тестирование хранилищ...")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        assert isinstance(db, StorageBackend)
+        check_storage(db)
+        db.close()
+    print("✅ SQLite")
+    
+    # Хранилище и очередь, реализованные не полностью, не создаются
+    for interface in (StorageBackend, JobQueue):
+        try:
+            type("Partial", (interface,), {"close": lambda self: None})()
+            assert False, f"неполный {interface.__name__} создан"
+        except TypeError:
+            pass
+    print("✅ Неполные хранилище и очередь не создаются")
+    
+    dsn = postgres_dsn()
+    if dsn is None:
+        print("⏭️ PostgreSQL пропущен: нет TEST_POSTGRES_DSN и pgserver")
+    else:
+        # Своя схема, чтобы не задеть данные в общей базе
+        schema = f"odanna_test_{os.getpid()}"
+        db = PostgresStorage(dsn, schema=schema)
+        try:
+            check_storage(db)
+            # Повторная инициализация схемы (второй узел) ничего не ломает
+            PostgresStorage(dsn, schema=schema).close()
+        finally:
+            db._execute(f'DROP SCHEMA "{schema}" CASCADE')
+            db.close()
+        print("✅ PostgreSQL")
+    
+    print("🎉 Тест хранилищ пройден!")
+
+def test_export_import():
+    """Тест выгрузки и загрузки пользователя в обоих форматах"""
+    print("\n📦 Тестирование выгрузки и загрузки...")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = DatabaseManager(os.path.join(temp_dir, "source.db"))
+        source.add_user(601, "guest", "Гость")
+        # Чаты, созданные в одну секунду, получают разные ключи
+        chats = [source.create_chat(601, "Чат 0"), source.create_chat(601, "Чат 1")]
+        assert chats[0] != chats[1]
+        for i in range(25):
+            source.add_message(chats[i % 2], 601, f"Сообщение {i} «ё»", None if i % 5 else "Ответ",
+                               "радость, удивление", 35 + i)
+        source.ignore_message_by_id(3, 601)
+        exported = list(source.export_user(601, batch_size=4))
+        assert max(len(rows) for _, rows in exported) == 4
+        
+        for name, fmt in (("user.jsonl.gz", "jsonl"), ("user.odx", "columnar")):
+            path = os.path.join(temp_dir, name)
+            assert write_export(source.export_user(601, batch_size=4), path, fmt) == {"user": 1, "chat": 2, "message": 25}
+            assert [row for _, rows in read_export(path, batch_size=4) for row in rows] == \
+                [row for _, rows in exported for row in rows]
+            
+            target = DatabaseManager(os.path.join(temp_dir, f"{fmt}.db"))
+            assert target.import_user(read_export(path, batch_size=4)) == \
+                {"user": 1, "chat": 2, "message": 25, "skipped": 0}
+            for chat_id in chats:
+                assert target.get_chat_history(chat_id, 50) == source.get_chat_history(chat_id, 50)
+            assert target.get_user_stats(601) == source.get_user_stats(601)
+            found = target.search_messages(601, "сообщ", limit=50)[0]
+            assert found and len(found) == len(source.search_messages(601, "сообщ", limit=50)[0])
+            print(f"✅ {fmt}: {os.path.getsize(path)} байт, загрузка совпадает с исходными данными")
+    
+    print("🎉 Тест выгрузки и загрузки пройден!")
+
+def test_compact_storage():
+    """Тест перевода старой базы в компактную запись и сжатия текстов"""
+    print("\n🗜️ Тестирование компактного хранения...")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "odanna_bot.db")
+        # База в прежнем формате: chat_id и строка эмоций в каждой реплике
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+        CREATE TABLE chats (chat_id TEXT PRIMARY KEY, user_id INTEGER, chat_name TEXT, scenario TEXT,
+                            empathy_level INTEGER DEFAULT 35, message_count INTEGER DEFAULT 0,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP, is_archived BOOLEAN DEFAULT FALSE);
+        CREATE TABLE messages (message_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT, user_id INTEGER,
+                               message_text TEXT, response_text TEXT, is_ignored BOOLEAN DEFAULT FALSE,
+                               emotion_analysis TEXT, empathy_level INTEGER,
+                               timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                               message_tokens BLOB, response_tokens BLOB, tokenizer_id TEXT);
+        CREATE TABLE chat_stats (chat_id TEXT, day TEXT, messages INTEGER DEFAULT 0, empathy_sum INTEGER DEFAULT 0,
+                                 PRIMARY KEY (chat_id, day));
+        INSERT INTO chat_stats VALUES ('701_20240101_120000', '2024-01-01', 2, 80);
+        ''')
+        chats = ["701_20240101_120000", "702_20240101_120000"]
+        conn.executemany("INSERT INTO chats (chat_id, user_id, chat_name, scenario) VALUES (?, ?, ?, ?)",
+                         [(chat, 701 + i, f"Чат {i}", "Небесная Гостиница") for i, chat in enumerate(chats)])
+        long_text = "*медленно наливает чай и смотрит на сад* " * 30
+        emotions = ["радость", "грусть, радость", "тоска", None]
+        conn.executemany('''
+        INSERT INTO messages (chat_id, user_id, message_text, response_text, emotion_analysis, empathy_level)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(chats[i % 2], 701 + i % 2, f"Сообщение {i} про ужин", long_text, emotions[i % 4], 40)
+              for i in range(400)])
+        conn.execute("DELETE FROM messages WHERE message_id = 400")  # номер не должен достаться новой реплике
+        conn.commit()
+        conn.close()
+        size_before = os.path.getsize(path)
+        
+        db = DatabaseManager(path, text_compression="zlib")
+        history = db.get_chat_history(chats[0], 4)
+        assert [row[0] for row in history] == [f"Сообщение {i} про ужин" for i in (392, 394, 396, 398)]
+        assert [row[3] for row in history] == ["радость", "тоска"] * 2
+        assert db.get_chat_history(chats[1], 2)[1][1] == long_text
+        assert [row[3] for row in db.get_chat_history(chats[1], 2)] == [None, "радость, грусть"]
+        assert db.find_message_id(chats[0], "сообщение 398 про ужин") == 399
+        assert db.search_messages(702, "ужин", limit=5)[0]
+        assert db.get_messages_by_ids(chats[0], [1])[0][2] == long_text
+        assert db.add_message(chats[0], 701, "Новая реплика", long_text, "тоска") == 401
+        
+        conn = sqlite3.connect(path)
+        stored, = conn.execute("SELECT response_text FROM messages WHERE message_id = 401").fetchone()
+        assert isinstance(stored, bytes) and len(stored) < len(long_text.encode())
+        short, = conn.execute("SELECT message_text FROM messages WHERE message_id = 401").fetchone()
+        assert short == "Новая реплика"  # короткие тексты не сжимаются
+        conn.close()
+        size_after = os.path.getsize(path)
+        assert size_after < size_before / 2
+        print(f"✅ Перевод базы: {size_before} → {size_after} байт, номера сообщений и эмоции сохранены")
+        
+        assert db.get_chat_stats(chats[0])[0] == ("2024-01-01", 2, 40.0)
+        print("✅ Статистика чата переведена на ключ chat_key")
+        
+        # Повторное открытие ничего не переводит заново
+        assert DatabaseManager(path).get_chat_history(chats[0], 1)[0][1] == long_text
+        
+        # Полнотекстовый индекс ведёт DatabaseManager: другим соединениям odanna_text не нужна
+        conn = sqlite3.connect(path)
+        conn.execute("DELETE FROM messages WHERE message_id = 399")
+        conn.execute("INSERT INTO messages (chat_key, user_id, message_text) VALUES (1, 701, 'Чужая запись')")
+        conn.commit()
+        conn.close()
+        assert db.search_messages(701, "наливает", limit=1)[0]  # сжатые ответы проиндексированы
+        db.delete_chat(chats[1])
+        assert db.search_messages(702, "ужин") == ([], False)
+        assert db.search_messages(701, "чужая") == ([], False)
+        print("✅ Сообщения пишутся и удаляются без функции odanna_text")
+    
+    print("🎉 Тест компактного хранения пройден!")
+
+def check_job_queue(job_queue):
+    """Общий набор проверок очереди заданий (таймаут видимости — 0 секунд)"""
+    job_queue.enqueue("a", "front", {"user_message": "раз"})
+    job_queue.enqueue("b", "front", {"user_message": "два"})
+    assert job_queue.depth() == 2
+    
+    assert job_queue.claim("w1", 10) == ("a", "front", {"user_message": "раз"}, 1)
+    # Узел w1 упал, не подтвердив задание: после таймаута его получает другой
+    assert job_queue.claim("w2", 10)[::3] == ("a", 2)
+    job_queue.retry("a", "w2")
+    assert job_queue.claim("w2", 10)[::3] == ("a", 3)
+    job_queue.complete("a", "front", {"response": "готово"})
+    
+    assert job_queue.fetch_results("other", 10) == []
+    assert job_queue.fetch_results("front", 10) == [("a", {"response": "готово"})]
+    assert job_queue.fetch_results("front", 10) == []
+    
+    assert job_queue.claim("w1", 10)[0] == "b"
+    job_queue.complete("b", "front", {"error": "сбой"})
+    assert job_queue.depth() == 0
+    assert job_queue.claim("w1", 10) is None
+    assert job_queue.fetch_results("front", 10) == [("b", {"error": "сбой"})]
+
+def test_job_queue():
+    """Тест очереди заданий между фронтендом и узлами генерации"""
+    print("\n📮 Тестирование очереди заданий...")
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        check_job_queue(SQLiteJobQueue(os.path.join(temp_dir, "jobs.db"), visibility_timeout=0))
+        print("✅ Очередь SQLite")
+        
+        try:
+            import fakeredis
+            client = fakeredis.FakeRedis(decode_responses=True)
+        except ImportError:
+            client = None
+        if client or os.getenv("TEST_REDIS_URL"):
+            job_queue = RedisJobQueue(os.getenv("TEST_REDIS_URL", ""), stream=f"odanna:test:{os.getpid()}",
+                                      visibility_timeout=0, client=None if os.getenv("TEST_REDIS_URL") else client)
+            try:
+                check_job_queue(job_queue)
+            finally:
+                job_queue.redis.delete(job_queue.stream)
+            print("✅ Очередь Redis Streams")
+        else:
+            print("⏭️ Redis пропущен: нет TEST_REDIS_URL и fakeredis")
+        
+        # Фронтенд ставит задание и ждёт ответа узла генерации в другом потоке
+        MODEL_BACKENDS["echo"] = EchoBackend
+        try:
+            worker_ai = AIManager("echo", "echo-model")
+        finally:
+            del MODEL_BACKENDS["echo"]
+        
+        job_queue = SQLiteJobQueue(os.path.join(temp_dir, "frontend.db"))
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=SemanticMemory(db, model_name=""),
+                        job_queue=job_queue)
+        worker = InferenceWorker(job_queue, worker_ai, consumer="w1", max_attempts=2)
+        inputs = dict(user_message="Добрый вечер", chat_history=[], empathy_level=50, emotion="радость",
+                      scenario="Небесная Гостиница", memories=[], history_tokens=None, message_tokens=None,
+                      session_key="chat", queue_depth=0)
+        
+        async def roundtrip():
+            thread = threading.Thread(target=worker.process_one, args=(2000,))
+            thread.start()
+            response = await bot._generate_response(**inputs)
+            thread.join()
+            return response
+        
+        assert asyncio.run(roundtrip()) == "Добро пожаловать в гостиницу"
+        assert worker_ai.backend.session_key == "chat"
+        print("✅ Ответ узла генерации возвращается фронтенду")
+        
+        # Сбой генерации: повтор, затем запасной ответ на фронтенде
+        def broken(*args, **kwargs):
+            raise RuntimeError("нет памяти")
+        worker_ai.backend.generate = broken
+        
+        async def failing():
+            thread = threading.Thread(target=lambda: [worker.process_one(2000) for _ in range(2)])
+            thread.start()
+            response = await bot._generate_response(**inputs)
+            thread.join()
+            return response
+        
+        assert asyncio.run(failing()) != "Добро пожаловать в гостиницу" and job_queue.depth() == 0
+        assert not bot.pending_jobs
+        print("✅ Сбойное задание повторяется и завершается запасным ответом")
+    
+    print("🎉 Тест очереди заданий пройден!")
+
+def test_delivery():
+    """Тест повторных обновлений и досылки ответов"""
+    print("\n📬 Тестирование доставки ответов...")
+    
+    class FlakyBot:
+        """Telegram, который не принимает первые failures отправок"""
+        def __init__(self, failures):
+            self.failures = failures
+            self.sent = []
+        
+        async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("сеть недоступна")
+            self.sent.append((chat_id, text))
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    telegram = FlakyBot(failures=1)
+    
+    def update(update_id, text):
+        return SimpleNamespace(
+            update_id=update_id,
+            effective_user=SimpleNamespace(id=601, username="guest", first_name="Гость", last_name=None),
+            effective_chat=SimpleNamespace(id=601),
+            message=SimpleNamespace(text=text),
+            get_bot=lambda: telegram,
+        )
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        
+        # Отправка не удалась, но реплика и ответ сохранены
+        asyncio.run(bot.handle_message(update(1, "Добрый вечер"), None))
+        assert telegram.sent == [] and len(db.get_chat_history(db.get_current_chat(601))) == 1
+        
+        # Повтор того же обновления не генерирует и не сохраняет ответ заново
+        ai.backend.generate = None
+        asyncio.run(bot.handle_message(update(1, "Добрый вечер"), None))
+        assert len(db.get_chat_history(db.get_current_chat(601))) == 1
+        print("✅ Повтор обновления пропускается")
+        
+        # После перезапуска неотправленный ответ досылается (закрепление за упавшим процессом истекло)
+        conn = sqlite3.connect(db.db_path)
+        conn.execute("UPDATE outbox SET locked_until = NULL")
+        conn.commit()
+        conn.close()
+        restarted = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        restarted.application = SimpleNamespace(bot=telegram)
+        
+        async def one_pass():
+            try:
+                await asyncio.wait_for(restarted._outbox_loop(), timeout=0.5)
+            except asyncio.TimeoutError:
+                pass
+        
+        asyncio.run(one_pass())
+        assert len(telegram.sent) == 1 and telegram.sent[0][1].startswith("Добро пожаловать в гостиницу")
+        assert db.claim_outbox(lease_seconds=0) == []
+        print("✅ Ответ, не ушедший из-за сбоя, досылается после перезапуска")
+        
+        class StrictBot:
+            """Telegram, который не разбирает разметку, а в чат 0 не пишет вовсе"""
+            def __init__(self):
+                self.sent = []
+            
+            async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+                if parse_mode or chat_id == 0:
+                    raise BadRequest("Can't parse entities" if chat_id else "Chat not found")
+                self.sent.append((chat_id, text))
+        
+        strict = StrictBot()
+        for update_id, telegram_chat_id in ((2, 601), (3, 0)):
+            message_id, outbox_id = db.add_reply(update_id, telegram_chat_id, db.get_current_chat(601), 601, "Ещё",
+                                                 "*незакрытая звёздочка", "нейтральное", 40, lease_seconds=0)
+            asyncio.run(restarted._deliver(strict, outbox_id, telegram_chat_id, message_id, "*незакрытая звёздочка"))
+        assert strict.sent == [(601, "*незакрытая звёздочка")]
+        assert db.claim_outbox(lease_seconds=0) == []
+        print("✅ Ответ с битой разметкой уходит простым текстом, отклонённый не досылается")
+    
+    print("🎉 Тест доставки ответов пройден!")
+
+def test_generation_watchdog():
+    """Тест пределов времени генерации, предохранителя и сторожа узла"""
+    print("\n⏱️ Тестирование пределов генерации...")
+    
+    # Предохранитель: размыкается по доле неудач, затем одна пробная генерация
+    breaker = CircuitBreaker(failure_ratio=0.5, cooldown=0.05, window=10, min_calls=4)
+    for ok in (True, False, True):
+        breaker.record(ok)
+        assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow() and not breaker.available()
+    time.sleep(0.06)
+    assert breaker.available() and breaker.allow() and not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    print("✅ Предохранитель размыкается и замыкается после успешной пробы")
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    inputs = dict(user_message="Добрый вечер", chat_history=[], empathy_level=50, emotion="радость",
+                  scenario="Небесная Гостиница")
+    
+    # Предел доходит до бэкенда; истёкший срок — ошибка до генерации
+    max_times = []
+    echo_generate = ai.backend.generate
+    ai.backend.generate = lambda *args: max_times.append(args[4]) or echo_generate(*args)
+    assert ai._generate(**inputs, deadline=time.monotonic() + 2).startswith("Добро пожаловать")
+    assert 1.5 < max_times[0] < 2
+    try:
+        ai._generate(**inputs, deadline=time.monotonic())
+        assert False, "генерация после срока"
+    except TimeoutError:
+        pass
+    print("✅ Генерация получает остаток срока")
+    
+    # Зависшая генерация: запасной ответ к сроку, затем предохранитель отвечает сразу
+    release = threading.Event()
+    ai.backend.generate = lambda *args: release.wait() and echo_generate(*args)
+    ai.breaker = CircuitBreaker(min_calls=2, cooldown=60)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        bot.generation_timeout = 0.3
+        
+        async def timed(**kwargs):
+            started = time.perf_counter()
+            response = await bot._generate_response(**kwargs)
+            return response, time.perf_counter() - started
+        
+        for _ in range(2):
+            response, elapsed = asyncio.run(timed(**inputs))
+            assert not response.startswith("Добро пожаловать") and 0.3 <= elapsed < 0.5
+        assert ai.breaker.state == CircuitBreaker.OPEN
+        response, elapsed = asyncio.run(timed(**inputs))
+        assert elapsed < 0.05
+        release.set()
+        bot.llm_executor.shutdown()
+    print("✅ Зависшая генерация не задерживает ответ дольше срока")
+    
+    # Узел генерации: просроченное задание не выполняется, зависание видит сторож
+    with tempfile.TemporaryDirectory() as temp_dir:
+        job_queue = SQLiteJobQueue(os.path.join(temp_dir, "jobs.db"))
+        worker = InferenceWorker(job_queue, ai, consumer="w1", hang_seconds=0.05)
+        job_queue.enqueue("late", "front", {**inputs, "deadline_at": time.time() - 1})
+        assert worker.process_one(10)
+        assert job_queue.fetch_results("front", 10) == [("late", {"error": "срок ответа истёк"})]
+        assert not worker.check_hang()
+        worker.busy_since = time.monotonic() - 0.1
+        assert worker.check_hang()
+    print("✅ Сторож узла замечает зависшую генерацию")
+    
+    print("🎉 Тест пределов генерации пройден!")
+
+def test_graceful_shutdown():
+    """Тест плавной остановки: начатое дописывается, остальное передаётся следующему экземпляру"""
+    print("\n🛑 Тестирование плавной остановки...")
+    
+    from telegram import Update
+    
+    class RecordingBot:
+        def __init__(self):
+            self.sent = []
+        
+        async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+            self.sent.append((chat_id, text))
+    
+    MODEL_BACKENDS["echo"] = EchoBackend
+    try:
+        ai = AIManager("echo", "echo-model")
+    finally:
+        del MODEL_BACKENDS["echo"]
+    
+    # Первая генерация завершается через 0.2 с, вторая зависает дольше срока остановки.
+    # Запросы к базе идут в потоках, поэтому первым может генерироваться любой из гостей
+    gates = [threading.Event(), threading.Event()]
+    echo_generate = ai.backend.generate
+    generating = []
+    
+    def gated_generate(input_ids, max_new_tokens, session_key, *args, **kwargs):
+        generating.append(session_key)
+        gates[min(len(generating) - 1, 1)].wait()
+        return echo_generate(input_ids, max_new_tokens, session_key, *args, **kwargs)
+    
+    ai.backend.generate = gated_generate
+    telegram = RecordingBot()
+    
+    def update(update_id, user_id, text):
+        user = {"id": user_id, "is_bot": False, "first_name": "Гость"}
+        return Update.de_json({"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": user,
+        }}, telegram)
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        bot = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        
+        async def scenario():
+            processor = PriorityUpdateProcessor(llm_lane_size=2, on_receive=bot._record_update)
+            application = SimpleNamespace(updater=None, update_processor=processor, running=False)
+            # Два сообщения генерируются, третье ждёт места в полосе
+            for update_id in (1, 2, 3):
+                message = update(update_id, 700 + update_id, "Добрый вечер")
+                asyncio.create_task(processor.process_update(message, bot.handle_message(message, None)))
+            while not generating:
+                await asyncio.sleep(0.01)
+            
+            threading.Timer(0.2, gates[0].set).start()
+            return await bot.graceful_shutdown(application, timeout=1)
+        
+        drained, handed_off = asyncio.run(scenario())
+        gates[1].set()
+        assert (drained, handed_off) == (1, 2)
+        assert len(telegram.sent) == 1 and generating[0].startswith(f"{telegram.sent[0][0]}_")
+        print("✅ Начатый ответ дописан, зависший и не начатый оставлены во входящих")
+        
+        # Следующий экземпляр ставит оставленные сообщения в свою очередь
+        successor = OdannaBot("123:TEST", db=db, ai=ai, memory=SemanticMemory(db, model_name=""))
+        
+        async def replay():
+            application = SimpleNamespace(bot=telegram, update_queue=asyncio.Queue())
+            assert await successor._replay_inbox(application) == 2
+            return [application.update_queue.get_nowait() for _ in range(2)]
+        
+        replayed = asyncio.run(replay())
+        assert sorted(u.update_id for u in replayed) == sorted({1, 2, 3} - {telegram.sent[0][0] - 700})
+        assert replayed[0].message.text == "Добрый вечер" and replayed[0].get_bot() is telegram
+        assert asyncio.run(successor._replay_inbox(SimpleNamespace(bot=telegram, update_queue=None))) == 0
+        print("✅ Следующий экземпляр получает оставленные сообщения один раз")
+    
+    print("🎉 Тест плавной остановки пройден!")
+
+def test_stats():
+    """Тест статистики чатов: счётчики, досчёт старых сообщений и экран статистики"""
+    print("\n📊 Тестирование статистики чатов...")
+    
+    class RecordingQuery:
+        async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+            self.text = text
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = DatabaseManager(os.path.join(temp_dir, "odanna_bot.db"))
+        chat_id = db.create_chat(801, "Статистика")
+        for i in range(7):
+            db.add_message(chat_id, 801, f"Сообщение {i}", "Ответ", "грусть, радость" if i % 2 else "радость", 40 + i)
+        expected = (db.get_user_stats(801), db.get_chat_stats(chat_id))
+        
+        # Как будто сообщения сохранены до появления статистики
+        conn = sqlite3.connect(db.db_path)
+        conn.execute("DELETE FROM user_stats")
+        conn.execute("DELETE FROM chat_stats")
+        conn.execute("UPDATE stats_backfill SET last_id = 0, upto = (SELECT MAX(message_id) FROM messages)")
+        conn.commit()
+        conn.close()
+        assert db.get_user_stats(801) == {}
+        
+        batches = []
+        while True:
+            counted = db.backfill_stats(batch_size=2)
+            if not counted:
+                break
+            batches.append(counted)
+        assert batches == [2, 2, 2, 1]
+        assert (db.get_user_stats(801), db.get_chat_stats(chat_id)) == expected
+        assert expected[0]["emotion:грусть"] == 3 and expected[0]["emotion:радость"] == 7
+        print("✅ Досчёт пачками даёт ту же статистику, что и подсчёт при записи")
+        
+        bot = OdannaBot("123:TEST", db=db, ai=AIManager(backend=""), memory=SemanticMemory(db, model_name=""))
+        query = RecordingQuery()
+        asyncio.run(bot._dispatch_callback(query, 801, "show_stats"))
+        assert "Сообщений:** 7" in query.text and "радость: 100%" in query.text and "грусть: 42%" in query.text
+        assert "Эмпатия активного чата" not in query.text
+        db.set_current_chat(801, chat_id)
+        asyncio.run(bot._dispatch_callback(query, 801, "show_stats"))
+        assert "43% (7 сообщ.)" in query.text
+        asyncio.run(bot._dispatch_callback(query, 802, "show_stats"))
+        assert "ещё не беседовали" in query.text
+        print("✅ Экран статистики строится из готовых счётчиков")
+        
+        # Запросы к базе идут в потоках: медленное хранилище не останавливает цикл событий
+        get_user_stats = db.get_user_stats
+        db.get_user_stats = lambda user_id: time.sleep(0.3) or get_user_stats(user_id)
+        
+        async def slow_storage():
+            screen = asyncio.create_task(bot._dispatch_callback(query, 801, "show_stats"))
+            await asyncio.sleep(0.05)
+            waiting = not screen.done()
+            await screen
+            return waiting
+        
+        assert asyncio.run(slow_storage()) and "43% (7 сообщ.)" in query.text
+        print("✅ Медленный запрос к базе не блокирует цикл событий")
+    
+    print("🎉 Тест статистики чатов пройден!")
+
 def test_empathy_progression():
     """Тест прогрессии эмпатии"""
     print("\n📈 Тестирование прогрессии эмпатии...")
@@ -199,6 +2008,29 @@ def run_all_tests():
         test_ai_manager()
         test_character_responses()
         test_memory_system()
+        test_pagination()
+        test_search()
+        test_forget_by_id()
+        test_memory_index()
+        test_archive()
+        test_metrics()
+        test_profiler()
+        test_model_backends()
+        test_token_cache()
+        test_kv_cache()
+        test_scenarios()
+        test_generation_policy()
+        test_speculative_decoding()
+        test_response_pool()
+        test_priority_lanes()
+        test_storage_conformance()
+        test_export_import()
+        test_compact_storage()
+        test_job_queue()
+        test_delivery()
+        test_generation_watchdog()
+        test_graceful_shutdown()
+        test_stats()
         test_empathy_progression()
         
         print("\n" + "="*50)